@@ -11,10 +11,19 @@ local function tonil(value)
   if (value == '') then return nil else return value end
 end
 
+--- Encodes the outcomes of a batch as a JSON array, even when there are none
+-- (cjson would otherwise encode an empty table as an object)
+-- @param outcomes
+--
+local function tooutcomes(outcomes)
+  if #outcomes == 0 then return '[]' else return cjson.encode(outcomes) end
+end
+
 -- Return json for the job identified by the provided jid. If the job is not
--- present, then `nil` is returned
-function QlessAPI.get(now, jid)
-  local data = Qless.job(jid):data()
+-- present, then `nil` is returned. Optionally, `fields` may be a profile name
+-- or a JSON array of the attributes to return.
+function QlessAPI.get(now, jid, fields)
+  local data = Qless.job(jid):project(QlessJob.projection(tonil(fields)))
   if not data then
     return nil
   end
@@ -30,13 +39,25 @@ function QlessAPI.multiget(now, ...)
   return cjson.encode(results)
 end
 
+-- Like multiget, but only returns the attributes named by `fields`, which is
+-- either a profile name or a JSON array of attributes
+function QlessAPI.project(now, fields, ...)
+  fields = QlessJob.projection(tonil(fields))
+  local results = {}
+  for i, jid in ipairs(arg) do
+    table.insert(results, Qless.job(jid):project(fields))
+  end
+  return cjson.encode(results)
+end
+
 -- Public access
 QlessAPI['config.get'] = function(now, key)
   key = tonil(key)
   if not key then
     return cjson.encode(Qless.config.get(key))
   else
-    return Qless.config.get(key)
+    -- Reply with the value as it's stored, rather than as a number
+    return Qless.config.stored()[key] or Qless.config.get(key)
   end
 end
 
@@ -61,6 +82,34 @@ QlessAPI.complete = function(now, jid, worker, queue, data, ...)
   return Qless.job(jid):complete(now, worker, queue, data, unpack(arg))
 end
 
+QlessAPI.complete_many = function(now, worker, queue, jobs)
+  return tooutcomes(QlessJob.complete_many(now, worker, queue, jobs))
+end
+
+-- Complete a job, and then pop up to `count` jobs from `popqueue` (or from the
+-- same queue, if empty) for the same worker. Any further arguments are the
+-- optional arguments to `complete`. Returns the completed job's new state and
+-- the popped jobs
+QlessAPI.complete_and_pop = function(now, jid, worker, queue, data, popqueue,
+  count, fields, ...)
+  data = tonil(data)
+  fields = QlessJob.projection(tonil(fields))
+  -- Check the arguments to pop before the job is completed, since that can't
+  -- be undone if they turn out to be malformed
+  popqueue = assert(tonil(popqueue) or queue,
+    'CompleteAndPop(): Arg "popqueue" missing')
+  count = assert(tonumber(count),
+    'CompleteAndPop(): Arg "count" missing or not a number: ' ..
+    tostring(count))
+  local state = Qless.job(jid):complete(now, worker, queue, data, unpack(arg))
+  local jids = Qless.queue(popqueue):pop(now, worker, count)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, Qless.job(jid):project(fields))
+  end
+  return cjson.encode({state = state, jobs = response})
+end
+
 QlessAPI.failed = function(now, group, start, limit)
   group = tonil(group)
   return cjson.encode(Qless.failed(group, start, limit))
@@ -71,6 +120,15 @@ QlessAPI.fail = function(now, jid, worker, group, message, data)
   return Qless.job(jid):fail(now, worker, group, message, data)
 end
 
+QlessAPI.fail_many = function(now, worker, group, message, jobs)
+  return tooutcomes(QlessJob.fail_many(now, worker, group, message, jobs))
+end
+
+-- Delete up to `budget` completed jobs that are past their retention
+QlessAPI.gc = function(now, budget)
+  return Qless.gc(now, budget)
+end
+
 QlessAPI.jobs = function(now, state, ...)
   return Qless.jobs(now, state, unpack(arg))
 end
@@ -92,6 +150,10 @@ QlessAPI.workers = function(now, worker)
   return cjson.encode(QlessWorker.counts(now, worker))
 end
 
+QlessAPI.worker_stats = function(now, worker, date, percentiles)
+  return cjson.encode(QlessWorker.stats(now, worker, date, percentiles))
+end
+
 QlessAPI.track = function(now, command, jid)
   return cjson.encode(Qless.track(now, command, jid))
 end
@@ -100,8 +162,30 @@ QlessAPI.tag = function(now, command, ...)
   return cjson.encode(Qless.tag(now, command, unpack(arg)))
 end
 
-QlessAPI.stats = function(now, queue, date)
-  return cjson.encode(Qless.queue(queue):stats(now, date))
+QlessAPI.stats = function(now, queue, date, percentiles)
+  return cjson.encode(Qless.queue(queue):stats(now, date, percentiles))
+end
+
+-- The stats of several queues over several days, combined
+QlessAPI.stats_merged = function(now, queues, from, to, percentiles)
+  return cjson.encode(
+    QlessQueue.merged_stats(now, queues, from, to, percentiles))
+end
+
+-- The wait and run stats of a queue over time, by the minute or hour
+QlessAPI.stats_range = function(now, queue, from, to, resolution)
+  return cjson.encode(
+    Qless.queue(queue):stats_range(now, from, to, resolution))
+end
+
+-- The jobs put, popped, completed, failed and retried in a queue recently
+QlessAPI.throughput = function(now, queue, window)
+  return cjson.encode(Qless.queue(queue):throughput(now, tonil(window)))
+end
+
+-- Enforce the retention of stats recorded since `since`
+QlessAPI['stats.compact'] = function(now, since, budget)
+  return cjson.encode(QlessQueue.compact(now, since, tonil(budget)))
 end
 
 QlessAPI.priority = function(now, jid, priority)
@@ -122,24 +206,46 @@ QlessAPI.log = function(now, jid, message, data)
   job:history(now, message, data)
 end
 
-QlessAPI.peek = function(now, queue, count)
-  local jids = Qless.queue(queue):peek(now, count)
+-- Peek at the next jobs in a queue. If `mode` is 'readonly', then the peek
+-- makes no writes, and so is safe to run against a replica
+QlessAPI.peek = function(now, queue, count, fields, mode)
+  fields = QlessJob.projection(tonil(fields))
+  mode = tonil(mode)
+  assert(mode == nil or mode == 'readonly',
+    'Peek(): Arg "mode" must be "readonly": ' .. tostring(mode))
+  local jids = Qless.queue(queue):peek(now, count, mode == 'readonly')
   local response = {}
   for i, jid in ipairs(jids) do
-    table.insert(response, Qless.job(jid):data())
+    table.insert(response, Qless.job(jid):project(fields))
   end
   return cjson.encode(response)
 end
 
-QlessAPI.pop = function(now, queue, worker, count)
+QlessAPI.pop = function(now, queue, worker, count, fields)
+  fields = QlessJob.projection(tonil(fields))
   local jids = Qless.queue(queue):pop(now, worker, count)
   local response = {}
   for i, jid in ipairs(jids) do
-    table.insert(response, Qless.job(jid):data())
+    table.insert(response, Qless.job(jid):project(fields))
   end
   return cjson.encode(response)
 end
 
+QlessAPI.multipop = function(now, worker, count, queues, fields)
+  fields = QlessJob.projection(tonil(fields))
+  local jids = QlessQueue.multipop(now, worker, count, queues)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, Qless.job(jid):project(fields))
+  end
+  return cjson.encode(response)
+end
+
+-- Promote due scheduled and recurring jobs in all queues
+QlessAPI.tick = function(now, budget)
+  return QlessQueue.tick(now, budget)
+end
+
 QlessAPI.pause = function(now, ...)
   return QlessQueue.pause(now, unpack(arg))
 end
@@ -167,6 +273,10 @@ QlessAPI.put = function(now, me, queue, jid, klass, data, delay, ...)
   return Qless.queue(queue):put(now, me, jid, klass, data, delay, unpack(arg))
 end
 
+QlessAPI.put_many = function(now, me, jobs)
+  return tooutcomes(QlessQueue.put_many(now, me, jobs))
+end
+
 QlessAPI.requeue = function(now, me, queue, jid, ...)
   local job = Qless.job(jid)
   assert(job:exists(), 'Requeue(): Job ' .. jid .. ' does not exist')
@@ -272,12 +382,19 @@ QlessAPI['resource.pending_count'] = function(now, rid)
   return Qless.resource(rid):pending_count()
 end
 
-QlessAPI['resource.stats_pending'] = function(now)
-  return cjson.encode(QlessResource.pending_counts(now))
+QlessAPI['resource.stats_pending'] = function(now, after, count)
+  return cjson.encode(
+    QlessResource.pending_counts(now, tonil(after), tonil(count)))
+end
+
+QlessAPI['resource.stats_locks'] = function(now, after, count)
+  return cjson.encode(
+    QlessResource.locks_counts(now, tonil(after), tonil(count)))
 end
 
-QlessAPI['resource.stats_locks'] = function(now)
-  return cjson.encode(QlessResource.locks_counts(now))
+-- Add resources set before the registry of resources existed to it
+QlessAPI['resource.backfill'] = function(now, cursor, count)
+  return cjson.encode(QlessResource.backfill(now, cursor, tonil(count)))
 end
 
 -------------------------------------------------------------------------------
@@ -44,11 +44,232 @@ function table.extend(self, other)
 end
 
 -- This is essentially the same as redis' publish, but it prefixes the channel
--- with the Qless namespace
+-- with the Qless namespace. In a batch, log messages are gathered up and
+-- published together, as a single 'batch' event, when the batch closes.
 function Qless.publish(channel, message)
+  local batch = Qless.batching
+  if batch and channel == 'log' then
+    table.insert(batch.logs, message)
+    return
+  end
   redis.call('publish', Qless.ns .. channel, message)
 end
 
+-- Encode one of the structures kept in job hashes: tags, resources, failures
+-- and history entries. These are JSON, unless the 'storage-format' config is
+-- 'msgpack', in which case they're packed with the (more compact) cmsgpack.
+function Qless.encode(value)
+  if Qless.config.get('storage-format') == 'msgpack' then
+    return cmsgpack.pack(value)
+  end
+  return cjson.encode(value)
+end
+
+-- Decode a structure written by Qless.encode, in either format. We only ever
+-- encode tables, and JSON ones begin with '[' or '{', which packed ones can't
+function Qless.decode(value)
+  local first = string.sub(value, 1, 1)
+  if first == '[' or first == '{' then
+    return cjson.decode(value)
+  end
+  return cmsgpack.unpack(value)
+end
+
+-- Format a time to be kept in a job hash. With the 'msgpack' storage format,
+-- it's kept to microseconds rather than 20 decimal places.
+function Qless.time(now)
+  if Qless.config.get('storage-format') == 'msgpack' then
+    return string.format('%.6f', now)
+  end
+  return string.format('%.20f', now)
+end
+
+-------------------------------------------------------------------------------
+-- Batches
+-------------------------------------------------------------------------------
+-- Commands that act on many jobs at once (like put_many) run the per-job code
+-- inside a batch. While a batch is open, sorted set additions made through
+-- Qless.zadd are buffered and made with one ZADD per key when it closes,
+-- counters incremented through Qless.hincrby are summed and incremented once,
+-- and bookkeeping passed to Qless.defer is done once, after all of those.
+-- Log messages are published as one event.
+Qless.batching = nil
+
+-- Run `func` inside a batch, returning what it returns. If a batch is already
+-- open, `func` simply joins it.
+function Qless.batch(func)
+  if Qless.batching then
+    return func()
+  end
+
+  Qless.batching = {
+    keys = {}, zadds = {}, after = {}, names = {}, deferred = {}, memos = {},
+    counters = {}, created = {}, fields = {}, logs = {}
+  }
+  local ok, result = pcall(func)
+  local batch = Qless.batching
+  Qless.batching = nil
+
+  -- Even if something went wrong, whatever was already done must be kept
+  -- consistent, just as it would have been outside of a batch
+  for _, key in ipairs(batch.keys) do
+    local args = batch.zadds[key]
+    local added = 0
+    -- Lua's stack limits how many arguments we can unpack at once
+    for i = 1, #args, 1000 do
+      added = added + redis.call(
+        'zadd', key, unpack(args, i, math.min(i + 999, #args)))
+    end
+    if batch.after[key] then
+      batch.after[key](added)
+    end
+  end
+  for _, field in ipairs(batch.fields) do
+    local key, name = unpack(field)
+    local increment = batch.counters[key][name]
+    local created = batch.created[key]
+    if redis.call('hincrby', key, name, increment) == increment and created then
+      batch.created[key] = nil
+      created()
+    end
+  end
+  if #batch.logs > 0 then
+    Qless.publish('log',
+      '{"event":"batch","events":[' .. table.concat(batch.logs, ',') .. ']}')
+  end
+  for _, name in ipairs(batch.names) do
+    batch.deferred[name]()
+  end
+
+  if not ok then
+    error(result, 0)
+  end
+  return result
+end
+
+-- Add `member` to the sorted set `key` with `score`, and then call `after`
+-- (if provided) with the number of members that were added. In a batch the
+-- ZADD is buffered, and only the first `after` given for each key is called,
+-- once, with the number added by the batch as a whole.
+function Qless.zadd(key, score, member, after)
+  local batch = Qless.batching
+  if not batch then
+    local added = redis.call('zadd', key, score, member)
+    if after then
+      after(added)
+    end
+    return added
+  end
+
+  if not batch.zadds[key] then
+    batch.zadds[key] = {}
+    batch.after[key] = after
+    table.insert(batch.keys, key)
+  end
+  table.insert(batch.zadds[key], score)
+  table.insert(batch.zadds[key], member)
+end
+
+-- Increment `field` of the hash `key` by `increment`, and then call `created`
+-- (if provided) if that's what created the field. In a batch, the increments
+-- to each field are summed and made once the batch closes, and only the first
+-- `created` given for each key is called, at most once.
+function Qless.hincrby(key, field, increment, created)
+  local batch = Qless.batching
+  if not batch then
+    local value = redis.call('hincrby', key, field, increment)
+    if created and value == increment then
+      created()
+    end
+    return value
+  end
+
+  local counters = batch.counters[key]
+  if not counters then
+    counters = {}
+    batch.counters[key] = counters
+  end
+  batch.created[key] = batch.created[key] or created
+  if not counters[field] then
+    counters[field] = 0
+    table.insert(batch.fields, {key, field})
+  end
+  counters[field] = counters[field] + increment
+end
+
+-- Call `func` now, or if in a batch, once the batch closes. Only the first
+-- function deferred under each name is called.
+function Qless.defer(name, func)
+  local batch = Qless.batching
+  if not batch then
+    return func()
+  end
+
+  if not batch.deferred[name] then
+    batch.deferred[name] = func
+    table.insert(batch.names, name)
+  end
+end
+
+-- Return the result of `func`, which in a batch is only called the first time
+-- that `name` is asked for
+function Qless.memo(name, func)
+  local batch = Qless.batching
+  if not batch then
+    return func()
+  end
+
+  if batch.memos[name] == nil then
+    batch.memos[name] = func()
+  end
+  return batch.memos[name]
+end
+
+-- Return whether the job is tracked. In a batch, we don't bother looking each
+-- job up if none are tracked
+function Qless.tracked(jid)
+  if Qless.batching and not Qless.memo('tracking', function()
+    return redis.call('zcard', 'ql:tracked') > 0
+  end) then
+    return false
+  end
+  return redis.call('zscore', 'ql:tracked', jid) ~= false
+end
+
+-- Call `func` with each of `specs` in a single batch, and return an outcome
+-- for each one, in order. An outcome is either what `func` returned or the
+-- error that it raised, along with the jid of the spec:
+--
+--  [{'jid': 'jid', 'result': ...}, {'jid': 'other', 'error': '...'}, ...]
+--
+-- A spec is either a jid or a table with a `jid`. Errors are given without the
+-- script name and line number that Lua puts in front of them.
+function Qless.outcomes(specs, func)
+  return Qless.batch(function()
+    local outcomes = {}
+    for _, spec in ipairs(specs) do
+      local ok, result = pcall(func, spec)
+      local jid = spec
+      if type(spec) == 'table' then
+        jid = spec.jid
+      end
+      if ok then
+        table.insert(outcomes, {jid = jid, result = result})
+      else
+        -- Errors from redis.call come back as tables, and those raised in the
+        -- script are prefixed with where they were raised, like
+        -- 'user_script:123: ', which means nothing to clients
+        if type(result) == 'table' then
+          result = result.err
+        end
+        result = string.gsub(tostring(result), '^@?[%w_]+:%d+: ', '')
+        table.insert(outcomes, {jid = jid, error = result})
+      end
+    end
+    return outcomes
+  end)
+end
+
 -- Return a job object given its job id
 function Qless.job(jid)
   assert(jid, 'Job(): no jid provided')
@@ -262,11 +483,11 @@ function Qless.tag(now, command, ...)
 
   if command == 'add' then
     local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
-    local tags = redis.call('hget', QlessJob.ns .. jid, 'tags')
+    local state, tags = unpack(Qless.job(jid):fields('state', 'tags'))
     -- If the job has been canceled / deleted, then return false
-    if tags then
+    if state then
       -- Decode the json blob, convert to dictionary
-      tags = cjson.decode(tags)
+      tags = Qless.decode(tags)
       local _tags = {}
       for i,v in ipairs(tags) do _tags[v] = true end
 
@@ -281,18 +502,18 @@ function Qless.tag(now, command, ...)
         redis.call('zincrby', 'ql:tags', 1, tag)
       end
 
-      redis.call('hset', QlessJob.ns .. jid, 'tags', cjson.encode(tags))
+      Qless.job(jid):update({tags = Qless.encode(tags)})
       return tags
     else
       error('Tag(): Job ' .. jid .. ' does not exist')
     end
   elseif command == 'remove' then
     local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
-    local tags = redis.call('hget', QlessJob.ns .. jid, 'tags')
+    local state, tags = unpack(Qless.job(jid):fields('state', 'tags'))
     -- If the job has been canceled / deleted, then return false
-    if tags then
+    if state then
       -- Decode the json blob, convert to dictionary
-      tags = cjson.decode(tags)
+      tags = Qless.decode(tags)
       local _tags = {}
       for i,v in ipairs(tags) do _tags[v] = true end
 
@@ -307,7 +528,7 @@ function Qless.tag(now, command, ...)
       local results = {}
       for i,tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
 
-      redis.call('hset', QlessJob.ns .. jid, 'tags', cjson.encode(results))
+      Qless.job(jid):update({tags = Qless.encode(results)})
       return results
     else
       error('Tag(): Job ' .. jid .. ' does not exist')
@@ -331,6 +552,61 @@ function Qless.tag(now, command, ...)
   end
 end
 
+-- Gc(now, budget)
+-- ---------------
+-- Delete the data of up to `budget` completed jobs that have outlived the
+-- retention policy, oldest first: first those older than `jobs-history`
+-- seconds, and then those beyond the most recent `jobs-history-count`. Any
+-- that are left over are deleted by later calls, so the cost of a call is
+-- bounded no matter how far behind the policy we are. `complete` calls this
+-- with a budget of `gc-budget` (10 by default), but it may also be invoked on
+-- its own. Returns the number of jobs deleted.
+function Qless.gc(now, budget)
+  budget = assert(tonumber(budget),
+    'Gc(): Arg "budget" missing or not a number: ' .. tostring(budget))
+  if budget <= 0 then
+    return 0
+  end
+
+  local count = Qless.config.get('jobs-history-count')
+  local time  = Qless.config.get('jobs-history')
+
+  -- Remove every trace of a completed job
+  local expire = function(jids)
+    for index, jid in ipairs(jids) do
+      local tags = Qless.decode(
+        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+      for i, tag in ipairs(tags) do
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+      redis.call('del', QlessJob.ns .. jid)
+      redis.call('del', QlessJob.ns .. jid .. '-history')
+    end
+  end
+
+  -- Now look at the expired job data. First, based on the current time
+  local jids = redis.call('zrangebyscore', 'ql:completed', 0, now - time,
+    'LIMIT', 0, budget)
+  expire(jids)
+  -- And now remove those from the queued-for-cleanup queue
+  if #jids > 0 then
+    redis.call('zremrangebyrank', 'ql:completed', 0, #jids - 1)
+  end
+  local deleted = #jids
+
+  -- Now take the all by the most recent 'count' ids
+  local excess = math.min(
+    redis.call('zcard', 'ql:completed') - count, budget - deleted)
+  if excess > 0 then
+    jids = redis.call('zrange', 'ql:completed', 0, excess - 1)
+    expire(jids)
+    redis.call('zremrangebyrank', 'ql:completed', 0, excess - 1)
+    deleted = deleted + excess
+  end
+  return deleted
+end
+
 -- Cancel(...)
 -- --------------
 -- Cancel a job from taking place. It will be deleted from the system, and any
@@ -361,8 +637,8 @@ function Qless.cancel(now, ...)
   -- remove any trace of all these jobs, as they form a dependent clique
   for _, jid in ipairs(arg) do
     -- Find any stage it's associated with and remove its from that stage
-    local state, queue, failure, worker = unpack(redis.call(
-      'hmget', QlessJob.ns .. jid, 'state', 'queue', 'failure', 'worker'))
+    local state, queue, failure, worker, unique = unpack(Qless.job(jid):fields(
+      'state', 'queue', 'failure', 'worker', 'unique'))
 
     if state ~= false and state ~= 'complete' then
       table.insert(cancelled_jids, jid)
@@ -390,6 +666,9 @@ function Qless.cancel(now, ...)
         queue.locks.remove(jid)
         queue.scheduled.remove(jid)
         queue.depends.remove(jid)
+        if unique then
+          queue:release_unique(unique, jid)
+        end
       end
 
       Qless.job(jid):release_resources(now)
@@ -406,7 +685,7 @@ function Qless.cancel(now, ...)
 
       -- If we're in the failed state, remove all of our data
       if state == 'failed' then
-        failure = cjson.decode(failure)
+        failure = Qless.decode(failure)
         -- We need to make this remove it from the failed queues
         redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
         if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
@@ -414,15 +693,11 @@ function Qless.cancel(now, ...)
         end
         -- Remove one count from the failed count of the particular
         -- queue
-        local bin = failure.when - (failure.when % 86400)
-        local failed = redis.call(
-          'hget', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed')
-        redis.call('hset',
-          'ql:s:stats:' .. bin .. ':' .. queue, 'failed', failed - 1)
+        Qless.queue(queue):tally(now, 'failed', -1, failure.when)
       end
 
       -- Remove it as a job that's tagged with this particular tag
-      local tags = cjson.decode(
+      local tags = Qless.decode(
         redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
       for i, tag in ipairs(tags) do
         redis.call('zrem', 'ql:t:' .. tag, jid)
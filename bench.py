@@ -0,0 +1,40 @@
+'''Report how much memory redis uses per job. This puts jobs with the
+qless.lua script, much as the tests do, and so should be run from the
+repository root against a redis that can be flushed:
+
+    python bench.py [count]
+'''
+
+import os
+import sys
+import redis
+import qless
+
+
+def memory(client):
+    '''The bytes of memory redis is using'''
+    return client.info('memory')['used_memory']
+
+
+def main(count):
+    client = redis.Redis.from_url(
+        os.environ.get('REDIS_URL', 'redis://localhost:6379/'))
+    lua = qless.QlessRecorder(client)
+    lua.flush()
+
+    before = memory(client)
+    for jid in xrange(count):
+        lua('put', 0, 'worker', 'queue', 'jid-%i' % jid, 'klass', {}, 0)
+    after = memory(client)
+
+    hash_bytes = client.execute_command('MEMORY', 'USAGE', 'ql:j:jid-0')
+    print 'jobs:               %i' % count
+    print 'fields per job:     %i' % client.hlen('ql:j:jid-0')
+    print 'job hash encoding:  %s' % client.object('encoding', 'ql:j:jid-0')
+    print 'bytes per job hash: %i' % hash_bytes
+    print 'bytes per job:      %.1f' % (float(after - before) / count)
+    lua.flush()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -4,27 +4,58 @@
 
 -- This represents our default configuration settings
 Qless.config.defaults = {
-  ['application']        = 'qless',
-  ['heartbeat']          = 60,
-  ['grace-period']       = 10,
-  ['stats-history']      = 30,
-  ['histogram-history']  = 7,
-  ['jobs-history-count'] = 50000,
-  ['jobs-history']       = 604800
+  ['application']           = 'qless',
+  ['heartbeat']             = 60,
+  ['grace-period']          = 10,
+  ['stats-history']         = 30,
+  ['histogram-history']     = 7,
+  ['jobs-history-count']    = 50000,
+  ['jobs-history']          = 604800,
+  ['gc-budget']             = 10,
+  ['resource-grant-budget'] = 100,
+  ['minute-stats-history']  = 21600,
+  ['hour-stats-history']    = 604800,
+  ['storage-format']        = 'json'
 }
 
--- Get one or more of the keys
-Qless.config.get = function(key, default)
-  if key then
-    return redis.call('hget', 'ql:config', key) or
-      Qless.config.defaults[key] or default
-  else
+-- The contents of `ql:config`, read at most once per invocation of the script.
+-- `snapshot` holds the values as they're stored, and `typed` the same values
+-- with those that are numbers converted to numbers, which is what lookups are
+-- served from. Both are kept up to date by set and unset.
+Qless.config.snapshot = nil
+Qless.config.typed = nil
+
+-- Return the snapshot of the stored configuration, loading it if need be
+Qless.config.stored = function()
+  if Qless.config.snapshot == nil then
     -- Inspired by redis-lua https://github.com/nrk/redis-lua/blob/version-2.0/src/redis.lua
+    local snapshot, typed = {}, {}
     local reply = redis.call('hgetall', 'ql:config')
     for i = 1, #reply, 2 do
-      Qless.config.defaults[reply[i]] = reply[i + 1]
+      snapshot[reply[i]] = reply[i + 1]
+      typed[reply[i]] = tonumber(reply[i + 1]) or reply[i + 1]
+    end
+    Qless.config.snapshot = snapshot
+    Qless.config.typed = typed
+  end
+  return Qless.config.snapshot
+end
+
+-- Get one of the keys, converted to a number if it is one, or all of them as
+-- they're stored
+Qless.config.get = function(key, default)
+  local stored = Qless.config.stored()
+  if key then
+    return Qless.config.typed[key] or Qless.config.defaults[key] or default
+  else
+    local response = {}
+    for option, value in pairs(Qless.config.defaults) do
+      response[option] = value
     end
-    return Qless.config.defaults
+    for option, value in pairs(stored) do
+      response[option] = value
+    end
+    return response
   end
 end
 
@@ -40,6 +71,10 @@ Qless.config.set = function(option, value)
   }))
 
   redis.call('hset', 'ql:config', option, value)
+  if Qless.config.snapshot then
+    Qless.config.snapshot[option] = tostring(value)
+    Qless.config.typed[option] = tonumber(value) or tostring(value)
+  end
 end
 
 -- Unset a configuration option
@@ -52,4 +87,8 @@ Qless.config.unset = function(option)
   }))
 
   redis.call('hdel', 'ql:config', option)
+  if Qless.config.snapshot then
+    Qless.config.snapshot[option] = nil
+    Qless.config.typed[option] = nil
+  end
 end
@@ -4,56 +4,199 @@
 -- It returns an object that represents the job with the provided JID
 -------------------------------------------------------------------------------
 
--- This gets all the data associated with the job with the provided id. If the
--- job is not found, it returns nil. If found, it returns an object with the
--- appropriate properties
-function QlessJob:data(...)
-  local job = redis.call(
-      'hmget', QlessJob.ns .. self.jid, 'jid', 'klass', 'state', 'queue',
-      'worker', 'priority', 'expires', 'retries', 'remaining', 'data',
-      'tags', 'failure', 'spawned_from_jid', 'resources', 'result_data', 'throttle_interval')
+-- Each attribute reported by data(), along with the field of the job's hash
+-- that backs it (if any) and how to decode that field
+QlessJob.attributes = {
+  jid              = {field = 'jid'},
+  klass            = {field = 'klass'},
+  state            = {field = 'state'},
+  queue            = {field = 'queue'},
+  worker           = {field = 'worker', read = function(job, value)
+    return value or ''
+  end},
+  tracked          = {read = function(job)
+    return redis.call('zscore', 'ql:tracked', job.jid) ~= false
+  end},
+  priority         = {field = 'priority', read = function(job, value)
+    return tonumber(value)
+  end},
+  expires          = {field = 'expires', read = function(job, value)
+    return tonumber(value) or 0
+  end},
+  retries          = {field = 'retries', read = function(job, value)
+    return tonumber(value)
+  end},
+  remaining        = {field = 'remaining', read = function(job, value)
+    return math.floor(tonumber(value))
+  end},
+  data             = {field = 'data'},
+  tags             = {field = 'tags', read = function(job, value)
+    return Qless.decode(value)
+  end},
+  history          = {read = function(job)
+    return job:history()
+  end},
+  failure          = {field = 'failure', read = function(job, value)
+    return Qless.decode(value or '{}')
+  end},
+  resources        = {field = 'resources', read = function(job, value)
+    -- Resources that some units are needed of are given as an object mapping
+    -- each resource to the number needed, as they were declared
+    local resources = Qless.decode(value or '[]')
+    if #resources == 0 then
+      return resources
+    end
+    local weights = job:weights()
+    if next(weights) == nil then
+      return resources
+    end
+    local declared = {}
+    for _, rid in ipairs(resources) do
+      declared[rid] = weights[rid] or 1
+    end
+    return declared
+  end},
+  result_data      = {field = 'result_data', read = function(job, value)
+    return cjson.decode(value or '{}')
+  end},
+  interval         = {field = 'throttle_interval', read = function(job, value)
+    return tonumber(value) or 0
+  end},
+  dependents       = {read = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependents')
+  end},
+  dependencies     = {read = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependencies')
+  end},
+  spawned_from_jid = {field = 'spawned_from_jid'}
+}
+
+-- The values that a job's hash leaves out, rather than storing, for fields that
+-- most jobs never change. They're filled back in when the job is read.
+QlessJob.defaults = {
+  worker            = '',
+  expires           = '0',
+  tags              = '{}',
+  resources         = '[]',
+  weights           = '{}',
+  failure           = '{}',
+  result_data       = '{}',
+  throttle_interval = '0',
+  throttle_next_run = '0'
+}
+
+-- The ways an empty list or object may be encoded, in JSON or msgpack
+QlessJob.empty = Set.new({'{}', '[]', '\144', '\128'})
+
+-- Whether or not `value` is the default for `field`, and so need not be stored
+function QlessJob.default(field, value)
+  local default = QlessJob.defaults[field]
+  if default == nil then
+    return false
+  end
+  value = tostring(value)
+  return value == default or
+    ((default == '{}' or default == '[]') and QlessJob.empty[value] == true)
+end
+
+-- Named projections that can be requested in place of a list of attributes.
+-- The 'full' profile is every attribute.
+QlessJob.profiles = {
+  worker = {'jid', 'klass', 'state', 'queue', 'worker', 'priority', 'expires',
+    'retries', 'remaining', 'data'},
+  ui     = {'jid', 'klass', 'state', 'queue', 'worker', 'tracked', 'priority',
+    'expires', 'retries', 'remaining', 'tags', 'failure', 'resources',
+    'interval', 'spawned_from_jid'}
+}
+
+-- Projection(fields)
+-- ------------------
+-- Turn the `fields` argument clients provide into a list of attributes. It may
+-- be the name of a profile ('worker', 'ui' or 'full') or a JSON array of
+-- attribute names. Returns nil if every attribute is wanted.
+function QlessJob.projection(fields)
+  if fields == nil or fields == '' or fields == 'full' then
+    return nil
+  elseif QlessJob.profiles[fields] then
+    return QlessJob.profiles[fields]
+  end
+
+  local ok, decoded = pcall(cjson.decode, fields)
+  if not ok or type(decoded) ~= 'table' or
+    (#decoded == 0 and next(decoded) ~= nil) then
+    error('Projection(): Arg "fields" not a profile or JSON array: ' ..
+      tostring(fields))
+  end
+  for _, key in ipairs(decoded) do
+    if QlessJob.attributes[key] == nil then
+      error('Projection(): Unknown field "' .. tostring(key) .. '"')
+    end
+  end
+  return decoded
+end
+
+-- This gets the requested attributes of the job with the provided id, reading
+-- only the parts of the job needed to produce them. If `fields` is nil, then
+-- every attribute is returned. If the job is not found, it returns nil.
+function QlessJob:project(fields)
+  if fields == nil then
+    fields = {}
+    for key in pairs(QlessJob.attributes) do table.insert(fields, key) end
+  end
+
+  -- The jid is always fetched, since it tells us whether the job exists
+  local keys = {'jid'}
+  for _, key in ipairs(fields) do
+    local attribute = assert(QlessJob.attributes[key],
+      'Project(): Unknown field "' .. tostring(key) .. '"')
+    if attribute.field and attribute.field ~= 'jid' then
+      table.insert(keys, attribute.field)
+    end
+  end
+
+  local values = redis.call('hmget', QlessJob.ns .. self.jid, unpack(keys))
 
   -- Return nil if we haven't found it
-  if not job[1] then
+  if not values[1] then
     return nil
   end
 
-  local data = {
-    jid              = job[1],
-    klass            = job[2],
-    state            = job[3],
-    queue            = job[4],
-    worker           = job[5] or '',
-    tracked          = redis.call(
-      'zscore', 'ql:tracked', self.jid) ~= false,
-    priority         = tonumber(job[6]),
-    expires          = tonumber(job[7]) or 0,
-    retries          = tonumber(job[8]),
-    remaining        = math.floor(tonumber(job[9])),
-    data             = job[10],
-    tags             = cjson.decode(job[11]),
-    history          = self:history(),
-    failure          = cjson.decode(job[12] or '{}'),
-    resources        = cjson.decode(job[14] or '[]'),
-    result_data      = cjson.decode(job[15] or '{}'),
-    interval         = tonumber(job[16]) or 0,
-    dependents       = redis.call(
-      'smembers', QlessJob.ns .. self.jid .. '-dependents'),
-    dependencies     = redis.call(
-      'smembers', QlessJob.ns .. self.jid .. '-dependencies'),
-    spawned_from_jid = job[13]
-  }
+  local job = {}
+  for index, key in ipairs(keys) do
+    job[key] = values[index] or QlessJob.defaults[key] or false
+  end
+
+  local data = {}
+  for _, key in ipairs(fields) do
+    local attribute = QlessJob.attributes[key]
+    local value = attribute.field and job[attribute.field]
+    if attribute.read then
+      data[key] = attribute.read(self, value)
+    else
+      data[key] = value
+    end
+  end
+  return data
+end
 
+-- This gets all the data associated with the job with the provided id. If the
+-- job is not found, it returns nil. If found, it returns an object with the
+-- appropriate properties. If particular attributes are named, then only those
+-- are fetched, and they're returned as a list in the order they were named.
+function QlessJob:data(...)
   if #arg > 0 then
-    -- This section could probably be optimized, but I wanted the interface
-    -- in place first
+    local data = self:project(arg)
+    if not data then
+      return nil
+    end
+
     local response = {}
     for index, key in ipairs(arg) do
       table.insert(response, data[key])
     end
     return response
   else
-    return data
+    return self:project()
   end
 end
 
@@ -104,10 +247,10 @@ function QlessJob:complete(now, worker, queue, data, ...)
 
   -- First things first, we should see if the worker still owns this job
   local lastworker, state, priority, retries, current_queue, interval = unpack(
-    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state',
-      'priority', 'retries', 'queue', 'throttle_interval'))
+    self:fields('worker', 'state', 'priority', 'retries', 'queue',
+      'throttle_interval'))
 
-  if lastworker == false then
+  if state == false then
     error('Complete(): Job ' .. self.jid .. ' does not exist')
   elseif (state ~= 'running') then
     error('Complete(): Job ' .. self.jid .. ' is not currently running: ' ..
@@ -120,14 +263,10 @@ function QlessJob:complete(now, worker, queue, data, ...)
       tostring(current_queue))
   end
 
+  -- Throttled jobs may not be run again until their interval has passed
   local next_run = 0
-  if interval then
-    interval = tonumber(interval)
-    if interval > 0 then
-      next_run = now + interval
-    else
-      next_run = -1
-    end
+  if tonumber(interval) > 0 then
+    next_run = now + tonumber(interval)
   end
 
   -- Now we can assume that the worker does own the job. We need to
@@ -143,7 +282,7 @@ function QlessJob:complete(now, worker, queue, data, ...)
   end
 
   if result_data then
-    redis.call('hset', QlessJob.ns .. self.jid, 'result_data', result_data)
+    self:update({result_data = result_data})
   end
 
   -- Remove the job from the previous queue
@@ -151,6 +290,7 @@ function QlessJob:complete(now, worker, queue, data, ...)
   queue_obj.work.remove(self.jid)
   queue_obj.locks.remove(self.jid)
   queue_obj.scheduled.remove(self.jid)
+  queue_obj:record(now, 'complete')
 
   self:release_resources(now)
 
@@ -163,13 +303,14 @@ function QlessJob:complete(now, worker, queue, data, ...)
     redis.call('hget', QlessJob.ns .. self.jid, 'time') or now)
   local waiting = now - time
   Qless.queue(queue):stat(now, 'run', waiting)
+  QlessWorker.stat(now, worker, waiting)
   redis.call('hset', QlessJob.ns .. self.jid,
-    'time', string.format("%.20f", now))
+    'time', Qless.time(now))
 
   -- Remove this job from the jobs that the worker that was running it has
   redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
 
-  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+  if Qless.tracked(self.jid) then
     Qless.publish('completed', self.jid)
   end
 
@@ -188,36 +329,27 @@ function QlessJob:complete(now, worker, queue, data, ...)
 
     -- We're going to make sure that this queue is in the
     -- set of known queues
-    if redis.call('zscore', 'ql:queues', nextq) == false then
-      redis.call('zadd', 'ql:queues', now, nextq)
-    end
-
-    redis.call('hmset', QlessJob.ns .. self.jid,
-      'state', 'waiting',
-      'worker', '',
-      'failure', '{}',
-      'queue', nextq,
-      'expires', 0,
-      'remaining', tonumber(retries))
+    Qless.defer('known:' .. nextq, function()
+      if redis.call('zscore', 'ql:queues', nextq) == false then
+        redis.call('zadd', 'ql:queues', now, nextq)
+      end
+    end)
+
+    self:update({
+      state     = 'waiting',
+      worker    = '',
+      failure   = '{}',
+      queue     = nextq,
+      expires   = 0,
+      remaining = tonumber(retries)
+    })
 
     if (delay > 0) and (#depends == 0) then
       queue_obj.scheduled.add(now + delay, self.jid)
       return 'scheduled'
     else
       -- These are the jids we legitimately have to wait on
-      local count = 0
-      for i, j in ipairs(depends) do
-        -- Make sure it's something other than 'nil' or complete.
-        local state = redis.call('hget', QlessJob.ns .. j, 'state')
-        if (state and state ~= 'complete') then
-          count = count + 1
-          redis.call(
-            'sadd', QlessJob.ns .. j .. '-dependents',self.jid)
-          redis.call(
-            'sadd', QlessJob.ns .. self.jid .. '-dependencies', j)
-        end
-      end
-      if count > 0 then
+      if self:add_dependencies(depends) > 0 then
         queue_obj.depends.add(now, self.jid)
         redis.call('hset', QlessJob.ns .. self.jid, 'state', 'depends')
         if delay > 0 then
@@ -242,82 +374,33 @@ function QlessJob:complete(now, worker, queue, data, ...)
       queue = queue
     }))
 
-    redis.call('hmset', QlessJob.ns .. self.jid,
-      'state', 'complete',
-      'worker', '',
-      'failure', '{}',
-      'queue', '',
-      'expires', 0,
-      'remaining', tonumber(retries),
-      'throttle_next_run', next_run
-    )
-
-    -- Do the completion dance
-    local count = Qless.config.get('jobs-history-count')
-    local time  = Qless.config.get('jobs-history')
-
-    -- These are the default values
-    count = tonumber(count or 50000)
-    time  = tonumber(time  or 7 * 24 * 60 * 60)
-
-    -- Schedule this job for destructination eventually
-    redis.call('zadd', 'ql:completed', now, self.jid)
-
-    -- Now look at the expired job data. First, based on the current time
-    local jids = redis.call('zrangebyscore', 'ql:completed', 0, now - time)
-    -- Any jobs that need to be expired... delete
-    for index, jid in ipairs(jids) do
-      local tags = cjson.decode(
-        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
-      for i, tag in ipairs(tags) do
-        redis.call('zrem', 'ql:t:' .. tag, jid)
-        redis.call('zincrby', 'ql:tags', -1, tag)
-      end
-      redis.call('del', QlessJob.ns .. jid)
-      redis.call('del', QlessJob.ns .. jid .. '-history')
-    end
-    -- And now remove those from the queued-for-cleanup queue
-    redis.call('zremrangebyscore', 'ql:completed', 0, now - time)
-
-    -- Now take the all by the most recent 'count' ids
-    jids = redis.call('zrange', 'ql:completed', 0, (-1-count))
-    for index, jid in ipairs(jids) do
-      local tags = cjson.decode(
-        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
-      for i, tag in ipairs(tags) do
-        redis.call('zrem', 'ql:t:' .. tag, jid)
-        redis.call('zincrby', 'ql:tags', -1, tag)
-      end
-      redis.call('del', QlessJob.ns .. jid)
-      redis.call('del', QlessJob.ns .. jid .. '-history')
-    end
-    redis.call('zremrangebyrank', 'ql:completed', 0, (-1-count))
+    self:update({
+      state             = 'complete',
+      worker            = '',
+      failure           = '{}',
+      queue             = '',
+      expires           = 0,
+      remaining         = tonumber(retries),
+      throttle_next_run = next_run
+    })
+
+    -- Schedule this job for destructination eventually, and do the
+    -- completion dance
+    Qless.zadd('ql:completed', now, self.jid)
+    Qless.defer('gc', function()
+      Qless.gc(now, Qless.config.get('gc-budget'))
+    end)
 
     -- Alright, if this has any dependents, then we should go ahead
     -- and unstick those guys.
+    local resolved = {}
     for i, j in ipairs(redis.call(
       'smembers', QlessJob.ns .. self.jid .. '-dependents')) do
-      redis.call('srem', QlessJob.ns .. j .. '-dependencies', self.jid)
-      if redis.call(
-        'scard', QlessJob.ns .. j .. '-dependencies') == 0 then
-        local q, p, scheduled = unpack(
-          redis.call('hmget', QlessJob.ns .. j, 'queue', 'priority', 'scheduled'))
-        if q then
-          local queue = Qless.queue(q)
-          queue.depends.remove(j)
-          if scheduled then
-            queue.scheduled.add(scheduled, j)
-            redis.call('hset', QlessJob.ns .. j, 'state', 'scheduled')
-            redis.call('hdel', QlessJob.ns .. j, 'scheduled')
-          else
-            if Qless.job(j):acquire_resources(now) then
-              queue.work.add(now, p, j)
-            end
-            redis.call('hset', QlessJob.ns .. j, 'state', 'waiting')
-          end
-        end
+      if Qless.job(j):remove_dependency(self.jid) == 0 then
+        table.insert(resolved, j)
       end
     end
+    QlessJob.resolve(now, resolved)
 
     -- Delete our dependents key
     redis.call('del', QlessJob.ns .. self.jid .. '-dependents')
@@ -326,6 +409,48 @@ function QlessJob:complete(now, worker, queue, data, ...)
   end
 end
 
+-- Complete_many(now, worker, queue, jobs)
+-- ---------------------------------------
+-- Complete several of the jobs `worker` is running in `queue` at once. `jobs`
+-- is a JSON array whose items are either jids, or objects with a `jid` and
+-- any of the optional arguments that `complete` accepts:
+--
+--  ['jid', {'jid': 'other', 'data': {...}, 'next': 'queue', 'delay': 10}]
+--
+-- Each job is checked and completed on its own, but stats, retention and log
+-- messages are all dealt with once for the whole lot. Returns an outcome for
+-- each job, as described in Qless.outcomes.
+function QlessJob.complete_many(now, worker, queue, jobs)
+  jobs = assert(cjson.decode(jobs or '[]'),
+    'Complete_many(): Arg "jobs" not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Complete_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  return Qless.outcomes(jobs, function(spec)
+    if type(spec) ~= 'table' then
+      return Qless.job(spec):complete(now, worker, queue)
+    end
+
+    local data = spec.data
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+    local options = {}
+    for _, key in ipairs({'next', 'delay', 'depends', 'result_data'}) do
+      local value = spec[key]
+      if value ~= nil then
+        if type(value) == 'table' then
+          value = cjson.encode(value)
+        end
+        table.insert(options, key)
+        table.insert(options, value)
+      end
+    end
+    return Qless.job(spec.jid):complete(
+      now, worker, queue, data, unpack(options))
+  end)
+end
+
 -- Fail(now, worker, group, message, [data])
 -- -------------------------------------------------
 -- Mark the particular job as failed, with the provided group, and a more
@@ -357,10 +482,6 @@ function QlessJob:fail(now, worker, group, message, data)
   local group   = assert(group            , 'Fail(): Arg "group" missing')
   local message = assert(message          , 'Fail(): Arg "message" missing')
 
-  -- The bin is midnight of the provided day
-  -- 24 * 60 * 60 = 86400
-  local bin = now - (now % 86400)
-
   if data then
     assert(cjson.decode(data), 'Fail(): Arg "data" not JSON: ' .. tostring(data))
   end
@@ -388,7 +509,7 @@ function QlessJob:fail(now, worker, group, message, data)
     message = message
   }))
 
-  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+  if Qless.tracked(self.jid) then
     Qless.publish('failed', self.jid)
   end
 
@@ -401,8 +522,11 @@ function QlessJob:fail(now, worker, group, message, data)
 
   -- Increment the number of failures for that queue for the
   -- given day.
-  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
-  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed'  , 1)
+  local queue_obj = Qless.queue(queue)
+  queue_obj:tally(now, 'failures', 1)
+  queue_obj:tally(now, 'failed'  , 1)
+  queue_obj:record(now, 'fail')
+  QlessWorker.tally(now, worker, 'failed', 1)
 
   -- Now remove the instance from the schedule, and work queues for the
   -- queue it's in
@@ -420,16 +544,17 @@ function QlessJob:fail(now, worker, group, message, data)
     redis.call('hset', QlessJob.ns .. self.jid, 'data', data)
   end
 
-  redis.call('hmset', QlessJob.ns .. self.jid,
-    'state', 'failed',
-    'worker', '',
-    'expires', '',
-    'failure', cjson.encode({
+  self:update({
+    state   = 'failed',
+    worker  = '',
+    expires = 0,
+    failure = Qless.encode({
       ['group']   = group,
       ['message'] = message,
       ['when']    = math.floor(now),
       ['worker']  = worker
-    }))
+    })
+  })
 
   -- Add this group of failure to the list of failures
   redis.call('sadd', 'ql:failures', group)
@@ -442,6 +567,36 @@ function QlessJob:fail(now, worker, group, message, data)
   return self.jid
 end
 
+-- Fail_many(now, worker, group, message, jobs)
+-- --------------------------------------------
+-- Fail several of the jobs `worker` is running at once. `jobs` is a JSON array
+-- whose items are either jids, or objects with a `jid` and optionally `data`
+-- and their own `group` and `message`:
+--
+--  ['jid', {'jid': 'other', 'message': 'Timed out', 'data': {...}}]
+--
+-- As with complete_many, stats and log messages are dealt with once for the
+-- whole lot, and an outcome is returned for each job.
+function QlessJob.fail_many(now, worker, group, message, jobs)
+  jobs = assert(cjson.decode(jobs or '[]'),
+    'Fail_many(): Arg "jobs" not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Fail_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  return Qless.outcomes(jobs, function(spec)
+    if type(spec) ~= 'table' then
+      return Qless.job(spec):fail(now, worker, group, message)
+    end
+
+    local data = spec.data
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+    return Qless.job(spec.jid):fail(now, worker,
+      spec.group or group, spec.message or message, data)
+  end)
+end
+
 -- retry(now, queue, worker, [delay, [group, [message]]])
 -- ------------------------------------------
 -- This script accepts jid, queue, worker and delay for retrying a job. This
@@ -467,11 +622,10 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
 
   -- Let's see what the old priority, and tags were
   local oldqueue, state, retries, oldworker, priority, failure = unpack(
-    redis.call('hmget', QlessJob.ns .. self.jid, 'queue', 'state',
-      'retries', 'worker', 'priority', 'failure'))
+    self:fields('queue', 'state', 'retries', 'worker', 'priority', 'failure'))
 
   -- If this isn't the worker that owns
-  if oldworker == false then
+  if state == false then
     error('Retry(): Job ' .. self.jid .. ' does not exist')
   elseif state ~= 'running' then
     error('Retry(): Job ' .. self.jid .. ' is not currently running: ' ..
@@ -490,6 +644,7 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
 
   -- Remove it from the locks key of the old queue
   Qless.queue(oldqueue).locks.remove(self.jid)
+  Qless.queue(oldqueue):record(now, 'retry')
   self:release_resources(now)
 
   -- Remove this job from the worker that was previously working it
@@ -501,13 +656,11 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
     local group = group or 'failed-retries-' .. queue
     self:history(now, 'failed', {['group'] = group})
 
-    redis.call('hmset', QlessJob.ns .. self.jid, 'state', 'failed',
-      'worker', '',
-      'expires', '')
+    self:update({state = 'failed', worker = '', expires = 0})
     -- If the failure has not already been set, then set it
     if group ~= nil and message ~= nil then
       redis.call('hset', QlessJob.ns .. self.jid,
-        'failure', cjson.encode({
+        'failure', Qless.encode({
           ['group']   = group,
           ['message'] = message,
           ['when']    = math.floor(now),
@@ -516,7 +669,7 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
       )
     else
       redis.call('hset', QlessJob.ns .. self.jid,
-      'failure', cjson.encode({
+      'failure', Qless.encode({
         ['group']   = group,
         ['message'] =
           'Job exhausted retries in queue "' .. oldqueue .. '"',
@@ -530,9 +683,10 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
     -- And add this particular instance to the failed types
     redis.call('lpush', 'ql:f:' .. group, self.jid)
     -- Increment the count of the failed jobs
-    local bin = now - (now % 86400)
-    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
-    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed'  , 1)
+    Qless.queue(queue):tally(now, 'failures', 1)
+    Qless.queue(queue):tally(now, 'failed'  , 1)
+    Qless.queue(queue):record(now, 'fail')
+    QlessWorker.tally(now, worker, 'failed', 1)
   else
     -- Put it in the queue again with a delay. Like put()
     local queue_obj = Qless.queue(queue)
@@ -549,7 +703,7 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
     -- If a group and a message was provided, then we should save it
     if group ~= nil and message ~= nil then
       redis.call('hset', QlessJob.ns .. self.jid,
-        'failure', cjson.encode({
+        'failure', Qless.encode({
           ['group']   = group,
           ['message'] = message,
           ['when']    = math.floor(now),
@@ -583,16 +737,7 @@ function QlessJob:depends(now, command, ...)
 
   if command == 'on' then
     -- These are the jids we legitimately have to wait on
-    for i, j in ipairs(arg) do
-      -- Make sure it's something other than 'nil' or complete.
-      local state = redis.call('hget', QlessJob.ns .. j, 'state')
-      if (state and state ~= 'complete') then
-        redis.call(
-          'sadd', QlessJob.ns .. j .. '-dependents'  , self.jid)
-        redis.call(
-          'sadd', QlessJob.ns .. self.jid .. '-dependencies', j)
-      end
-    end
+    self:add_dependencies(arg)
     return true
   elseif command == 'off' then
     if arg[1] == 'all' then
@@ -601,35 +746,16 @@ function QlessJob:depends(now, command, ...)
         redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
       end
       redis.call('del', QlessJob.ns .. self.jid .. '-dependencies')
-      local q, p = unpack(redis.call(
-        'hmget', QlessJob.ns .. self.jid, 'queue', 'priority'))
-      if q then
-        local queue_obj = Qless.queue(q)
-        queue_obj.depends.remove(self.jid)
-        if self:acquire_resources(now) then
-          queue_obj.work.add(now, p, self.jid)
-        end
-        redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
-      end
+      redis.call('hdel', QlessJob.ns .. self.jid, 'unresolved')
+      QlessJob.resolve(now, {self.jid})
     else
+      local unresolved = nil
       for i, j in ipairs(arg) do
         redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
-        redis.call(
-          'srem', QlessJob.ns .. self.jid .. '-dependencies', j)
-        if redis.call('scard',
-          QlessJob.ns .. self.jid .. '-dependencies') == 0 then
-          local q, p = unpack(redis.call(
-            'hmget', QlessJob.ns .. self.jid, 'queue', 'priority'))
-          if q then
-            local queue_obj = Qless.queue(q)
-            queue_obj.depends.remove(self.jid)
-            if self:acquire_resources(now) then
-              queue_obj.work.add(now, p, self.jid)
-            end
-            redis.call('hset',
-              QlessJob.ns .. self.jid, 'state', 'waiting')
-          end
-        end
+        unresolved = self:remove_dependency(j)
+      end
+      if unresolved == 0 then
+        QlessJob.resolve(now, {self.jid})
       end
     end
     return true
@@ -638,6 +764,124 @@ function QlessJob:depends(now, command, ...)
   end
 end
 
+-- Each job keeps a count of its unresolved dependencies in the 'unresolved'
+-- field of its hash, next to the set of their jids, so that resolving one need
+-- only decrement it to know whether the job is free to run. Jobs whose
+-- dependencies were recorded before the count was kept don't have the field,
+-- and their count is taken from the set.
+
+-- Make this job depend on each of the jobs `jids` that exists and hasn't been
+-- completed, and return the number of its unresolved dependencies. Their
+-- states are read all at once, by sorting a list of them without ordering it
+-- and getting each one's state along the way
+function QlessJob:add_dependencies(jids)
+  if #jids > 0 then
+    local key = QlessJob.ns .. self.jid .. '-candidates'
+    -- Lua's stack limits how many arguments we can unpack at once
+    for i = 1, #jids, 1000 do
+      redis.call('rpush', key, unpack(jids, i, math.min(i + 999, #jids)))
+    end
+    local states = redis.call(
+      'sort', key, 'by', 'nosort', 'get', QlessJob.ns .. '*->state')
+    redis.call('del', key)
+    for i, jid in ipairs(jids) do
+      if states[i] and states[i] ~= 'complete' then
+        self:add_dependency(jid)
+      end
+    end
+  end
+  return self:unresolved()
+end
+
+-- Make this job depend on the job `jid`
+function QlessJob:add_dependency(jid)
+  local key = QlessJob.ns .. self.jid .. '-dependencies'
+  if redis.call('sadd', key, jid) == 1 then
+    redis.call('sadd', QlessJob.ns .. jid .. '-dependents', self.jid)
+    if redis.call('hincrby', QlessJob.ns .. self.jid, 'unresolved', 1) == 1 then
+      local count = redis.call('scard', key)
+      if count > 1 then
+        redis.call('hset', QlessJob.ns .. self.jid, 'unresolved', count)
+      end
+    end
+  end
+end
+
+-- Remove the job `jid` from this job's dependencies, and return the number of
+-- dependencies it still has. The caller is responsible for removing this job
+-- from the other's dependents.
+function QlessJob:remove_dependency(jid)
+  if redis.call(
+    'srem', QlessJob.ns .. self.jid .. '-dependencies', jid) == 0 then
+    return self:unresolved()
+  end
+
+  local count = redis.call('hincrby', QlessJob.ns .. self.jid, 'unresolved', -1)
+  if count < 0 then
+    count = redis.call('scard', QlessJob.ns .. self.jid .. '-dependencies')
+    redis.call('hset', QlessJob.ns .. self.jid, 'unresolved', count)
+  end
+  if count == 0 then
+    redis.call('hdel', QlessJob.ns .. self.jid, 'unresolved')
+  end
+  return count
+end
+
+-- The number of this job's dependencies that have yet to be resolved
+function QlessJob:unresolved()
+  local count = redis.call('hget', QlessJob.ns .. self.jid, 'unresolved')
+  if count then
+    return tonumber(count)
+  end
+  return redis.call('scard', QlessJob.ns .. self.jid .. '-dependencies')
+end
+
+-- Move the jobs `jids`, whose dependencies have all been resolved, out of the
+-- depends state and into their queues. Their additions to the queues are made
+-- in a batch, and they're removed from each queue's depends set at once.
+function QlessJob.resolve(now, jids)
+  if #jids == 0 then
+    return
+  end
+
+  Qless.batch(function()
+    local names = {}
+    local released = {}
+    for _, jid in ipairs(jids) do
+      local q, p, scheduled = unpack(
+        redis.call('hmget', QlessJob.ns .. jid, 'queue', 'priority', 'scheduled'))
+      if q then
+        if not released[q] then
+          released[q] = {}
+          table.insert(names, q)
+        end
+        table.insert(released[q], jid)
+
+        local queue = Qless.queue(q)
+        if scheduled then
+          queue.scheduled.add(scheduled, jid)
+          redis.call('hset', QlessJob.ns .. jid, 'state', 'scheduled')
+          redis.call('hdel', QlessJob.ns .. jid, 'scheduled')
+        else
+          if Qless.job(jid):acquire_resources(now) then
+            queue.work.add(now, p, jid)
+          end
+          redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
+        end
+      end
+    end
+
+    for _, q in ipairs(names) do
+      local queue = Qless.queue(q)
+      local jids = released[q]
+      -- Lua's stack limits how many arguments we can unpack at once
+      for i = 1, #jids, 1000 do
+        queue.depends.remove(unpack(jids, i, math.min(i + 999, #jids)))
+      end
+    end
+  end)
+end
+
 -- Heartbeat
 ------------
 -- Renew this worker's lock on this job. Throws an exception if:
@@ -652,9 +896,9 @@ function QlessJob:heartbeat(now, worker, data)
   -- heartbeat. First, though, we need to find the queue
   -- this particular job is in
   local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue') or ''
-  local expires = now + tonumber(
+  local expires = now + (
     Qless.config.get(queue .. '-heartbeat') or
-    Qless.config.get('heartbeat', 60))
+    Qless.config.get('heartbeat'))
 
   if data then
     assert(cjson.decode(data), 'Heartbeat(): Arg "data" not JSON: ' .. tostring(data))
@@ -662,9 +906,8 @@ function QlessJob:heartbeat(now, worker, data)
 
   -- First, let's see if the worker still owns this job, and there is a
   -- worker
-  local job_worker, state = unpack(
-    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state'))
-  if job_worker == false then
+  local job_worker, state = unpack(self:fields('worker', 'state'))
+  if state == false then
     -- This means the job doesn't exist
     error('Heartbeat(): Job ' .. self.jid .. ' does not exist')
   elseif state ~= 'running' then
@@ -730,14 +973,37 @@ function QlessJob:priority(priority)
   end
 end
 
--- Update the jobs' attributes with the provided dictionary
+-- Update the jobs' attributes with the provided dictionary. Attributes set to
+-- their defaults are removed from the hash rather than stored.
 function QlessJob:update(data)
   local tmp = {}
+  local defaults = {}
   for k, v in pairs(data) do
-    table.insert(tmp, k)
-    table.insert(tmp, v)
+    if QlessJob.default(k, v) then
+      table.insert(defaults, k)
+    else
+      table.insert(tmp, k)
+      table.insert(tmp, v)
+    end
+  end
+  if #defaults > 0 then
+    redis.call('hdel', QlessJob.ns .. self.jid, unpack(defaults))
+  end
+  if #tmp > 0 then
+    redis.call('hmset', QlessJob.ns .. self.jid, unpack(tmp))
   end
-  redis.call('hmset', QlessJob.ns .. self.jid, unpack(tmp))
+end
+
+-- Get the named fields of the job's hash, like HMGET, except that fields left
+-- out because they have their default values are filled in
+function QlessJob:fields(...)
+  local values = redis.call('hmget', QlessJob.ns .. self.jid, unpack(arg))
+  for index, field in ipairs(arg) do
+    if not values[index] and QlessJob.defaults[field] then
+      values[index] = QlessJob.defaults[field]
+    end
+  end
+  return values
 end
 
 -- Times out the job now rather than when its lock is normally set to expire
@@ -754,8 +1020,7 @@ function QlessJob:timeout(now)
     local queue = Qless.queue(queue_name)
     queue.locks.remove(self.jid)
     queue.work.add(now, '+inf', self.jid)
-    redis.call('hmset', QlessJob.ns .. self.jid,
-      'state', 'stalled', 'expires', 0)
+    self:update({state = 'stalled', expires = 0})
     local encoded = cjson.encode({
       jid    = self.jid,
       event  = 'lock_lost',
@@ -772,48 +1037,68 @@ function QlessJob:exists()
   return redis.call('exists', QlessJob.ns .. self.jid) == 1
 end
 
--- Get or append to history
-function QlessJob:history(now, what, item)
-  -- First, check if there's an old-style history, and update it if there is
-  local history = redis.call('hget', QlessJob.ns .. self.jid, 'history')
-  if history then
-    history = cjson.decode(history)
-    for i, value in ipairs(history) do
-      redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
-        cjson.encode({math.floor(value.put), 'put', {q = value.q}}))
-
-      -- If there's any popped time
-      if value.popped then
-        redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
-          cjson.encode({math.floor(value.popped), 'popped',
-            {worker = value.worker}}))
-      end
+-- Convert an old-style history, which was kept as a JSON blob in the job's
+-- hash, into a list of history entries
+function QlessJob.legacy_history(history)
+  local entries = {}
+  for i, value in ipairs(cjson.decode(history)) do
+    table.insert(entries, {math.floor(value.put), 'put', {q = value.q}})
+
+    -- If there's any popped time
+    if value.popped then
+      table.insert(entries, {math.floor(value.popped), 'popped',
+        {worker = value.worker}})
+    end
 
-      -- If there's any failure
-      if value.failed then
-        redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
-          cjson.encode(
-            {math.floor(value.failed), 'failed', nil}))
-      end
+    -- If there's any failure
+    if value.failed then
+      table.insert(entries, {math.floor(value.failed), 'failed', nil})
+    end
 
-      -- If it was completed
-      if value.done then
-        redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
-          cjson.encode(
-            {math.floor(value.done), 'done', nil}))
-      end
+    -- If it was completed
+    if value.done then
+      table.insert(entries, {math.floor(value.done), 'done', nil})
+    end
+  end
+  return entries
+end
+
+-- Move an old-style history into the front of the history list, and remove it
+-- from the job's hash. This happens whenever such a job is put again.
+function QlessJob:migrate_history(history)
+  local entries = QlessJob.legacy_history(history)
+  if #entries > 0 then
+    -- Pushing onto the head of the list, so in reverse
+    local encoded = {}
+    for i = #entries, 1, -1 do
+      table.insert(encoded, Qless.encode(entries[i]))
     end
-    -- With all this ported forward, delete the old-style history
-    redis.call('hdel', QlessJob.ns .. self.jid, 'history')
+    redis.call('lpush', QlessJob.ns .. self.jid .. '-history', unpack(encoded))
   end
+  redis.call('hdel', QlessJob.ns .. self.jid, 'history')
+end
 
-  -- Now to the meat of the function
+-- Get or append to history
+function QlessJob:history(now, what, item)
   if what == nil then
     -- Get the history
     local response = {}
+
+    -- Jobs that haven't been put since an old-style history was kept have
+    -- that history come before anything in the list
+    local history = redis.call('hget', QlessJob.ns .. self.jid, 'history')
+    if history then
+      for i, value in ipairs(QlessJob.legacy_history(history)) do
+        local dict = value[3] or {}
+        dict['when'] = value[1]
+        dict['what'] = value[2]
+        table.insert(response, dict)
+      end
+    end
+
     for i, value in ipairs(redis.call('lrange',
       QlessJob.ns .. self.jid .. '-history', 0, -1)) do
-      value = cjson.decode(value)
+      value = Qless.decode(value)
       local dict = value[3] or {}
       dict['when'] = value[1]
       dict['what'] = value[2]
@@ -821,41 +1106,72 @@ function QlessJob:history(now, what, item)
     end
     return response
   else
-    -- Append to the history. If the length of the history should be limited,
-    -- then we'll truncate it.
-    local count = tonumber(Qless.config.get('max-job-history', 100))
-    if count > 0 then
+    local length = redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+      Qless.encode({math.floor(now), what, item}))
+
+    -- If the length of the history should be limited, then we'll truncate it,
+    -- but only once it's actually grown past that limit
+    local count = Qless.config.get('max-job-history', 100)
+    if count > 0 and length > count then
       -- We'll always keep the first item around
       local obj = redis.call('lpop', QlessJob.ns .. self.jid .. '-history')
-      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history', -count + 2, -1)
-      if obj ~= nil and obj ~= false then
-        redis.call('lpush', QlessJob.ns .. self.jid .. '-history', obj)
-      end
+      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history',
+        -math.max(count - 1, 1), -1)
+      length = redis.call(
+        'lpush', QlessJob.ns .. self.jid .. '-history', obj)
     end
-    return redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
-      cjson.encode({math.floor(now), what, item}))
+    return length
   end
 end
 
 function QlessJob:release_resources(now)
   local resources = redis.call('hget', QlessJob.ns .. self.jid, 'resources')
-  resources = cjson.decode(resources or '[]')
+  resources = Qless.decode(resources or '[]')
   for _, res in ipairs(resources) do
     Qless.resource(res):release(now, self.jid)
   end
 end
 
+-- Return whether this job is waiting on a resource other than `rid` that
+-- has no lock free for it. Resources that don't exist don't count, so that
+-- trying to acquire them fails the job.
+function QlessJob:blocked(rid)
+  local resources = Qless.decode(
+    redis.call('hget', QlessJob.ns .. self.jid, 'resources') or '[]')
+  for _, res in ipairs(resources) do
+    local resource = Qless.resource(res)
+    if res ~= rid and resource:exists() and
+      not resource:available(self.jid) then
+      return true
+    end
+  end
+  return false
+end
+
+-- Return the number of units of each of its resources that this job needs,
+-- for those that it needs more than one of
+function QlessJob:weights()
+  return Qless.decode(
+    redis.call('hget', QlessJob.ns .. self.jid, 'weights') or '{}')
+end
+
+-- Return the number of units of the resource `rid` that this job needs
+function QlessJob:weight(rid)
+  return self:weights()[rid] or 1
+end
+
 function QlessJob:acquire_resources(now)
-  local resources, priority = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'resources', 'priority'))
-  resources = cjson.decode(resources or '[]')
+  local resources, priority, weights = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'resources', 'priority', 'weights'))
+  resources = Qless.decode(resources or '[]')
   if (#resources == 0) then
     return true
   end
+  weights = Qless.decode(weights or '{}')
 
   local acquired_all = true
 
   for _, res in ipairs(resources) do
-    local ok, res = pcall(function() return Qless.resource(res):acquire(now, priority, self.jid) end)
+    local ok, res = pcall(function() return Qless.resource(res):acquire(now, priority, self.jid, weights[res]) end)
     if not ok then
       self:set_failed(now, 'system:fatal', res.msg)
       return false
@@ -869,14 +1185,14 @@ end
 function QlessJob:set_failed(now, group, message, worker, release_work, release_resources)
   local group             = assert(group, 'Fail(): Arg "group" missing')
   local message           = assert(message, 'Fail(): Arg "message" missing')
+  -- Only a job that a worker had is counted among that worker's failures
+  if worker then
+    QlessWorker.tally(now, worker, 'failed', 1)
+  end
   local worker            = worker or 'none'
   local release_work      = release_work or true
   local release_resources = release_resources or false
 
-  -- The bin is midnight of the provided day
-  -- 24 * 60 * 60 = 86400
-  local bin = now - (now % 86400)
-
   local queue = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'queue'))
 
   -- Send out a log message
@@ -898,8 +1214,9 @@ function QlessJob:set_failed(now, group, message, worker, release_work, release_
 
   -- Increment the number of failures for that queue for the
   -- given day.
-  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
-  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed'  , 1)
+  Qless.queue(queue):tally(now, 'failures', 1)
+  Qless.queue(queue):tally(now, 'failed'  , 1)
+  Qless.queue(queue):record(now, 'fail')
 
   -- Now remove the instance from the schedule, and work queues for the
   -- queue it's in
@@ -915,15 +1232,16 @@ function QlessJob:set_failed(now, group, message, worker, release_work, release_
     self:release_resources(now)
   end
 
-  redis.call('hmset', QlessJob.ns .. self.jid,
-    'state', 'failed',
-    'worker', '',
-    'expires', '',
-    'failure', cjson.encode({
+  self:update({
+    state   = 'failed',
+    worker  = '',
+    expires = 0,
+    failure = Qless.encode({
       ['group']   = group,
       ['message'] = message,
       ['when']    = math.floor(now)
-    }))
+    })
+  })
 
   -- Add this group of failure to the list of failures
   redis.call('sadd', 'ql:failures', group)
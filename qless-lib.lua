@@ -0,0 +1,4738 @@
+-- Current SHA: 94e2017e3b8d6b2bece18934fac35afb6b04391b
+-- This is a generated file
+-------------------------------------------------------------------------------
+-- Forward declarations to make everything happy
+-------------------------------------------------------------------------------
+local Qless = {
+  ns = 'ql:'
+}
+
+-- Queue forward delcaration
+local QlessQueue = {
+  ns = Qless.ns .. 'q:'
+}
+QlessQueue.__index = QlessQueue
+
+-- Worker forward declaration
+local QlessWorker = {
+  ns = Qless.ns .. 'w:'
+}
+QlessWorker.__index = QlessWorker
+
+-- Job forward declaration
+local QlessJob = {
+  ns = Qless.ns .. 'j:'
+}
+QlessJob.__index = QlessJob
+
+-- RecurringJob forward declaration
+local QlessRecurringJob = {}
+QlessRecurringJob.__index = QlessRecurringJob
+
+-- Resource forward declaration
+local QlessResource = {
+  ns = Qless.ns .. 'rs:'
+}
+QlessResource.__index = QlessResource;
+
+-- Config forward declaration
+Qless.config = {}
+
+-- Extend a table. This comes up quite frequently
+function table.extend(self, other)
+  for i, v in ipairs(other) do
+    table.insert(self, v)
+  end
+end
+
+-- This is essentially the same as redis' publish, but it prefixes the channel
+-- with the Qless namespace. In a batch, log messages are gathered up and
+-- published together, as a single 'batch' event, when the batch closes.
+function Qless.publish(channel, message)
+  local batch = Qless.batching
+  if batch and channel == 'log' then
+    table.insert(batch.logs, message)
+    return
+  end
+  redis.call('publish', Qless.ns .. channel, message)
+end
+
+-- Encode one of the structures kept in job hashes: tags, resources, failures
+-- and history entries. These are JSON, unless the 'storage-format' config is
+-- 'msgpack', in which case they're packed with the (more compact) cmsgpack.
+function Qless.encode(value)
+  if Qless.config.get('storage-format') == 'msgpack' then
+    return cmsgpack.pack(value)
+  end
+  return cjson.encode(value)
+end
+
+-- Decode a structure written by Qless.encode, in either format. We only ever
+-- encode tables, and JSON ones begin with '[' or '{', which packed ones can't
+function Qless.decode(value)
+  local first = string.sub(value, 1, 1)
+  if first == '[' or first == '{' then
+    return cjson.decode(value)
+  end
+  return cmsgpack.unpack(value)
+end
+
+-- Format a time to be kept in a job hash. With the 'msgpack' storage format,
+-- it's kept to microseconds rather than 20 decimal places.
+function Qless.time(now)
+  if Qless.config.get('storage-format') == 'msgpack' then
+    return string.format('%.6f', now)
+  end
+  return string.format('%.20f', now)
+end
+
+-------------------------------------------------------------------------------
+-- Batches
+-------------------------------------------------------------------------------
+-- Commands that act on many jobs at once (like put_many) run the per-job code
+-- inside a batch. While a batch is open, sorted set additions made through
+-- Qless.zadd are buffered and made with one ZADD per key when it closes,
+-- counters incremented through Qless.hincrby are summed and incremented once,
+-- and bookkeeping passed to Qless.defer is done once, after all of those.
+-- Log messages are published as one event.
+Qless.batching = nil
+
+-- Run `func` inside a batch, returning what it returns. If a batch is already
+-- open, `func` simply joins it.
+function Qless.batch(func)
+  if Qless.batching then
+    return func()
+  end
+
+  Qless.batching = {
+    keys = {}, zadds = {}, after = {}, names = {}, deferred = {}, memos = {},
+    counters = {}, created = {}, fields = {}, logs = {}
+  }
+  local ok, result = pcall(func)
+  local batch = Qless.batching
+  Qless.batching = nil
+
+  -- Even if something went wrong, whatever was already done must be kept
+  -- consistent, just as it would have been outside of a batch
+  for _, key in ipairs(batch.keys) do
+    local args = batch.zadds[key]
+    local added = 0
+    -- Lua's stack limits how many arguments we can unpack at once
+    for i = 1, #args, 1000 do
+      added = added + redis.call(
+        'zadd', key, unpack(args, i, math.min(i + 999, #args)))
+    end
+    if batch.after[key] then
+      batch.after[key](added)
+    end
+  end
+  for _, field in ipairs(batch.fields) do
+    local key, name = unpack(field)
+    local increment = batch.counters[key][name]
+    local created = batch.created[key]
+    if redis.call('hincrby', key, name, increment) == increment and created then
+      batch.created[key] = nil
+      created()
+    end
+  end
+  if #batch.logs > 0 then
+    Qless.publish('log',
+      '{"event":"batch","events":[' .. table.concat(batch.logs, ',') .. ']}')
+  end
+  for _, name in ipairs(batch.names) do
+    batch.deferred[name]()
+  end
+
+  if not ok then
+    error(result, 0)
+  end
+  return result
+end
+
+-- Add `member` to the sorted set `key` with `score`, and then call `after`
+-- (if provided) with the number of members that were added. In a batch the
+-- ZADD is buffered, and only the first `after` given for each key is called,
+-- once, with the number added by the batch as a whole.
+function Qless.zadd(key, score, member, after)
+  local batch = Qless.batching
+  if not batch then
+    local added = redis.call('zadd', key, score, member)
+    if after then
+      after(added)
+    end
+    return added
+  end
+
+  if not batch.zadds[key] then
+    batch.zadds[key] = {}
+    batch.after[key] = after
+    table.insert(batch.keys, key)
+  end
+  table.insert(batch.zadds[key], score)
+  table.insert(batch.zadds[key], member)
+end
+
+-- Increment `field` of the hash `key` by `increment`, and then call `created`
+-- (if provided) if that's what created the field. In a batch, the increments
+-- to each field are summed and made once the batch closes, and only the first
+-- `created` given for each key is called, at most once.
+function Qless.hincrby(key, field, increment, created)
+  local batch = Qless.batching
+  if not batch then
+    local value = redis.call('hincrby', key, field, increment)
+    if created and value == increment then
+      created()
+    end
+    return value
+  end
+
+  local counters = batch.counters[key]
+  if not counters then
+    counters = {}
+    batch.counters[key] = counters
+  end
+  batch.created[key] = batch.created[key] or created
+  if not counters[field] then
+    counters[field] = 0
+    table.insert(batch.fields, {key, field})
+  end
+  counters[field] = counters[field] + increment
+end
+
+-- Call `func` now, or if in a batch, once the batch closes. Only the first
+-- function deferred under each name is called.
+function Qless.defer(name, func)
+  local batch = Qless.batching
+  if not batch then
+    return func()
+  end
+
+  if not batch.deferred[name] then
+    batch.deferred[name] = func
+    table.insert(batch.names, name)
+  end
+end
+
+-- Return the result of `func`, which in a batch is only called the first time
+-- that `name` is asked for
+function Qless.memo(name, func)
+  local batch = Qless.batching
+  if not batch then
+    return func()
+  end
+
+  if batch.memos[name] == nil then
+    batch.memos[name] = func()
+  end
+  return batch.memos[name]
+end
+
+-- Return whether the job is tracked. In a batch, we don't bother looking each
+-- job up if none are tracked
+function Qless.tracked(jid)
+  if Qless.batching and not Qless.memo('tracking', function()
+    return redis.call('zcard', 'ql:tracked') > 0
+  end) then
+    return false
+  end
+  return redis.call('zscore', 'ql:tracked', jid) ~= false
+end
+
+-- Call `func` with each of `specs` in a single batch, and return an outcome
+-- for each one, in order. An outcome is either what `func` returned or the
+-- error that it raised, along with the jid of the spec:
+--
+--  [{'jid': 'jid', 'result': ...}, {'jid': 'other', 'error': '...'}, ...]
+--
+-- A spec is either a jid or a table with a `jid`. Errors are given without the
+-- script name and line number that Lua puts in front of them.
+function Qless.outcomes(specs, func)
+  return Qless.batch(function()
+    local outcomes = {}
+    for _, spec in ipairs(specs) do
+      local ok, result = pcall(func, spec)
+      local jid = spec
+      if type(spec) == 'table' then
+        jid = spec.jid
+      end
+      if ok then
+        table.insert(outcomes, {jid = jid, result = result})
+      else
+        -- Errors from redis.call come back as tables, and those raised in the
+        -- script are prefixed with where they were raised, like
+        -- 'user_script:123: ', which means nothing to clients
+        if type(result) == 'table' then
+          result = result.err
+        end
+        result = string.gsub(tostring(result), '^@?[%w_]+:%d+: ', '')
+        table.insert(outcomes, {jid = jid, error = result})
+      end
+    end
+    return outcomes
+  end)
+end
+
+-- Return a job object given its job id
+function Qless.job(jid)
+  assert(jid, 'Job(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessJob)
+  job.jid = jid
+  return job
+end
+
+-- Return a recurring job object
+function Qless.recurring(jid)
+  assert(jid, 'Recurring(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessRecurringJob)
+  job.jid = jid
+  return job
+end
+
+-- Return a resource object
+function Qless.resource(rid)
+  assert(rid, 'Resource(): no rid provided')
+  local res = {}
+  setmetatable(res, QlessResource)
+  res.rid = rid
+  return res
+end
+
+-- Failed([group, [start, [limit]]])
+-- ------------------------------------
+-- If no group is provided, this returns a JSON blob of the counts of the
+-- various groups of failures known. If a group is provided, it will report up
+-- to `limit` from `start` of the jobs affected by that issue.
+--
+--  # If no group, then...
+--  {
+--      'group1': 1,
+--      'group2': 5,
+--      ...
+--  }
+--
+--  # If a group is provided, then...
+--  {
+--      'total': 20,
+--      'jobs': [
+--          {
+--              # All the normal keys for a job
+--              'jid': ...,
+--              'data': ...
+--              # The message for this particular instance
+--              'message': ...,
+--              'group': ...,
+--          }, ...
+--      ]
+--  }
+--
+function Qless.failed(group, start, limit)
+  start = assert(tonumber(start or 0),
+    'Failed(): Arg "start" is not a number: ' .. (start or 'nil'))
+  limit = assert(tonumber(limit or 25),
+    'Failed(): Arg "limit" is not a number: ' .. (limit or 'nil'))
+
+  if group then
+    -- If a group was provided, then we should do paginated lookup
+    return {
+      total = redis.call('llen', 'ql:f:' .. group),
+      jobs  = redis.call('lrange', 'ql:f:' .. group, start, start + limit - 1)
+    }
+  else
+    -- Otherwise, we should just list all the known failure groups we have
+    local response = {}
+    local groups = redis.call('smembers', 'ql:failures')
+    for index, group in ipairs(groups) do
+      response[group] = redis.call('llen', 'ql:f:' .. group)
+    end
+    return response
+  end
+end
+
+-- Jobs(now, 'complete', [offset, [count]])
+-- Jobs(now, (
+--          'stalled' | 'running' | 'scheduled' | 'depends', 'recurring'
+--      ), queue, [offset, [count]])
+-------------------------------------------------------------------------------
+-- Return all the job ids currently considered to be in the provided state
+-- in a particular queue. The response is a list of job ids:
+--
+--  [
+--      jid1,
+--      jid2,
+--      ...
+--  ]
+function Qless.jobs(now, state, ...)
+  assert(state, 'Jobs(): Arg "state" missing')
+  if state == 'complete' then
+    local offset = assert(tonumber(arg[1] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrange', 'ql:completed', offset,
+      offset + count - 1)
+  else
+    local name  = assert(arg[1], 'Jobs(): Arg "queue" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[3]))
+
+    local queue = Qless.queue(name)
+    if state == 'running' then
+      return queue.locks.peek(now, offset, count)
+    elseif state == 'stalled' then
+      return queue.locks.expired(now, offset, count)
+    elseif state == 'waiting' then
+      return queue.work.peek(now, offset, count)
+    elseif state == 'scheduled' then
+      queue:check_scheduled(now, queue.scheduled.length())
+      return queue.scheduled.peek(now, offset, count)
+    elseif state == 'depends' then
+      return queue.depends.peek(now, offset, count)
+    elseif state == 'recurring' then
+      return queue.recurring.peek('+inf', offset, count)
+    else
+      error('Jobs(): Unknown type "' .. state .. '"')
+    end
+  end
+end
+
+-- Track()
+-- Track(now, ('track' | 'untrack'), jid)
+-- ------------------------------------------
+-- If no arguments are provided, it returns details of all currently-tracked
+-- jobs. If the first argument is 'track', then it will start tracking the job
+-- associated with that id, and 'untrack' stops tracking it. In this context,
+-- tracking is nothing more than saving the job to a list of jobs that are
+-- considered special.
+--
+--  {
+--      'jobs': [
+--          {
+--              'jid': ...,
+--              # All the other details you'd get from 'get'
+--          }, {
+--              ...
+--          }
+--      ], 'expired': [
+--          # These are all the jids that are completed and whose data expired
+--          'deadbeef',
+--          ...,
+--          ...,
+--      ]
+--  }
+--
+function Qless.track(now, command, jid)
+  if command ~= nil then
+    assert(jid, 'Track(): Arg "jid" missing')
+    -- Verify that job exists
+    assert(Qless.job(jid):exists(), 'Track(): Job does not exist')
+    if string.lower(command) == 'track' then
+      Qless.publish('track', jid)
+      return redis.call('zadd', 'ql:tracked', now, jid)
+    elseif string.lower(command) == 'untrack' then
+      Qless.publish('untrack', jid)
+      return redis.call('zrem', 'ql:tracked', jid)
+    else
+      error('Track(): Unknown action "' .. command .. '"')
+    end
+  else
+    local response = {
+      jobs = {},
+      expired = {}
+    }
+    local jids = redis.call('zrange', 'ql:tracked', 0, -1)
+    for index, jid in ipairs(jids) do
+      local data = Qless.job(jid):data()
+      if data then
+        table.insert(response.jobs, data)
+      else
+        table.insert(response.expired, jid)
+      end
+    end
+    return response
+  end
+end
+
+-- tag(now, ('add' | 'remove'), jid, tag, [tag, ...])
+-- tag(now, 'get', tag, [offset, [count]])
+-- tag(now, 'top', [offset, [count]])
+-- -----------------------------------------------------------------------------
+-- Accepts a jid, 'add' or 'remove', and then a list of tags
+-- to either add or remove from the job. Alternatively, 'get',
+-- a tag to get jobs associated with that tag, and offset and
+-- count
+--
+-- If 'add' or 'remove', the response is a list of the jobs
+-- current tags, or False if the job doesn't exist. If 'get',
+-- the response is of the form:
+--
+--  {
+--      total: ...,
+--      jobs: [
+--          jid,
+--          ...
+--      ]
+--  }
+--
+-- If 'top' is supplied, it returns the most commonly-used tags
+-- in a paginated fashion.
+function Qless.tag(now, command, ...)
+  assert(command,
+    'Tag(): Arg "command" must be "add", "remove", "get" or "top"')
+
+  if command == 'add' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local state, tags = unpack(Qless.job(jid):fields('state', 'tags'))
+    -- If the job has been canceled / deleted, then return false
+    if state then
+      -- Decode the json blob, convert to dictionary
+      tags = Qless.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      -- Otherwise, add the job to the sorted set with that tags
+      for i=2,#arg do
+        local tag = arg[i]
+        if _tags[tag] == nil or _tags[tag] == false then
+          _tags[tag] = true
+          table.insert(tags, tag)
+        end
+        redis.call('zadd', 'ql:t:' .. tag, now, jid)
+        redis.call('zincrby', 'ql:tags', 1, tag)
+      end
+
+      Qless.job(jid):update({tags = Qless.encode(tags)})
+      return tags
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'remove' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local state, tags = unpack(Qless.job(jid):fields('state', 'tags'))
+    -- If the job has been canceled / deleted, then return false
+    if state then
+      -- Decode the json blob, convert to dictionary
+      tags = Qless.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      -- Otherwise, add the job to the sorted set with that tags
+      for i=2,#arg do
+        local tag = arg[i]
+        _tags[tag] = nil
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+
+      local results = {}
+      for i,tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+
+      Qless.job(jid):update({tags = Qless.encode(results)})
+      return results
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'get' then
+    local tag    = assert(arg[1], 'Tag(): Arg "tag" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Tag(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Tag(): Arg "count" not a number: ' .. tostring(arg[3]))
+    return {
+      total = redis.call('zcard', 'ql:t:' .. tag),
+      jobs  = redis.call('zrange', 'ql:t:' .. tag, offset, offset + count - 1)
+    }
+  elseif command == 'top' then
+    local offset = assert(tonumber(arg[1] or 0) , 'Tag(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25), 'Tag(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrangebyscore', 'ql:tags', '+inf', 2, 'limit', offset, count)
+  else
+    error('Tag(): First argument must be "add", "remove" or "get"')
+  end
+end
+
+-- Gc(now, budget)
+-- ---------------
+-- Delete the data of up to `budget` completed jobs that have outlived the
+-- retention policy, oldest first: first those older than `jobs-history`
+-- seconds, and then those beyond the most recent `jobs-history-count`. Any
+-- that are left over are deleted by later calls, so the cost of a call is
+-- bounded no matter how far behind the policy we are. `complete` calls this
+-- with a budget of `gc-budget` (10 by default), but it may also be invoked on
+-- its own. Returns the number of jobs deleted.
+function Qless.gc(now, budget)
+  budget = assert(tonumber(budget),
+    'Gc(): Arg "budget" missing or not a number: ' .. tostring(budget))
+  if budget <= 0 then
+    return 0
+  end
+
+  local count = Qless.config.get('jobs-history-count')
+  local time  = Qless.config.get('jobs-history')
+
+  -- Remove every trace of a completed job
+  local expire = function(jids)
+    for index, jid in ipairs(jids) do
+      local tags = Qless.decode(
+        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+      for i, tag in ipairs(tags) do
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+      redis.call('del', QlessJob.ns .. jid)
+      redis.call('del', QlessJob.ns .. jid .. '-history')
+    end
+  end
+
+  -- Now look at the expired job data. First, based on the current time
+  local jids = redis.call('zrangebyscore', 'ql:completed', 0, now - time,
+    'LIMIT', 0, budget)
+  expire(jids)
+  -- And now remove those from the queued-for-cleanup queue
+  if #jids > 0 then
+    redis.call('zremrangebyrank', 'ql:completed', 0, #jids - 1)
+  end
+  local deleted = #jids
+
+  -- Now take the all by the most recent 'count' ids
+  local excess = math.min(
+    redis.call('zcard', 'ql:completed') - count, budget - deleted)
+  if excess > 0 then
+    jids = redis.call('zrange', 'ql:completed', 0, excess - 1)
+    expire(jids)
+    redis.call('zremrangebyrank', 'ql:completed', 0, excess - 1)
+    deleted = deleted + excess
+  end
+  return deleted
+end
+
+-- Cancel(...)
+-- --------------
+-- Cancel a job from taking place. It will be deleted from the system, and any
+-- attempts to renew a heartbeat will fail, and any attempts to complete it
+-- will fail. If you try to get the data on the object, you will get nothing.
+function Qless.cancel(now, ...)
+  -- Dependents is a mapping of a job to its dependent jids
+  local dependents = {}
+  for _, jid in ipairs(arg) do
+    dependents[jid] = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependents') or {}
+  end
+
+  -- Now, we'll loop through every jid we intend to cancel, and we'll go
+  -- make sure that this operation will be ok
+  for i, jid in ipairs(arg) do
+    for j, dep in ipairs(dependents[jid]) do
+      if dependents[dep] == nil or dependents[dep] == false then
+        error('Cancel(): ' .. jid .. ' is a dependency of ' .. dep ..
+           ' but is not mentioned to be canceled')
+      end
+    end
+  end
+
+  local cancelled_jids = {}
+
+  -- If we've made it this far, then we are good to go. We can now just
+  -- remove any trace of all these jobs, as they form a dependent clique
+  for _, jid in ipairs(arg) do
+    -- Find any stage it's associated with and remove its from that stage
+    local state, queue, failure, worker, unique = unpack(Qless.job(jid):fields(
+      'state', 'queue', 'failure', 'worker', 'unique'))
+
+    if state ~= false and state ~= 'complete' then
+      table.insert(cancelled_jids, jid)
+
+      -- Send a message out on the appropriate channels
+      local encoded = cjson.encode({
+        jid    = jid,
+        worker = worker,
+        event  = 'canceled',
+        queue  = queue
+      })
+      Qless.publish('log', encoded)
+
+      -- Remove this job from whatever worker has it, if any
+      if worker and (worker ~= '') then
+        redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+        -- If necessary, send a message to the appropriate worker, too
+        Qless.publish('w:' .. worker, encoded)
+      end
+
+      -- Remove it from that queue
+      if queue then
+        local queue = Qless.queue(queue)
+        queue.work.remove(jid)
+        queue.locks.remove(jid)
+        queue.scheduled.remove(jid)
+        queue.depends.remove(jid)
+        if unique then
+          queue:release_unique(unique, jid)
+        end
+      end
+
+      Qless.job(jid):release_resources(now)
+
+      -- We should probably go through all our dependencies and remove
+      -- ourselves from the list of dependents
+      for i, j in ipairs(redis.call(
+        'smembers', QlessJob.ns .. jid .. '-dependencies')) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', jid)
+      end
+
+      -- Delete any notion of dependencies it has
+      redis.call('del', QlessJob.ns .. jid .. '-dependencies')
+
+      -- If we're in the failed state, remove all of our data
+      if state == 'failed' then
+        failure = Qless.decode(failure)
+        -- We need to make this remove it from the failed queues
+        redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
+        if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
+          redis.call('srem', 'ql:failures', failure.group)
+        end
+        -- Remove one count from the failed count of the particular
+        -- queue
+        Qless.queue(queue):tally(now, 'failed', -1, failure.when)
+      end
+
+      -- Remove it as a job that's tagged with this particular tag
+      local tags = Qless.decode(
+        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+      for i, tag in ipairs(tags) do
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+
+      -- If the job was being tracked, we should notify
+      if redis.call('zscore', 'ql:tracked', jid) ~= false then
+        Qless.publish('canceled', jid)
+      end
+
+      -- Just go ahead and delete our data
+      redis.call('del', QlessJob.ns .. jid)
+      redis.call('del', QlessJob.ns .. jid .. '-history')
+    end
+  end
+
+  return cancelled_jids
+end
+
+local Set = {}
+
+function Set.new (t)
+  local set = {}
+  for _, l in ipairs(t) do set[l] = true end
+  return set
+end
+
+function Set.union (a,b)
+  local res = Set.new{}
+  for k in pairs(a) do res[k] = true end
+  for k in pairs(b) do res[k] = true end
+  return res
+end
+
+function Set.intersection (a,b)
+  local res = Set.new{}
+  for k in pairs(a) do
+    res[k] = b[k]
+  end
+  return res
+end
+
+function Set.diff(a,b)
+  local res = Set.new{}
+  for k in pairs(a) do
+    if not b[k] then res[k] = true end
+  end
+
+  return res
+end
+-------------------------------------------------------------------------------
+-- Configuration interactions
+-------------------------------------------------------------------------------
+
+-- This represents our default configuration settings
+Qless.config.defaults = {
+  ['application']           = 'qless',
+  ['heartbeat']             = 60,
+  ['grace-period']          = 10,
+  ['stats-history']         = 30,
+  ['histogram-history']     = 7,
+  ['jobs-history-count']    = 50000,
+  ['jobs-history']          = 604800,
+  ['gc-budget']             = 10,
+  ['resource-grant-budget'] = 100,
+  ['minute-stats-history']  = 21600,
+  ['hour-stats-history']    = 604800,
+  ['storage-format']        = 'json'
+}
+
+-- The contents of `ql:config`, read at most once per invocation of the script.
+-- `snapshot` holds the values as they're stored, and `typed` the same values
+-- with those that are numbers converted to numbers, which is what lookups are
+-- served from. Both are kept up to date by set and unset.
+Qless.config.snapshot = nil
+Qless.config.typed = nil
+
+-- Return the snapshot of the stored configuration, loading it if need be
+Qless.config.stored = function()
+  if Qless.config.snapshot == nil then
+    -- Inspired by redis-lua https://github.com/nrk/redis-lua/blob/version-2.0/src/redis.lua
+    local snapshot, typed = {}, {}
+    local reply = redis.call('hgetall', 'ql:config')
+    for i = 1, #reply, 2 do
+      snapshot[reply[i]] = reply[i + 1]
+      typed[reply[i]] = tonumber(reply[i + 1]) or reply[i + 1]
+    end
+    Qless.config.snapshot = snapshot
+    Qless.config.typed = typed
+  end
+  return Qless.config.snapshot
+end
+
+-- Get one of the keys, converted to a number if it is one, or all of them as
+-- they're stored
+Qless.config.get = function(key, default)
+  local stored = Qless.config.stored()
+  if key then
+    return Qless.config.typed[key] or Qless.config.defaults[key] or default
+  else
+    local response = {}
+    for option, value in pairs(Qless.config.defaults) do
+      response[option] = value
+    end
+    for option, value in pairs(stored) do
+      response[option] = value
+    end
+    return response
+  end
+end
+
+-- Set a configuration variable
+Qless.config.set = function(option, value)
+  assert(option, 'config.set(): Arg "option" missing')
+  assert(value , 'config.set(): Arg "value" missing')
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    event  = 'config_set',
+    option = option,
+    value  = value
+  }))
+
+  redis.call('hset', 'ql:config', option, value)
+  if Qless.config.snapshot then
+    Qless.config.snapshot[option] = tostring(value)
+    Qless.config.typed[option] = tonumber(value) or tostring(value)
+  end
+end
+
+-- Unset a configuration option
+Qless.config.unset = function(option)
+  assert(option, 'config.unset(): Arg "option" missing')
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    event  = 'config_unset',
+    option = option
+  }))
+
+  redis.call('hdel', 'ql:config', option)
+  if Qless.config.snapshot then
+    Qless.config.snapshot[option] = nil
+    Qless.config.typed[option] = nil
+  end
+end
+-------------------------------------------------------------------------------
+-- Job Class
+--
+-- It returns an object that represents the job with the provided JID
+-------------------------------------------------------------------------------
+
+-- Each attribute reported by data(), along with the field of the job's hash
+-- that backs it (if any) and how to decode that field
+QlessJob.attributes = {
+  jid              = {field = 'jid'},
+  klass            = {field = 'klass'},
+  state            = {field = 'state'},
+  queue            = {field = 'queue'},
+  worker           = {field = 'worker', read = function(job, value)
+    return value or ''
+  end},
+  tracked          = {read = function(job)
+    return redis.call('zscore', 'ql:tracked', job.jid) ~= false
+  end},
+  priority         = {field = 'priority', read = function(job, value)
+    return tonumber(value)
+  end},
+  expires          = {field = 'expires', read = function(job, value)
+    return tonumber(value) or 0
+  end},
+  retries          = {field = 'retries', read = function(job, value)
+    return tonumber(value)
+  end},
+  remaining        = {field = 'remaining', read = function(job, value)
+    return math.floor(tonumber(value))
+  end},
+  data             = {field = 'data'},
+  tags             = {field = 'tags', read = function(job, value)
+    return Qless.decode(value)
+  end},
+  history          = {read = function(job)
+    return job:history()
+  end},
+  failure          = {field = 'failure', read = function(job, value)
+    return Qless.decode(value or '{}')
+  end},
+  resources        = {field = 'resources', read = function(job, value)
+    -- Resources that some units are needed of are given as an object mapping
+    -- each resource to the number needed, as they were declared
+    local resources = Qless.decode(value or '[]')
+    if #resources == 0 then
+      return resources
+    end
+    local weights = job:weights()
+    if next(weights) == nil then
+      return resources
+    end
+    local declared = {}
+    for _, rid in ipairs(resources) do
+      declared[rid] = weights[rid] or 1
+    end
+    return declared
+  end},
+  result_data      = {field = 'result_data', read = function(job, value)
+    return cjson.decode(value or '{}')
+  end},
+  interval         = {field = 'throttle_interval', read = function(job, value)
+    return tonumber(value) or 0
+  end},
+  dependents       = {read = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependents')
+  end},
+  dependencies     = {read = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependencies')
+  end},
+  spawned_from_jid = {field = 'spawned_from_jid'}
+}
+
+-- The values that a job's hash leaves out, rather than storing, for fields that
+-- most jobs never change. They're filled back in when the job is read.
+QlessJob.defaults = {
+  worker            = '',
+  expires           = '0',
+  tags              = '{}',
+  resources         = '[]',
+  weights           = '{}',
+  failure           = '{}',
+  result_data       = '{}',
+  throttle_interval = '0',
+  throttle_next_run = '0'
+}
+
+-- The ways an empty list or object may be encoded, in JSON or msgpack
+QlessJob.empty = Set.new({'{}', '[]', '\144', '\128'})
+
+-- Whether or not `value` is the default for `field`, and so need not be stored
+function QlessJob.default(field, value)
+  local default = QlessJob.defaults[field]
+  if default == nil then
+    return false
+  end
+  value = tostring(value)
+  return value == default or
+    ((default == '{}' or default == '[]') and QlessJob.empty[value] == true)
+end
+
+-- Named projections that can be requested in place of a list of attributes.
+-- The 'full' profile is every attribute.
+QlessJob.profiles = {
+  worker = {'jid', 'klass', 'state', 'queue', 'worker', 'priority', 'expires',
+    'retries', 'remaining', 'data'},
+  ui     = {'jid', 'klass', 'state', 'queue', 'worker', 'tracked', 'priority',
+    'expires', 'retries', 'remaining', 'tags', 'failure', 'resources',
+    'interval', 'spawned_from_jid'}
+}
+
+-- Projection(fields)
+-- ------------------
+-- Turn the `fields` argument clients provide into a list of attributes. It may
+-- be the name of a profile ('worker', 'ui' or 'full') or a JSON array of
+-- attribute names. Returns nil if every attribute is wanted.
+function QlessJob.projection(fields)
+  if fields == nil or fields == '' or fields == 'full' then
+    return nil
+  elseif QlessJob.profiles[fields] then
+    return QlessJob.profiles[fields]
+  end
+
+  local ok, decoded = pcall(cjson.decode, fields)
+  if not ok or type(decoded) ~= 'table' or
+    (#decoded == 0 and next(decoded) ~= nil) then
+    error('Projection(): Arg "fields" not a profile or JSON array: ' ..
+      tostring(fields))
+  end
+  for _, key in ipairs(decoded) do
+    if QlessJob.attributes[key] == nil then
+      error('Projection(): Unknown field "' .. tostring(key) .. '"')
+    end
+  end
+  return decoded
+end
+
+-- This gets the requested attributes of the job with the provided id, reading
+-- only the parts of the job needed to produce them. If `fields` is nil, then
+-- every attribute is returned. If the job is not found, it returns nil.
+function QlessJob:project(fields)
+  if fields == nil then
+    fields = {}
+    for key in pairs(QlessJob.attributes) do table.insert(fields, key) end
+  end
+
+  -- The jid is always fetched, since it tells us whether the job exists
+  local keys = {'jid'}
+  for _, key in ipairs(fields) do
+    local attribute = assert(QlessJob.attributes[key],
+      'Project(): Unknown field "' .. tostring(key) .. '"')
+    if attribute.field and attribute.field ~= 'jid' then
+      table.insert(keys, attribute.field)
+    end
+  end
+
+  local values = redis.call('hmget', QlessJob.ns .. self.jid, unpack(keys))
+
+  -- Return nil if we haven't found it
+  if not values[1] then
+    return nil
+  end
+
+  local job = {}
+  for index, key in ipairs(keys) do
+    job[key] = values[index] or QlessJob.defaults[key] or false
+  end
+
+  local data = {}
+  for _, key in ipairs(fields) do
+    local attribute = QlessJob.attributes[key]
+    local value = attribute.field and job[attribute.field]
+    if attribute.read then
+      data[key] = attribute.read(self, value)
+    else
+      data[key] = value
+    end
+  end
+  return data
+end
+
+-- This gets all the data associated with the job with the provided id. If the
+-- job is not found, it returns nil. If found, it returns an object with the
+-- appropriate properties. If particular attributes are named, then only those
+-- are fetched, and they're returned as a list in the order they were named.
+function QlessJob:data(...)
+  if #arg > 0 then
+    local data = self:project(arg)
+    if not data then
+      return nil
+    end
+
+    local response = {}
+    for index, key in ipairs(arg) do
+      table.insert(response, data[key])
+    end
+    return response
+  else
+    return self:project()
+  end
+end
+
+-- Complete a job and optionally put it in another queue, either scheduled or
+-- to be considered waiting immediately. It can also optionally accept other
+-- jids on which this job will be considered dependent before it's considered
+-- valid.
+--
+-- The variable-length arguments may be pairs of the form:
+--
+--      ('next'   , queue) : The queue to advance it to next
+--      ('delay'  , delay) : The delay for the next queue
+--      ('depends',        : Json of jobs it depends on in the new queue
+--          '["jid1", "jid2", ...]')
+---
+function QlessJob:complete(now, worker, queue, data, ...)
+  assert(worker, 'Complete(): Arg "worker" missing')
+  assert(queue , 'Complete(): Arg "queue" missing')
+  if data then
+    assert(cjson.decode(data), 'Complete(): Arg "data" not JSON: ' .. tostring(data))
+  end
+
+  -- Read in all the optional parameters
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  -- Sanity check on optional args
+  local nextq   = options['next']
+  local delay   = assert(tonumber(options['delay'] or 0))
+  local depends = assert(cjson.decode(options['depends'] or '[]'),
+    'Complete(): Arg "depends" not JSON: ' .. tostring(options['depends']))
+
+  local result_data = options['result_data']
+
+  -- Depends doesn't make sense without nextq
+  if options['delay'] and nextq == nil then
+    error('Complete(): "delay" cannot be used without a "next".')
+  end
+
+  -- Depends doesn't make sense without nextq
+  if options['depends'] and nextq == nil then
+    error('Complete(): "depends" cannot be used without a "next".')
+  end
+
+  -- The bin is midnight of the provided day
+  -- 24 * 60 * 60 = 86400
+  local bin = now - (now % 86400)
+
+  -- First things first, we should see if the worker still owns this job
+  local lastworker, state, priority, retries, current_queue, interval = unpack(
+    self:fields('worker', 'state', 'priority', 'retries', 'queue',
+      'throttle_interval'))
+
+  if state == false then
+    error('Complete(): Job ' .. self.jid .. ' does not exist')
+  elseif (state ~= 'running') then
+    error('Complete(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif lastworker ~= worker then
+    error('Complete(): Job ' .. self.jid ..
+      ' has been handed out to another worker: ' .. tostring(lastworker))
+  elseif queue ~= current_queue then
+    error('Complete(): Job ' .. self.jid .. ' running in another queue: ' ..
+      tostring(current_queue))
+  end
+
+  -- Throttled jobs may not be run again until their interval has passed
+  local next_run = 0
+  if tonumber(interval) > 0 then
+    next_run = now + tonumber(interval)
+  end
+
+  -- Now we can assume that the worker does own the job. We need to
+  --    1) Remove the job from the 'locks' from the old queue
+  --    2) Enqueue it in the next stage if necessary
+  --    3) Update the data
+  --    4) Mark the job as completed, remove the worker, remove expires, and
+  --          update history
+  self:history(now, 'done')
+
+  if data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', data)
+  end
+
+  if result_data then
+    self:update({result_data = result_data})
+  end
+
+  -- Remove the job from the previous queue
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+  queue_obj:record(now, 'complete')
+
+  self:release_resources(now)
+
+  ----------------------------------------------------------
+  -- This is the massive stats update that we have to do
+  ----------------------------------------------------------
+  -- This is how long we've been waiting to get popped
+  -- local waiting = math.floor(now) - history[#history]['popped']
+  local time = tonumber(
+    redis.call('hget', QlessJob.ns .. self.jid, 'time') or now)
+  local waiting = now - time
+  Qless.queue(queue):stat(now, 'run', waiting)
+  QlessWorker.stat(now, worker, waiting)
+  redis.call('hset', QlessJob.ns .. self.jid,
+    'time', Qless.time(now))
+
+  -- Remove this job from the jobs that the worker that was running it has
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  if Qless.tracked(self.jid) then
+    Qless.publish('completed', self.jid)
+  end
+
+  if nextq then
+    queue_obj = Qless.queue(nextq)
+    -- Send a message out to log
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'advanced',
+      queue = queue,
+      to    = nextq
+    }))
+
+    -- Enqueue the job
+    self:history(now, 'put', {q = nextq})
+
+    -- We're going to make sure that this queue is in the
+    -- set of known queues
+    Qless.defer('known:' .. nextq, function()
+      if redis.call('zscore', 'ql:queues', nextq) == false then
+        redis.call('zadd', 'ql:queues', now, nextq)
+      end
+    end)
+
+    self:update({
+      state     = 'waiting',
+      worker    = '',
+      failure   = '{}',
+      queue     = nextq,
+      expires   = 0,
+      remaining = tonumber(retries)
+    })
+
+    if (delay > 0) and (#depends == 0) then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      return 'scheduled'
+    else
+      -- These are the jids we legitimately have to wait on
+      if self:add_dependencies(depends) > 0 then
+        queue_obj.depends.add(now, self.jid)
+        redis.call('hset', QlessJob.ns .. self.jid, 'state', 'depends')
+        if delay > 0 then
+          -- We've already put it in 'depends'. Now, we must just save the data
+          -- for when it's scheduled
+          queue_obj.depends.add(now, self.jid)
+          redis.call('hset', QlessJob.ns .. self.jid, 'scheduled', now + delay)
+        end
+        return 'depends'
+      else
+        if self:acquire_resources(now) then
+          queue_obj.work.add(now, priority, self.jid)
+        end
+        return 'waiting'
+      end
+    end
+  else
+    -- Send a message out to log
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'completed',
+      queue = queue
+    }))
+
+    self:update({
+      state             = 'complete',
+      worker            = '',
+      failure           = '{}',
+      queue             = '',
+      expires           = 0,
+      remaining         = tonumber(retries),
+      throttle_next_run = next_run
+    })
+
+    -- Schedule this job for destructination eventually, and do the
+    -- completion dance
+    Qless.zadd('ql:completed', now, self.jid)
+    Qless.defer('gc', function()
+      Qless.gc(now, Qless.config.get('gc-budget'))
+    end)
+
+    -- Alright, if this has any dependents, then we should go ahead
+    -- and unstick those guys.
+    local resolved = {}
+    for i, j in ipairs(redis.call(
+      'smembers', QlessJob.ns .. self.jid .. '-dependents')) do
+      if Qless.job(j):remove_dependency(self.jid) == 0 then
+        table.insert(resolved, j)
+      end
+    end
+    QlessJob.resolve(now, resolved)
+
+    -- Delete our dependents key
+    redis.call('del', QlessJob.ns .. self.jid .. '-dependents')
+
+    return 'complete'
+  end
+end
+
+-- Complete_many(now, worker, queue, jobs)
+-- ---------------------------------------
+-- Complete several of the jobs `worker` is running in `queue` at once. `jobs`
+-- is a JSON array whose items are either jids, or objects with a `jid` and
+-- any of the optional arguments that `complete` accepts:
+--
+--  ['jid', {'jid': 'other', 'data': {...}, 'next': 'queue', 'delay': 10}]
+--
+-- Each job is checked and completed on its own, but stats, retention and log
+-- messages are all dealt with once for the whole lot. Returns an outcome for
+-- each job, as described in Qless.outcomes.
+function QlessJob.complete_many(now, worker, queue, jobs)
+  jobs = assert(cjson.decode(jobs or '[]'),
+    'Complete_many(): Arg "jobs" not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Complete_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  return Qless.outcomes(jobs, function(spec)
+    if type(spec) ~= 'table' then
+      return Qless.job(spec):complete(now, worker, queue)
+    end
+
+    local data = spec.data
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+    local options = {}
+    for _, key in ipairs({'next', 'delay', 'depends', 'result_data'}) do
+      local value = spec[key]
+      if value ~= nil then
+        if type(value) == 'table' then
+          value = cjson.encode(value)
+        end
+        table.insert(options, key)
+        table.insert(options, value)
+      end
+    end
+    return Qless.job(spec.jid):complete(
+      now, worker, queue, data, unpack(options))
+  end)
+end
+
+-- Fail(now, worker, group, message, [data])
+-- -------------------------------------------------
+-- Mark the particular job as failed, with the provided group, and a more
+-- specific message. By `group`, we mean some phrase that might be one of
+-- several categorical modes of failure. The `message` is something more
+-- job-specific, like perhaps a traceback.
+--
+-- This method should __not__ be used to note that a job has been dropped or
+-- has failed in a transient way. This method __should__ be used to note that
+-- a job has something really wrong with it that must be remedied.
+--
+-- The motivation behind the `group` is so that similar errors can be grouped
+-- together. Optionally, updated data can be provided for the job. A job in
+-- any state can be marked as failed. If it has been given to a worker as a
+-- job, then its subsequent requests to heartbeat or complete that job will
+-- fail. Failed jobs are kept until they are canceled or completed.
+--
+-- __Returns__ the id of the failed job if successful, or `False` on failure.
+--
+-- Args:
+--    1) jid
+--    2) worker
+--    3) group
+--    4) message
+--    5) the current time
+--    6) [data]
+function QlessJob:fail(now, worker, group, message, data)
+  local worker  = assert(worker           , 'Fail(): Arg "worker" missing')
+  local group   = assert(group            , 'Fail(): Arg "group" missing')
+  local message = assert(message          , 'Fail(): Arg "message" missing')
+
+  if data then
+    assert(cjson.decode(data), 'Fail(): Arg "data" not JSON: ' .. tostring(data))
+  end
+
+  -- First things first, we should get the history
+  local queue, state, oldworker = unpack(redis.call(
+    'hmget', QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+
+  -- If the job has been completed, we cannot fail it
+  if not state then
+    error('Fail(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Fail(): Job ' .. self.jid .. ' not currently running: ' .. state)
+  elseif worker ~= oldworker then
+    error('Fail(): Job ' .. self.jid .. ' running with another worker: ' ..
+      oldworker)
+  end
+
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    jid     = self.jid,
+    event   = 'failed',
+    worker  = worker,
+    group   = group,
+    message = message
+  }))
+
+  if Qless.tracked(self.jid) then
+    Qless.publish('failed', self.jid)
+  end
+
+  -- Remove this job from the jobs that the worker that was running it has
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  -- Now, take the element of the history for which our provided worker is
+  -- the worker, and update 'failed'
+  self:history(now, 'failed', {worker = worker, group = group})
+
+  -- Increment the number of failures for that queue for the
+  -- given day.
+  local queue_obj = Qless.queue(queue)
+  queue_obj:tally(now, 'failures', 1)
+  queue_obj:tally(now, 'failed'  , 1)
+  queue_obj:record(now, 'fail')
+  QlessWorker.tally(now, worker, 'failed', 1)
+
+  -- Now remove the instance from the schedule, and work queues for the
+  -- queue it's in
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+
+  -- release any resource locks the job might have
+  self:release_resources(now)
+
+  -- The reason that this appears here is that the above will fail if the
+  -- job doesn't exist
+  if data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', data)
+  end
+
+  self:update({
+    state   = 'failed',
+    worker  = '',
+    expires = 0,
+    failure = Qless.encode({
+      ['group']   = group,
+      ['message'] = message,
+      ['when']    = math.floor(now),
+      ['worker']  = worker
+    })
+  })
+
+  -- Add this group of failure to the list of failures
+  redis.call('sadd', 'ql:failures', group)
+  -- And add this particular instance to the failed groups
+  redis.call('lpush', 'ql:f:' .. group, self.jid)
+
+  -- Here is where we'd intcrement stats about the particular stage
+  -- and possibly the workers
+
+  return self.jid
+end
+
+-- Fail_many(now, worker, group, message, jobs)
+-- --------------------------------------------
+-- Fail several of the jobs `worker` is running at once. `jobs` is a JSON array
+-- whose items are either jids, or objects with a `jid` and optionally `data`
+-- and their own `group` and `message`:
+--
+--  ['jid', {'jid': 'other', 'message': 'Timed out', 'data': {...}}]
+--
+-- As with complete_many, stats and log messages are dealt with once for the
+-- whole lot, and an outcome is returned for each job.
+function QlessJob.fail_many(now, worker, group, message, jobs)
+  jobs = assert(cjson.decode(jobs or '[]'),
+    'Fail_many(): Arg "jobs" not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Fail_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  return Qless.outcomes(jobs, function(spec)
+    if type(spec) ~= 'table' then
+      return Qless.job(spec):fail(now, worker, group, message)
+    end
+
+    local data = spec.data
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+    return Qless.job(spec.jid):fail(now, worker,
+      spec.group or group, spec.message or message, data)
+  end)
+end
+
+-- retry(now, queue, worker, [delay, [group, [message]]])
+-- ------------------------------------------
+-- This script accepts jid, queue, worker and delay for retrying a job. This
+-- is similar in functionality to `put`, except that this counts against the
+-- retries a job has for a stage.
+--
+-- Throws an exception if:
+--      - the worker is not the worker with a lock on the job
+--      - the job is not actually running
+--
+-- Otherwise, it returns the number of retries remaining. If the allowed
+-- retries have been exhausted, then it is automatically failed, and a negative
+-- number is returned.
+--
+-- If a group and message is provided, then if the retries are exhausted, then
+-- the provided group and message will be used in place of the default
+-- messaging about retries in the particular queue being exhausted
+function QlessJob:retry(now, queue, worker, delay, group, message)
+  assert(queue , 'Retry(): Arg "queue" missing')
+  assert(worker, 'Retry(): Arg "worker" missing')
+  delay = assert(tonumber(delay or 0),
+    'Retry(): Arg "delay" not a number: ' .. tostring(delay))
+
+  -- Let's see what the old priority, and tags were
+  local oldqueue, state, retries, oldworker, priority, failure = unpack(
+    self:fields('queue', 'state', 'retries', 'worker', 'priority', 'failure'))
+
+  -- If this isn't the worker that owns
+  if state == false then
+    error('Retry(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Retry(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif oldworker ~= worker then
+    error('Retry(): Job ' .. self.jid ..
+      ' has been given to another worker: ' .. oldworker)
+  end
+
+  -- For each of these, decrement their retries. If any of them
+  -- have exhausted their retries, then we should mark them as
+  -- failed.
+  local remaining = tonumber(redis.call(
+    'hincrby', QlessJob.ns .. self.jid, 'remaining', -1))
+  redis.call('hdel', QlessJob.ns .. self.jid, 'grace')
+
+  -- Remove it from the locks key of the old queue
+  Qless.queue(oldqueue).locks.remove(self.jid)
+  Qless.queue(oldqueue):record(now, 'retry')
+  self:release_resources(now)
+
+  -- Remove this job from the worker that was previously working it
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  if remaining < 0 then
+    -- Now remove the instance from the schedule, and work queues for the
+    -- queue it's in
+    local group = group or 'failed-retries-' .. queue
+    self:history(now, 'failed', {['group'] = group})
+
+    self:update({state = 'failed', worker = '', expires = 0})
+    -- If the failure has not already been set, then set it
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', Qless.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    else
+      redis.call('hset', QlessJob.ns .. self.jid,
+      'failure', Qless.encode({
+        ['group']   = group,
+        ['message'] =
+          'Job exhausted retries in queue "' .. oldqueue .. '"',
+        ['when']    = now,
+        ['worker']  = unpack(self:data('worker'))
+      }))
+    end
+
+    -- Add this type of failure to the list of failures
+    redis.call('sadd', 'ql:failures', group)
+    -- And add this particular instance to the failed types
+    redis.call('lpush', 'ql:f:' .. group, self.jid)
+    -- Increment the count of the failed jobs
+    Qless.queue(queue):tally(now, 'failures', 1)
+    Qless.queue(queue):tally(now, 'failed'  , 1)
+    Qless.queue(queue):record(now, 'fail')
+    QlessWorker.tally(now, worker, 'failed', 1)
+  else
+    -- Put it in the queue again with a delay. Like put()
+    local queue_obj = Qless.queue(queue)
+    if delay > 0 then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'scheduled')
+    else
+      if self:acquire_resources(now) then
+        queue_obj.work.add(now, priority, self.jid)
+      end
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
+    end
+
+    -- If a group and a message was provided, then we should save it
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', Qless.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    end
+  end
+
+  return math.floor(remaining)
+end
+
+-- Depends(jid, 'on', [jid, [jid, [...]]]
+-- Depends(jid, 'off', [jid, [jid, [...]]])
+-- Depends(jid, 'off', 'all')
+-------------------------------------------------------------------------------
+-- Add or remove dependencies a job has. If 'on' is provided, the provided
+-- jids are added as dependencies. If 'off' and 'all' are provided, then all
+-- the current dependencies are removed. If 'off' is provided and the next
+-- argument is not 'all', then those jids are removed as dependencies.
+--
+-- If a job is not already in the 'depends' state, then this call will return
+-- false. Otherwise, it will return true
+function QlessJob:depends(now, command, ...)
+  assert(command, 'Depends(): Arg "command" missing')
+  local state = redis.call('hget', QlessJob.ns .. self.jid, 'state')
+  if state ~= 'depends' then
+    error('Depends(): Job ' .. self.jid ..
+      ' not in the depends state: ' .. tostring(state))
+  end
+
+  if command == 'on' then
+    -- These are the jids we legitimately have to wait on
+    self:add_dependencies(arg)
+    return true
+  elseif command == 'off' then
+    if arg[1] == 'all' then
+      for i, j in ipairs(redis.call(
+        'smembers', QlessJob.ns .. self.jid .. '-dependencies')) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+      end
+      redis.call('del', QlessJob.ns .. self.jid .. '-dependencies')
+      redis.call('hdel', QlessJob.ns .. self.jid, 'unresolved')
+      QlessJob.resolve(now, {self.jid})
+    else
+      local unresolved = nil
+      for i, j in ipairs(arg) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+        unresolved = self:remove_dependency(j)
+      end
+      if unresolved == 0 then
+        QlessJob.resolve(now, {self.jid})
+      end
+    end
+    return true
+  else
+    error('Depends(): Argument "command" must be "on" or "off"')
+  end
+end
+
+-- Each job keeps a count of its unresolved dependencies in the 'unresolved'
+-- field of its hash, next to the set of their jids, so that resolving one need
+-- only decrement it to know whether the job is free to run. Jobs whose
+-- dependencies were recorded before the count was kept don't have the field,
+-- and their count is taken from the set.
+
+-- Make this job depend on each of the jobs `jids` that exists and hasn't been
+-- completed, and return the number of its unresolved dependencies. Their
+-- states are read all at once, by sorting a list of them without ordering it
+-- and getting each one's state along the way
+function QlessJob:add_dependencies(jids)
+  if #jids > 0 then
+    local key = QlessJob.ns .. self.jid .. '-candidates'
+    -- Lua's stack limits how many arguments we can unpack at once
+    for i = 1, #jids, 1000 do
+      redis.call('rpush', key, unpack(jids, i, math.min(i + 999, #jids)))
+    end
+    local states = redis.call(
+      'sort', key, 'by', 'nosort', 'get', QlessJob.ns .. '*->state')
+    redis.call('del', key)
+    for i, jid in ipairs(jids) do
+      if states[i] and states[i] ~= 'complete' then
+        self:add_dependency(jid)
+      end
+    end
+  end
+  return self:unresolved()
+end
+
+-- Make this job depend on the job `jid`
+function QlessJob:add_dependency(jid)
+  local key = QlessJob.ns .. self.jid .. '-dependencies'
+  if redis.call('sadd', key, jid) == 1 then
+    redis.call('sadd', QlessJob.ns .. jid .. '-dependents', self.jid)
+    if redis.call('hincrby', QlessJob.ns .. self.jid, 'unresolved', 1) == 1 then
+      local count = redis.call('scard', key)
+      if count > 1 then
+        redis.call('hset', QlessJob.ns .. self.jid, 'unresolved', count)
+      end
+    end
+  end
+end
+
+-- Remove the job `jid` from this job's dependencies, and return the number of
+-- dependencies it still has. The caller is responsible for removing this job
+-- from the other's dependents.
+function QlessJob:remove_dependency(jid)
+  if redis.call(
+    'srem', QlessJob.ns .. self.jid .. '-dependencies', jid) == 0 then
+    return self:unresolved()
+  end
+
+  local count = redis.call('hincrby', QlessJob.ns .. self.jid, 'unresolved', -1)
+  if count < 0 then
+    count = redis.call('scard', QlessJob.ns .. self.jid .. '-dependencies')
+    redis.call('hset', QlessJob.ns .. self.jid, 'unresolved', count)
+  end
+  if count == 0 then
+    redis.call('hdel', QlessJob.ns .. self.jid, 'unresolved')
+  end
+  return count
+end
+
+-- The number of this job's dependencies that have yet to be resolved
+function QlessJob:unresolved()
+  local count = redis.call('hget', QlessJob.ns .. self.jid, 'unresolved')
+  if count then
+    return tonumber(count)
+  end
+  return redis.call('scard', QlessJob.ns .. self.jid .. '-dependencies')
+end
+
+-- Move the jobs `jids`, whose dependencies have all been resolved, out of the
+-- depends state and into their queues. Their additions to the queues are made
+-- in a batch, and they're removed from each queue's depends set at once.
+function QlessJob.resolve(now, jids)
+  if #jids == 0 then
+    return
+  end
+
+  Qless.batch(function()
+    local names = {}
+    local released = {}
+    for _, jid in ipairs(jids) do
+      local q, p, scheduled = unpack(
+        redis.call('hmget', QlessJob.ns .. jid, 'queue', 'priority', 'scheduled'))
+      if q then
+        if not released[q] then
+          released[q] = {}
+          table.insert(names, q)
+        end
+        table.insert(released[q], jid)
+
+        local queue = Qless.queue(q)
+        if scheduled then
+          queue.scheduled.add(scheduled, jid)
+          redis.call('hset', QlessJob.ns .. jid, 'state', 'scheduled')
+          redis.call('hdel', QlessJob.ns .. jid, 'scheduled')
+        else
+          if Qless.job(jid):acquire_resources(now) then
+            queue.work.add(now, p, jid)
+          end
+          redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
+        end
+      end
+    end
+
+    for _, q in ipairs(names) do
+      local queue = Qless.queue(q)
+      local jids = released[q]
+      -- Lua's stack limits how many arguments we can unpack at once
+      for i = 1, #jids, 1000 do
+        queue.depends.remove(unpack(jids, i, math.min(i + 999, #jids)))
+      end
+    end
+  end)
+end
+
+-- Heartbeat
+------------
+-- Renew this worker's lock on this job. Throws an exception if:
+--      - the job's been given to another worker
+--      - the job's been completed
+--      - the job's been canceled
+--      - the job's not running
+function QlessJob:heartbeat(now, worker, data)
+  assert(worker, 'Heatbeat(): Arg "worker" missing')
+
+  -- We should find the heartbeat interval for this queue
+  -- heartbeat. First, though, we need to find the queue
+  -- this particular job is in
+  local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue') or ''
+  local expires = now + (
+    Qless.config.get(queue .. '-heartbeat') or
+    Qless.config.get('heartbeat'))
+
+  if data then
+    assert(cjson.decode(data), 'Heartbeat(): Arg "data" not JSON: ' .. tostring(data))
+  end
+
+  -- First, let's see if the worker still owns this job, and there is a
+  -- worker
+  local job_worker, state = unpack(self:fields('worker', 'state'))
+  if state == false then
+    -- This means the job doesn't exist
+    error('Heartbeat(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error(
+      'Heartbeat(): Job ' .. self.jid .. ' not currently running: ' .. state)
+  elseif job_worker ~= worker or #job_worker == 0 then
+    error(
+      'Heartbeat(): Job ' .. self.jid ..
+      ' given out to another worker: ' .. job_worker)
+  else
+    -- Otherwise, optionally update the user data, and the heartbeat
+    if data then
+      redis.call('hmset', QlessJob.ns .. self.jid, 'expires',
+        expires, 'worker', worker, 'data', data)
+    else
+      redis.call('hmset', QlessJob.ns .. self.jid,
+        'expires', expires, 'worker', worker)
+    end
+
+    -- Update hwen this job was last updated on that worker
+    -- Add this job to the list of jobs handled by this worker
+    redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, self.jid)
+
+    -- Make sure we add this worker to the list of seen workers
+    redis.call('zadd', 'ql:workers', now, worker)
+
+    -- And now we should just update the locks
+    local queue = Qless.queue(
+      redis.call('hget', QlessJob.ns .. self.jid, 'queue'))
+    queue.locks.add(expires, self.jid)
+    return expires
+  end
+end
+
+-- Priority
+-- --------
+-- Update the priority of this job. If the job doesn't exist, throws an
+-- exception
+function QlessJob:priority(priority)
+  priority = assert(tonumber(priority),
+    'Priority(): Arg "priority" missing or not a number: ' ..
+    tostring(priority))
+
+  -- Get the queue the job is currently in, if any
+  local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue')
+
+  if queue == nil or queue == false then
+    -- If the job doesn't exist, throw an error
+    error('Priority(): Job ' .. self.jid .. ' does not exist')
+  elseif queue == '' then
+    -- Just adjust the priority
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  else
+    -- Adjust the priority and see if it's a candidate for updating
+    -- its priority in the queue it's currently in
+    local queue_obj = Qless.queue(queue)
+    if queue_obj.work.score(self.jid) then
+      queue_obj.work.add(0, priority, self.jid)
+    end
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  end
+end
+
+-- Update the jobs' attributes with the provided dictionary. Attributes set to
+-- their defaults are removed from the hash rather than stored.
+function QlessJob:update(data)
+  local tmp = {}
+  local defaults = {}
+  for k, v in pairs(data) do
+    if QlessJob.default(k, v) then
+      table.insert(defaults, k)
+    else
+      table.insert(tmp, k)
+      table.insert(tmp, v)
+    end
+  end
+  if #defaults > 0 then
+    redis.call('hdel', QlessJob.ns .. self.jid, unpack(defaults))
+  end
+  if #tmp > 0 then
+    redis.call('hmset', QlessJob.ns .. self.jid, unpack(tmp))
+  end
+end
+
+-- Get the named fields of the job's hash, like HMGET, except that fields left
+-- out because they have their default values are filled in
+function QlessJob:fields(...)
+  local values = redis.call('hmget', QlessJob.ns .. self.jid, unpack(arg))
+  for index, field in ipairs(arg) do
+    if not values[index] and QlessJob.defaults[field] then
+      values[index] = QlessJob.defaults[field]
+    end
+  end
+  return values
+end
+
+-- Times out the job now rather than when its lock is normally set to expire
+function QlessJob:timeout(now)
+  local queue_name, state, worker = unpack(redis.call('hmget',
+    QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+  if queue_name == nil or queue_name == false then
+    error('Timeout(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Timeout(): Job ' .. self.jid .. ' not running')
+  else
+    -- Time out the job
+    self:history(now, 'timed-out')
+    local queue = Qless.queue(queue_name)
+    queue.locks.remove(self.jid)
+    queue.work.add(now, '+inf', self.jid)
+    self:update({state = 'stalled', expires = 0})
+    local encoded = cjson.encode({
+      jid    = self.jid,
+      event  = 'lock_lost',
+      worker = worker
+    })
+    Qless.publish('w:' .. worker, encoded)
+    Qless.publish('log', encoded)
+    return queue_name
+  end
+end
+
+-- Return whether or not this job exists
+function QlessJob:exists()
+  return redis.call('exists', QlessJob.ns .. self.jid) == 1
+end
+
+-- Convert an old-style history, which was kept as a JSON blob in the job's
+-- hash, into a list of history entries
+function QlessJob.legacy_history(history)
+  local entries = {}
+  for i, value in ipairs(cjson.decode(history)) do
+    table.insert(entries, {math.floor(value.put), 'put', {q = value.q}})
+
+    -- If there's any popped time
+    if value.popped then
+      table.insert(entries, {math.floor(value.popped), 'popped',
+        {worker = value.worker}})
+    end
+
+    -- If there's any failure
+    if value.failed then
+      table.insert(entries, {math.floor(value.failed), 'failed', nil})
+    end
+
+    -- If it was completed
+    if value.done then
+      table.insert(entries, {math.floor(value.done), 'done', nil})
+    end
+  end
+  return entries
+end
+
+-- Move an old-style history into the front of the history list, and remove it
+-- from the job's hash. This happens whenever such a job is put again.
+function QlessJob:migrate_history(history)
+  local entries = QlessJob.legacy_history(history)
+  if #entries > 0 then
+    -- Pushing onto the head of the list, so in reverse
+    local encoded = {}
+    for i = #entries, 1, -1 do
+      table.insert(encoded, Qless.encode(entries[i]))
+    end
+    redis.call('lpush', QlessJob.ns .. self.jid .. '-history', unpack(encoded))
+  end
+  redis.call('hdel', QlessJob.ns .. self.jid, 'history')
+end
+
+-- Get or append to history
+function QlessJob:history(now, what, item)
+  if what == nil then
+    -- Get the history
+    local response = {}
+
+    -- Jobs that haven't been put since an old-style history was kept have
+    -- that history come before anything in the list
+    local history = redis.call('hget', QlessJob.ns .. self.jid, 'history')
+    if history then
+      for i, value in ipairs(QlessJob.legacy_history(history)) do
+        local dict = value[3] or {}
+        dict['when'] = value[1]
+        dict['what'] = value[2]
+        table.insert(response, dict)
+      end
+    end
+
+    for i, value in ipairs(redis.call('lrange',
+      QlessJob.ns .. self.jid .. '-history', 0, -1)) do
+      value = Qless.decode(value)
+      local dict = value[3] or {}
+      dict['when'] = value[1]
+      dict['what'] = value[2]
+      table.insert(response, dict)
+    end
+    return response
+  else
+    local length = redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+      Qless.encode({math.floor(now), what, item}))
+
+    -- If the length of the history should be limited, then we'll truncate it,
+    -- but only once it's actually grown past that limit
+    local count = Qless.config.get('max-job-history', 100)
+    if count > 0 and length > count then
+      -- We'll always keep the first item around
+      local obj = redis.call('lpop', QlessJob.ns .. self.jid .. '-history')
+      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history',
+        -math.max(count - 1, 1), -1)
+      length = redis.call(
+        'lpush', QlessJob.ns .. self.jid .. '-history', obj)
+    end
+    return length
+  end
+end
+
+function QlessJob:release_resources(now)
+  local resources = redis.call('hget', QlessJob.ns .. self.jid, 'resources')
+  resources = Qless.decode(resources or '[]')
+  for _, res in ipairs(resources) do
+    Qless.resource(res):release(now, self.jid)
+  end
+end
+
+-- Return whether this job is waiting on a resource other than `rid` that
+-- has no lock free for it. Resources that don't exist don't count, so that
+-- trying to acquire them fails the job.
+function QlessJob:blocked(rid)
+  local resources = Qless.decode(
+    redis.call('hget', QlessJob.ns .. self.jid, 'resources') or '[]')
+  for _, res in ipairs(resources) do
+    local resource = Qless.resource(res)
+    if res ~= rid and resource:exists() and
+      not resource:available(self.jid) then
+      return true
+    end
+  end
+  return false
+end
+
+-- Return the number of units of each of its resources that this job needs,
+-- for those that it needs more than one of
+function QlessJob:weights()
+  return Qless.decode(
+    redis.call('hget', QlessJob.ns .. self.jid, 'weights') or '{}')
+end
+
+-- Return the number of units of the resource `rid` that this job needs
+function QlessJob:weight(rid)
+  return self:weights()[rid] or 1
+end
+
+function QlessJob:acquire_resources(now)
+  local resources, priority, weights = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'resources', 'priority', 'weights'))
+  resources = Qless.decode(resources or '[]')
+  if (#resources == 0) then
+    return true
+  end
+  weights = Qless.decode(weights or '{}')
+
+  local acquired_all = true
+
+  for _, res in ipairs(resources) do
+    local ok, res = pcall(function() return Qless.resource(res):acquire(now, priority, self.jid, weights[res]) end)
+    if not ok then
+      self:set_failed(now, 'system:fatal', res.msg)
+      return false
+    end
+    acquired_all = acquired_all and res
+  end
+
+  return acquired_all
+end
+
+function QlessJob:set_failed(now, group, message, worker, release_work, release_resources)
+  local group             = assert(group, 'Fail(): Arg "group" missing')
+  local message           = assert(message, 'Fail(): Arg "message" missing')
+  -- Only a job that a worker had is counted among that worker's failures
+  if worker then
+    QlessWorker.tally(now, worker, 'failed', 1)
+  end
+  local worker            = worker or 'none'
+  local release_work      = release_work or true
+  local release_resources = release_resources or false
+
+  local queue = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'queue'))
+
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    jid     = self.jid,
+    event   = 'failed',
+    worker  = worker,
+    group   = group,
+    message = message
+  }))
+
+  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+    Qless.publish('failed', self.jid)
+  end
+
+  -- Now, take the element of the history for which our provided worker is
+  -- the worker, and update 'failed'
+  self:history(now, 'failed', {group = group})
+
+  -- Increment the number of failures for that queue for the
+  -- given day.
+  Qless.queue(queue):tally(now, 'failures', 1)
+  Qless.queue(queue):tally(now, 'failed'  , 1)
+  Qless.queue(queue):record(now, 'fail')
+
+  -- Now remove the instance from the schedule, and work queues for the
+  -- queue it's in
+  if release_work then
+    local queue_obj = Qless.queue(queue)
+    queue_obj.work.remove(self.jid)
+    queue_obj.locks.remove(self.jid)
+    queue_obj.scheduled.remove(self.jid)
+  end
+
+  -- release any resource locks the job might have
+  if release_resources then
+    self:release_resources(now)
+  end
+
+  self:update({
+    state   = 'failed',
+    worker  = '',
+    expires = 0,
+    failure = Qless.encode({
+      ['group']   = group,
+      ['message'] = message,
+      ['when']    = math.floor(now)
+    })
+  })
+
+  -- Add this group of failure to the list of failures
+  redis.call('sadd', 'ql:failures', group)
+  -- And add this particular instance to the failed groups
+  redis.call('lpush', 'ql:f:' .. group, self.jid)
+
+  -- Here is where we'd increment stats about the particular stage
+  -- and possibly the workers
+
+  return self.jid
+end
+-------------------------------------------------------------------------------
+-- Queue class
+-------------------------------------------------------------------------------
+-- Return a queue object
+function Qless.queue(name)
+  assert(name, 'Queue(): no queue name provided')
+  local queue = {}
+  setmetatable(queue, QlessQueue)
+  queue.name = name
+
+  -- Access to our work
+  queue.work = {
+    peek = function(now, offset, count)
+      if count == 0 then
+        return {}
+      end
+      local jids = {}
+      for index, jid in ipairs(redis.call(
+        'zrevrange', queue:prefix('work'), offset, offset + count - 1)) do
+        table.insert(jids, jid)
+      end
+      return jids
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('work'), unpack(arg))
+      end
+    end, add = function(now, priority, jid)
+      if priority ~= '+inf' then
+        priority = priority - (now / 10000000000)
+      end
+      return Qless.zadd(queue:prefix('work'), priority, jid, function(added)
+        -- If the queue just went from empty to non-empty, wake up a worker
+        if added > 0 and queue.work.length() == added then
+          queue:signal()
+        end
+      end)
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('work'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('work'))
+    end
+  }
+
+  -- Access to our locks
+  queue.locks = {
+    expired = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('locks'), '-inf', now, 'LIMIT', offset, count)
+    end, peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('locks'),
+        now, '+inf', 'LIMIT', offset, count)
+    end, add = function(expires, jid)
+      redis.call('zadd', queue:prefix('locks'), expires, jid)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('locks'), unpack(arg))
+      end
+    end, running = function(now)
+      return redis.call('zcount', queue:prefix('locks'), now, '+inf')
+    end, length = function(now)
+      -- If a 'now' is provided, we're interested in how many are before
+      -- that time
+      if now then
+        return redis.call('zcount', queue:prefix('locks'), 0, now)
+      else
+        return redis.call('zcard', queue:prefix('locks'))
+      end
+    end, job_time_left = function(now, jid)
+      return tonumber(redis.call('zscore', queue:prefix('locks'), jid) or 0) - now
+    end
+  }
+
+  -- Access to our dependent jobs
+  queue.depends = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('depends'), offset, offset + count - 1)
+    end, add = function(now, jid)
+      redis.call('zadd', queue:prefix('depends'), now, jid)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('depends'), unpack(arg))
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('depends'))
+    end
+  }
+
+  -- Access to our scheduled jobs
+  queue.scheduled = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('scheduled'), offset, offset + count - 1)
+    end, ready = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('scheduled'), 0, now, 'LIMIT', offset, count)
+    end, add = function(when, jid)
+      Qless.zadd(queue:prefix('scheduled'), when, jid)
+      queue:due(when)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('scheduled'), unpack(arg))
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('scheduled'))
+    end
+  }
+
+  -- Access to our recurring jobs
+  queue.recurring = {
+    peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('recur'),
+        0, now, 'LIMIT', offset, count)
+    end, ready = function(now, offset, count)
+    end, add = function(when, jid)
+      redis.call('zadd', queue:prefix('recur'), when, jid)
+      queue:due(when)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('recur'), unpack(arg))
+      end
+    end, update = function(increment, jid)
+      queue:due(redis.call('zincrby', queue:prefix('recur'), increment, jid))
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('recur'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('recur'))
+    end
+  }
+  return queue
+end
+
+-- Return the prefix for this particular queue
+function QlessQueue:prefix(group)
+  if group then
+    return QlessQueue.ns..self.name..'-'..group
+  else
+    return QlessQueue.ns..self.name
+  end
+end
+
+-- The fields of the wait and run stats that hold the histogram, in order
+QlessQueue.histogram = {
+  's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
+  'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
+  'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
+  'd1','d2','d3','d4','d5','d6'
+}
+
+-- Stats(now, date, [percentiles])
+-- ---------------------
+-- Return the current statistics for a given queue on a given date. The
+-- results are returned are a JSON blob:
+--
+--
+--  {
+--      # These are unimplemented as of yet
+--      'failed': 3,
+--      'retries': 5,
+--      'wait' : {
+--          'total'    : ...,
+--          'mean'     : ...,
+--          'variance' : ...,
+--          'histogram': [
+--              ...
+--          ]
+--      }, 'run': {
+--          'total'    : ...,
+--          'mean'     : ...,
+--          'variance' : ...,
+--          'histogram': [
+--              ...
+--          ]
+--      }
+--  }
+--
+-- The histogram's data points are at the second resolution for the first
+-- minute, the minute resolution for the first hour, the 15-minute resolution
+-- for the first day, the hour resolution for the first 3 days, and then at
+-- the day resolution from there on out. The `histogram` key is a list of
+-- those values.
+--
+-- If `percentiles` is provided as a JSON array of numbers between 0 and 100,
+-- then the histograms are replaced by a `percentiles` list of estimates of
+-- those percentiles.
+function QlessQueue:stats(now, date, percentiles)
+  date = assert(tonumber(date),
+    'Stats(): Arg "date" missing or not a number: '.. (date or 'nil'))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  -- The bin is midnight of the provided day
+  -- 24 * 60 * 60 = 86400
+  local bin = date - (date % 86400)
+
+  local retries, failed, failures = unpack(redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
+  return {
+    retries  = tonumber(retries  or 0),
+    failed   = tonumber(failed   or 0),
+    failures = tonumber(failures or 0),
+    wait     = QlessQueue.summarize(
+      QlessQueue.read_stats('wait', bin, self.name), percentiles),
+    run      = QlessQueue.summarize(
+      QlessQueue.read_stats('run' , bin, self.name), percentiles)
+  }
+end
+
+-- StatsMerged(now, queues, from, to, [percentiles])
+-- -------------------------------------------------
+-- Return the statistics of all of `queues` (a JSON array of names) over every
+-- day from the day of `from` to the day of `to` combined, in the same form
+-- that `stats` returns them.
+function QlessQueue.merged_stats(now, queues, from, to, percentiles)
+  local ok, names = pcall(cjson.decode, queues or '')
+  if not ok or type(names) ~= 'table' then
+    error('StatsMerged(): Arg "queues" not a JSON array: ' ..
+      tostring(queues))
+  end
+  from = assert(tonumber(from),
+    'StatsMerged(): Arg "from" missing or not a number: ' .. tostring(from))
+  to = assert(tonumber(to),
+    'StatsMerged(): Arg "to" missing or not a number: ' .. tostring(to))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  local first, last = from - (from % 86400), to - (to % 86400)
+  if last < first then
+    error('StatsMerged(): Arg "to" must not be before "from"')
+  elseif #names * ((last - first) / 86400 + 1) > 10000 then
+    error('StatsMerged(): More than 10000 days of queue stats requested')
+  end
+
+  local response = {retries = 0, failed = 0, failures = 0}
+  local wait, run = QlessQueue.read_stats(), QlessQueue.read_stats()
+  for _, name in ipairs(names) do
+    for bin = first, last, 86400 do
+      local counts = redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. name,
+        'retries', 'failed', 'failures')
+      response.retries  = response.retries  + (tonumber(counts[1]) or 0)
+      response.failed   = response.failed   + (tonumber(counts[2]) or 0)
+      response.failures = response.failures + (tonumber(counts[3]) or 0)
+      wait = QlessQueue.merge_stats(wait,
+        QlessQueue.read_stats('wait', bin, name))
+      run  = QlessQueue.merge_stats(run,
+        QlessQueue.read_stats('run' , bin, name))
+    end
+  end
+  response.wait = QlessQueue.summarize(wait, percentiles)
+  response.run  = QlessQueue.summarize(run , percentiles)
+  return response
+end
+
+-- Parse the percentiles argument of `stats`, returning nil if none were asked
+-- for
+function QlessQueue.percentiles(percentiles)
+  if percentiles == nil or percentiles == '' then
+    return nil
+  end
+  local ok, decoded = pcall(cjson.decode, percentiles)
+  if not ok or type(decoded) ~= 'table' then
+    error('Stats(): Arg "percentiles" not a JSON array: ' ..
+      tostring(percentiles))
+  end
+  for _, percentile in ipairs(decoded) do
+    if type(percentile) ~= 'number' or percentile < 0 or percentile > 100 then
+      error('Stats(): Percentile not between 0 and 100: ' ..
+        tostring(percentile))
+    end
+  end
+  return decoded
+end
+
+-- Read the `name` stats ('wait' or 'run') of `queue` for the day `bin`, as
+-- their count, mean, sum of squared differences from the mean (`vk`) and
+-- histogram. With no arguments, returns empty stats.
+function QlessQueue.read_stats(name, bin, queue)
+  local stats = {count = 0, mean = 0, vk = 0, histogram = {}}
+  if name == nil then
+    for i=1,#QlessQueue.histogram do
+      table.insert(stats.histogram, 0)
+    end
+    return stats
+  end
+
+  local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
+  local fields = redis.call('hmget', key,
+    'total', 'mean', 'vk', 'count', 'sum', 'sumsq', unpack(QlessQueue.histogram))
+
+  -- Stats may have been accumulated by older versions as a running mean and
+  -- variance (`total`, `mean` and `vk`), and by this one as sums (`count`,
+  -- `sum` and `sumsq`). Either may be present, so combine the two.
+  stats.count = tonumber(fields[1]) or 0
+  stats.mean  = tonumber(fields[2]) or 0
+  stats.vk    = tonumber(fields[3]) or 0
+  local count = tonumber(fields[4]) or 0
+  if count > 0 then
+    local sum   = tonumber(fields[5]) or 0
+    local sumsq = tonumber(fields[6]) or 0
+    local mean  = sum / count
+    stats = QlessQueue.merge_stats(stats, {
+      count = count, mean = mean, vk = math.max(0, sumsq - sum * mean)})
+  end
+
+  stats.histogram = {}
+  for i=1,#QlessQueue.histogram do
+    table.insert(stats.histogram, tonumber(fields[i + 6]) or 0)
+  end
+  return stats
+end
+
+-- Combine two sets of stats, as returned by read_stats. The histogram of the
+-- first is added to in place, if the second has one.
+function QlessQueue.merge_stats(a, b)
+  local count = a.count + b.count
+  local stats = {count = count, mean = a.mean, vk = a.vk,
+    histogram = a.histogram}
+  if b.count > 0 then
+    local delta = b.mean - a.mean
+    stats.mean = (a.count * a.mean + b.count * b.mean) / count
+    stats.vk   = a.vk + b.vk + delta * delta * a.count * b.count / count
+  end
+  if a.histogram and b.histogram then
+    for i=1,#b.histogram do
+      a.histogram[i] = a.histogram[i] + b.histogram[i]
+    end
+  end
+  return stats
+end
+
+-- Turn stats, as returned by read_stats, into what `stats` reports: their
+-- count, mean, standard deviation, and either the histogram or, if asked for,
+-- estimates of `percentiles`
+function QlessQueue.summarize(stats, percentiles)
+  local results = {count = stats.count, mean = stats.mean}
+  if stats.count > 1 then
+    results.std = math.sqrt(stats.vk / (stats.count - 1))
+  else
+    results.std = 0
+  end
+
+  if percentiles then
+    results.percentiles = {}
+    for _, percentile in ipairs(percentiles) do
+      table.insert(results.percentiles,
+        QlessQueue.percentile(stats.histogram, percentile))
+    end
+  else
+    results.histogram = stats.histogram
+  end
+  return results
+end
+
+-- Estimate the `percentile` of the values counted in `histogram`, assuming
+-- that the values in each bucket are spread evenly across it, with each at
+-- the middle of its share of the bucket. Returns 0 if there are no values.
+function QlessQueue.percentile(histogram, percentile)
+  local total = 0
+  for _, count in ipairs(histogram) do
+    total = total + count
+  end
+  if total == 0 then
+    return 0
+  end
+
+  local rank = percentile / 100 * total
+  local seen = 0
+  for i, count in ipairs(histogram) do
+    if count > 0 and seen + count >= rank then
+      local field = QlessQueue.histogram[i]
+      local width = QlessQueue.widths[string.sub(field, 1, 1)]
+      local lower = tonumber(string.sub(field, 2)) * width
+      return lower + width * math.max(0, rank - seen - 0.5) / count
+    end
+    seen = seen + count
+  end
+end
+
+-- The width in seconds of the histogram's buckets of each resolution
+QlessQueue.widths = {s = 1, m = 60, h = 3600, d = 86400}
+
+-- Peek
+-------
+-- Examine the next jobs that would be popped from the queue without actually
+-- popping them. If `readonly`, nothing is written: due scheduled jobs are
+-- merged with the work queue in memory rather than being moved into it, and
+-- due recurring jobs are left unspawned.
+function QlessQueue:peek(now, count, readonly)
+  count = assert(tonumber(count),
+    'Peek(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  -- These are the ids that we're going to return. We'll begin with any jobs
+  -- that have lost their locks
+  local jids = self.locks.expired(now, 0, count)
+
+  if readonly then
+    table.extend(jids, self:preview(now, count - #jids))
+    return jids
+  end
+
+  -- If we still need jobs in order to meet demand, then we should
+  -- look for all the recurring jobs that need jobs run, and whether any
+  -- scheduled items should be inserted to ensure correctness when pulling off
+  -- the next unit of work. Both are skipped if nothing in this queue has come
+  -- due yet.
+  self:promote(now, count - #jids)
+
+  -- With these in place, we can expand this list of jids based on the work
+  -- queue itself and the priorities therein
+  table.extend(jids, self.work.peek(now, 0, count - #jids))
+
+  return jids
+end
+
+-- Return up to `count` jids in the order they would be taken from the work
+-- queue if the due scheduled jobs were first moved into it, without moving
+-- them. Scheduled jobs that couldn't acquire their resources are left out.
+function QlessQueue:preview(now, count)
+  if count <= 0 then
+    return {}
+  end
+
+  -- The candidates, along with the score they have (or would have) in the
+  -- work queue
+  local candidates = {}
+  local work = redis.call(
+    'zrevrange', self:prefix('work'), 0, count - 1, 'WITHSCORES')
+  for i = 1, #work, 2 do
+    table.insert(candidates, {jid = work[i], score = tonumber(work[i + 1])})
+  end
+
+  -- The number of locks on each resource promised to earlier candidates
+  local claimed = {}
+  for _, jid in ipairs(self.scheduled.ready(now, 0, count)) do
+    local priority, resources, weights = unpack(redis.call(
+      'hmget', QlessJob.ns .. jid, 'priority', 'resources', 'weights'))
+    resources = Qless.decode(resources or '[]')
+    weights = Qless.decode(weights or '{}')
+    local available = true
+    for _, rid in ipairs(resources) do
+      available = available and
+        Qless.resource(rid):available(jid, claimed[rid] or 0)
+    end
+    if available then
+      for _, rid in ipairs(resources) do
+        claimed[rid] = (claimed[rid] or 0) + (weights[rid] or 1)
+      end
+      table.insert(candidates, {
+        jid   = jid,
+        score = tonumber(priority or 0) - (now / 10000000000)
+      })
+    end
+  end
+
+  -- Order them the way zrevrange would
+  table.sort(candidates, function(a, b)
+    if a.score ~= b.score then
+      return a.score > b.score
+    end
+    return a.jid > b.jid
+  end)
+
+  local jids = {}
+  for i = 1, math.min(count, #candidates) do
+    table.insert(jids, candidates[i].jid)
+  end
+  return jids
+end
+
+-- Push a readiness token onto this queue's signal list, which clients may
+-- BLPOP on before popping. Tokens are coalesced so that there's never more
+-- than one waiting
+function QlessQueue:signal()
+  local key = self:prefix('signal')
+  redis.call('rpush', key, self.name)
+  redis.call('ltrim', key, 0, 0)
+end
+
+-- Return true if this queue is paused
+function QlessQueue:paused()
+  return redis.call('sismember', 'ql:paused_queues', self.name) == 1
+end
+
+-- Pause this queue
+--
+-- Note: long term, we have discussed adding a rate-limiting
+-- feature to qless-core, which would be more flexible and
+-- could be used for pausing (i.e. pause = set the rate to 0).
+-- For now, this is far simpler, but we should rewrite this
+-- in terms of the rate limiting feature if/when that is added.
+function QlessQueue.pause(now, ...)
+  redis.call('sadd', 'ql:paused_queues', unpack(arg))
+end
+
+-- Unpause this queue
+function QlessQueue.unpause(...)
+  redis.call('srem', 'ql:paused_queues', unpack(arg))
+end
+
+-- Checks for expired locks, scheduled and recurring jobs, returning any
+-- jobs that are ready to be processes
+function QlessQueue:pop(now, worker, count)
+  assert(worker, 'Pop(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'Pop(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  -- We should find the heartbeat interval for this queue heartbeat
+  local expires = now + (
+    Qless.config.get(self.name .. '-heartbeat') or
+    Qless.config.get('heartbeat'))
+
+  -- If this queue is paused, then return no jobs
+  if self:paused() then
+    return {}
+  end
+
+  -- Make sure we this worker to the list of seen workers
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  -- Check our max concurrency, and limit the count
+  local max_concurrency =
+    Qless.config.get(self.name .. '-max-concurrency', 0)
+
+  if max_concurrency > 0 then
+    -- Allow at most max_concurrency - #running
+    local allowed = math.max(0, max_concurrency - self.locks.running(now))
+    count = math.min(allowed, count)
+    if count == 0 then
+      return {}
+    end
+  end
+
+  local jids = self:invalidate_locks(now, count)
+  -- Now we've checked __all__ the locks for this queue the could
+  -- have expired, and are no more than the number requested.
+
+  -- If we still need jobs in order to meet demand, then we should
+  -- look for all the recurring jobs that need jobs run, and whether any
+  -- scheduled items should be inserted to ensure correctness when pulling off
+  -- the next unit of work. Both are skipped if nothing in this queue has come
+  -- due yet.
+  self:promote(now, count - #jids)
+
+  -- With these in place, we can expand this list of jids based on the work
+  -- queue itself and the priorities therein
+  table.extend(jids, self.work.peek(now, 0, count - #jids))
+
+  -- How long each of these jobs has been waiting
+  local waits = {}
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    job:history(now, 'popped', {worker = worker})
+
+    -- Note the wait time for the statistics
+    local time, unique = unpack(
+      redis.call('hmget', QlessJob.ns .. jid, 'time', 'unique'))
+    table.insert(waits, now - tonumber(time or now))
+
+    -- Once it's running, another job with the same unique key may be put
+    if unique then
+      self:release_unique(unique, jid)
+    end
+
+    -- Add this job to the list of jobs handled by this worker
+    redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, jid)
+
+    -- Update the jobs data, and add its locks, and return the job
+    job:update({
+      worker  = worker,
+      expires = expires,
+      state   = 'running',
+      time    = Qless.time(now)
+    })
+
+    self.locks.add(expires, jid)
+
+    local tracked = redis.call('zscore', 'ql:tracked', jid) ~= false
+    if tracked then
+      Qless.publish('popped', jid)
+    end
+  end
+
+  -- Update the wait time statistics for all of these jobs at once
+  self:stat(now, 'wait', waits)
+
+  -- If we are returning any jobs, then we should remove them from the work
+  -- queue
+  self.work.remove(unpack(jids))
+
+  -- The token that woke this worker has been consumed, so if there's still
+  -- work left then some other worker should be woken
+  local waiting = self.work.length()
+  if #jids > 0 and waiting > 0 then
+    self:signal()
+  end
+
+  if #jids > 0 then
+    self:record(now, 'pop', #jids)
+    QlessWorker.tally(now, worker, 'popped', #jids)
+  end
+
+  return jids
+end
+
+-- Multipop(now, worker, count, queues)
+-- ------------------------------------
+-- Pop up to `count` jobs from several queues in a single invocation. The
+-- `queues` argument is either a JSON array of queue names, in which case the
+-- queues are drained in the order provided:
+--
+--  ['urgent', 'normal', 'batch']
+--
+-- or a JSON object of queue names to (positive) weights, in which case `count`
+-- is first apportioned between the queues by weight:
+--
+--  {'urgent': 3, 'normal': 1}
+--
+-- Whatever the weighted share of a queue could not fill is then offered to the
+-- queues in order of decreasing weight. Returns the list of popped jids.
+function QlessQueue.multipop(now, worker, count, queues)
+  assert(worker, 'Multipop(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'Multipop(): Arg "count" missing or not a number: ' .. tostring(count))
+  assert(queues, 'Multipop(): Arg "queues" missing')
+  local decoded = cjson.decode(queues)
+  assert(type(decoded) == 'table',
+    'Multipop(): Arg "queues" not a JSON array or object: ' .. queues)
+  queues = decoded
+
+  -- This is the list of queue names in the order they should be drained, and
+  -- the number of jobs we'd like from each before draining in that order
+  local order  = {}
+  local shares = {}
+  if #queues > 0 then
+    for _, name in ipairs(queues) do
+      table.insert(order, name)
+    end
+  else
+    local weights = {}
+    local total   = 0
+    for name, weight in pairs(queues) do
+      weights[name] = assert(tonumber(weight),
+        'Multipop(): Weight for "' .. name .. '" not a number: ' ..
+        tostring(weight))
+      if weights[name] <= 0 then
+        error('Multipop(): Weight for "' .. name .. '" must be positive')
+      end
+      total = total + weights[name]
+      table.insert(order, name)
+    end
+
+    -- Heaviest first, and by name for queues with the same weight
+    table.sort(order, function(a, b)
+      if weights[a] == weights[b] then
+        return a < b
+      end
+      return weights[a] > weights[b]
+    end)
+
+    for _, name in ipairs(order) do
+      shares[name] = math.floor(count * weights[name] / total)
+    end
+  end
+
+  local jids = {}
+  -- First, pop each queue's weighted share, if it has one
+  for _, name in ipairs(order) do
+    local share = math.min(shares[name] or 0, count - #jids)
+    if share > 0 then
+      table.extend(jids, Qless.queue(name):pop(now, worker, share))
+    end
+  end
+
+  -- And then fill whatever remains in order
+  for _, name in ipairs(order) do
+    if #jids >= count then
+      break
+    end
+    table.extend(jids, Qless.queue(name):pop(now, worker, count - #jids))
+  end
+
+  return jids
+end
+
+-- Update the stats for this queue with one value, or a list of values. The
+-- count, sum and sum of squares are accumulated so that the stats can be
+-- updated without first reading them. The mean and standard deviation are
+-- derived from these when they're read.
+function QlessQueue:stat(now, stat, vals)
+  if type(vals) ~= 'table' then
+    vals = {vals}
+  end
+  if #vals == 0 then
+    return
+  end
+
+  -- In a batch, gather up the values and record them all at once
+  if Qless.batching then
+    local name = 'stat:' .. stat .. ':' .. self.name
+    local pending = Qless.memo(name, function() return {} end)
+    table.extend(pending, vals)
+    return Qless.defer(name, function() self:stat(now, stat, pending) end)
+  end
+
+  -- The bin is midnight of the provided day
+  local bin = now - (now % 86400)
+  local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. self.name
+  local sum, sumsq = QlessQueue.accumulate(key, vals, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+
+  -- Roll the values up into each of the time series, too
+  for _, resolution in ipairs({'minute', 'hour'}) do
+    local series = QlessQueue.series[resolution]
+    local bucket = now - (now % series.width)
+    local key = 'ql:s:' .. stat .. '-' .. resolution .. ':' .. bucket .. ':' ..
+      self.name
+    Qless.hincrby(key, 'count', #vals, function()
+      QlessQueue.expire_series(now, key, resolution, bucket)
+    end)
+    redis.call('hincrbyfloat', key, 'sum', sum)
+    redis.call('hincrbyfloat', key, 'sumsq', sumsq)
+  end
+end
+
+-- Add `vals` to the stats hash `key`: their histogram, count, sum and sum of
+-- squares, calling `created` if this is the first time values have been
+-- added to it. Returns the sum and sum of squares.
+function QlessQueue.accumulate(key, vals, created)
+  -- Update the histogram
+  -- - `s1`, `s2`, ..., -- second-resolution histogram counts
+  -- - `m1`, `m2`, ..., -- minute-resolution
+  -- - `h1`, `h2`, ..., -- hour-resolution
+  -- - `d1`, `d2`, ..., -- day-resolution
+  local sum, sumsq = 0, 0
+  local histogram, buckets = {}, {}
+  for _, val in ipairs(vals) do
+    sum   = sum + val
+    sumsq = sumsq + val * val
+
+    val = math.floor(val)
+    local bucket
+    if val < 60 then -- seconds
+      bucket = 's' .. val
+    elseif val < 3600 then -- minutes
+      bucket = 'm' .. math.floor(val / 60)
+    elseif val < 86400 then -- hours
+      bucket = 'h' .. math.floor(val / 3600)
+    else -- days
+      bucket = 'd' .. math.floor(val / 86400)
+    end
+    if histogram[bucket] == nil then
+      histogram[bucket] = 0
+      table.insert(buckets, bucket)
+    end
+    histogram[bucket] = histogram[bucket] + 1
+  end
+
+  Qless.hincrby(key, 'count', #vals, created)
+  for _, bucket in ipairs(buckets) do
+    Qless.hincrby(key, bucket, histogram[bucket])
+  end
+  redis.call('hincrbyfloat', key, 'sum', sum)
+  redis.call('hincrbyfloat', key, 'sumsq', sumsq)
+  return sum, sumsq
+end
+
+-- Count `count` (or 1) of `event` ('put', 'pop', 'complete', 'fail' or
+-- 'retry') happening in this queue, in the minute's throughput counters. The
+-- first time each event is counted in a minute, the jobs waiting and running
+-- are sampled, too.
+function QlessQueue:record(now, event, count)
+  local bucket = now - (now % 60)
+  local key = 'ql:s:throughput:' .. bucket .. ':' .. self.name
+  Qless.hincrby(key, event, count or 1, function()
+    QlessQueue.expire_series(now, key, 'minute', bucket)
+    self:sample(now, key)
+  end)
+end
+
+-- Record the number of jobs waiting in this queue and running now in the
+-- throughput counters `key`, unless they've already been recorded there. As
+-- this is only done when events are recorded, polling an idle queue costs
+-- nothing more, while a queue with jobs put and none popped is still sampled.
+function QlessQueue:sample(now, key)
+  if redis.call('hexists', key, 'waiting') == 0 then
+    redis.call('hmset', key,
+      'waiting', self.work.length(), 'running', self.locks.running(now))
+  end
+end
+
+-- Set `key`, the `resolution` time series bucket starting at `bucket`, to
+-- expire once it's older than the series is kept for
+function QlessQueue.expire_series(now, key, resolution, bucket)
+  local series = QlessQueue.series[resolution]
+  redis.call('expire', key, math.ceil(bucket + series.width - now +
+    Qless.config.get(series.history)))
+end
+
+-- Throughput(now, window)
+-- -----------------------
+-- Return the number of jobs put, popped, completed, failed and retried in this
+-- queue over the last `window` seconds (by default, 60), along with their
+-- rates per second. Events are counted by the minute, so the window is
+-- stretched back to the start of its first minute, and the seconds it covers
+-- are returned as `window`. The jobs waiting and running are sampled at most
+-- once a minute, and the samples in the window are returned as `depth`:
+--
+--  {
+--      'window': 90,
+--      'counts': {'put': 12, 'pop': 10, 'complete': 9, 'fail': 1, 'retry': 0},
+--      'rates' : {'put': 0.13, ...},
+--      'depth' : [{'time': ..., 'waiting': 3, 'running': 2}, ...]
+--  }
+function QlessQueue:throughput(now, window)
+  window = assert(tonumber(window or 60),
+    'Throughput(): Arg "window" not a number: ' .. tostring(window))
+  -- Counters older than `minute-stats-history` have expired, so a longer
+  -- window would undercount
+  local longest = math.min(86400, Qless.config.get('minute-stats-history'))
+  if window <= 0 or window > longest then
+    error('Throughput(): Arg "window" must be between 0 and ' .. longest ..
+      ': ' .. window)
+  end
+
+  local first = (now - window) - ((now - window) % 60)
+  local elapsed = now - first
+  local events = {'put', 'pop', 'complete', 'fail', 'retry'}
+  local response = {window = elapsed, counts = {}, rates = {}, depth = {}}
+  for _, event in ipairs(events) do
+    response.counts[event] = 0
+  end
+
+  for bucket = first, now, 60 do
+    local values = redis.call('hmget',
+      'ql:s:throughput:' .. bucket .. ':' .. self.name,
+      'waiting', 'running', unpack(events))
+    if values[1] then
+      table.insert(response.depth, {
+        time    = bucket,
+        waiting = tonumber(values[1]),
+        running = tonumber(values[2])
+      })
+    end
+    for index, event in ipairs(events) do
+      response.counts[event] =
+        response.counts[event] + (tonumber(values[index + 2]) or 0)
+    end
+  end
+
+  for _, event in ipairs(events) do
+    response.rates[event] = response.counts[event] / elapsed
+  end
+  return response
+end
+
+-- The time series that the wait and run stats are kept in, besides the daily
+-- stats. Each has buckets `width` seconds wide, which are kept for as many
+-- seconds as its `history` config option says.
+QlessQueue.series = {
+  minute = {width = 60  , history = 'minute-stats-history'},
+  hour   = {width = 3600, history = 'hour-stats-history'  }
+}
+
+-- StatsRange(now, from, to, resolution)
+-- -------------------------------------
+-- Return the wait and run stats of this queue for each bucket of the
+-- `resolution` ('minute' or 'hour') time series from the one holding `from`
+-- to the one holding `to`:
+--
+--  {
+--      'wait': [{'time': ..., 'count': ..., 'mean': ..., 'std': ...}, ...],
+--      'run' : [...]
+--  }
+--
+-- Buckets that saw no values, or that have since expired, have a count of 0.
+function QlessQueue:stats_range(now, from, to, resolution)
+  from = assert(tonumber(from),
+    'StatsRange(): Arg "from" missing or not a number: ' .. tostring(from))
+  to = assert(tonumber(to),
+    'StatsRange(): Arg "to" missing or not a number: ' .. tostring(to))
+  local series = QlessQueue.series[tostring(resolution)]
+  if not series then
+    error('StatsRange(): Arg "resolution" must be "minute" or "hour": ' ..
+      tostring(resolution))
+  end
+
+  local first = from - (from % series.width)
+  local buckets = math.floor((to - first) / series.width) + 1
+  if to < from then
+    error('StatsRange(): Arg "to" must not be before "from"')
+  elseif buckets > 10000 then
+    error('StatsRange(): Range spans more than 10000 buckets: ' .. buckets)
+  end
+
+  local response = {}
+  for _, stat in ipairs({'wait', 'run'}) do
+    local points = {}
+    for index = 0, buckets - 1 do
+      local bucket = first + index * series.width
+      local count, sum, sumsq = unpack(redis.call('hmget',
+        'ql:s:' .. stat .. '-' .. resolution .. ':' .. bucket .. ':' ..
+        self.name, 'count', 'sum', 'sumsq'))
+      count = tonumber(count) or 0
+      sum   = tonumber(sum) or 0
+      sumsq = tonumber(sumsq) or 0
+
+      local mean, std = 0, 0
+      if count > 0 then
+        mean = sum / count
+      end
+      if count > 1 then
+        std = math.sqrt(math.max(0, sumsq - sum * mean) / (count - 1))
+      end
+      table.insert(points, {time = bucket, count = count, mean = mean, std = std})
+    end
+    response[stat] = points
+  end
+  return response
+end
+
+-- Increment the `field` counter ('failed', 'failures' or 'retries') of this
+-- queue's stats by `increment`. The stats are those of the day of `when`, if
+-- provided, and otherwise of today.
+function QlessQueue:tally(now, field, increment, when)
+  when = when or now
+  local bin = when - (when % 86400)
+  local key = 'ql:s:stats:' .. bin .. ':' .. self.name
+  local expire = function() QlessQueue.expire(now, key, bin) end
+  if bin == now - (now % 86400) then
+    Qless.hincrby(key, field, increment, expire)
+  else
+    -- The stats of past days are seldom written to, and may well be past the
+    -- point they should be dropped
+    Qless.hincrby(key, field, increment)
+    Qless.defer('expire:' .. key, expire)
+  end
+end
+
+-- Set the stats `key` for the day `bin` to expire once it's older than the
+-- `stats-history` config option allows
+function QlessQueue.expire(now, key, bin)
+  local days = Qless.config.get('stats-history')
+  redis.call('expire', key, math.ceil(bin + (days + 1) * 86400 - now))
+end
+
+-- Compact(now, since, [budget])
+-- -----------------------------
+-- Enforce the retention of stats recorded by every known queue from the day
+-- of `since` up to today. Stats older than `stats-history` days are deleted,
+-- histograms older than `histogram-history` days are dropped while keeping
+-- their counts, and the rest are set to expire. Stats are expired as they're
+-- recorded, so this is only needed for stats that were recorded before that
+-- was the case.
+--
+-- Whole days are gone through until about `budget` (by default, 1000) keys
+-- have been looked at, though always at least one day. Returns the number of
+-- keys that were changed and, if there are days left, the day to pick up from
+-- as `next`:
+--
+--  {'changed': 9, 'next': 1352073600}
+function QlessQueue.compact(now, since, budget)
+  since = assert(tonumber(since),
+    'Compact(): Arg "since" missing or not a number: ' .. tostring(since))
+  budget = assert(tonumber(budget or 1000),
+    'Compact(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local today = now - (now % 86400)
+  local stats_cutoff = today - Qless.config.get('stats-history') * 86400
+  local histogram_cutoff =
+    today - Qless.config.get('histogram-history') * 86400
+
+  local queues = redis.call('zrange', 'ql:queues', 0, -1)
+  local changed, examined = 0, 0
+  if #queues == 0 then
+    return {changed = changed}
+  end
+
+  for bin = since - (since % 86400), today, 86400 do
+    if examined > 0 and examined + #queues * 3 > budget then
+      return {changed = changed, next = bin}
+    end
+    examined = examined + #queues * 3
+    for _, name in ipairs(queues) do
+      for _, stat in ipairs({'stats', 'wait', 'run'}) do
+        local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. name
+        if bin < stats_cutoff then
+          changed = changed + redis.call('del', key)
+        elseif redis.call('exists', key) == 1 then
+          if bin < histogram_cutoff and stat ~= 'stats' then
+            redis.call('hdel', key, unpack(QlessQueue.histogram))
+          end
+          QlessQueue.expire(now, key, bin)
+          changed = changed + 1
+        end
+      end
+    end
+  end
+  return {changed = changed}
+end
+
+-- Put(now, jid, klass, data, delay,
+--     [priority, p],
+--     [tags, t],
+--     [retries, r],
+--     [depends, '[...]'],
+--     [unique, key],
+--     [coalesce, 0|1])
+-- -----------------------
+-- Insert a job into the queue with the given priority, tags, delay, klass and
+-- data.
+--
+-- At most one job holding a given `unique` key may be waiting or scheduled in
+-- a queue at a time. Putting another returns the jid of the job already there
+-- instead, having first updated its data (and priority, if given) when
+-- `coalesce` is 1. The key is released once the job is popped.
+function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
+  assert(jid  , 'Put(): Arg "jid" missing')
+  assert(klass, 'Put(): Arg "klass" missing')
+  assert(cjson.decode(data), 'Put(): Arg "data" missing or not JSON: ' .. tostring(data))
+  delay = assert(tonumber(delay),
+    'Put(): Arg "delay" not a number: ' .. tostring(delay))
+
+  -- Read in all the optional parameters. All of these must come in pairs, so
+  -- if we have an odd number of extra args, raise an error
+  if #arg % 2 == 1 then
+    error('Odd number of additional args: ' .. tostring(arg))
+  end
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  -- Sanity check on optional args. This happens before anything is written,
+  -- even if the job turns out to be a duplicate of one already in the queue
+  for _, name in ipairs({'priority', 'retries', 'interval', 'replace'}) do
+    if options[name] then
+      assert(tonumber(options[name]),
+        'Put(): Arg "' .. name .. '" not a number: ' .. tostring(options[name]))
+    end
+  end
+  local new_tags = options['tags'] and assert(cjson.decode(options['tags']),
+    'Put(): Arg "tags" not JSON'        .. tostring(options['tags']))
+  local depends = assert(cjson.decode(options['depends'] or '[]') ,
+    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
+  local resources, weights = QlessResource.parse('Put', options['resources'])
+  assert(#resources == 0 or QlessResource.all_exist(resources), 'Put(): invalid resources requested')
+  QlessResource.check_weights('Put', weights)
+
+  -- If another job holding the same unique key is already waiting (or
+  -- scheduled) in this queue, then this put is either dropped or, if asked
+  -- to coalesce, folded into that job. Either way, that job's jid is returned
+  local unique = options['unique']
+  local coalesce = assert(tonumber(options['coalesce'] or 0),
+    'Put(): Arg "coalesce" not a number: ' .. tostring(options['coalesce']))
+  if unique then
+    local existing = self:unique(unique)
+    if existing and existing ~= jid then
+      if coalesce ~= 0 then
+        redis.call('hset', QlessJob.ns .. existing, 'data', data)
+        if options['priority'] then
+          Qless.job(existing):priority(options['priority'])
+        end
+      end
+      return existing
+    end
+  end
+
+  -- Let's see what the old priority and tags were
+  local job = Qless.job(jid)
+  local priority, tags, oldqueue, state, failure, retries, oldworker, interval, next_run, old_resources, history, old_unique =
+    unpack(redis.call('hmget', QlessJob.ns .. jid, 'priority', 'tags',
+      'queue', 'state', 'failure', 'retries', 'worker', 'throttle_interval', 'throttle_next_run', 'resources',
+      'history', 'unique'))
+
+  next_run = next_run or now
+
+  -- true if empty or anything other than false
+  local replace = assert(tonumber(options['replace'] or 1) ,
+    'Put(): Arg "replace" not a number: ' .. tostring(options['replace']))
+
+  if replace == 0 and state == 'running' then
+    local time_left = self.locks.job_time_left(now, jid)
+    if time_left > 0 then
+      return time_left
+    end
+  end
+
+  -- Remember the old tags, so that we only update the index for the tags that
+  -- have actually changed
+  local old_tags = Set.new(Qless.decode(tags or '[]'))
+
+  retries  = assert(tonumber(options['retries']  or retries or 5) ,
+    'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
+  tags = new_tags or Qless.decode(tags or '[]')
+  priority = assert(tonumber(options['priority'] or priority or 0),
+    'Put(): Arg "priority" not a number'  .. tostring(options['priority']))
+
+    -- if there were previously acquired resources, verify consistency
+  if old_resources then
+    old_resources = Set.new(Qless.decode(old_resources))
+    local removed_resources = Set.diff(old_resources, Set.new(resources))
+    for k in pairs(removed_resources) do
+      Qless.resource(k):release(now, jid)
+    end
+    -- The locks it keeps may need a different number of units now
+    for _, rid in ipairs(resources) do
+      if old_resources[rid] then
+        Qless.resource(rid):reweigh(now, jid, weights[rid] or 1)
+      end
+    end
+  end
+
+  local interval = assert(tonumber(options['interval'] or interval or 0),
+    'Put(): Arg "interval" not a number: ' .. tostring(options['interval']))
+
+  if interval > 0 then
+    local minimum_delay = next_run - now
+    if minimum_delay < 0 then
+      minimum_delay = 0
+    elseif minimum_delay > delay then
+      delay = minimum_delay
+    end
+  else
+    next_run = 0
+  end
+
+  -- If the job has old dependencies, determine which dependencies are
+  -- in the new dependencies but not in the old ones, and which are in the
+  -- old ones but not in the new
+  if #depends > 0 then
+    -- This makes it easier to check if it's in the new list
+    local new = {}
+    for _, d in ipairs(depends) do new[d] = 1 end
+
+    -- Now find what's in the original, but not the new
+    local original = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependencies')
+    for _, dep in pairs(original) do
+      if new[dep] == nil or new[dep] == false then
+        -- Remove k as a dependency
+        redis.call('srem', QlessJob.ns .. dep .. '-dependents'  , jid)
+        job:remove_dependency(dep)
+      end
+    end
+  end
+
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    jid   = jid,
+    event = 'put',
+    queue = self.name
+  }))
+
+  -- Update the history to include this new change, first bringing forward
+  -- any old-style history this job might have
+  if history then
+    job:migrate_history(history)
+  end
+  job:history(now, 'put', {q = self.name})
+
+  -- If this item was previously in another queue, then we should remove it from there
+  if oldqueue then
+    local queue_obj = Qless.queue(oldqueue)
+    queue_obj.work.remove(jid)
+    queue_obj.locks.remove(jid)
+    queue_obj.depends.remove(jid)
+    queue_obj.scheduled.remove(jid)
+    if old_unique then
+      queue_obj:release_unique(old_unique, jid)
+    end
+  end
+
+  -- If this had previously been given out to a worker, make sure to remove it
+  -- from that worker's jobs
+  if oldworker and oldworker ~= '' then
+    redis.call('zrem', 'ql:w:' .. oldworker .. ':jobs', jid)
+    -- If it's a different worker that's putting this job, send a notification
+    -- to the last owner of the job
+    if oldworker ~= worker then
+      -- We need to inform whatever worker had that job
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = oldworker
+      })
+      Qless.publish('w:' .. oldworker, encoded)
+      Qless.publish('log', encoded)
+    end
+  end
+
+  -- If the job was previously in the 'completed' state, then we should
+  -- remove it from being enqueued for destructination
+  if state == 'complete' then
+    redis.call('zrem', 'ql:completed', jid)
+  end
+
+  -- Remove this job from the tags it no longer has, and add it to those it
+  -- didn't have before
+  local new_tags = Set.new(tags)
+  for tag in pairs(Set.diff(old_tags, new_tags)) do
+    redis.call('zrem', 'ql:t:' .. tag, jid)
+    redis.call('zincrby', 'ql:tags', -1, tag)
+  end
+  for tag in pairs(Set.diff(new_tags, old_tags)) do
+    redis.call('zadd', 'ql:t:' .. tag, now, jid)
+    redis.call('zincrby', 'ql:tags', 1, tag)
+  end
+
+  -- If we're in the failed state, remove all of our data
+  if state == 'failed' then
+    failure = Qless.decode(failure)
+    -- We need to make this remove it from the failed queues
+    redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
+    if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
+      redis.call('srem', 'ql:failures', failure.group)
+    end
+    -- We also need to decrement the stats about the queue on
+    -- the day that this failure actually happened.
+    self:tally(now, 'failed', -1, failure.when)
+  end
+
+  -- First, let's save its data. Fields that are left at their defaults are
+  -- not stored at all
+  job:update({
+    jid               = jid,
+    klass             = klass,
+    data              = data,
+    priority          = priority,
+    tags              = Qless.encode(tags),
+    resources         = Qless.encode(resources),
+    weights           = Qless.encode(weights),
+    state             = ((delay > 0) and 'scheduled') or 'waiting',
+    worker            = '',
+    expires           = 0,
+    queue             = self.name,
+    retries           = retries,
+    remaining         = retries,
+    time              = Qless.time(now),
+    throttle_interval = interval,
+    throttle_next_run = next_run,
+    result_data       = '{}'
+  })
+
+  -- Claim the unique key, if there is one
+  if unique then
+    redis.call('set', 'ql:u:' .. self.name .. ':' .. unique, jid)
+    redis.call('hset', QlessJob.ns .. jid, 'unique', unique)
+  end
+
+  -- These are the jids we legitimately have to wait on
+  local unresolved = job:add_dependencies(depends)
+
+  -- Now, if a delay was provided, and if it's in the future,
+  -- then we'll have to schedule it. Otherwise, we're just
+  -- going to add it to the work queue.
+  if delay > 0 then
+    if unresolved > 0 then
+      -- We've already put it in 'depends'. Now, we must just save the data
+      -- for when it's scheduled
+      self.depends.add(now, jid)
+      redis.call('hmset', QlessJob.ns .. jid,
+        'state', 'depends',
+        'scheduled', now + delay)
+    else
+      self.scheduled.add(now + delay, jid)
+    end
+  else
+    if unresolved > 0 then
+      self.depends.add(now, jid)
+      redis.call('hset', QlessJob.ns .. jid, 'state', 'depends')
+    elseif #resources > 0 then
+      if Qless.job(jid):acquire_resources(now) then
+        self.work.add(now, priority, jid)
+      end
+    else
+      self.work.add(now, priority, jid)
+    end
+  end
+
+  self:record(now, 'put')
+
+  -- Lastly, we're going to make sure that this item is in the
+  -- set of known queues. We should keep this sorted by the
+  -- order in which we saw each of these queues
+  Qless.defer('known:' .. self.name, function()
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+  end)
+
+  if Qless.tracked(jid) then
+    Qless.publish('put', jid)
+  end
+
+  return jid
+end
+
+-- Put_many(now, worker, jobs)
+-- ---------------------------
+-- Put many jobs, possibly into several queues, in a single invocation. `jobs`
+-- is a JSON array of job specs, each with the arguments `put` would take:
+--
+--  [{
+--      'queue': 'queue',
+--      'jid': 'jid',
+--      'klass': 'klass',
+--      'data': {...},
+--      'delay': 0,
+--      # Any of put's options may also be given, like
+--      'priority': 10,
+--      'tags': ['foo', 'bar']
+--  }, ...]
+--
+-- Each job is put on its own, so one bad spec doesn't affect the others, and
+-- an outcome is returned for each, in order. That's either what `put` would
+-- have returned, or the error it raised:
+--
+--  [{'jid': 'jid', 'result': 'jid'}, {'jid': 'other', 'error': '...'}, ...]
+function QlessQueue.put_many(now, worker, jobs)
+  jobs = assert(cjson.decode(jobs or ''),
+    'Put_many(): Arg "jobs" missing or not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Put_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  -- Options are JSON-encoded when given to put
+  local encoded = {
+    tags = true, depends = true, resources = true
+  }
+  local fields = {
+    queue = true, jid = true, klass = true, data = true, delay = true
+  }
+
+  local seen = {}
+  return Qless.outcomes(jobs, function(spec)
+    assert(type(spec) == 'table', 'Put_many(): job spec not an object')
+    assert(spec.queue, 'Put_many(): Arg "queue" missing')
+    assert(not seen[spec.jid],
+      'Put_many(): job ' .. tostring(spec.jid) .. ' given more than once')
+    if spec.jid then
+      seen[spec.jid] = true
+    end
+
+    local data = spec.data or '{}'
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+
+    local options = {}
+    for key, value in pairs(spec) do
+      if not fields[key] then
+        if encoded[key] and type(value) == 'table' then
+          value = cjson.encode(value)
+        end
+        table.insert(options, key)
+        table.insert(options, value)
+      end
+    end
+
+    return Qless.queue(spec.queue):put(now, worker, spec.jid,
+      spec.klass, data, spec.delay or 0, unpack(options))
+  end)
+end
+
+-- Return the jid of the job waiting (or scheduled) in this queue that holds
+-- the unique `key`, if there is one. The index may be stale, so it's checked
+-- against the job itself
+function QlessQueue:unique(key)
+  local jid = redis.call('get', 'ql:u:' .. self.name .. ':' .. key)
+  if not jid then
+    return nil
+  end
+
+  local queue, state, unique = unpack(redis.call(
+    'hmget', QlessJob.ns .. jid, 'queue', 'state', 'unique'))
+  if queue == self.name and unique == key and
+    (state == 'waiting' or state == 'scheduled') then
+    return jid
+  end
+  return nil
+end
+
+-- Release the unique `key` held by `jid` in this queue, so that another job
+-- with the same key may be put
+function QlessQueue:release_unique(key, jid)
+  local index = 'ql:u:' .. self.name .. ':' .. key
+  if redis.call('get', index) == jid then
+    redis.call('del', index)
+  end
+  redis.call('hdel', QlessJob.ns .. jid, 'unique')
+end
+
+-- Move `count` jobs out of the failed state and into this queue
+function QlessQueue:unfail(now, group, count)
+  assert(group, 'Unfail(): Arg "group" missing')
+  count = assert(tonumber(count or 25),
+    'Unfail(): Arg "count" not a number: ' .. tostring(count))
+
+  -- Get up to that many jobs, and we'll put them in the appropriate queue
+  local jids = redis.call('lrange', 'ql:f:' .. group, -count, -1)
+
+  -- And now set each job's state, and put it into the appropriate queue
+  local toinsert = {}
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    local data = job:project({'jid', 'priority', 'retries', 'resources'})
+    job:history(now, 'put', {q = self.name})
+    job:update({
+      state     = 'waiting',
+      worker    = '',
+      expires   = 0,
+      queue     = self.name,
+      remaining = data.retries or 5
+    })
+
+    if #data['resources'] then
+      if job:acquire_resources(now) then
+        self.work.add(now, data.priority, data.jid)
+      end
+    else
+      self.work.add(now, data.priority, data.jid)
+    end
+  end
+
+  -- Remove these jobs from the failed state
+  redis.call('ltrim', 'ql:f:' .. group, 0, -count - 1)
+  if (redis.call('llen', 'ql:f:' .. group) == 0) then
+    redis.call('srem', 'ql:failures', group)
+  end
+
+  return #jids
+end
+
+-- Recur a job of type klass in this queue
+function QlessQueue:recur(now, jid, klass, data, spec, ...)
+  assert(jid  , 'RecurringJob On(): Arg "jid" missing')
+  assert(klass, 'RecurringJob On(): Arg "klass" missing')
+  assert(spec , 'RecurringJob On(): Arg "spec" missing')
+  assert(cjson.decode(data), 'RecurringJob On(): Arg "data" missing or not JSON: ' .. tostring(data))
+
+  -- At some point in the future, we may have different types of recurring
+  -- jobs, but for the time being, we only have 'interval'-type jobs
+  if spec == 'interval' then
+    local interval = assert(tonumber(arg[1]),
+      'Recur(): Arg "interval" not a number: ' .. tostring(arg[1]))
+    local offset   = assert(tonumber(arg[2]),
+      'Recur(): Arg "offset" not a number: '   .. tostring(arg[2]))
+    if interval <= 0 then
+      error('Recur(): Arg "interval" must be greater than 0')
+    end
+
+    -- Read in all the optional parameters. All of these must come in
+    -- pairs, so if we have an odd number of extra args, raise an error
+    if #arg % 2 == 1 then
+      error('Odd number of additional args: ' .. tostring(arg))
+    end
+
+    -- Read in all the optional parameters
+    local options = {}
+    for i = 3, #arg, 2 do options[arg[i]] = arg[i + 1] end
+    options.tags = assert(cjson.decode(options.tags or '{}'),
+      'Recur(): Arg "tags" must be JSON string array: ' .. tostring(
+        options.tags))
+    options.priority = assert(tonumber(options.priority or 0),
+      'Recur(): Arg "priority" not a number: ' .. tostring(
+        options.priority))
+    options.retries = assert(tonumber(options.retries  or 0),
+      'Recur(): Arg "retries" not a number: ' .. tostring(
+        options.retries))
+    options.backlog = assert(tonumber(options.backlog  or 0),
+      'Recur(): Arg "backlog" not a number: ' .. tostring(
+        options.backlog))
+    -- Make sure the resources are valid, though they're stored as declared
+    QlessResource.check_weights('Recur',
+      select(2, QlessResource.parse('Recur', options['resources'])))
+    options.resources = cjson.decode(options['resources'] or '[]')
+
+    local count, old_queue = unpack(redis.call('hmget', 'ql:r:' .. jid, 'count', 'queue'))
+    count = count or 0
+
+    -- If it has previously been in another queue, then we should remove
+    -- some information about it
+    if old_queue then
+      Qless.queue(old_queue).recurring.remove(jid)
+    end
+
+    -- Do some insertions
+    redis.call('hmset', 'ql:r:' .. jid,
+      'jid'      , jid,
+      'klass'    , klass,
+      'data'     , data,
+      'priority' , options.priority,
+      'tags'     , cjson.encode(options.tags or {}),
+      'state'    , 'recur',
+      'queue'    , self.name,
+      'type'     , 'interval',
+      -- How many jobs we've spawned from this
+      'count'    , count,
+      'interval' , interval,
+      'retries'  , options.retries,
+      'backlog'  , options.backlog,
+      'resources', cjson.encode(options.resources))
+    -- Now, we should schedule the next run of the job
+    self.recurring.add(now + offset, jid)
+
+    -- Lastly, we're going to make sure that this item is in the
+    -- set of known queues. We should keep this sorted by the
+    -- order in which we saw each of these queues
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+
+    return jid
+  else
+    error('Recur(): schedule type "' .. tostring(spec) .. '" unknown')
+  end
+end
+
+-- Return the length of the queue
+function QlessQueue:length()
+  return  self.locks.length() + self.work.length() + self.scheduled.length()
+end
+
+-------------------------------------------------------------------------------
+-- Housekeeping methods
+-------------------------------------------------------------------------------
+-- Note that this queue has a scheduled or recurring job due at `when`, so
+-- that its entry in the global due-time index is no later than that
+function QlessQueue:due(when)
+  -- In a batch, the entry is recomputed once all its additions are made
+  if Qless.batching then
+    return Qless.defer('due:' .. self.name, function() self:reindex() end)
+  end
+
+  local score = redis.call('zscore', 'ql:due', self.name)
+  if (not score) or (tonumber(when) < tonumber(score)) then
+    redis.call('zadd', 'ql:due', when, self.name)
+  end
+end
+
+-- Recompute this queue's entry in the due-time index from the earliest of its
+-- scheduled and recurring jobs. Queues with neither are kept in the index
+-- with a score of '+inf', so that they can be told apart from queues that
+-- were created before the index existed, which we always have to check
+function QlessQueue:reindex()
+  local when = '+inf'
+  for _, group in ipairs({'scheduled', 'recur'}) do
+    local first = redis.call(
+      'zrange', self:prefix(group), 0, 0, 'WITHSCORES')[2]
+    if first and (when == '+inf' or tonumber(first) < when) then
+      when = tonumber(first)
+    end
+  end
+  redis.call('zadd', 'ql:due', when, self.name)
+end
+
+-- Instantiate up to `count` recurring jobs and move up to `count` scheduled
+-- jobs into the work queue, but only if the due-time index says that
+-- something in this queue has come due. Returns the number of jobs promoted
+function QlessQueue:promote(now, count)
+  local due = redis.call('zscore', 'ql:due', self.name)
+  if due and tonumber(due) > now then
+    return 0
+  end
+
+  local moved = self:check_recurring(now, count)
+  moved = moved + self:check_scheduled(now, count)
+  self:reindex()
+  return moved
+end
+
+-- Tick(now, budget)
+-- -----------------
+-- Promote due scheduled jobs and spawn due recurring jobs across all queues,
+-- earliest due first, without waiting for somebody to pop those queues.
+-- At most `budget` jobs are promoted per call, so a large backlog may take
+-- several ticks to drain. Returns the number of jobs promoted.
+function QlessQueue.tick(now, budget)
+  budget = assert(tonumber(budget),
+    'Tick(): Arg "budget" missing or not a number: ' .. tostring(budget))
+
+  local moved = 0
+  local queues = redis.call(
+    'zrangebyscore', 'ql:due', '-inf', now, 'LIMIT', 0, budget)
+  for _, name in ipairs(queues) do
+    if moved >= budget then
+      break
+    end
+    local queue = Qless.queue(name)
+    moved = moved + queue:check_recurring(now, budget - moved)
+    moved = moved + queue:check_scheduled(now, budget - moved)
+    queue:reindex()
+  end
+  return moved
+end
+
+-- Instantiate any recurring jobs that are ready, returning how many were
+-- spawned
+function QlessQueue:check_recurring(now, count)
+  -- This is how many jobs we've moved so far
+  local moved = 0
+  -- These are the recurring jobs that need work
+  local r = self.recurring.peek(now, 0, count)
+  for index, jid in ipairs(r) do
+    -- For each of the jids that need jobs scheduled, first
+    -- get the last time each of them was run, and then increment
+    -- it by its interval. While this time is less than now,
+    -- we need to keep putting jobs on the queue
+    local klass, data, priority, tags, retries, interval, backlog, resources = unpack(
+      redis.call('hmget', 'ql:r:' .. jid, 'klass', 'data', 'priority',
+        'tags', 'retries', 'interval', 'backlog', 'resources'))
+    local _tags = cjson.decode(tags)
+    local resources, weights = QlessResource.parse('Recur', resources)
+    local score = math.floor(tonumber(self.recurring.score(jid)))
+    interval = tonumber(interval)
+
+    -- If the backlog is set for this job, then see if it's been a long
+    -- time since the last pop
+    backlog = tonumber(backlog or 0)
+    if backlog ~= 0 then
+      -- Check how many jobs we could concievably generate
+      local num = ((now - score) / interval)
+      if num > backlog then
+        -- Update the score
+        score = score + (
+          math.ceil(num - backlog) * interval
+        )
+      end
+    end
+
+    -- We're saving this value so that in the history, we can accurately
+    -- reflect when the job would normally have been scheduled
+    while (score <= now) and (moved < count) do
+      local count = redis.call('hincrby', 'ql:r:' .. jid, 'count', 1)
+      moved = moved + 1
+
+      local child_jid = jid .. '-' .. count
+
+      -- Add this job to the list of jobs tagged with whatever tags were
+      -- supplied
+      for i, tag in ipairs(_tags) do
+        redis.call('zadd', 'ql:t:' .. tag, now, child_jid)
+        redis.call('zincrby', 'ql:tags', 1, tag)
+      end
+
+      -- First, let's save its data
+      local job = Qless.job(child_jid)
+      job:update({
+        jid               = child_jid,
+        klass             = klass,
+        data              = data,
+        priority          = priority,
+        tags              = Qless.encode(_tags),
+        state             = 'waiting',
+        worker            = '',
+        expires           = 0,
+        queue             = self.name,
+        retries           = retries,
+        remaining         = retries,
+        resources         = Qless.encode(resources),
+        weights           = Qless.encode(weights),
+        throttle_interval = 0,
+        time              = Qless.time(score),
+        spawned_from_jid  = jid
+      })
+      job:history(score, 'put', {q = self.name})
+
+      -- Now, if a delay was provided, and if it's in the future,
+      -- then we'll have to schedule it. Otherwise, we're just
+      -- going to add it to the work queue.
+
+      local add_job = true
+      if #resources then
+        add_job = job:acquire_resources(score)
+      end
+      if add_job then
+        self.work.add(score, priority, child_jid)
+      end
+
+      score = score + interval
+      self.recurring.add(score, jid)
+    end
+  end
+  return moved
+end
+
+-- Check for any jobs that have been scheduled, and shovel them onto
+-- the work queue. Up to `count` scheduled jobs will be moved into the work
+-- queue, and the number moved is returned
+function QlessQueue:check_scheduled(now, count)
+  -- zadd is a list of arguments that we'll be able to use to
+  -- insert into the work queue
+  local scheduled = self.scheduled.ready(now, 0, count)
+  for index, jid in ipairs(scheduled) do
+    -- With these in hand, we'll have to go out and find the
+    -- priorities of these jobs, and then we'll insert them
+    -- into the work queue and then when that's complete, we'll
+    -- remove them from the scheduled queue
+    local priority = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'priority') or 0)
+    if Qless.job(jid):acquire_resources(now) then
+      self.work.add(now, priority, jid)
+    end
+    self.scheduled.remove(jid)
+
+    -- We should also update them to have the state 'waiting'
+    -- instead of 'scheduled'
+    redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
+  end
+  return #scheduled
+end
+
+-- Check for and invalidate any locks that have been lost. Returns the
+-- list of jids that have been invalidated
+function QlessQueue:invalidate_locks(now, count)
+  local jids = {}
+  -- Iterate through all the expired locks and add them to the list
+  -- of keys that we'll return
+  for index, jid in ipairs(self.locks.expired(now, 0, count)) do
+    -- Remove this job from the jobs that the worker that was running it
+    -- has
+    local worker, failure = unpack(
+      redis.call('hmget', QlessJob.ns .. jid, 'worker', 'failure'))
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+
+    -- We'll provide a grace period after jobs time out for them to give
+    -- some indication of the failure mode. After that time, however, we'll
+    -- consider the worker dust in the wind
+    local grace_period = Qless.config.get('grace-period')
+
+    -- Whether or not we've already sent a coutesy message
+    local courtesy_sent = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'grace') or 0)
+
+    -- If the remaining value is an odd multiple of 0.5, then we'll assume
+    -- that we're just sending the message. Otherwise, it's time to
+    -- actually hand out the work to another worker
+    local send_message = (courtesy_sent ~= 1)
+    local invalidate   = not send_message
+
+    -- If the grace period has been disabled, then we'll do both.
+    if grace_period <= 0 then
+      send_message = true
+      invalidate   = true
+    end
+
+    if send_message then
+      -- This is where we supply a courtesy message and give the worker
+      -- time to provide a failure message
+      if redis.call('zscore', 'ql:tracked', jid) ~= false then
+        Qless.publish('stalled', jid)
+      end
+      Qless.job(jid):history(now, 'timed-out')
+      redis.call('hset', QlessJob.ns .. jid, 'grace', 1)
+
+      -- Send a message to let the worker know that its lost its lock on
+      -- the job
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = worker
+      })
+      Qless.publish('w:' .. worker, encoded)
+      Qless.publish('log', encoded)
+      self.locks.add(now + grace_period, jid)
+      QlessWorker.tally(now, worker, 'lost', 1)
+
+      -- If we got any expired locks, then we should increment the
+      -- number of retries for this stage for this bin
+      self:tally(now, 'retries', 1)
+    end
+
+    if invalidate then
+      -- Unset the grace period attribute so that next time we'll send
+      -- the grace period
+      redis.call('hdel', QlessJob.ns .. jid, 'grace', 0)
+
+      -- See how many remaining retries the job has
+      local remaining = tonumber(redis.call(
+        'hincrby', QlessJob.ns .. jid, 'remaining', -1))
+
+      -- This is where we actually have to time out the work
+      if remaining < 0 then
+        Qless.job(jid):release_resources(now)
+
+        -- Now remove the instance from the schedule, and work queues
+        -- for the queue it's in
+        self.work.remove(jid)
+        self.locks.remove(jid)
+        self.scheduled.remove(jid)
+
+        local group = 'failed-retries-' .. unpack(Qless.job(jid):data('queue'))
+        local job = Qless.job(jid)
+        job:history(now, 'failed', {group = group})
+        job:update({state = 'failed', worker = '', expires = 0})
+        -- If the failure has not already been set, then set it
+        redis.call('hset', QlessJob.ns .. jid,
+        'failure', Qless.encode({
+          ['group']   = group,
+          ['message'] =
+            'Job exhausted retries in queue "' .. self.name .. '"',
+          ['when']    = now,
+          ['worker']  = unpack(job:data('worker'))
+        }))
+
+        -- Add this type of failure to the list of failures
+        redis.call('sadd', 'ql:failures', group)
+        -- And add this particular instance to the failed types
+        redis.call('lpush', 'ql:f:' .. group, jid)
+
+        if redis.call('zscore', 'ql:tracked', jid) ~= false then
+          Qless.publish('failed', jid)
+        end
+        Qless.publish('log', cjson.encode({
+          jid     = jid,
+          event   = 'failed',
+          group   = group,
+          worker  = worker,
+          message =
+            'Job exhausted retries in queue "' .. self.name .. '"'
+        }))
+
+        -- Increment the count of the failed jobs
+        self:tally(now, 'failures', 1)
+        self:tally(now, 'failed'  , 1)
+        self:record(now, 'fail')
+        QlessWorker.tally(now, worker, 'failed', 1)
+      else
+        table.insert(jids, jid)
+      end
+    end
+  end
+
+  return jids
+end
+
+-- Forget the provided queues. As in, remove them from the list of known queues
+function QlessQueue.deregister(...)
+  redis.call('zrem', Qless.ns .. 'queues', unpack(arg))
+  redis.call('zrem', Qless.ns .. 'due', unpack(arg))
+end
+
+-- Return information about a particular queue, or all queues
+--  [
+--      {
+--          'name': 'testing',
+--          'stalled': 2,
+--          'waiting': 5,
+--          'running': 5,
+--          'scheduled': 10,
+--          'depends': 5,
+--          'recurring': 0
+--      }, {
+--          ...
+--      }
+--  ]
+function QlessQueue.counts(now, name)
+  if name then
+    local queue = Qless.queue(name)
+    local stalled = queue.locks.length(now)
+    -- Check for any scheduled jobs that need to be moved
+    queue:check_scheduled(now, queue.scheduled.length())
+    return {
+      name      = name,
+      waiting   = queue.work.length(),
+      stalled   = stalled,
+      running   = queue.locks.length() - stalled,
+      scheduled = queue.scheduled.length(),
+      depends   = queue.depends.length(),
+      recurring = queue.recurring.length(),
+      paused    = queue:paused()
+    }
+  else
+    local queues = redis.call('zrange', 'ql:queues', 0, -1)
+    local response = {}
+    for index, qname in ipairs(queues) do
+      table.insert(response, QlessQueue.counts(now, qname))
+    end
+    return response
+  end
+end
+-- Get all the attributes of this particular job
+function QlessRecurringJob:data()
+  local job = redis.call(
+    'hmget', 'ql:r:' .. self.jid, 'jid', 'klass', 'state', 'queue',
+    'priority', 'interval', 'retries', 'count', 'data', 'tags', 'backlog')
+
+  if not job[1] then
+    return nil
+  end
+
+  return {
+    jid          = job[1],
+    klass        = job[2],
+    state        = job[3],
+    queue        = job[4],
+    priority     = tonumber(job[5]),
+    interval     = tonumber(job[6]),
+    retries      = tonumber(job[7]),
+    count        = tonumber(job[8]),
+    data         = job[9],
+    tags         = cjson.decode(job[10]),
+    backlog      = tonumber(job[11] or 0)
+  }
+end
+
+-- Update the recurring job data. Key can be:
+--      - priority
+--      - interval
+--      - retries
+--      - data
+--      - klass
+--      - queue
+--      - backlog
+function QlessRecurringJob:update(now, ...)
+  local options = {}
+  -- Make sure that the job exists
+  if redis.call('exists', 'ql:r:' .. self.jid) ~= 0 then
+    for i = 1, #arg, 2 do
+      local key = arg[i]
+      local value = arg[i+1]
+      assert(value, 'No value provided for ' .. tostring(key))
+      if key == 'priority' or key == 'interval' or key == 'retries' then
+        value = assert(tonumber(value), 'Recur(): Arg "' .. key .. '" must be a number: ' .. tostring(value))
+        -- If the command is 'interval', then we need to update the
+        -- time when it should next be scheduled
+        if key == 'interval' then
+          local queue, interval = unpack(redis.call('hmget', 'ql:r:' .. self.jid, 'queue', 'interval'))
+          Qless.queue(queue).recurring.update(
+            value - tonumber(interval), self.jid)
+        end
+        redis.call('hset', 'ql:r:' .. self.jid, key, value)
+      elseif key == 'data' then
+        assert(cjson.decode(value), 'Recur(): Arg "data" is not JSON-encoded: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'data', value)
+      elseif key == 'klass' then
+        redis.call('hset', 'ql:r:' .. self.jid, 'klass', value)
+      elseif key == 'queue' then
+        local queue_obj = Qless.queue(
+          redis.call('hget', 'ql:r:' .. self.jid, 'queue'))
+        local score = queue_obj.recurring.score(self.jid)
+        queue_obj.recurring.remove(self.jid)
+        Qless.queue(value).recurring.add(score, self.jid)
+        redis.call('hset', 'ql:r:' .. self.jid, 'queue', value)
+        -- If we don't already know about the queue, learn about it
+        if redis.call('zscore', 'ql:queues', value) == false then
+          redis.call('zadd', 'ql:queues', now, value)
+        end
+      elseif key == 'backlog' then
+        value = assert(tonumber(value),
+          'Recur(): Arg "backlog" not a number: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'backlog', value)
+      else
+        error('Recur(): Unrecognized option "' .. key .. '"')
+      end
+    end
+    return true
+  else
+    error('Recur(): No recurring job ' .. self.jid)
+  end
+end
+
+-- Tags this recurring job with the provided tags
+function QlessRecurringJob:tag(...)
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  -- If the job has been canceled / deleted, then return false
+  if tags then
+    -- Decode the json blob, convert to dictionary
+    tags = cjson.decode(tags)
+    local _tags = {}
+    for i,v in ipairs(tags) do _tags[v] = true end
+
+    -- Otherwise, add the job to the sorted set with that tags
+    for i=1,#arg do if _tags[arg[i]] == nil or _tags[arg[i]] == false then table.insert(tags, arg[i]) end end
+
+    tags = cjson.encode(tags)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Tag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+-- Removes a tag from the recurring job
+function QlessRecurringJob:untag(...)
+  -- Get the existing tags
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  -- If the job has been canceled / deleted, then return false
+  if tags then
+    -- Decode the json blob, convert to dictionary
+    tags = cjson.decode(tags)
+    local _tags    = {}
+    -- Make a hash
+    for i,v in ipairs(tags) do _tags[v] = true end
+    -- Delete these from the hash
+    for i = 1,#arg do _tags[arg[i]] = nil end
+    -- Back into a list
+    local results = {}
+    for i, tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+    -- json encode them, set, and return
+    tags = cjson.encode(results)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Untag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+-- Stop further occurrences of this job
+function QlessRecurringJob:unrecur()
+  -- First, find out what queue it was attached to
+  local queue = redis.call('hget', 'ql:r:' .. self.jid, 'queue')
+  if queue then
+    -- Now, delete it from the queue it was attached to, and delete the
+    -- thing itself
+    Qless.queue(queue).recurring.remove(self.jid)
+    redis.call('del', 'ql:r:' .. self.jid)
+    return true
+  else
+    return true
+  end
+end
+-- Deregisters these workers from the list of known workers
+function QlessWorker.deregister(...)
+  redis.call('zrem', 'ql:workers', unpack(arg))
+end
+
+-- Provide data about all the workers, or if a specific worker is provided,
+-- then which jobs that worker is responsible for. If no worker is provided,
+-- expect a response of the form:
+--
+--  [
+--      # This is sorted by the recency of activity from that worker
+--      {
+--          'name'   : 'hostname1-pid1',
+--          'jobs'   : 20,
+--          'stalled': 0
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- If a worker id is provided, then expect a response of the form:
+--
+--  {
+--      'jobs': [
+--          jid1,
+--          jid2,
+--          ...
+--      ], 'stalled': [
+--          jid1,
+--          ...
+--      ]
+--  }
+--
+function QlessWorker.counts(now, worker)
+  -- Clean up all the workers' job lists if they're too old. This is
+  -- determined by the `max-worker-age` configuration, defaulting to the
+  -- last day. Seems like a 'reasonable' default
+  local interval = Qless.config.get('max-worker-age', 86400)
+
+  local workers  = redis.call('zrangebyscore', 'ql:workers', 0, now - interval)
+  for index, worker in ipairs(workers) do
+    redis.call('del', 'ql:w:' .. worker .. ':jobs')
+  end
+
+  -- And now remove them from the list of known workers
+  redis.call('zremrangebyscore', 'ql:workers', 0, now - interval)
+
+  if worker then
+    return {
+      jobs    = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now + 8640000, now),
+      stalled = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now, 0)
+    }
+  else
+    local response = {}
+    local workers = redis.call('zrevrange', 'ql:workers', 0, -1)
+    for index, worker in ipairs(workers) do
+      table.insert(response, {
+        name    = worker,
+        jobs    = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', now, now + 8640000),
+        stalled = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', 0, now)
+      })
+    end
+    return response
+  end
+end
+
+-- Stats(now, worker, date, [percentiles])
+-- ---------------------------------------
+-- Return the stats of `worker` for the day of `date`, kept much as those of
+-- queues are. It returns how many jobs it popped, completed and failed, how
+-- many locks it lost, and the run time of the jobs that it completed:
+--
+--  {
+--      'popped'   : 12,
+--      'completed': 10,
+--      'failed'   : 1,
+--      'lost'     : 1,
+--      'run'      : {
+--          'count'    : 10,
+--          'mean'     : ...,
+--          'std'      : ...,
+--          'histogram': [...]
+--      }
+--  }
+--
+-- As with the stats of queues, if `percentiles` is provided as a JSON array of
+-- numbers between 0 and 100, then the run time histogram is replaced by a
+-- `percentiles` list of estimates of those percentiles.
+function QlessWorker.stats(now, worker, date, percentiles)
+  worker = assert(worker, 'WorkerStats(): Arg "worker" missing')
+  date = assert(tonumber(date),
+    'WorkerStats(): Arg "date" missing or not a number: ' .. tostring(date))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  -- The run time of every job completed is recorded, so the number completed
+  -- is the count of those
+  local bin = date - (date % 86400)
+  local popped, completed, failed, lost = unpack(redis.call('hmget',
+    'ql:s:worker:' .. bin .. ':' .. worker,
+    'popped', 'count', 'failed', 'lost'))
+  return {
+    popped    = tonumber(popped    or 0),
+    completed = tonumber(completed or 0),
+    failed    = tonumber(failed    or 0),
+    lost      = tonumber(lost      or 0),
+    run       = QlessQueue.summarize(
+      QlessQueue.read_stats('worker', bin, worker), percentiles)
+  }
+end
+
+-- Increment the `field` counter ('popped', 'failed' or 'lost')
+-- of today's stats for `worker` by `increment`
+function QlessWorker.tally(now, worker, field, increment)
+  local bin = now - (now % 86400)
+  local key = 'ql:s:worker:' .. bin .. ':' .. worker
+  Qless.hincrby(key, field, increment, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+end
+
+-- Record the run times `vals` (a number or a table of them) of jobs that
+-- `worker` completed in today's stats
+function QlessWorker.stat(now, worker, vals)
+  if type(vals) ~= 'table' then
+    vals = {vals}
+  end
+
+  -- In a batch, gather up the values and record them all at once
+  if Qless.batching then
+    local name = 'stat:worker:' .. worker
+    local pending = Qless.memo(name, function() return {} end)
+    table.extend(pending, vals)
+    return Qless.defer(name, function()
+      QlessWorker.stat(now, worker, pending)
+    end)
+  end
+
+  local bin = now - (now % 86400)
+  local key = 'ql:s:worker:' .. bin .. ':' .. worker
+  QlessQueue.accumulate(key, vals, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+end
+-------------------------------------------------------------------------------
+-- Resource Class
+--
+-- Returns an object that represents a resource with the provided RID
+-------------------------------------------------------------------------------
+
+----
+-- This gets all the data associated with the resource with the provided id. If the
+-- job is not found, it returns nil. If found, it returns an object with the
+-- appropriate properties
+function QlessResource:data(...)
+  local res = redis.call(
+    'hmget', QlessResource.ns .. self.rid, 'rid', 'max')
+
+  -- Return nil if we haven't found it
+  if not res[1] then
+    return nil
+  end
+
+  local data = {
+    rid          = res[1],
+    max          = tonumber(res[2] or 0),
+    used         = self:used(),
+    pending      = self:pending(),
+    locks        = self:locks(),
+  }
+
+  return data
+end
+
+function QlessResource:get(...)
+  local res = redis.call(
+    'hmget', QlessResource.ns .. self.rid, 'rid', 'max')
+
+  -- Return nil if we haven't found it
+  if not res[1] then
+    return nil
+  end
+
+  return tonumber(res[2] or 0)
+end
+
+function QlessResource:set(now, max)
+  local max = assert(tonumber(max), 'Set(): Arg "max" not a number: ' .. tostring(max))
+
+  redis.call('hmset', QlessResource.ns .. self.rid, 'rid', self.rid, 'max', max);
+  redis.call('zadd', 'ql:resources', 0, self.rid)
+
+  -- If the max has gone up, there may be locks free for jobs waiting on it
+  self:grant(now)
+
+  return self.rid
+end
+
+function QlessResource:unset()
+  redis.call('zrem', 'ql:resources', self.rid)
+  return redis.call('del', QlessResource.ns .. self.rid);
+end
+
+function QlessResource:prefix(group)
+  if group then
+    return QlessResource.ns..self.rid..'-'..group
+  end
+
+  return QlessResource.ns..self.rid
+end
+
+-- Return whether `jid` holds, or could acquire, a lock on this resource
+-- without acquiring it, given that `claimed` further units have already been
+-- promised elsewhere
+function QlessResource:available(jid, claimed)
+  local max = self:get()
+  if max == nil then
+    return false
+  end
+
+  if redis.call('sismember', self:prefix('locks'), jid) == 1 then
+    return true
+  end
+
+  return max - self:used() - self:held_back(jid) - (claimed or 0) >=
+    Qless.job(jid):weight(self.rid)
+end
+
+-- Return the number of free units that are held back from `jid` for a job
+-- that needs more than are free, and that's waiting ahead of it
+function QlessResource:held_back(jid)
+  local reserved = redis.call('hget', QlessResource.ns .. self.rid, 'reserved')
+  if not reserved or reserved == jid or
+    redis.call('zscore', self:prefix('pending'), reserved) == false then
+    return 0
+  end
+  return Qless.job(reserved):weight(self.rid)
+end
+
+-- Acquire a lock on this resource for `jid`, which takes `weight` (by
+-- default, 1) of its units, or else add it to the jobs waiting on it. If it
+-- has to wait because too few units are free, rather than because they're
+-- held back for another job, then they're held back for it from then on.
+function QlessResource:acquire(now, priority, jid, weight)
+  local keyLocks = self:prefix('locks')
+  local max = self:get()
+  if max == nil then
+    error({code=1, msg='Acquire(): resource ' .. self.rid .. ' does not exist'})
+  end
+
+  if type(jid) ~= 'string' then
+    error({code=2, msg='Acquire(): invalid jid; expected string, got \'' .. type(jid) .. '\''})
+  end
+
+
+  -- check if already has a lock, then just return.  This is used for when multiple resources are needed.
+  if redis.call('sismember', self:prefix('locks'), jid) == 1 then
+    return true
+  end
+
+  local held_back = self:held_back(jid)
+  local remaining = max - self:used() - held_back
+  weight = weight or 1
+
+  if remaining >= weight then
+    -- acquire a lock and release it from the pending queue
+    redis.call('sadd', keyLocks, jid)
+    if weight ~= 1 then
+      redis.call('hset', self:prefix('weights'), jid, weight)
+    end
+    redis.call('hincrby', self:prefix(), 'used', weight)
+    redis.call('zrem', self:prefix('pending'), jid)
+
+    return true
+  end
+
+  -- check if already pending, then don't update its priority.
+  if redis.call('zscore', self:prefix('pending'), jid) == false then
+    redis.call('zadd', self:prefix('pending'), priority - (now / 10000000000), jid)
+  end
+
+  -- Jobs needing more than the max can only wait for it to be raised
+  if held_back == 0 and weight <= max then
+  end
+
+  return false
+end
+
+--- Releases the resource for the specified job identifier and assigns it to the next waiting job
+-- @param now
+-- @param jid
+--
+function QlessResource:release(now, jid)
+  local keyLocks = self:prefix('locks')
+  local keyPending = self:prefix('pending')
+
+  if redis.call('sismember', keyLocks, jid) == 1 then
+    self:use(-tonumber(redis.call('hget', self:prefix('weights'), jid) or 1))
+    redis.call('srem', keyLocks, jid)
+    redis.call('hdel', self:prefix('weights'), jid)
+  end
+  redis.call('zrem', keyPending, jid)
+
+  return self:grant(now)[1] or false
+end
+
+-- Change the number of units that the lock `jid` holds on this resource takes
+-- to `weight`, if it holds one. If too few units are free for that, the lock
+-- is released instead, for the job to wait on it again.
+function QlessResource:reweigh(now, jid, weight)
+  if redis.call('sismember', self:prefix('locks'), jid) == 0 then
+    return
+  end
+
+  local held = tonumber(redis.call('hget', self:prefix('weights'), jid) or 1)
+  if held == weight then
+    return
+  end
+
+  if self:used() - held + weight > (self:get() or 0) then
+    self:release(now, jid)
+    return
+  end
+
+  self:use(weight - held)
+  if weight == 1 then
+    redis.call('hdel', self:prefix('weights'), jid)
+  else
+    redis.call('hset', self:prefix('weights'), jid, weight)
+  end
+  -- Units that it no longer needs may be of use to the jobs waiting
+  if weight < held then
+    self:grant(now)
+  end
+end
+
+-- Grant this resource's free units to the jobs waiting on it, in order of
+-- priority. Jobs that are also waiting on another resource are passed over in
+-- favour of later ones that can run, looking at no more than
+-- `resource-grant-budget` (100 by default) of them. If there's still room after
+-- that, the first job passed over takes a lock, so that jobs that need several
+-- resources aren't starved. Likewise, once a job needs more units than are
+-- free, the free units are held back for it rather than granted to the jobs
+-- after it, so that jobs that need many units aren't starved either. Returns
+-- the jids that took locks.
+function QlessResource:grant(now)
+  local max = self:get()
+  if max == nil then
+    return {}
+  end
+
+  -- Whichever job units were held back for, it's decided again here
+  redis.call('hdel', QlessResource.ns .. self.rid, 'reserved')
+  local free = max - self:used()
+  if free <= 0 then
+    return {}
+  end
+
+  local budget = Qless.config.get('resource-grant-budget')
+  local jids = redis.call(
+    'zrevrange', self:prefix('pending'), 0, budget - 1, 'withscores')
+
+  local granted, passed = {}, nil
+  for i = 1, #jids, 2 do
+    if free <= 0 then
+      break
+    end
+
+    local weight = Qless.job(jids[i]):weight(self.rid)
+    if weight > max then
+      -- The max has been lowered below what it needs, so it can only wait
+      -- for it to be raised again
+    elseif weight > free then
+      redis.call('hset', QlessResource.ns .. self.rid, 'reserved', jids[i])
+      break
+    elseif Qless.job(jids[i]):blocked(self.rid) then
+      passed = passed or i
+    else
+      self:admit(now, jids[i], jids[i + 1])
+      table.insert(granted, jids[i])
+      free = max - self:used()
+    end
+  end
+
+  if passed and self:available(jids[passed]) then
+    self:admit(now, jids[passed], jids[passed + 1])
+    table.insert(granted, jids[passed])
+  end
+  return granted
+end
+
+-- Have the pending `jid` acquire its resources, and if it gets them all, add
+-- it to the work queue of its queue with the pending `score`
+function QlessResource:admit(now, jid, score)
+  if Qless.job(jid):acquire_resources(now) then
+    local queue = Qless.queue(unpack(Qless.job(jid):data('queue')))
+    queue.work.add(score, 0, jid)
+  end
+end
+
+--- Return the list of job IDs with locks for this resource
+--
+function QlessResource:locks()
+  return redis.call('smembers', self:prefix('locks'))
+end
+
+--- Return the number of active locks for this resource
+--
+function QlessResource:lock_count()
+  return redis.call('scard', self:prefix('locks'))
+end
+
+--- Return the number of units of this resource that its locks take. This is
+--  kept in the `used` field of its hash as locks are taken and released. If
+--  it isn't there yet (as for resources whose locks were taken before it was
+--  kept), it's counted from the locks, each of which takes one unit except
+--  for those with a weight in the `-weights` hash, and then kept from then on.
+--  Returns whether it's kept, too, which it isn't for resources that have been
+--  unset.
+--
+function QlessResource:used()
+  local used = redis.call('hget', self:prefix(), 'used')
+  if used then
+    return tonumber(used), true
+  end
+
+  used = self:lock_count()
+  for _, weight in ipairs(redis.call('hvals', self:prefix('weights'))) do
+    used = used + tonumber(weight) - 1
+  end
+  if redis.call('exists', self:prefix()) == 0 then
+    return used, false
+  end
+  redis.call('hset', self:prefix(), 'used', used)
+  return used, true
+end
+
+--- Add `units` (which may be negative) to the number of units in use, which
+--  must be done before the locks themselves change
+--
+function QlessResource:use(units)
+  local _, kept = self:used()
+  if kept then
+    redis.call('hincrby', self:prefix(), 'used', units)
+  end
+end
+
+--- Return the list of job identifiers waiting for this resource
+--
+function QlessResource:pending()
+  return redis.call('zrevrange', self:prefix('pending'), 0, -1)
+end
+
+--- Return the number of jobs waiting for this resource
+--
+function QlessResource:pending_count()
+  return redis.call('zcard', self:prefix('pending'))
+end
+
+function QlessResource:exists()
+  return redis.call('exists', self:prefix()) == 1
+end
+
+-- Parse the resources that a job needs, declared by `name` ('Put' or 'Recur')
+-- as either a JSON array of resource ids, each needing a single unit, or a
+-- JSON object mapping resource ids to the number of units needed. Returns the
+-- list of resource ids, and a table of the weights of those that need more
+-- than a single unit.
+function QlessResource.parse(name, resources)
+  local ok, decoded = pcall(cjson.decode, resources or '[]')
+  if not ok or type(decoded) ~= 'table' then
+    error(name .. '(): Arg "resources" not JSON array or object: ' ..
+      tostring(resources))
+  end
+  if #decoded > 0 or next(decoded) == nil then
+    return decoded, {}
+  end
+
+  local rids, weights = {}, {}
+  for rid, weight in pairs(decoded) do
+    if type(weight) ~= 'number' or weight < 1 or
+      weight ~= math.floor(weight) then
+      error(name .. '(): Weight of resource "' .. rid ..
+        '" not a positive integer: ' .. tostring(weight))
+    end
+    table.insert(rids, rid)
+    if weight ~= 1 then
+      weights[rid] = weight
+    end
+  end
+  table.sort(rids)
+  return rids, weights
+end
+
+-- Raise an error on behalf of `name` ('Put' or 'Recur') if any of `weights`
+-- is more than the units that its resource has, since that job could never
+-- run. Resources that don't exist are left for the caller to check.
+function QlessResource.check_weights(name, weights)
+  for rid, weight in pairs(weights) do
+    local max = Qless.resource(rid):get()
+    if max and weight > max then
+      error(name .. '(): Weight of resource "' .. rid .. '" (' .. weight ..
+        ') more than its max: ' .. max)
+    end
+  end
+end
+
+---- Return true if all resources exist
+--
+function QlessResource.all_exist(resources)
+  for _, res in ipairs(resources) do
+    if redis.call('exists', QlessResource.ns .. res) == 0 then
+      return false
+    end
+  end
+  return true
+end
+
+-- Return the resources with jobs waiting on them, and how many, in order of
+-- their ids, starting after the id `after` (if provided) and returning at
+-- most `count` (by default, 25) of them. The next page starts after the last
+-- id returned.
+--  [
+--      {
+--          'name': 'res-1',
+--          'count': 5
+--      }, {
+--          'name': 'res-2',
+--          'count': 2
+--      }
+--  ]
+function QlessResource.pending_counts(now, after, count)
+  return QlessResource.counts('PendingCounts', 'pending_count', after, count)
+end
+
+-- Return the resources with locks held on them, and how many, in order of
+-- their ids, paginated as `pending_counts` is
+--  [
+--      {
+--          'name': 'res-1',
+--          'count': 5
+--      }, {
+--          'name': 'res-2',
+--          'count': 2
+--      }
+--  ]
+function QlessResource.locks_counts(now, after, count)
+  return QlessResource.counts('LocksCounts', 'lock_count', after, count)
+end
+
+-- Walk the registry of resources in `ql:resources`, returning those for which
+-- the `method` count is non-zero, paginated by `after` and `count`. All of
+-- the registry's scores are 0, so it's walked in order of id from `after`,
+-- rather than from its start.
+function QlessResource.counts(name, method, after, count)
+  count = assert(tonumber(count or 25),
+    name .. '(): Arg "count" not a number: ' .. tostring(count))
+
+  local response = {}
+  local start = after and ('(' .. after) or '-'
+  while #response < count do
+    local rids = redis.call(
+      'zrangebylex', 'ql:resources', start, '+', 'limit', 0, 1000)
+    for _, rid in ipairs(rids) do
+      local resource = Qless.resource(rid)
+      local resource_count = resource[method](resource)
+      if resource_count > 0 then
+        table.insert(response, {name = rid, count = resource_count})
+        if #response >= count then
+          return response
+        end
+      end
+    end
+    if #rids < 1000 then
+      break
+    end
+    start = '(' .. rids[#rids]
+  end
+  return response
+end
+
+-- Backfill(now, cursor, [count])
+-- ------------------------------
+-- Add the resources that were set before the `ql:resources` registry existed
+-- to it. This scans about `count` (by default, 1000) keys from `cursor` (0 to
+-- begin with) for resources, and returns the cursor to continue from, which is
+-- 0 once every key has been seen, along with how many resources were added:
+--
+--  {'cursor': 1234, 'registered': 5}
+--
+-- This needs Redis 3.2 or later, since a script can only write after scanning
+-- once its writes are replicated in place of the script.
+function QlessResource.backfill(now, cursor, count)
+  cursor = assert(tonumber(cursor),
+    'Backfill(): Arg "cursor" missing or not a number: ' .. tostring(cursor))
+  count = assert(tonumber(count or 1000),
+    'Backfill(): Arg "count" not a number: ' .. tostring(count))
+  if not redis.replicate_commands then
+    error('Backfill(): Redis 3.2 or later is needed to scan for resources')
+  end
+
+  -- Scanning isn't deterministic, so replicate the writes that follow rather
+  -- than the script
+  redis.replicate_commands()
+  local reply = redis.call('scan', cursor,
+    'match', QlessResource.ns .. '*', 'count', count)
+
+  local registered = 0
+  for _, key in ipairs(reply[2]) do
+    -- A resource's own hash has its rid, unlike its locks, pending jobs and
+    -- weights
+    if redis.call('type', key)['ok'] == 'hash' then
+      local rid = redis.call('hget', key, 'rid')
+      if rid and QlessResource.ns .. rid == key then
+        registered = registered + redis.call('zadd', 'ql:resources', 0, rid)
+      end
+    end
+  end
+  return {cursor = tonumber(reply[1]), registered = registered}
+end
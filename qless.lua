@@ -0,0 +1,3977 @@
+-- Current SHA: 94e2017e3b8d6b2bece18934fac35afb6b04391b
+-- This is a generated file
+local Qless = {
+  ns = 'ql:'
+}
+
+local QlessQueue = {
+  ns = Qless.ns .. 'q:'
+}
+QlessQueue.__index = QlessQueue
+
+local QlessWorker = {
+  ns = Qless.ns .. 'w:'
+}
+QlessWorker.__index = QlessWorker
+
+local QlessJob = {
+  ns = Qless.ns .. 'j:'
+}
+QlessJob.__index = QlessJob
+
+local QlessRecurringJob = {}
+QlessRecurringJob.__index = QlessRecurringJob
+
+local QlessResource = {
+  ns = Qless.ns .. 'rs:'
+}
+QlessResource.__index = QlessResource;
+
+Qless.config = {}
+
+function table.extend(self, other)
+  for i, v in ipairs(other) do
+    table.insert(self, v)
+  end
+end
+
+function Qless.publish(channel, message)
+  local batch = Qless.batching
+  if batch and channel == 'log' then
+    table.insert(batch.logs, message)
+    return
+  end
+  redis.call('publish', Qless.ns .. channel, message)
+end
+
+function Qless.encode(value)
+  if Qless.config.get('storage-format') == 'msgpack' then
+    return cmsgpack.pack(value)
+  end
+  return cjson.encode(value)
+end
+
+function Qless.decode(value)
+  local first = string.sub(value, 1, 1)
+  if first == '[' or first == '{' then
+    return cjson.decode(value)
+  end
+  return cmsgpack.unpack(value)
+end
+
+function Qless.time(now)
+  if Qless.config.get('storage-format') == 'msgpack' then
+    return string.format('%.6f', now)
+  end
+  return string.format('%.20f', now)
+end
+
+Qless.batching = nil
+
+function Qless.batch(func)
+  if Qless.batching then
+    return func()
+  end
+
+  Qless.batching = {
+    keys = {}, zadds = {}, after = {}, names = {}, deferred = {}, memos = {},
+    counters = {}, created = {}, fields = {}, logs = {}
+  }
+  local ok, result = pcall(func)
+  local batch = Qless.batching
+  Qless.batching = nil
+
+  for _, key in ipairs(batch.keys) do
+    local args = batch.zadds[key]
+    local added = 0
+    for i = 1, #args, 1000 do
+      added = added + redis.call(
+        'zadd', key, unpack(args, i, math.min(i + 999, #args)))
+    end
+    if batch.after[key] then
+      batch.after[key](added)
+    end
+  end
+  for _, field in ipairs(batch.fields) do
+    local key, name = unpack(field)
+    local increment = batch.counters[key][name]
+    local created = batch.created[key]
+    if redis.call('hincrby', key, name, increment) == increment and created then
+      batch.created[key] = nil
+      created()
+    end
+  end
+  if #batch.logs > 0 then
+    Qless.publish('log',
+      '{"event":"batch","events":[' .. table.concat(batch.logs, ',') .. ']}')
+  end
+  for _, name in ipairs(batch.names) do
+    batch.deferred[name]()
+  end
+
+  if not ok then
+    error(result, 0)
+  end
+  return result
+end
+
+function Qless.zadd(key, score, member, after)
+  local batch = Qless.batching
+  if not batch then
+    local added = redis.call('zadd', key, score, member)
+    if after then
+      after(added)
+    end
+    return added
+  end
+
+  if not batch.zadds[key] then
+    batch.zadds[key] = {}
+    batch.after[key] = after
+    table.insert(batch.keys, key)
+  end
+  table.insert(batch.zadds[key], score)
+  table.insert(batch.zadds[key], member)
+end
+
+function Qless.hincrby(key, field, increment, created)
+  local batch = Qless.batching
+  if not batch then
+    local value = redis.call('hincrby', key, field, increment)
+    if created and value == increment then
+      created()
+    end
+    return value
+  end
+
+  local counters = batch.counters[key]
+  if not counters then
+    counters = {}
+    batch.counters[key] = counters
+  end
+  batch.created[key] = batch.created[key] or created
+  if not counters[field] then
+    counters[field] = 0
+    table.insert(batch.fields, {key, field})
+  end
+  counters[field] = counters[field] + increment
+end
+
+function Qless.defer(name, func)
+  local batch = Qless.batching
+  if not batch then
+    return func()
+  end
+
+  if not batch.deferred[name] then
+    batch.deferred[name] = func
+    table.insert(batch.names, name)
+  end
+end
+
+function Qless.memo(name, func)
+  local batch = Qless.batching
+  if not batch then
+    return func()
+  end
+
+  if batch.memos[name] == nil then
+    batch.memos[name] = func()
+  end
+  return batch.memos[name]
+end
+
+function Qless.tracked(jid)
+  if Qless.batching and not Qless.memo('tracking', function()
+    return redis.call('zcard', 'ql:tracked') > 0
+  end) then
+    return false
+  end
+  return redis.call('zscore', 'ql:tracked', jid) ~= false
+end
+
+function Qless.outcomes(specs, func)
+  return Qless.batch(function()
+    local outcomes = {}
+    for _, spec in ipairs(specs) do
+      local ok, result = pcall(func, spec)
+      local jid = spec
+      if type(spec) == 'table' then
+        jid = spec.jid
+      end
+      if ok then
+        table.insert(outcomes, {jid = jid, result = result})
+      else
+        if type(result) == 'table' then
+          result = result.err
+        end
+        result = string.gsub(tostring(result), '^@?[%w_]+:%d+: ', '')
+        table.insert(outcomes, {jid = jid, error = result})
+      end
+    end
+    return outcomes
+  end)
+end
+
+function Qless.job(jid)
+  assert(jid, 'Job(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessJob)
+  job.jid = jid
+  return job
+end
+
+function Qless.recurring(jid)
+  assert(jid, 'Recurring(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessRecurringJob)
+  job.jid = jid
+  return job
+end
+
+function Qless.resource(rid)
+  assert(rid, 'Resource(): no rid provided')
+  local res = {}
+  setmetatable(res, QlessResource)
+  res.rid = rid
+  return res
+end
+
+function Qless.failed(group, start, limit)
+  start = assert(tonumber(start or 0),
+    'Failed(): Arg "start" is not a number: ' .. (start or 'nil'))
+  limit = assert(tonumber(limit or 25),
+    'Failed(): Arg "limit" is not a number: ' .. (limit or 'nil'))
+
+  if group then
+    return {
+      total = redis.call('llen', 'ql:f:' .. group),
+      jobs  = redis.call('lrange', 'ql:f:' .. group, start, start + limit - 1)
+    }
+  else
+    local response = {}
+    local groups = redis.call('smembers', 'ql:failures')
+    for index, group in ipairs(groups) do
+      response[group] = redis.call('llen', 'ql:f:' .. group)
+    end
+    return response
+  end
+end
+
+function Qless.jobs(now, state, ...)
+  assert(state, 'Jobs(): Arg "state" missing')
+  if state == 'complete' then
+    local offset = assert(tonumber(arg[1] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrange', 'ql:completed', offset,
+      offset + count - 1)
+  else
+    local name  = assert(arg[1], 'Jobs(): Arg "queue" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[3]))
+
+    local queue = Qless.queue(name)
+    if state == 'running' then
+      return queue.locks.peek(now, offset, count)
+    elseif state == 'stalled' then
+      return queue.locks.expired(now, offset, count)
+    elseif state == 'waiting' then
+      return queue.work.peek(now, offset, count)
+    elseif state == 'scheduled' then
+      queue:check_scheduled(now, queue.scheduled.length())
+      return queue.scheduled.peek(now, offset, count)
+    elseif state == 'depends' then
+      return queue.depends.peek(now, offset, count)
+    elseif state == 'recurring' then
+      return queue.recurring.peek('+inf', offset, count)
+    else
+      error('Jobs(): Unknown type "' .. state .. '"')
+    end
+  end
+end
+
+function Qless.track(now, command, jid)
+  if command ~= nil then
+    assert(jid, 'Track(): Arg "jid" missing')
+    assert(Qless.job(jid):exists(), 'Track(): Job does not exist')
+    if string.lower(command) == 'track' then
+      Qless.publish('track', jid)
+      return redis.call('zadd', 'ql:tracked', now, jid)
+    elseif string.lower(command) == 'untrack' then
+      Qless.publish('untrack', jid)
+      return redis.call('zrem', 'ql:tracked', jid)
+    else
+      error('Track(): Unknown action "' .. command .. '"')
+    end
+  else
+    local response = {
+      jobs = {},
+      expired = {}
+    }
+    local jids = redis.call('zrange', 'ql:tracked', 0, -1)
+    for index, jid in ipairs(jids) do
+      local data = Qless.job(jid):data()
+      if data then
+        table.insert(response.jobs, data)
+      else
+        table.insert(response.expired, jid)
+      end
+    end
+    return response
+  end
+end
+
+function Qless.tag(now, command, ...)
+  assert(command,
+    'Tag(): Arg "command" must be "add", "remove", "get" or "top"')
+
+  if command == 'add' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local state, tags = unpack(Qless.job(jid):fields('state', 'tags'))
+    if state then
+      tags = Qless.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      for i=2,#arg do
+        local tag = arg[i]
+        if _tags[tag] == nil or _tags[tag] == false then
+          _tags[tag] = true
+          table.insert(tags, tag)
+        end
+        redis.call('zadd', 'ql:t:' .. tag, now, jid)
+        redis.call('zincrby', 'ql:tags', 1, tag)
+      end
+
+      Qless.job(jid):update({tags = Qless.encode(tags)})
+      return tags
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'remove' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local state, tags = unpack(Qless.job(jid):fields('state', 'tags'))
+    if state then
+      tags = Qless.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      for i=2,#arg do
+        local tag = arg[i]
+        _tags[tag] = nil
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+
+      local results = {}
+      for i,tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+
+      Qless.job(jid):update({tags = Qless.encode(results)})
+      return results
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'get' then
+    local tag    = assert(arg[1], 'Tag(): Arg "tag" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Tag(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Tag(): Arg "count" not a number: ' .. tostring(arg[3]))
+    return {
+      total = redis.call('zcard', 'ql:t:' .. tag),
+      jobs  = redis.call('zrange', 'ql:t:' .. tag, offset, offset + count - 1)
+    }
+  elseif command == 'top' then
+    local offset = assert(tonumber(arg[1] or 0) , 'Tag(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25), 'Tag(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrangebyscore', 'ql:tags', '+inf', 2, 'limit', offset, count)
+  else
+    error('Tag(): First argument must be "add", "remove" or "get"')
+  end
+end
+
+function Qless.gc(now, budget)
+  budget = assert(tonumber(budget),
+    'Gc(): Arg "budget" missing or not a number: ' .. tostring(budget))
+  if budget <= 0 then
+    return 0
+  end
+
+  local count = Qless.config.get('jobs-history-count')
+  local time  = Qless.config.get('jobs-history')
+
+  local expire = function(jids)
+    for index, jid in ipairs(jids) do
+      local tags = Qless.decode(
+        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+      for i, tag in ipairs(tags) do
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+      redis.call('del', QlessJob.ns .. jid)
+      redis.call('del', QlessJob.ns .. jid .. '-history')
+    end
+  end
+
+  local jids = redis.call('zrangebyscore', 'ql:completed', 0, now - time,
+    'LIMIT', 0, budget)
+  expire(jids)
+  if #jids > 0 then
+    redis.call('zremrangebyrank', 'ql:completed', 0, #jids - 1)
+  end
+  local deleted = #jids
+
+  local excess = math.min(
+    redis.call('zcard', 'ql:completed') - count, budget - deleted)
+  if excess > 0 then
+    jids = redis.call('zrange', 'ql:completed', 0, excess - 1)
+    expire(jids)
+    redis.call('zremrangebyrank', 'ql:completed', 0, excess - 1)
+    deleted = deleted + excess
+  end
+  return deleted
+end
+
+function Qless.cancel(now, ...)
+  local dependents = {}
+  for _, jid in ipairs(arg) do
+    dependents[jid] = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependents') or {}
+  end
+
+  for i, jid in ipairs(arg) do
+    for j, dep in ipairs(dependents[jid]) do
+      if dependents[dep] == nil or dependents[dep] == false then
+        error('Cancel(): ' .. jid .. ' is a dependency of ' .. dep ..
+           ' but is not mentioned to be canceled')
+      end
+    end
+  end
+
+  local cancelled_jids = {}
+
+  for _, jid in ipairs(arg) do
+    local state, queue, failure, worker, unique = unpack(Qless.job(jid):fields(
+      'state', 'queue', 'failure', 'worker', 'unique'))
+
+    if state ~= false and state ~= 'complete' then
+      table.insert(cancelled_jids, jid)
+
+      local encoded = cjson.encode({
+        jid    = jid,
+        worker = worker,
+        event  = 'canceled',
+        queue  = queue
+      })
+      Qless.publish('log', encoded)
+
+      if worker and (worker ~= '') then
+        redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+        Qless.publish('w:' .. worker, encoded)
+      end
+
+      if queue then
+        local queue = Qless.queue(queue)
+        queue.work.remove(jid)
+        queue.locks.remove(jid)
+        queue.scheduled.remove(jid)
+        queue.depends.remove(jid)
+        if unique then
+          queue:release_unique(unique, jid)
+        end
+      end
+
+      Qless.job(jid):release_resources(now)
+
+      for i, j in ipairs(redis.call(
+        'smembers', QlessJob.ns .. jid .. '-dependencies')) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', jid)
+      end
+
+      redis.call('del', QlessJob.ns .. jid .. '-dependencies')
+
+      if state == 'failed' then
+        failure = Qless.decode(failure)
+        redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
+        if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
+          redis.call('srem', 'ql:failures', failure.group)
+        end
+        Qless.queue(queue):tally(now, 'failed', -1, failure.when)
+      end
+
+      local tags = Qless.decode(
+        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+      for i, tag in ipairs(tags) do
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+
+      if redis.call('zscore', 'ql:tracked', jid) ~= false then
+        Qless.publish('canceled', jid)
+      end
+
+      redis.call('del', QlessJob.ns .. jid)
+      redis.call('del', QlessJob.ns .. jid .. '-history')
+    end
+  end
+
+  return cancelled_jids
+end
+
+local Set = {}
+
+function Set.new (t)
+  local set = {}
+  for _, l in ipairs(t) do set[l] = true end
+  return set
+end
+
+function Set.union (a,b)
+  local res = Set.new{}
+  for k in pairs(a) do res[k] = true end
+  for k in pairs(b) do res[k] = true end
+  return res
+end
+
+function Set.intersection (a,b)
+  local res = Set.new{}
+  for k in pairs(a) do
+    res[k] = b[k]
+  end
+  return res
+end
+
+function Set.diff(a,b)
+  local res = Set.new{}
+  for k in pairs(a) do
+    if not b[k] then res[k] = true end
+  end
+
+  return res
+end
+
+Qless.config.defaults = {
+  ['application']           = 'qless',
+  ['heartbeat']             = 60,
+  ['grace-period']          = 10,
+  ['stats-history']         = 30,
+  ['histogram-history']     = 7,
+  ['jobs-history-count']    = 50000,
+  ['jobs-history']          = 604800,
+  ['gc-budget']             = 10,
+  ['resource-grant-budget'] = 100,
+  ['minute-stats-history']  = 21600,
+  ['hour-stats-history']    = 604800,
+  ['storage-format']        = 'json'
+}
+
+Qless.config.snapshot = nil
+Qless.config.typed = nil
+
+Qless.config.stored = function()
+  if Qless.config.snapshot == nil then
+    local snapshot, typed = {}, {}
+    local reply = redis.call('hgetall', 'ql:config')
+    for i = 1, #reply, 2 do
+      snapshot[reply[i]] = reply[i + 1]
+      typed[reply[i]] = tonumber(reply[i + 1]) or reply[i + 1]
+    end
+    Qless.config.snapshot = snapshot
+    Qless.config.typed = typed
+  end
+  return Qless.config.snapshot
+end
+
+Qless.config.get = function(key, default)
+  local stored = Qless.config.stored()
+  if key then
+    return Qless.config.typed[key] or Qless.config.defaults[key] or default
+  else
+    local response = {}
+    for option, value in pairs(Qless.config.defaults) do
+      response[option] = value
+    end
+    for option, value in pairs(stored) do
+      response[option] = value
+    end
+    return response
+  end
+end
+
+Qless.config.set = function(option, value)
+  assert(option, 'config.set(): Arg "option" missing')
+  assert(value , 'config.set(): Arg "value" missing')
+  Qless.publish('log', cjson.encode({
+    event  = 'config_set',
+    option = option,
+    value  = value
+  }))
+
+  redis.call('hset', 'ql:config', option, value)
+  if Qless.config.snapshot then
+    Qless.config.snapshot[option] = tostring(value)
+    Qless.config.typed[option] = tonumber(value) or tostring(value)
+  end
+end
+
+Qless.config.unset = function(option)
+  assert(option, 'config.unset(): Arg "option" missing')
+  Qless.publish('log', cjson.encode({
+    event  = 'config_unset',
+    option = option
+  }))
+
+  redis.call('hdel', 'ql:config', option)
+  if Qless.config.snapshot then
+    Qless.config.snapshot[option] = nil
+    Qless.config.typed[option] = nil
+  end
+end
+
+QlessJob.attributes = {
+  jid              = {field = 'jid'},
+  klass            = {field = 'klass'},
+  state            = {field = 'state'},
+  queue            = {field = 'queue'},
+  worker           = {field = 'worker', read = function(job, value)
+    return value or ''
+  end},
+  tracked          = {read = function(job)
+    return redis.call('zscore', 'ql:tracked', job.jid) ~= false
+  end},
+  priority         = {field = 'priority', read = function(job, value)
+    return tonumber(value)
+  end},
+  expires          = {field = 'expires', read = function(job, value)
+    return tonumber(value) or 0
+  end},
+  retries          = {field = 'retries', read = function(job, value)
+    return tonumber(value)
+  end},
+  remaining        = {field = 'remaining', read = function(job, value)
+    return math.floor(tonumber(value))
+  end},
+  data             = {field = 'data'},
+  tags             = {field = 'tags', read = function(job, value)
+    return Qless.decode(value)
+  end},
+  history          = {read = function(job)
+    return job:history()
+  end},
+  failure          = {field = 'failure', read = function(job, value)
+    return Qless.decode(value or '{}')
+  end},
+  resources        = {field = 'resources', read = function(job, value)
+    local resources = Qless.decode(value or '[]')
+    if #resources == 0 then
+      return resources
+    end
+    local weights = job:weights()
+    if next(weights) == nil then
+      return resources
+    end
+    local declared = {}
+    for _, rid in ipairs(resources) do
+      declared[rid] = weights[rid] or 1
+    end
+    return declared
+  end},
+  result_data      = {field = 'result_data', read = function(job, value)
+    return cjson.decode(value or '{}')
+  end},
+  interval         = {field = 'throttle_interval', read = function(job, value)
+    return tonumber(value) or 0
+  end},
+  dependents       = {read = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependents')
+  end},
+  dependencies     = {read = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependencies')
+  end},
+  spawned_from_jid = {field = 'spawned_from_jid'}
+}
+
+QlessJob.defaults = {
+  worker            = '',
+  expires           = '0',
+  tags              = '{}',
+  resources         = '[]',
+  weights           = '{}',
+  failure           = '{}',
+  result_data       = '{}',
+  throttle_interval = '0',
+  throttle_next_run = '0'
+}
+
+QlessJob.empty = Set.new({'{}', '[]', '\144', '\128'})
+
+function QlessJob.default(field, value)
+  local default = QlessJob.defaults[field]
+  if default == nil then
+    return false
+  end
+  value = tostring(value)
+  return value == default or
+    ((default == '{}' or default == '[]') and QlessJob.empty[value] == true)
+end
+
+QlessJob.profiles = {
+  worker = {'jid', 'klass', 'state', 'queue', 'worker', 'priority', 'expires',
+    'retries', 'remaining', 'data'},
+  ui     = {'jid', 'klass', 'state', 'queue', 'worker', 'tracked', 'priority',
+    'expires', 'retries', 'remaining', 'tags', 'failure', 'resources',
+    'interval', 'spawned_from_jid'}
+}
+
+function QlessJob.projection(fields)
+  if fields == nil or fields == '' or fields == 'full' then
+    return nil
+  elseif QlessJob.profiles[fields] then
+    return QlessJob.profiles[fields]
+  end
+
+  local ok, decoded = pcall(cjson.decode, fields)
+  if not ok or type(decoded) ~= 'table' or
+    (#decoded == 0 and next(decoded) ~= nil) then
+    error('Projection(): Arg "fields" not a profile or JSON array: ' ..
+      tostring(fields))
+  end
+  for _, key in ipairs(decoded) do
+    if QlessJob.attributes[key] == nil then
+      error('Projection(): Unknown field "' .. tostring(key) .. '"')
+    end
+  end
+  return decoded
+end
+
+function QlessJob:project(fields)
+  if fields == nil then
+    fields = {}
+    for key in pairs(QlessJob.attributes) do table.insert(fields, key) end
+  end
+
+  local keys = {'jid'}
+  for _, key in ipairs(fields) do
+    local attribute = assert(QlessJob.attributes[key],
+      'Project(): Unknown field "' .. tostring(key) .. '"')
+    if attribute.field and attribute.field ~= 'jid' then
+      table.insert(keys, attribute.field)
+    end
+  end
+
+  local values = redis.call('hmget', QlessJob.ns .. self.jid, unpack(keys))
+
+  if not values[1] then
+    return nil
+  end
+
+  local job = {}
+  for index, key in ipairs(keys) do
+    job[key] = values[index] or QlessJob.defaults[key] or false
+  end
+
+  local data = {}
+  for _, key in ipairs(fields) do
+    local attribute = QlessJob.attributes[key]
+    local value = attribute.field and job[attribute.field]
+    if attribute.read then
+      data[key] = attribute.read(self, value)
+    else
+      data[key] = value
+    end
+  end
+  return data
+end
+
+function QlessJob:data(...)
+  if #arg > 0 then
+    local data = self:project(arg)
+    if not data then
+      return nil
+    end
+
+    local response = {}
+    for index, key in ipairs(arg) do
+      table.insert(response, data[key])
+    end
+    return response
+  else
+    return self:project()
+  end
+end
+
+function QlessJob:complete(now, worker, queue, data, ...)
+  assert(worker, 'Complete(): Arg "worker" missing')
+  assert(queue , 'Complete(): Arg "queue" missing')
+  if data then
+    assert(cjson.decode(data), 'Complete(): Arg "data" not JSON: ' .. tostring(data))
+  end
+
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  local nextq   = options['next']
+  local delay   = assert(tonumber(options['delay'] or 0))
+  local depends = assert(cjson.decode(options['depends'] or '[]'),
+    'Complete(): Arg "depends" not JSON: ' .. tostring(options['depends']))
+
+  local result_data = options['result_data']
+
+  if options['delay'] and nextq == nil then
+    error('Complete(): "delay" cannot be used without a "next".')
+  end
+
+  if options['depends'] and nextq == nil then
+    error('Complete(): "depends" cannot be used without a "next".')
+  end
+
+  local bin = now - (now % 86400)
+
+  local lastworker, state, priority, retries, current_queue, interval = unpack(
+    self:fields('worker', 'state', 'priority', 'retries', 'queue',
+      'throttle_interval'))
+
+  if state == false then
+    error('Complete(): Job ' .. self.jid .. ' does not exist')
+  elseif (state ~= 'running') then
+    error('Complete(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif lastworker ~= worker then
+    error('Complete(): Job ' .. self.jid ..
+      ' has been handed out to another worker: ' .. tostring(lastworker))
+  elseif queue ~= current_queue then
+    error('Complete(): Job ' .. self.jid .. ' running in another queue: ' ..
+      tostring(current_queue))
+  end
+
+  local next_run = 0
+  if tonumber(interval) > 0 then
+    next_run = now + tonumber(interval)
+  end
+
+  self:history(now, 'done')
+
+  if data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', data)
+  end
+
+  if result_data then
+    self:update({result_data = result_data})
+  end
+
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+  queue_obj:record(now, 'complete')
+
+  self:release_resources(now)
+
+  local time = tonumber(
+    redis.call('hget', QlessJob.ns .. self.jid, 'time') or now)
+  local waiting = now - time
+  Qless.queue(queue):stat(now, 'run', waiting)
+  QlessWorker.stat(now, worker, waiting)
+  redis.call('hset', QlessJob.ns .. self.jid,
+    'time', Qless.time(now))
+
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  if Qless.tracked(self.jid) then
+    Qless.publish('completed', self.jid)
+  end
+
+  if nextq then
+    queue_obj = Qless.queue(nextq)
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'advanced',
+      queue = queue,
+      to    = nextq
+    }))
+
+    self:history(now, 'put', {q = nextq})
+
+    Qless.defer('known:' .. nextq, function()
+      if redis.call('zscore', 'ql:queues', nextq) == false then
+        redis.call('zadd', 'ql:queues', now, nextq)
+      end
+    end)
+
+    self:update({
+      state     = 'waiting',
+      worker    = '',
+      failure   = '{}',
+      queue     = nextq,
+      expires   = 0,
+      remaining = tonumber(retries)
+    })
+
+    if (delay > 0) and (#depends == 0) then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      return 'scheduled'
+    else
+      if self:add_dependencies(depends) > 0 then
+        queue_obj.depends.add(now, self.jid)
+        redis.call('hset', QlessJob.ns .. self.jid, 'state', 'depends')
+        if delay > 0 then
+          queue_obj.depends.add(now, self.jid)
+          redis.call('hset', QlessJob.ns .. self.jid, 'scheduled', now + delay)
+        end
+        return 'depends'
+      else
+        if self:acquire_resources(now) then
+          queue_obj.work.add(now, priority, self.jid)
+        end
+        return 'waiting'
+      end
+    end
+  else
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'completed',
+      queue = queue
+    }))
+
+    self:update({
+      state             = 'complete',
+      worker            = '',
+      failure           = '{}',
+      queue             = '',
+      expires           = 0,
+      remaining         = tonumber(retries),
+      throttle_next_run = next_run
+    })
+
+    Qless.zadd('ql:completed', now, self.jid)
+    Qless.defer('gc', function()
+      Qless.gc(now, Qless.config.get('gc-budget'))
+    end)
+
+    local resolved = {}
+    for i, j in ipairs(redis.call(
+      'smembers', QlessJob.ns .. self.jid .. '-dependents')) do
+      if Qless.job(j):remove_dependency(self.jid) == 0 then
+        table.insert(resolved, j)
+      end
+    end
+    QlessJob.resolve(now, resolved)
+
+    redis.call('del', QlessJob.ns .. self.jid .. '-dependents')
+
+    return 'complete'
+  end
+end
+
+function QlessJob.complete_many(now, worker, queue, jobs)
+  jobs = assert(cjson.decode(jobs or '[]'),
+    'Complete_many(): Arg "jobs" not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Complete_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  return Qless.outcomes(jobs, function(spec)
+    if type(spec) ~= 'table' then
+      return Qless.job(spec):complete(now, worker, queue)
+    end
+
+    local data = spec.data
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+    local options = {}
+    for _, key in ipairs({'next', 'delay', 'depends', 'result_data'}) do
+      local value = spec[key]
+      if value ~= nil then
+        if type(value) == 'table' then
+          value = cjson.encode(value)
+        end
+        table.insert(options, key)
+        table.insert(options, value)
+      end
+    end
+    return Qless.job(spec.jid):complete(
+      now, worker, queue, data, unpack(options))
+  end)
+end
+
+function QlessJob:fail(now, worker, group, message, data)
+  local worker  = assert(worker           , 'Fail(): Arg "worker" missing')
+  local group   = assert(group            , 'Fail(): Arg "group" missing')
+  local message = assert(message          , 'Fail(): Arg "message" missing')
+
+  if data then
+    assert(cjson.decode(data), 'Fail(): Arg "data" not JSON: ' .. tostring(data))
+  end
+
+  local queue, state, oldworker = unpack(redis.call(
+    'hmget', QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+
+  if not state then
+    error('Fail(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Fail(): Job ' .. self.jid .. ' not currently running: ' .. state)
+  elseif worker ~= oldworker then
+    error('Fail(): Job ' .. self.jid .. ' running with another worker: ' ..
+      oldworker)
+  end
+
+  Qless.publish('log', cjson.encode({
+    jid     = self.jid,
+    event   = 'failed',
+    worker  = worker,
+    group   = group,
+    message = message
+  }))
+
+  if Qless.tracked(self.jid) then
+    Qless.publish('failed', self.jid)
+  end
+
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  self:history(now, 'failed', {worker = worker, group = group})
+
+  local queue_obj = Qless.queue(queue)
+  queue_obj:tally(now, 'failures', 1)
+  queue_obj:tally(now, 'failed'  , 1)
+  queue_obj:record(now, 'fail')
+  QlessWorker.tally(now, worker, 'failed', 1)
+
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+
+  self:release_resources(now)
+
+  if data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', data)
+  end
+
+  self:update({
+    state   = 'failed',
+    worker  = '',
+    expires = 0,
+    failure = Qless.encode({
+      ['group']   = group,
+      ['message'] = message,
+      ['when']    = math.floor(now),
+      ['worker']  = worker
+    })
+  })
+
+  redis.call('sadd', 'ql:failures', group)
+  redis.call('lpush', 'ql:f:' .. group, self.jid)
+
+
+  return self.jid
+end
+
+function QlessJob.fail_many(now, worker, group, message, jobs)
+  jobs = assert(cjson.decode(jobs or '[]'),
+    'Fail_many(): Arg "jobs" not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Fail_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  return Qless.outcomes(jobs, function(spec)
+    if type(spec) ~= 'table' then
+      return Qless.job(spec):fail(now, worker, group, message)
+    end
+
+    local data = spec.data
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+    return Qless.job(spec.jid):fail(now, worker,
+      spec.group or group, spec.message or message, data)
+  end)
+end
+
+function QlessJob:retry(now, queue, worker, delay, group, message)
+  assert(queue , 'Retry(): Arg "queue" missing')
+  assert(worker, 'Retry(): Arg "worker" missing')
+  delay = assert(tonumber(delay or 0),
+    'Retry(): Arg "delay" not a number: ' .. tostring(delay))
+
+  local oldqueue, state, retries, oldworker, priority, failure = unpack(
+    self:fields('queue', 'state', 'retries', 'worker', 'priority', 'failure'))
+
+  if state == false then
+    error('Retry(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Retry(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif oldworker ~= worker then
+    error('Retry(): Job ' .. self.jid ..
+      ' has been given to another worker: ' .. oldworker)
+  end
+
+  local remaining = tonumber(redis.call(
+    'hincrby', QlessJob.ns .. self.jid, 'remaining', -1))
+  redis.call('hdel', QlessJob.ns .. self.jid, 'grace')
+
+  Qless.queue(oldqueue).locks.remove(self.jid)
+  Qless.queue(oldqueue):record(now, 'retry')
+  self:release_resources(now)
+
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  if remaining < 0 then
+    local group = group or 'failed-retries-' .. queue
+    self:history(now, 'failed', {['group'] = group})
+
+    self:update({state = 'failed', worker = '', expires = 0})
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', Qless.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    else
+      redis.call('hset', QlessJob.ns .. self.jid,
+      'failure', Qless.encode({
+        ['group']   = group,
+        ['message'] =
+          'Job exhausted retries in queue "' .. oldqueue .. '"',
+        ['when']    = now,
+        ['worker']  = unpack(self:data('worker'))
+      }))
+    end
+
+    redis.call('sadd', 'ql:failures', group)
+    redis.call('lpush', 'ql:f:' .. group, self.jid)
+    Qless.queue(queue):tally(now, 'failures', 1)
+    Qless.queue(queue):tally(now, 'failed'  , 1)
+    Qless.queue(queue):record(now, 'fail')
+    QlessWorker.tally(now, worker, 'failed', 1)
+  else
+    local queue_obj = Qless.queue(queue)
+    if delay > 0 then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'scheduled')
+    else
+      if self:acquire_resources(now) then
+        queue_obj.work.add(now, priority, self.jid)
+      end
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
+    end
+
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', Qless.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    end
+  end
+
+  return math.floor(remaining)
+end
+
+function QlessJob:depends(now, command, ...)
+  assert(command, 'Depends(): Arg "command" missing')
+  local state = redis.call('hget', QlessJob.ns .. self.jid, 'state')
+  if state ~= 'depends' then
+    error('Depends(): Job ' .. self.jid ..
+      ' not in the depends state: ' .. tostring(state))
+  end
+
+  if command == 'on' then
+    self:add_dependencies(arg)
+    return true
+  elseif command == 'off' then
+    if arg[1] == 'all' then
+      for i, j in ipairs(redis.call(
+        'smembers', QlessJob.ns .. self.jid .. '-dependencies')) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+      end
+      redis.call('del', QlessJob.ns .. self.jid .. '-dependencies')
+      redis.call('hdel', QlessJob.ns .. self.jid, 'unresolved')
+      QlessJob.resolve(now, {self.jid})
+    else
+      local unresolved = nil
+      for i, j in ipairs(arg) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+        unresolved = self:remove_dependency(j)
+      end
+      if unresolved == 0 then
+        QlessJob.resolve(now, {self.jid})
+      end
+    end
+    return true
+  else
+    error('Depends(): Argument "command" must be "on" or "off"')
+  end
+end
+
+
+function QlessJob:add_dependencies(jids)
+  if #jids > 0 then
+    local key = QlessJob.ns .. self.jid .. '-candidates'
+    for i = 1, #jids, 1000 do
+      redis.call('rpush', key, unpack(jids, i, math.min(i + 999, #jids)))
+    end
+    local states = redis.call(
+      'sort', key, 'by', 'nosort', 'get', QlessJob.ns .. '*->state')
+    redis.call('del', key)
+    for i, jid in ipairs(jids) do
+      if states[i] and states[i] ~= 'complete' then
+        self:add_dependency(jid)
+      end
+    end
+  end
+  return self:unresolved()
+end
+
+function QlessJob:add_dependency(jid)
+  local key = QlessJob.ns .. self.jid .. '-dependencies'
+  if redis.call('sadd', key, jid) == 1 then
+    redis.call('sadd', QlessJob.ns .. jid .. '-dependents', self.jid)
+    if redis.call('hincrby', QlessJob.ns .. self.jid, 'unresolved', 1) == 1 then
+      local count = redis.call('scard', key)
+      if count > 1 then
+        redis.call('hset', QlessJob.ns .. self.jid, 'unresolved', count)
+      end
+    end
+  end
+end
+
+function QlessJob:remove_dependency(jid)
+  if redis.call(
+    'srem', QlessJob.ns .. self.jid .. '-dependencies', jid) == 0 then
+    return self:unresolved()
+  end
+
+  local count = redis.call('hincrby', QlessJob.ns .. self.jid, 'unresolved', -1)
+  if count < 0 then
+    count = redis.call('scard', QlessJob.ns .. self.jid .. '-dependencies')
+    redis.call('hset', QlessJob.ns .. self.jid, 'unresolved', count)
+  end
+  if count == 0 then
+    redis.call('hdel', QlessJob.ns .. self.jid, 'unresolved')
+  end
+  return count
+end
+
+function QlessJob:unresolved()
+  local count = redis.call('hget', QlessJob.ns .. self.jid, 'unresolved')
+  if count then
+    return tonumber(count)
+  end
+  return redis.call('scard', QlessJob.ns .. self.jid .. '-dependencies')
+end
+
+function QlessJob.resolve(now, jids)
+  if #jids == 0 then
+    return
+  end
+
+  Qless.batch(function()
+    local names = {}
+    local released = {}
+    for _, jid in ipairs(jids) do
+      local q, p, scheduled = unpack(
+        redis.call('hmget', QlessJob.ns .. jid, 'queue', 'priority', 'scheduled'))
+      if q then
+        if not released[q] then
+          released[q] = {}
+          table.insert(names, q)
+        end
+        table.insert(released[q], jid)
+
+        local queue = Qless.queue(q)
+        if scheduled then
+          queue.scheduled.add(scheduled, jid)
+          redis.call('hset', QlessJob.ns .. jid, 'state', 'scheduled')
+          redis.call('hdel', QlessJob.ns .. jid, 'scheduled')
+        else
+          if Qless.job(jid):acquire_resources(now) then
+            queue.work.add(now, p, jid)
+          end
+          redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
+        end
+      end
+    end
+
+    for _, q in ipairs(names) do
+      local queue = Qless.queue(q)
+      local jids = released[q]
+      for i = 1, #jids, 1000 do
+        queue.depends.remove(unpack(jids, i, math.min(i + 999, #jids)))
+      end
+    end
+  end)
+end
+
+function QlessJob:heartbeat(now, worker, data)
+  assert(worker, 'Heatbeat(): Arg "worker" missing')
+
+  local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue') or ''
+  local expires = now + (
+    Qless.config.get(queue .. '-heartbeat') or
+    Qless.config.get('heartbeat'))
+
+  if data then
+    assert(cjson.decode(data), 'Heartbeat(): Arg "data" not JSON: ' .. tostring(data))
+  end
+
+  local job_worker, state = unpack(self:fields('worker', 'state'))
+  if state == false then
+    error('Heartbeat(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error(
+      'Heartbeat(): Job ' .. self.jid .. ' not currently running: ' .. state)
+  elseif job_worker ~= worker or #job_worker == 0 then
+    error(
+      'Heartbeat(): Job ' .. self.jid ..
+      ' given out to another worker: ' .. job_worker)
+  else
+    if data then
+      redis.call('hmset', QlessJob.ns .. self.jid, 'expires',
+        expires, 'worker', worker, 'data', data)
+    else
+      redis.call('hmset', QlessJob.ns .. self.jid,
+        'expires', expires, 'worker', worker)
+    end
+
+    redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, self.jid)
+
+    redis.call('zadd', 'ql:workers', now, worker)
+
+    local queue = Qless.queue(
+      redis.call('hget', QlessJob.ns .. self.jid, 'queue'))
+    queue.locks.add(expires, self.jid)
+    return expires
+  end
+end
+
+function QlessJob:priority(priority)
+  priority = assert(tonumber(priority),
+    'Priority(): Arg "priority" missing or not a number: ' ..
+    tostring(priority))
+
+  local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue')
+
+  if queue == nil or queue == false then
+    error('Priority(): Job ' .. self.jid .. ' does not exist')
+  elseif queue == '' then
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  else
+    local queue_obj = Qless.queue(queue)
+    if queue_obj.work.score(self.jid) then
+      queue_obj.work.add(0, priority, self.jid)
+    end
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  end
+end
+
+function QlessJob:update(data)
+  local tmp = {}
+  local defaults = {}
+  for k, v in pairs(data) do
+    if QlessJob.default(k, v) then
+      table.insert(defaults, k)
+    else
+      table.insert(tmp, k)
+      table.insert(tmp, v)
+    end
+  end
+  if #defaults > 0 then
+    redis.call('hdel', QlessJob.ns .. self.jid, unpack(defaults))
+  end
+  if #tmp > 0 then
+    redis.call('hmset', QlessJob.ns .. self.jid, unpack(tmp))
+  end
+end
+
+function QlessJob:fields(...)
+  local values = redis.call('hmget', QlessJob.ns .. self.jid, unpack(arg))
+  for index, field in ipairs(arg) do
+    if not values[index] and QlessJob.defaults[field] then
+      values[index] = QlessJob.defaults[field]
+    end
+  end
+  return values
+end
+
+function QlessJob:timeout(now)
+  local queue_name, state, worker = unpack(redis.call('hmget',
+    QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+  if queue_name == nil or queue_name == false then
+    error('Timeout(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Timeout(): Job ' .. self.jid .. ' not running')
+  else
+    self:history(now, 'timed-out')
+    local queue = Qless.queue(queue_name)
+    queue.locks.remove(self.jid)
+    queue.work.add(now, '+inf', self.jid)
+    self:update({state = 'stalled', expires = 0})
+    local encoded = cjson.encode({
+      jid    = self.jid,
+      event  = 'lock_lost',
+      worker = worker
+    })
+    Qless.publish('w:' .. worker, encoded)
+    Qless.publish('log', encoded)
+    return queue_name
+  end
+end
+
+function QlessJob:exists()
+  return redis.call('exists', QlessJob.ns .. self.jid) == 1
+end
+
+function QlessJob.legacy_history(history)
+  local entries = {}
+  for i, value in ipairs(cjson.decode(history)) do
+    table.insert(entries, {math.floor(value.put), 'put', {q = value.q}})
+
+    if value.popped then
+      table.insert(entries, {math.floor(value.popped), 'popped',
+        {worker = value.worker}})
+    end
+
+    if value.failed then
+      table.insert(entries, {math.floor(value.failed), 'failed', nil})
+    end
+
+    if value.done then
+      table.insert(entries, {math.floor(value.done), 'done', nil})
+    end
+  end
+  return entries
+end
+
+function QlessJob:migrate_history(history)
+  local entries = QlessJob.legacy_history(history)
+  if #entries > 0 then
+    local encoded = {}
+    for i = #entries, 1, -1 do
+      table.insert(encoded, Qless.encode(entries[i]))
+    end
+    redis.call('lpush', QlessJob.ns .. self.jid .. '-history', unpack(encoded))
+  end
+  redis.call('hdel', QlessJob.ns .. self.jid, 'history')
+end
+
+function QlessJob:history(now, what, item)
+  if what == nil then
+    local response = {}
+
+    local history = redis.call('hget', QlessJob.ns .. self.jid, 'history')
+    if history then
+      for i, value in ipairs(QlessJob.legacy_history(history)) do
+        local dict = value[3] or {}
+        dict['when'] = value[1]
+        dict['what'] = value[2]
+        table.insert(response, dict)
+      end
+    end
+
+    for i, value in ipairs(redis.call('lrange',
+      QlessJob.ns .. self.jid .. '-history', 0, -1)) do
+      value = Qless.decode(value)
+      local dict = value[3] or {}
+      dict['when'] = value[1]
+      dict['what'] = value[2]
+      table.insert(response, dict)
+    end
+    return response
+  else
+    local length = redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+      Qless.encode({math.floor(now), what, item}))
+
+    local count = Qless.config.get('max-job-history', 100)
+    if count > 0 and length > count then
+      local obj = redis.call('lpop', QlessJob.ns .. self.jid .. '-history')
+      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history',
+        -math.max(count - 1, 1), -1)
+      length = redis.call(
+        'lpush', QlessJob.ns .. self.jid .. '-history', obj)
+    end
+    return length
+  end
+end
+
+function QlessJob:release_resources(now)
+  local resources = redis.call('hget', QlessJob.ns .. self.jid, 'resources')
+  resources = Qless.decode(resources or '[]')
+  for _, res in ipairs(resources) do
+    Qless.resource(res):release(now, self.jid)
+  end
+end
+
+function QlessJob:blocked(rid)
+  local resources = Qless.decode(
+    redis.call('hget', QlessJob.ns .. self.jid, 'resources') or '[]')
+  for _, res in ipairs(resources) do
+    local resource = Qless.resource(res)
+    if res ~= rid and resource:exists() and
+      not resource:available(self.jid) then
+      return true
+    end
+  end
+  return false
+end
+
+function QlessJob:weights()
+  return Qless.decode(
+    redis.call('hget', QlessJob.ns .. self.jid, 'weights') or '{}')
+end
+
+function QlessJob:weight(rid)
+  return self:weights()[rid] or 1
+end
+
+function QlessJob:acquire_resources(now)
+  local resources, priority, weights = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'resources', 'priority', 'weights'))
+  resources = Qless.decode(resources or '[]')
+  if (#resources == 0) then
+    return true
+  end
+  weights = Qless.decode(weights or '{}')
+
+  local acquired_all = true
+
+  for _, res in ipairs(resources) do
+    local ok, res = pcall(function() return Qless.resource(res):acquire(now, priority, self.jid, weights[res]) end)
+    if not ok then
+      self:set_failed(now, 'system:fatal', res.msg)
+      return false
+    end
+    acquired_all = acquired_all and res
+  end
+
+  return acquired_all
+end
+
+function QlessJob:set_failed(now, group, message, worker, release_work, release_resources)
+  local group             = assert(group, 'Fail(): Arg "group" missing')
+  local message           = assert(message, 'Fail(): Arg "message" missing')
+  if worker then
+    QlessWorker.tally(now, worker, 'failed', 1)
+  end
+  local worker            = worker or 'none'
+  local release_work      = release_work or true
+  local release_resources = release_resources or false
+
+  local queue = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'queue'))
+
+  Qless.publish('log', cjson.encode({
+    jid     = self.jid,
+    event   = 'failed',
+    worker  = worker,
+    group   = group,
+    message = message
+  }))
+
+  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+    Qless.publish('failed', self.jid)
+  end
+
+  self:history(now, 'failed', {group = group})
+
+  Qless.queue(queue):tally(now, 'failures', 1)
+  Qless.queue(queue):tally(now, 'failed'  , 1)
+  Qless.queue(queue):record(now, 'fail')
+
+  if release_work then
+    local queue_obj = Qless.queue(queue)
+    queue_obj.work.remove(self.jid)
+    queue_obj.locks.remove(self.jid)
+    queue_obj.scheduled.remove(self.jid)
+  end
+
+  if release_resources then
+    self:release_resources(now)
+  end
+
+  self:update({
+    state   = 'failed',
+    worker  = '',
+    expires = 0,
+    failure = Qless.encode({
+      ['group']   = group,
+      ['message'] = message,
+      ['when']    = math.floor(now)
+    })
+  })
+
+  redis.call('sadd', 'ql:failures', group)
+  redis.call('lpush', 'ql:f:' .. group, self.jid)
+
+
+  return self.jid
+end
+function Qless.queue(name)
+  assert(name, 'Queue(): no queue name provided')
+  local queue = {}
+  setmetatable(queue, QlessQueue)
+  queue.name = name
+
+  queue.work = {
+    peek = function(now, offset, count)
+      if count == 0 then
+        return {}
+      end
+      local jids = {}
+      for index, jid in ipairs(redis.call(
+        'zrevrange', queue:prefix('work'), offset, offset + count - 1)) do
+        table.insert(jids, jid)
+      end
+      return jids
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('work'), unpack(arg))
+      end
+    end, add = function(now, priority, jid)
+      if priority ~= '+inf' then
+        priority = priority - (now / 10000000000)
+      end
+      return Qless.zadd(queue:prefix('work'), priority, jid, function(added)
+        if added > 0 and queue.work.length() == added then
+          queue:signal()
+        end
+      end)
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('work'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('work'))
+    end
+  }
+
+  queue.locks = {
+    expired = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('locks'), '-inf', now, 'LIMIT', offset, count)
+    end, peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('locks'),
+        now, '+inf', 'LIMIT', offset, count)
+    end, add = function(expires, jid)
+      redis.call('zadd', queue:prefix('locks'), expires, jid)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('locks'), unpack(arg))
+      end
+    end, running = function(now)
+      return redis.call('zcount', queue:prefix('locks'), now, '+inf')
+    end, length = function(now)
+      if now then
+        return redis.call('zcount', queue:prefix('locks'), 0, now)
+      else
+        return redis.call('zcard', queue:prefix('locks'))
+      end
+    end, job_time_left = function(now, jid)
+      return tonumber(redis.call('zscore', queue:prefix('locks'), jid) or 0) - now
+    end
+  }
+
+  queue.depends = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('depends'), offset, offset + count - 1)
+    end, add = function(now, jid)
+      redis.call('zadd', queue:prefix('depends'), now, jid)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('depends'), unpack(arg))
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('depends'))
+    end
+  }
+
+  queue.scheduled = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('scheduled'), offset, offset + count - 1)
+    end, ready = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('scheduled'), 0, now, 'LIMIT', offset, count)
+    end, add = function(when, jid)
+      Qless.zadd(queue:prefix('scheduled'), when, jid)
+      queue:due(when)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('scheduled'), unpack(arg))
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('scheduled'))
+    end
+  }
+
+  queue.recurring = {
+    peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('recur'),
+        0, now, 'LIMIT', offset, count)
+    end, ready = function(now, offset, count)
+    end, add = function(when, jid)
+      redis.call('zadd', queue:prefix('recur'), when, jid)
+      queue:due(when)
+    end, remove = function(...)
+      if #arg > 0 then
+        return redis.call('zrem', queue:prefix('recur'), unpack(arg))
+      end
+    end, update = function(increment, jid)
+      queue:due(redis.call('zincrby', queue:prefix('recur'), increment, jid))
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('recur'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('recur'))
+    end
+  }
+  return queue
+end
+
+function QlessQueue:prefix(group)
+  if group then
+    return QlessQueue.ns..self.name..'-'..group
+  else
+    return QlessQueue.ns..self.name
+  end
+end
+
+QlessQueue.histogram = {
+  's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
+  'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
+  'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
+  'd1','d2','d3','d4','d5','d6'
+}
+
+function QlessQueue:stats(now, date, percentiles)
+  date = assert(tonumber(date),
+    'Stats(): Arg "date" missing or not a number: '.. (date or 'nil'))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  local bin = date - (date % 86400)
+
+  local retries, failed, failures = unpack(redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
+  return {
+    retries  = tonumber(retries  or 0),
+    failed   = tonumber(failed   or 0),
+    failures = tonumber(failures or 0),
+    wait     = QlessQueue.summarize(
+      QlessQueue.read_stats('wait', bin, self.name), percentiles),
+    run      = QlessQueue.summarize(
+      QlessQueue.read_stats('run' , bin, self.name), percentiles)
+  }
+end
+
+function QlessQueue.merged_stats(now, queues, from, to, percentiles)
+  local ok, names = pcall(cjson.decode, queues or '')
+  if not ok or type(names) ~= 'table' then
+    error('StatsMerged(): Arg "queues" not a JSON array: ' ..
+      tostring(queues))
+  end
+  from = assert(tonumber(from),
+    'StatsMerged(): Arg "from" missing or not a number: ' .. tostring(from))
+  to = assert(tonumber(to),
+    'StatsMerged(): Arg "to" missing or not a number: ' .. tostring(to))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  local first, last = from - (from % 86400), to - (to % 86400)
+  if last < first then
+    error('StatsMerged(): Arg "to" must not be before "from"')
+  elseif #names * ((last - first) / 86400 + 1) > 10000 then
+    error('StatsMerged(): More than 10000 days of queue stats requested')
+  end
+
+  local response = {retries = 0, failed = 0, failures = 0}
+  local wait, run = QlessQueue.read_stats(), QlessQueue.read_stats()
+  for _, name in ipairs(names) do
+    for bin = first, last, 86400 do
+      local counts = redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. name,
+        'retries', 'failed', 'failures')
+      response.retries  = response.retries  + (tonumber(counts[1]) or 0)
+      response.failed   = response.failed   + (tonumber(counts[2]) or 0)
+      response.failures = response.failures + (tonumber(counts[3]) or 0)
+      wait = QlessQueue.merge_stats(wait,
+        QlessQueue.read_stats('wait', bin, name))
+      run  = QlessQueue.merge_stats(run,
+        QlessQueue.read_stats('run' , bin, name))
+    end
+  end
+  response.wait = QlessQueue.summarize(wait, percentiles)
+  response.run  = QlessQueue.summarize(run , percentiles)
+  return response
+end
+
+function QlessQueue.percentiles(percentiles)
+  if percentiles == nil or percentiles == '' then
+    return nil
+  end
+  local ok, decoded = pcall(cjson.decode, percentiles)
+  if not ok or type(decoded) ~= 'table' then
+    error('Stats(): Arg "percentiles" not a JSON array: ' ..
+      tostring(percentiles))
+  end
+  for _, percentile in ipairs(decoded) do
+    if type(percentile) ~= 'number' or percentile < 0 or percentile > 100 then
+      error('Stats(): Percentile not between 0 and 100: ' ..
+        tostring(percentile))
+    end
+  end
+  return decoded
+end
+
+function QlessQueue.read_stats(name, bin, queue)
+  local stats = {count = 0, mean = 0, vk = 0, histogram = {}}
+  if name == nil then
+    for i=1,#QlessQueue.histogram do
+      table.insert(stats.histogram, 0)
+    end
+    return stats
+  end
+
+  local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
+  local fields = redis.call('hmget', key,
+    'total', 'mean', 'vk', 'count', 'sum', 'sumsq', unpack(QlessQueue.histogram))
+
+  stats.count = tonumber(fields[1]) or 0
+  stats.mean  = tonumber(fields[2]) or 0
+  stats.vk    = tonumber(fields[3]) or 0
+  local count = tonumber(fields[4]) or 0
+  if count > 0 then
+    local sum   = tonumber(fields[5]) or 0
+    local sumsq = tonumber(fields[6]) or 0
+    local mean  = sum / count
+    stats = QlessQueue.merge_stats(stats, {
+      count = count, mean = mean, vk = math.max(0, sumsq - sum * mean)})
+  end
+
+  stats.histogram = {}
+  for i=1,#QlessQueue.histogram do
+    table.insert(stats.histogram, tonumber(fields[i + 6]) or 0)
+  end
+  return stats
+end
+
+function QlessQueue.merge_stats(a, b)
+  local count = a.count + b.count
+  local stats = {count = count, mean = a.mean, vk = a.vk,
+    histogram = a.histogram}
+  if b.count > 0 then
+    local delta = b.mean - a.mean
+    stats.mean = (a.count * a.mean + b.count * b.mean) / count
+    stats.vk   = a.vk + b.vk + delta * delta * a.count * b.count / count
+  end
+  if a.histogram and b.histogram then
+    for i=1,#b.histogram do
+      a.histogram[i] = a.histogram[i] + b.histogram[i]
+    end
+  end
+  return stats
+end
+
+function QlessQueue.summarize(stats, percentiles)
+  local results = {count = stats.count, mean = stats.mean}
+  if stats.count > 1 then
+    results.std = math.sqrt(stats.vk / (stats.count - 1))
+  else
+    results.std = 0
+  end
+
+  if percentiles then
+    results.percentiles = {}
+    for _, percentile in ipairs(percentiles) do
+      table.insert(results.percentiles,
+        QlessQueue.percentile(stats.histogram, percentile))
+    end
+  else
+    results.histogram = stats.histogram
+  end
+  return results
+end
+
+function QlessQueue.percentile(histogram, percentile)
+  local total = 0
+  for _, count in ipairs(histogram) do
+    total = total + count
+  end
+  if total == 0 then
+    return 0
+  end
+
+  local rank = percentile / 100 * total
+  local seen = 0
+  for i, count in ipairs(histogram) do
+    if count > 0 and seen + count >= rank then
+      local field = QlessQueue.histogram[i]
+      local width = QlessQueue.widths[string.sub(field, 1, 1)]
+      local lower = tonumber(string.sub(field, 2)) * width
+      return lower + width * math.max(0, rank - seen - 0.5) / count
+    end
+    seen = seen + count
+  end
+end
+
+QlessQueue.widths = {s = 1, m = 60, h = 3600, d = 86400}
+
+function QlessQueue:peek(now, count, readonly)
+  count = assert(tonumber(count),
+    'Peek(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  local jids = self.locks.expired(now, 0, count)
+
+  if readonly then
+    table.extend(jids, self:preview(now, count - #jids))
+    return jids
+  end
+
+  self:promote(now, count - #jids)
+
+  table.extend(jids, self.work.peek(now, 0, count - #jids))
+
+  return jids
+end
+
+function QlessQueue:preview(now, count)
+  if count <= 0 then
+    return {}
+  end
+
+  local candidates = {}
+  local work = redis.call(
+    'zrevrange', self:prefix('work'), 0, count - 1, 'WITHSCORES')
+  for i = 1, #work, 2 do
+    table.insert(candidates, {jid = work[i], score = tonumber(work[i + 1])})
+  end
+
+  local claimed = {}
+  for _, jid in ipairs(self.scheduled.ready(now, 0, count)) do
+    local priority, resources, weights = unpack(redis.call(
+      'hmget', QlessJob.ns .. jid, 'priority', 'resources', 'weights'))
+    resources = Qless.decode(resources or '[]')
+    weights = Qless.decode(weights or '{}')
+    local available = true
+    for _, rid in ipairs(resources) do
+      available = available and
+        Qless.resource(rid):available(jid, claimed[rid] or 0)
+    end
+    if available then
+      for _, rid in ipairs(resources) do
+        claimed[rid] = (claimed[rid] or 0) + (weights[rid] or 1)
+      end
+      table.insert(candidates, {
+        jid   = jid,
+        score = tonumber(priority or 0) - (now / 10000000000)
+      })
+    end
+  end
+
+  table.sort(candidates, function(a, b)
+    if a.score ~= b.score then
+      return a.score > b.score
+    end
+    return a.jid > b.jid
+  end)
+
+  local jids = {}
+  for i = 1, math.min(count, #candidates) do
+    table.insert(jids, candidates[i].jid)
+  end
+  return jids
+end
+
+function QlessQueue:signal()
+  local key = self:prefix('signal')
+  redis.call('rpush', key, self.name)
+  redis.call('ltrim', key, 0, 0)
+end
+
+function QlessQueue:paused()
+  return redis.call('sismember', 'ql:paused_queues', self.name) == 1
+end
+
+function QlessQueue.pause(now, ...)
+  redis.call('sadd', 'ql:paused_queues', unpack(arg))
+end
+
+function QlessQueue.unpause(...)
+  redis.call('srem', 'ql:paused_queues', unpack(arg))
+end
+
+function QlessQueue:pop(now, worker, count)
+  assert(worker, 'Pop(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'Pop(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  local expires = now + (
+    Qless.config.get(self.name .. '-heartbeat') or
+    Qless.config.get('heartbeat'))
+
+  if self:paused() then
+    return {}
+  end
+
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  local max_concurrency =
+    Qless.config.get(self.name .. '-max-concurrency', 0)
+
+  if max_concurrency > 0 then
+    local allowed = math.max(0, max_concurrency - self.locks.running(now))
+    count = math.min(allowed, count)
+    if count == 0 then
+      return {}
+    end
+  end
+
+  local jids = self:invalidate_locks(now, count)
+
+  self:promote(now, count - #jids)
+
+  table.extend(jids, self.work.peek(now, 0, count - #jids))
+
+  local waits = {}
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    job:history(now, 'popped', {worker = worker})
+
+    local time, unique = unpack(
+      redis.call('hmget', QlessJob.ns .. jid, 'time', 'unique'))
+    table.insert(waits, now - tonumber(time or now))
+
+    if unique then
+      self:release_unique(unique, jid)
+    end
+
+    redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, jid)
+
+    job:update({
+      worker  = worker,
+      expires = expires,
+      state   = 'running',
+      time    = Qless.time(now)
+    })
+
+    self.locks.add(expires, jid)
+
+    local tracked = redis.call('zscore', 'ql:tracked', jid) ~= false
+    if tracked then
+      Qless.publish('popped', jid)
+    end
+  end
+
+  self:stat(now, 'wait', waits)
+
+  self.work.remove(unpack(jids))
+
+  local waiting = self.work.length()
+  if #jids > 0 and waiting > 0 then
+    self:signal()
+  end
+
+  if #jids > 0 then
+    self:record(now, 'pop', #jids)
+    QlessWorker.tally(now, worker, 'popped', #jids)
+  end
+
+  return jids
+end
+
+function QlessQueue.multipop(now, worker, count, queues)
+  assert(worker, 'Multipop(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'Multipop(): Arg "count" missing or not a number: ' .. tostring(count))
+  assert(queues, 'Multipop(): Arg "queues" missing')
+  local decoded = cjson.decode(queues)
+  assert(type(decoded) == 'table',
+    'Multipop(): Arg "queues" not a JSON array or object: ' .. queues)
+  queues = decoded
+
+  local order  = {}
+  local shares = {}
+  if #queues > 0 then
+    for _, name in ipairs(queues) do
+      table.insert(order, name)
+    end
+  else
+    local weights = {}
+    local total   = 0
+    for name, weight in pairs(queues) do
+      weights[name] = assert(tonumber(weight),
+        'Multipop(): Weight for "' .. name .. '" not a number: ' ..
+        tostring(weight))
+      if weights[name] <= 0 then
+        error('Multipop(): Weight for "' .. name .. '" must be positive')
+      end
+      total = total + weights[name]
+      table.insert(order, name)
+    end
+
+    table.sort(order, function(a, b)
+      if weights[a] == weights[b] then
+        return a < b
+      end
+      return weights[a] > weights[b]
+    end)
+
+    for _, name in ipairs(order) do
+      shares[name] = math.floor(count * weights[name] / total)
+    end
+  end
+
+  local jids = {}
+  for _, name in ipairs(order) do
+    local share = math.min(shares[name] or 0, count - #jids)
+    if share > 0 then
+      table.extend(jids, Qless.queue(name):pop(now, worker, share))
+    end
+  end
+
+  for _, name in ipairs(order) do
+    if #jids >= count then
+      break
+    end
+    table.extend(jids, Qless.queue(name):pop(now, worker, count - #jids))
+  end
+
+  return jids
+end
+
+function QlessQueue:stat(now, stat, vals)
+  if type(vals) ~= 'table' then
+    vals = {vals}
+  end
+  if #vals == 0 then
+    return
+  end
+
+  if Qless.batching then
+    local name = 'stat:' .. stat .. ':' .. self.name
+    local pending = Qless.memo(name, function() return {} end)
+    table.extend(pending, vals)
+    return Qless.defer(name, function() self:stat(now, stat, pending) end)
+  end
+
+  local bin = now - (now % 86400)
+  local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. self.name
+  local sum, sumsq = QlessQueue.accumulate(key, vals, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+
+  for _, resolution in ipairs({'minute', 'hour'}) do
+    local series = QlessQueue.series[resolution]
+    local bucket = now - (now % series.width)
+    local key = 'ql:s:' .. stat .. '-' .. resolution .. ':' .. bucket .. ':' ..
+      self.name
+    Qless.hincrby(key, 'count', #vals, function()
+      QlessQueue.expire_series(now, key, resolution, bucket)
+    end)
+    redis.call('hincrbyfloat', key, 'sum', sum)
+    redis.call('hincrbyfloat', key, 'sumsq', sumsq)
+  end
+end
+
+function QlessQueue.accumulate(key, vals, created)
+  local sum, sumsq = 0, 0
+  local histogram, buckets = {}, {}
+  for _, val in ipairs(vals) do
+    sum   = sum + val
+    sumsq = sumsq + val * val
+
+    val = math.floor(val)
+    local bucket
+    if val < 60 then -- seconds
+      bucket = 's' .. val
+    elseif val < 3600 then -- minutes
+      bucket = 'm' .. math.floor(val / 60)
+    elseif val < 86400 then -- hours
+      bucket = 'h' .. math.floor(val / 3600)
+    else -- days
+      bucket = 'd' .. math.floor(val / 86400)
+    end
+    if histogram[bucket] == nil then
+      histogram[bucket] = 0
+      table.insert(buckets, bucket)
+    end
+    histogram[bucket] = histogram[bucket] + 1
+  end
+
+  Qless.hincrby(key, 'count', #vals, created)
+  for _, bucket in ipairs(buckets) do
+    Qless.hincrby(key, bucket, histogram[bucket])
+  end
+  redis.call('hincrbyfloat', key, 'sum', sum)
+  redis.call('hincrbyfloat', key, 'sumsq', sumsq)
+  return sum, sumsq
+end
+
+function QlessQueue:record(now, event, count)
+  local bucket = now - (now % 60)
+  local key = 'ql:s:throughput:' .. bucket .. ':' .. self.name
+  Qless.hincrby(key, event, count or 1, function()
+    QlessQueue.expire_series(now, key, 'minute', bucket)
+    self:sample(now, key)
+  end)
+end
+
+function QlessQueue:sample(now, key)
+  if redis.call('hexists', key, 'waiting') == 0 then
+    redis.call('hmset', key,
+      'waiting', self.work.length(), 'running', self.locks.running(now))
+  end
+end
+
+function QlessQueue.expire_series(now, key, resolution, bucket)
+  local series = QlessQueue.series[resolution]
+  redis.call('expire', key, math.ceil(bucket + series.width - now +
+    Qless.config.get(series.history)))
+end
+
+function QlessQueue:throughput(now, window)
+  window = assert(tonumber(window or 60),
+    'Throughput(): Arg "window" not a number: ' .. tostring(window))
+  local longest = math.min(86400, Qless.config.get('minute-stats-history'))
+  if window <= 0 or window > longest then
+    error('Throughput(): Arg "window" must be between 0 and ' .. longest ..
+      ': ' .. window)
+  end
+
+  local first = (now - window) - ((now - window) % 60)
+  local elapsed = now - first
+  local events = {'put', 'pop', 'complete', 'fail', 'retry'}
+  local response = {window = elapsed, counts = {}, rates = {}, depth = {}}
+  for _, event in ipairs(events) do
+    response.counts[event] = 0
+  end
+
+  for bucket = first, now, 60 do
+    local values = redis.call('hmget',
+      'ql:s:throughput:' .. bucket .. ':' .. self.name,
+      'waiting', 'running', unpack(events))
+    if values[1] then
+      table.insert(response.depth, {
+        time    = bucket,
+        waiting = tonumber(values[1]),
+        running = tonumber(values[2])
+      })
+    end
+    for index, event in ipairs(events) do
+      response.counts[event] =
+        response.counts[event] + (tonumber(values[index + 2]) or 0)
+    end
+  end
+
+  for _, event in ipairs(events) do
+    response.rates[event] = response.counts[event] / elapsed
+  end
+  return response
+end
+
+QlessQueue.series = {
+  minute = {width = 60  , history = 'minute-stats-history'},
+  hour   = {width = 3600, history = 'hour-stats-history'  }
+}
+
+function QlessQueue:stats_range(now, from, to, resolution)
+  from = assert(tonumber(from),
+    'StatsRange(): Arg "from" missing or not a number: ' .. tostring(from))
+  to = assert(tonumber(to),
+    'StatsRange(): Arg "to" missing or not a number: ' .. tostring(to))
+  local series = QlessQueue.series[tostring(resolution)]
+  if not series then
+    error('StatsRange(): Arg "resolution" must be "minute" or "hour": ' ..
+      tostring(resolution))
+  end
+
+  local first = from - (from % series.width)
+  local buckets = math.floor((to - first) / series.width) + 1
+  if to < from then
+    error('StatsRange(): Arg "to" must not be before "from"')
+  elseif buckets > 10000 then
+    error('StatsRange(): Range spans more than 10000 buckets: ' .. buckets)
+  end
+
+  local response = {}
+  for _, stat in ipairs({'wait', 'run'}) do
+    local points = {}
+    for index = 0, buckets - 1 do
+      local bucket = first + index * series.width
+      local count, sum, sumsq = unpack(redis.call('hmget',
+        'ql:s:' .. stat .. '-' .. resolution .. ':' .. bucket .. ':' ..
+        self.name, 'count', 'sum', 'sumsq'))
+      count = tonumber(count) or 0
+      sum   = tonumber(sum) or 0
+      sumsq = tonumber(sumsq) or 0
+
+      local mean, std = 0, 0
+      if count > 0 then
+        mean = sum / count
+      end
+      if count > 1 then
+        std = math.sqrt(math.max(0, sumsq - sum * mean) / (count - 1))
+      end
+      table.insert(points, {time = bucket, count = count, mean = mean, std = std})
+    end
+    response[stat] = points
+  end
+  return response
+end
+
+function QlessQueue:tally(now, field, increment, when)
+  when = when or now
+  local bin = when - (when % 86400)
+  local key = 'ql:s:stats:' .. bin .. ':' .. self.name
+  local expire = function() QlessQueue.expire(now, key, bin) end
+  if bin == now - (now % 86400) then
+    Qless.hincrby(key, field, increment, expire)
+  else
+    Qless.hincrby(key, field, increment)
+    Qless.defer('expire:' .. key, expire)
+  end
+end
+
+function QlessQueue.expire(now, key, bin)
+  local days = Qless.config.get('stats-history')
+  redis.call('expire', key, math.ceil(bin + (days + 1) * 86400 - now))
+end
+
+function QlessQueue.compact(now, since, budget)
+  since = assert(tonumber(since),
+    'Compact(): Arg "since" missing or not a number: ' .. tostring(since))
+  budget = assert(tonumber(budget or 1000),
+    'Compact(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local today = now - (now % 86400)
+  local stats_cutoff = today - Qless.config.get('stats-history') * 86400
+  local histogram_cutoff =
+    today - Qless.config.get('histogram-history') * 86400
+
+  local queues = redis.call('zrange', 'ql:queues', 0, -1)
+  local changed, examined = 0, 0
+  if #queues == 0 then
+    return {changed = changed}
+  end
+
+  for bin = since - (since % 86400), today, 86400 do
+    if examined > 0 and examined + #queues * 3 > budget then
+      return {changed = changed, next = bin}
+    end
+    examined = examined + #queues * 3
+    for _, name in ipairs(queues) do
+      for _, stat in ipairs({'stats', 'wait', 'run'}) do
+        local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. name
+        if bin < stats_cutoff then
+          changed = changed + redis.call('del', key)
+        elseif redis.call('exists', key) == 1 then
+          if bin < histogram_cutoff and stat ~= 'stats' then
+            redis.call('hdel', key, unpack(QlessQueue.histogram))
+          end
+          QlessQueue.expire(now, key, bin)
+          changed = changed + 1
+        end
+      end
+    end
+  end
+  return {changed = changed}
+end
+
+function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
+  assert(jid  , 'Put(): Arg "jid" missing')
+  assert(klass, 'Put(): Arg "klass" missing')
+  assert(cjson.decode(data), 'Put(): Arg "data" missing or not JSON: ' .. tostring(data))
+  delay = assert(tonumber(delay),
+    'Put(): Arg "delay" not a number: ' .. tostring(delay))
+
+  if #arg % 2 == 1 then
+    error('Odd number of additional args: ' .. tostring(arg))
+  end
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  for _, name in ipairs({'priority', 'retries', 'interval', 'replace'}) do
+    if options[name] then
+      assert(tonumber(options[name]),
+        'Put(): Arg "' .. name .. '" not a number: ' .. tostring(options[name]))
+    end
+  end
+  local new_tags = options['tags'] and assert(cjson.decode(options['tags']),
+    'Put(): Arg "tags" not JSON'        .. tostring(options['tags']))
+  local depends = assert(cjson.decode(options['depends'] or '[]') ,
+    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
+  local resources, weights = QlessResource.parse('Put', options['resources'])
+  assert(#resources == 0 or QlessResource.all_exist(resources), 'Put(): invalid resources requested')
+  QlessResource.check_weights('Put', weights)
+
+  local unique = options['unique']
+  local coalesce = assert(tonumber(options['coalesce'] or 0),
+    'Put(): Arg "coalesce" not a number: ' .. tostring(options['coalesce']))
+  if unique then
+    local existing = self:unique(unique)
+    if existing and existing ~= jid then
+      if coalesce ~= 0 then
+        redis.call('hset', QlessJob.ns .. existing, 'data', data)
+        if options['priority'] then
+          Qless.job(existing):priority(options['priority'])
+        end
+      end
+      return existing
+    end
+  end
+
+  local job = Qless.job(jid)
+  local priority, tags, oldqueue, state, failure, retries, oldworker, interval, next_run, old_resources, history, old_unique =
+    unpack(redis.call('hmget', QlessJob.ns .. jid, 'priority', 'tags',
+      'queue', 'state', 'failure', 'retries', 'worker', 'throttle_interval', 'throttle_next_run', 'resources',
+      'history', 'unique'))
+
+  next_run = next_run or now
+
+  local replace = assert(tonumber(options['replace'] or 1) ,
+    'Put(): Arg "replace" not a number: ' .. tostring(options['replace']))
+
+  if replace == 0 and state == 'running' then
+    local time_left = self.locks.job_time_left(now, jid)
+    if time_left > 0 then
+      return time_left
+    end
+  end
+
+  local old_tags = Set.new(Qless.decode(tags or '[]'))
+
+  retries  = assert(tonumber(options['retries']  or retries or 5) ,
+    'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
+  tags = new_tags or Qless.decode(tags or '[]')
+  priority = assert(tonumber(options['priority'] or priority or 0),
+    'Put(): Arg "priority" not a number'  .. tostring(options['priority']))
+
+  if old_resources then
+    old_resources = Set.new(Qless.decode(old_resources))
+    local removed_resources = Set.diff(old_resources, Set.new(resources))
+    for k in pairs(removed_resources) do
+      Qless.resource(k):release(now, jid)
+    end
+    for _, rid in ipairs(resources) do
+      if old_resources[rid] then
+        Qless.resource(rid):reweigh(now, jid, weights[rid] or 1)
+      end
+    end
+  end
+
+  local interval = assert(tonumber(options['interval'] or interval or 0),
+    'Put(): Arg "interval" not a number: ' .. tostring(options['interval']))
+
+  if interval > 0 then
+    local minimum_delay = next_run - now
+    if minimum_delay < 0 then
+      minimum_delay = 0
+    elseif minimum_delay > delay then
+      delay = minimum_delay
+    end
+  else
+    next_run = 0
+  end
+
+  if #depends > 0 then
+    local new = {}
+    for _, d in ipairs(depends) do new[d] = 1 end
+
+    local original = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependencies')
+    for _, dep in pairs(original) do
+      if new[dep] == nil or new[dep] == false then
+        redis.call('srem', QlessJob.ns .. dep .. '-dependents'  , jid)
+        job:remove_dependency(dep)
+      end
+    end
+  end
+
+  Qless.publish('log', cjson.encode({
+    jid   = jid,
+    event = 'put',
+    queue = self.name
+  }))
+
+  if history then
+    job:migrate_history(history)
+  end
+  job:history(now, 'put', {q = self.name})
+
+  if oldqueue then
+    local queue_obj = Qless.queue(oldqueue)
+    queue_obj.work.remove(jid)
+    queue_obj.locks.remove(jid)
+    queue_obj.depends.remove(jid)
+    queue_obj.scheduled.remove(jid)
+    if old_unique then
+      queue_obj:release_unique(old_unique, jid)
+    end
+  end
+
+  if oldworker and oldworker ~= '' then
+    redis.call('zrem', 'ql:w:' .. oldworker .. ':jobs', jid)
+    if oldworker ~= worker then
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = oldworker
+      })
+      Qless.publish('w:' .. oldworker, encoded)
+      Qless.publish('log', encoded)
+    end
+  end
+
+  if state == 'complete' then
+    redis.call('zrem', 'ql:completed', jid)
+  end
+
+  local new_tags = Set.new(tags)
+  for tag in pairs(Set.diff(old_tags, new_tags)) do
+    redis.call('zrem', 'ql:t:' .. tag, jid)
+    redis.call('zincrby', 'ql:tags', -1, tag)
+  end
+  for tag in pairs(Set.diff(new_tags, old_tags)) do
+    redis.call('zadd', 'ql:t:' .. tag, now, jid)
+    redis.call('zincrby', 'ql:tags', 1, tag)
+  end
+
+  if state == 'failed' then
+    failure = Qless.decode(failure)
+    redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
+    if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
+      redis.call('srem', 'ql:failures', failure.group)
+    end
+    self:tally(now, 'failed', -1, failure.when)
+  end
+
+  job:update({
+    jid               = jid,
+    klass             = klass,
+    data              = data,
+    priority          = priority,
+    tags              = Qless.encode(tags),
+    resources         = Qless.encode(resources),
+    weights           = Qless.encode(weights),
+    state             = ((delay > 0) and 'scheduled') or 'waiting',
+    worker            = '',
+    expires           = 0,
+    queue             = self.name,
+    retries           = retries,
+    remaining         = retries,
+    time              = Qless.time(now),
+    throttle_interval = interval,
+    throttle_next_run = next_run,
+    result_data       = '{}'
+  })
+
+  if unique then
+    redis.call('set', 'ql:u:' .. self.name .. ':' .. unique, jid)
+    redis.call('hset', QlessJob.ns .. jid, 'unique', unique)
+  end
+
+  local unresolved = job:add_dependencies(depends)
+
+  if delay > 0 then
+    if unresolved > 0 then
+      self.depends.add(now, jid)
+      redis.call('hmset', QlessJob.ns .. jid,
+        'state', 'depends',
+        'scheduled', now + delay)
+    else
+      self.scheduled.add(now + delay, jid)
+    end
+  else
+    if unresolved > 0 then
+      self.depends.add(now, jid)
+      redis.call('hset', QlessJob.ns .. jid, 'state', 'depends')
+    elseif #resources > 0 then
+      if Qless.job(jid):acquire_resources(now) then
+        self.work.add(now, priority, jid)
+      end
+    else
+      self.work.add(now, priority, jid)
+    end
+  end
+
+  self:record(now, 'put')
+
+  Qless.defer('known:' .. self.name, function()
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+  end)
+
+  if Qless.tracked(jid) then
+    Qless.publish('put', jid)
+  end
+
+  return jid
+end
+
+function QlessQueue.put_many(now, worker, jobs)
+  jobs = assert(cjson.decode(jobs or ''),
+    'Put_many(): Arg "jobs" missing or not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Put_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  local encoded = {
+    tags = true, depends = true, resources = true
+  }
+  local fields = {
+    queue = true, jid = true, klass = true, data = true, delay = true
+  }
+
+  local seen = {}
+  return Qless.outcomes(jobs, function(spec)
+    assert(type(spec) == 'table', 'Put_many(): job spec not an object')
+    assert(spec.queue, 'Put_many(): Arg "queue" missing')
+    assert(not seen[spec.jid],
+      'Put_many(): job ' .. tostring(spec.jid) .. ' given more than once')
+    if spec.jid then
+      seen[spec.jid] = true
+    end
+
+    local data = spec.data or '{}'
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+
+    local options = {}
+    for key, value in pairs(spec) do
+      if not fields[key] then
+        if encoded[key] and type(value) == 'table' then
+          value = cjson.encode(value)
+        end
+        table.insert(options, key)
+        table.insert(options, value)
+      end
+    end
+
+    return Qless.queue(spec.queue):put(now, worker, spec.jid,
+      spec.klass, data, spec.delay or 0, unpack(options))
+  end)
+end
+
+function QlessQueue:unique(key)
+  local jid = redis.call('get', 'ql:u:' .. self.name .. ':' .. key)
+  if not jid then
+    return nil
+  end
+
+  local queue, state, unique = unpack(redis.call(
+    'hmget', QlessJob.ns .. jid, 'queue', 'state', 'unique'))
+  if queue == self.name and unique == key and
+    (state == 'waiting' or state == 'scheduled') then
+    return jid
+  end
+  return nil
+end
+
+function QlessQueue:release_unique(key, jid)
+  local index = 'ql:u:' .. self.name .. ':' .. key
+  if redis.call('get', index) == jid then
+    redis.call('del', index)
+  end
+  redis.call('hdel', QlessJob.ns .. jid, 'unique')
+end
+
+function QlessQueue:unfail(now, group, count)
+  assert(group, 'Unfail(): Arg "group" missing')
+  count = assert(tonumber(count or 25),
+    'Unfail(): Arg "count" not a number: ' .. tostring(count))
+
+  local jids = redis.call('lrange', 'ql:f:' .. group, -count, -1)
+
+  local toinsert = {}
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    local data = job:project({'jid', 'priority', 'retries', 'resources'})
+    job:history(now, 'put', {q = self.name})
+    job:update({
+      state     = 'waiting',
+      worker    = '',
+      expires   = 0,
+      queue     = self.name,
+      remaining = data.retries or 5
+    })
+
+    if #data['resources'] then
+      if job:acquire_resources(now) then
+        self.work.add(now, data.priority, data.jid)
+      end
+    else
+      self.work.add(now, data.priority, data.jid)
+    end
+  end
+
+  redis.call('ltrim', 'ql:f:' .. group, 0, -count - 1)
+  if (redis.call('llen', 'ql:f:' .. group) == 0) then
+    redis.call('srem', 'ql:failures', group)
+  end
+
+  return #jids
+end
+
+function QlessQueue:recur(now, jid, klass, data, spec, ...)
+  assert(jid  , 'RecurringJob On(): Arg "jid" missing')
+  assert(klass, 'RecurringJob On(): Arg "klass" missing')
+  assert(spec , 'RecurringJob On(): Arg "spec" missing')
+  assert(cjson.decode(data), 'RecurringJob On(): Arg "data" missing or not JSON: ' .. tostring(data))
+
+  if spec == 'interval' then
+    local interval = assert(tonumber(arg[1]),
+      'Recur(): Arg "interval" not a number: ' .. tostring(arg[1]))
+    local offset   = assert(tonumber(arg[2]),
+      'Recur(): Arg "offset" not a number: '   .. tostring(arg[2]))
+    if interval <= 0 then
+      error('Recur(): Arg "interval" must be greater than 0')
+    end
+
+    if #arg % 2 == 1 then
+      error('Odd number of additional args: ' .. tostring(arg))
+    end
+
+    local options = {}
+    for i = 3, #arg, 2 do options[arg[i]] = arg[i + 1] end
+    options.tags = assert(cjson.decode(options.tags or '{}'),
+      'Recur(): Arg "tags" must be JSON string array: ' .. tostring(
+        options.tags))
+    options.priority = assert(tonumber(options.priority or 0),
+      'Recur(): Arg "priority" not a number: ' .. tostring(
+        options.priority))
+    options.retries = assert(tonumber(options.retries  or 0),
+      'Recur(): Arg "retries" not a number: ' .. tostring(
+        options.retries))
+    options.backlog = assert(tonumber(options.backlog  or 0),
+      'Recur(): Arg "backlog" not a number: ' .. tostring(
+        options.backlog))
+    QlessResource.check_weights('Recur',
+      select(2, QlessResource.parse('Recur', options['resources'])))
+    options.resources = cjson.decode(options['resources'] or '[]')
+
+    local count, old_queue = unpack(redis.call('hmget', 'ql:r:' .. jid, 'count', 'queue'))
+    count = count or 0
+
+    if old_queue then
+      Qless.queue(old_queue).recurring.remove(jid)
+    end
+
+    redis.call('hmset', 'ql:r:' .. jid,
+      'jid'      , jid,
+      'klass'    , klass,
+      'data'     , data,
+      'priority' , options.priority,
+      'tags'     , cjson.encode(options.tags or {}),
+      'state'    , 'recur',
+      'queue'    , self.name,
+      'type'     , 'interval',
+      'count'    , count,
+      'interval' , interval,
+      'retries'  , options.retries,
+      'backlog'  , options.backlog,
+      'resources', cjson.encode(options.resources))
+    self.recurring.add(now + offset, jid)
+
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+
+    return jid
+  else
+    error('Recur(): schedule type "' .. tostring(spec) .. '" unknown')
+  end
+end
+
+function QlessQueue:length()
+  return  self.locks.length() + self.work.length() + self.scheduled.length()
+end
+
+function QlessQueue:due(when)
+  if Qless.batching then
+    return Qless.defer('due:' .. self.name, function() self:reindex() end)
+  end
+
+  local score = redis.call('zscore', 'ql:due', self.name)
+  if (not score) or (tonumber(when) < tonumber(score)) then
+    redis.call('zadd', 'ql:due', when, self.name)
+  end
+end
+
+function QlessQueue:reindex()
+  local when = '+inf'
+  for _, group in ipairs({'scheduled', 'recur'}) do
+    local first = redis.call(
+      'zrange', self:prefix(group), 0, 0, 'WITHSCORES')[2]
+    if first and (when == '+inf' or tonumber(first) < when) then
+      when = tonumber(first)
+    end
+  end
+  redis.call('zadd', 'ql:due', when, self.name)
+end
+
+function QlessQueue:promote(now, count)
+  local due = redis.call('zscore', 'ql:due', self.name)
+  if due and tonumber(due) > now then
+    return 0
+  end
+
+  local moved = self:check_recurring(now, count)
+  moved = moved + self:check_scheduled(now, count)
+  self:reindex()
+  return moved
+end
+
+function QlessQueue.tick(now, budget)
+  budget = assert(tonumber(budget),
+    'Tick(): Arg "budget" missing or not a number: ' .. tostring(budget))
+
+  local moved = 0
+  local queues = redis.call(
+    'zrangebyscore', 'ql:due', '-inf', now, 'LIMIT', 0, budget)
+  for _, name in ipairs(queues) do
+    if moved >= budget then
+      break
+    end
+    local queue = Qless.queue(name)
+    moved = moved + queue:check_recurring(now, budget - moved)
+    moved = moved + queue:check_scheduled(now, budget - moved)
+    queue:reindex()
+  end
+  return moved
+end
+
+function QlessQueue:check_recurring(now, count)
+  local moved = 0
+  local r = self.recurring.peek(now, 0, count)
+  for index, jid in ipairs(r) do
+    local klass, data, priority, tags, retries, interval, backlog, resources = unpack(
+      redis.call('hmget', 'ql:r:' .. jid, 'klass', 'data', 'priority',
+        'tags', 'retries', 'interval', 'backlog', 'resources'))
+    local _tags = cjson.decode(tags)
+    local resources, weights = QlessResource.parse('Recur', resources)
+    local score = math.floor(tonumber(self.recurring.score(jid)))
+    interval = tonumber(interval)
+
+    backlog = tonumber(backlog or 0)
+    if backlog ~= 0 then
+      local num = ((now - score) / interval)
+      if num > backlog then
+        score = score + (
+          math.ceil(num - backlog) * interval
+        )
+      end
+    end
+
+    while (score <= now) and (moved < count) do
+      local count = redis.call('hincrby', 'ql:r:' .. jid, 'count', 1)
+      moved = moved + 1
+
+      local child_jid = jid .. '-' .. count
+
+      for i, tag in ipairs(_tags) do
+        redis.call('zadd', 'ql:t:' .. tag, now, child_jid)
+        redis.call('zincrby', 'ql:tags', 1, tag)
+      end
+
+      local job = Qless.job(child_jid)
+      job:update({
+        jid               = child_jid,
+        klass             = klass,
+        data              = data,
+        priority          = priority,
+        tags              = Qless.encode(_tags),
+        state             = 'waiting',
+        worker            = '',
+        expires           = 0,
+        queue             = self.name,
+        retries           = retries,
+        remaining         = retries,
+        resources         = Qless.encode(resources),
+        weights           = Qless.encode(weights),
+        throttle_interval = 0,
+        time              = Qless.time(score),
+        spawned_from_jid  = jid
+      })
+      job:history(score, 'put', {q = self.name})
+
+
+      local add_job = true
+      if #resources then
+        add_job = job:acquire_resources(score)
+      end
+      if add_job then
+        self.work.add(score, priority, child_jid)
+      end
+
+      score = score + interval
+      self.recurring.add(score, jid)
+    end
+  end
+  return moved
+end
+
+function QlessQueue:check_scheduled(now, count)
+  local scheduled = self.scheduled.ready(now, 0, count)
+  for index, jid in ipairs(scheduled) do
+    local priority = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'priority') or 0)
+    if Qless.job(jid):acquire_resources(now) then
+      self.work.add(now, priority, jid)
+    end
+    self.scheduled.remove(jid)
+
+    redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
+  end
+  return #scheduled
+end
+
+function QlessQueue:invalidate_locks(now, count)
+  local jids = {}
+  for index, jid in ipairs(self.locks.expired(now, 0, count)) do
+    local worker, failure = unpack(
+      redis.call('hmget', QlessJob.ns .. jid, 'worker', 'failure'))
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+
+    local grace_period = Qless.config.get('grace-period')
+
+    local courtesy_sent = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'grace') or 0)
+
+    local send_message = (courtesy_sent ~= 1)
+    local invalidate   = not send_message
+
+    if grace_period <= 0 then
+      send_message = true
+      invalidate   = true
+    end
+
+    if send_message then
+      if redis.call('zscore', 'ql:tracked', jid) ~= false then
+        Qless.publish('stalled', jid)
+      end
+      Qless.job(jid):history(now, 'timed-out')
+      redis.call('hset', QlessJob.ns .. jid, 'grace', 1)
+
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = worker
+      })
+      Qless.publish('w:' .. worker, encoded)
+      Qless.publish('log', encoded)
+      self.locks.add(now + grace_period, jid)
+      QlessWorker.tally(now, worker, 'lost', 1)
+
+      self:tally(now, 'retries', 1)
+    end
+
+    if invalidate then
+      redis.call('hdel', QlessJob.ns .. jid, 'grace', 0)
+
+      local remaining = tonumber(redis.call(
+        'hincrby', QlessJob.ns .. jid, 'remaining', -1))
+
+      if remaining < 0 then
+        Qless.job(jid):release_resources(now)
+
+        self.work.remove(jid)
+        self.locks.remove(jid)
+        self.scheduled.remove(jid)
+
+        local group = 'failed-retries-' .. unpack(Qless.job(jid):data('queue'))
+        local job = Qless.job(jid)
+        job:history(now, 'failed', {group = group})
+        job:update({state = 'failed', worker = '', expires = 0})
+        redis.call('hset', QlessJob.ns .. jid,
+        'failure', Qless.encode({
+          ['group']   = group,
+          ['message'] =
+            'Job exhausted retries in queue "' .. self.name .. '"',
+          ['when']    = now,
+          ['worker']  = unpack(job:data('worker'))
+        }))
+
+        redis.call('sadd', 'ql:failures', group)
+        redis.call('lpush', 'ql:f:' .. group, jid)
+
+        if redis.call('zscore', 'ql:tracked', jid) ~= false then
+          Qless.publish('failed', jid)
+        end
+        Qless.publish('log', cjson.encode({
+          jid     = jid,
+          event   = 'failed',
+          group   = group,
+          worker  = worker,
+          message =
+            'Job exhausted retries in queue "' .. self.name .. '"'
+        }))
+
+        self:tally(now, 'failures', 1)
+        self:tally(now, 'failed'  , 1)
+        self:record(now, 'fail')
+        QlessWorker.tally(now, worker, 'failed', 1)
+      else
+        table.insert(jids, jid)
+      end
+    end
+  end
+
+  return jids
+end
+
+function QlessQueue.deregister(...)
+  redis.call('zrem', Qless.ns .. 'queues', unpack(arg))
+  redis.call('zrem', Qless.ns .. 'due', unpack(arg))
+end
+
+function QlessQueue.counts(now, name)
+  if name then
+    local queue = Qless.queue(name)
+    local stalled = queue.locks.length(now)
+    queue:check_scheduled(now, queue.scheduled.length())
+    return {
+      name      = name,
+      waiting   = queue.work.length(),
+      stalled   = stalled,
+      running   = queue.locks.length() - stalled,
+      scheduled = queue.scheduled.length(),
+      depends   = queue.depends.length(),
+      recurring = queue.recurring.length(),
+      paused    = queue:paused()
+    }
+  else
+    local queues = redis.call('zrange', 'ql:queues', 0, -1)
+    local response = {}
+    for index, qname in ipairs(queues) do
+      table.insert(response, QlessQueue.counts(now, qname))
+    end
+    return response
+  end
+end
+function QlessRecurringJob:data()
+  local job = redis.call(
+    'hmget', 'ql:r:' .. self.jid, 'jid', 'klass', 'state', 'queue',
+    'priority', 'interval', 'retries', 'count', 'data', 'tags', 'backlog')
+
+  if not job[1] then
+    return nil
+  end
+
+  return {
+    jid          = job[1],
+    klass        = job[2],
+    state        = job[3],
+    queue        = job[4],
+    priority     = tonumber(job[5]),
+    interval     = tonumber(job[6]),
+    retries      = tonumber(job[7]),
+    count        = tonumber(job[8]),
+    data         = job[9],
+    tags         = cjson.decode(job[10]),
+    backlog      = tonumber(job[11] or 0)
+  }
+end
+
+function QlessRecurringJob:update(now, ...)
+  local options = {}
+  if redis.call('exists', 'ql:r:' .. self.jid) ~= 0 then
+    for i = 1, #arg, 2 do
+      local key = arg[i]
+      local value = arg[i+1]
+      assert(value, 'No value provided for ' .. tostring(key))
+      if key == 'priority' or key == 'interval' or key == 'retries' then
+        value = assert(tonumber(value), 'Recur(): Arg "' .. key .. '" must be a number: ' .. tostring(value))
+        if key == 'interval' then
+          local queue, interval = unpack(redis.call('hmget', 'ql:r:' .. self.jid, 'queue', 'interval'))
+          Qless.queue(queue).recurring.update(
+            value - tonumber(interval), self.jid)
+        end
+        redis.call('hset', 'ql:r:' .. self.jid, key, value)
+      elseif key == 'data' then
+        assert(cjson.decode(value), 'Recur(): Arg "data" is not JSON-encoded: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'data', value)
+      elseif key == 'klass' then
+        redis.call('hset', 'ql:r:' .. self.jid, 'klass', value)
+      elseif key == 'queue' then
+        local queue_obj = Qless.queue(
+          redis.call('hget', 'ql:r:' .. self.jid, 'queue'))
+        local score = queue_obj.recurring.score(self.jid)
+        queue_obj.recurring.remove(self.jid)
+        Qless.queue(value).recurring.add(score, self.jid)
+        redis.call('hset', 'ql:r:' .. self.jid, 'queue', value)
+        if redis.call('zscore', 'ql:queues', value) == false then
+          redis.call('zadd', 'ql:queues', now, value)
+        end
+      elseif key == 'backlog' then
+        value = assert(tonumber(value),
+          'Recur(): Arg "backlog" not a number: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'backlog', value)
+      else
+        error('Recur(): Unrecognized option "' .. key .. '"')
+      end
+    end
+    return true
+  else
+    error('Recur(): No recurring job ' .. self.jid)
+  end
+end
+
+function QlessRecurringJob:tag(...)
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  if tags then
+    tags = cjson.decode(tags)
+    local _tags = {}
+    for i,v in ipairs(tags) do _tags[v] = true end
+
+    for i=1,#arg do if _tags[arg[i]] == nil or _tags[arg[i]] == false then table.insert(tags, arg[i]) end end
+
+    tags = cjson.encode(tags)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Tag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+function QlessRecurringJob:untag(...)
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  if tags then
+    tags = cjson.decode(tags)
+    local _tags    = {}
+    for i,v in ipairs(tags) do _tags[v] = true end
+    for i = 1,#arg do _tags[arg[i]] = nil end
+    local results = {}
+    for i, tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+    tags = cjson.encode(results)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Untag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+function QlessRecurringJob:unrecur()
+  local queue = redis.call('hget', 'ql:r:' .. self.jid, 'queue')
+  if queue then
+    Qless.queue(queue).recurring.remove(self.jid)
+    redis.call('del', 'ql:r:' .. self.jid)
+    return true
+  else
+    return true
+  end
+end
+function QlessWorker.deregister(...)
+  redis.call('zrem', 'ql:workers', unpack(arg))
+end
+
+function QlessWorker.counts(now, worker)
+  local interval = Qless.config.get('max-worker-age', 86400)
+
+  local workers  = redis.call('zrangebyscore', 'ql:workers', 0, now - interval)
+  for index, worker in ipairs(workers) do
+    redis.call('del', 'ql:w:' .. worker .. ':jobs')
+  end
+
+  redis.call('zremrangebyscore', 'ql:workers', 0, now - interval)
+
+  if worker then
+    return {
+      jobs    = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now + 8640000, now),
+      stalled = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now, 0)
+    }
+  else
+    local response = {}
+    local workers = redis.call('zrevrange', 'ql:workers', 0, -1)
+    for index, worker in ipairs(workers) do
+      table.insert(response, {
+        name    = worker,
+        jobs    = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', now, now + 8640000),
+        stalled = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', 0, now)
+      })
+    end
+    return response
+  end
+end
+
+function QlessWorker.stats(now, worker, date, percentiles)
+  worker = assert(worker, 'WorkerStats(): Arg "worker" missing')
+  date = assert(tonumber(date),
+    'WorkerStats(): Arg "date" missing or not a number: ' .. tostring(date))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  local bin = date - (date % 86400)
+  local popped, completed, failed, lost = unpack(redis.call('hmget',
+    'ql:s:worker:' .. bin .. ':' .. worker,
+    'popped', 'count', 'failed', 'lost'))
+  return {
+    popped    = tonumber(popped    or 0),
+    completed = tonumber(completed or 0),
+    failed    = tonumber(failed    or 0),
+    lost      = tonumber(lost      or 0),
+    run       = QlessQueue.summarize(
+      QlessQueue.read_stats('worker', bin, worker), percentiles)
+  }
+end
+
+function QlessWorker.tally(now, worker, field, increment)
+  local bin = now - (now % 86400)
+  local key = 'ql:s:worker:' .. bin .. ':' .. worker
+  Qless.hincrby(key, field, increment, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+end
+
+function QlessWorker.stat(now, worker, vals)
+  if type(vals) ~= 'table' then
+    vals = {vals}
+  end
+
+  if Qless.batching then
+    local name = 'stat:worker:' .. worker
+    local pending = Qless.memo(name, function() return {} end)
+    table.extend(pending, vals)
+    return Qless.defer(name, function()
+      QlessWorker.stat(now, worker, pending)
+    end)
+  end
+
+  local bin = now - (now % 86400)
+  local key = 'ql:s:worker:' .. bin .. ':' .. worker
+  QlessQueue.accumulate(key, vals, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+end
+
+function QlessResource:data(...)
+  local res = redis.call(
+    'hmget', QlessResource.ns .. self.rid, 'rid', 'max')
+
+  if not res[1] then
+    return nil
+  end
+
+  local data = {
+    rid          = res[1],
+    max          = tonumber(res[2] or 0),
+    used         = self:used(),
+    pending      = self:pending(),
+    locks        = self:locks(),
+  }
+
+  return data
+end
+
+function QlessResource:get(...)
+  local res = redis.call(
+    'hmget', QlessResource.ns .. self.rid, 'rid', 'max')
+
+  if not res[1] then
+    return nil
+  end
+
+  return tonumber(res[2] or 0)
+end
+
+function QlessResource:set(now, max)
+  local max = assert(tonumber(max), 'Set(): Arg "max" not a number: ' .. tostring(max))
+
+  redis.call('hmset', QlessResource.ns .. self.rid, 'rid', self.rid, 'max', max);
+  redis.call('zadd', 'ql:resources', 0, self.rid)
+
+  self:grant(now)
+
+  return self.rid
+end
+
+function QlessResource:unset()
+  redis.call('zrem', 'ql:resources', self.rid)
+  return redis.call('del', QlessResource.ns .. self.rid);
+end
+
+function QlessResource:prefix(group)
+  if group then
+    return QlessResource.ns..self.rid..'-'..group
+  end
+
+  return QlessResource.ns..self.rid
+end
+
+function QlessResource:available(jid, claimed)
+  local max = self:get()
+  if max == nil then
+    return false
+  end
+
+  if redis.call('sismember', self:prefix('locks'), jid) == 1 then
+    return true
+  end
+
+  return max - self:used() - self:held_back(jid) - (claimed or 0) >=
+    Qless.job(jid):weight(self.rid)
+end
+
+function QlessResource:held_back(jid)
+  local reserved = redis.call('hget', QlessResource.ns .. self.rid, 'reserved')
+  if not reserved or reserved == jid or
+    redis.call('zscore', self:prefix('pending'), reserved) == false then
+    return 0
+  end
+  return Qless.job(reserved):weight(self.rid)
+end
+
+function QlessResource:acquire(now, priority, jid, weight)
+  local keyLocks = self:prefix('locks')
+  local max = self:get()
+  if max == nil then
+    error({code=1, msg='Acquire(): resource ' .. self.rid .. ' does not exist'})
+  end
+
+  if type(jid) ~= 'string' then
+    error({code=2, msg='Acquire(): invalid jid; expected string, got \'' .. type(jid) .. '\''})
+  end
+
+
+  if redis.call('sismember', self:prefix('locks'), jid) == 1 then
+    return true
+  end
+
+  local held_back = self:held_back(jid)
+  local remaining = max - self:used() - held_back
+  weight = weight or 1
+
+  if remaining >= weight then
+    redis.call('sadd', keyLocks, jid)
+    if weight ~= 1 then
+      redis.call('hset', self:prefix('weights'), jid, weight)
+    end
+    redis.call('hincrby', self:prefix(), 'used', weight)
+    redis.call('zrem', self:prefix('pending'), jid)
+
+    return true
+  end
+
+  if redis.call('zscore', self:prefix('pending'), jid) == false then
+    redis.call('zadd', self:prefix('pending'), priority - (now / 10000000000), jid)
+  end
+
+  if held_back == 0 and weight <= max then
+  end
+
+  return false
+end
+
+function QlessResource:release(now, jid)
+  local keyLocks = self:prefix('locks')
+  local keyPending = self:prefix('pending')
+
+  if redis.call('sismember', keyLocks, jid) == 1 then
+    self:use(-tonumber(redis.call('hget', self:prefix('weights'), jid) or 1))
+    redis.call('srem', keyLocks, jid)
+    redis.call('hdel', self:prefix('weights'), jid)
+  end
+  redis.call('zrem', keyPending, jid)
+
+  return self:grant(now)[1] or false
+end
+
+function QlessResource:reweigh(now, jid, weight)
+  if redis.call('sismember', self:prefix('locks'), jid) == 0 then
+    return
+  end
+
+  local held = tonumber(redis.call('hget', self:prefix('weights'), jid) or 1)
+  if held == weight then
+    return
+  end
+
+  if self:used() - held + weight > (self:get() or 0) then
+    self:release(now, jid)
+    return
+  end
+
+  self:use(weight - held)
+  if weight == 1 then
+    redis.call('hdel', self:prefix('weights'), jid)
+  else
+    redis.call('hset', self:prefix('weights'), jid, weight)
+  end
+  if weight < held then
+    self:grant(now)
+  end
+end
+
+function QlessResource:grant(now)
+  local max = self:get()
+  if max == nil then
+    return {}
+  end
+
+  redis.call('hdel', QlessResource.ns .. self.rid, 'reserved')
+  local free = max - self:used()
+  if free <= 0 then
+    return {}
+  end
+
+  local budget = Qless.config.get('resource-grant-budget')
+  local jids = redis.call(
+    'zrevrange', self:prefix('pending'), 0, budget - 1, 'withscores')
+
+  local granted, passed = {}, nil
+  for i = 1, #jids, 2 do
+    if free <= 0 then
+      break
+    end
+
+    local weight = Qless.job(jids[i]):weight(self.rid)
+    if weight > max then
+    elseif weight > free then
+      redis.call('hset', QlessResource.ns .. self.rid, 'reserved', jids[i])
+      break
+    elseif Qless.job(jids[i]):blocked(self.rid) then
+      passed = passed or i
+    else
+      self:admit(now, jids[i], jids[i + 1])
+      table.insert(granted, jids[i])
+      free = max - self:used()
+    end
+  end
+
+  if passed and self:available(jids[passed]) then
+    self:admit(now, jids[passed], jids[passed + 1])
+    table.insert(granted, jids[passed])
+  end
+  return granted
+end
+
+function QlessResource:admit(now, jid, score)
+  if Qless.job(jid):acquire_resources(now) then
+    local queue = Qless.queue(unpack(Qless.job(jid):data('queue')))
+    queue.work.add(score, 0, jid)
+  end
+end
+
+function QlessResource:locks()
+  return redis.call('smembers', self:prefix('locks'))
+end
+
+function QlessResource:lock_count()
+  return redis.call('scard', self:prefix('locks'))
+end
+
+function QlessResource:used()
+  local used = redis.call('hget', self:prefix(), 'used')
+  if used then
+    return tonumber(used), true
+  end
+
+  used = self:lock_count()
+  for _, weight in ipairs(redis.call('hvals', self:prefix('weights'))) do
+    used = used + tonumber(weight) - 1
+  end
+  if redis.call('exists', self:prefix()) == 0 then
+    return used, false
+  end
+  redis.call('hset', self:prefix(), 'used', used)
+  return used, true
+end
+
+function QlessResource:use(units)
+  local _, kept = self:used()
+  if kept then
+    redis.call('hincrby', self:prefix(), 'used', units)
+  end
+end
+
+function QlessResource:pending()
+  return redis.call('zrevrange', self:prefix('pending'), 0, -1)
+end
+
+function QlessResource:pending_count()
+  return redis.call('zcard', self:prefix('pending'))
+end
+
+function QlessResource:exists()
+  return redis.call('exists', self:prefix()) == 1
+end
+
+function QlessResource.parse(name, resources)
+  local ok, decoded = pcall(cjson.decode, resources or '[]')
+  if not ok or type(decoded) ~= 'table' then
+    error(name .. '(): Arg "resources" not JSON array or object: ' ..
+      tostring(resources))
+  end
+  if #decoded > 0 or next(decoded) == nil then
+    return decoded, {}
+  end
+
+  local rids, weights = {}, {}
+  for rid, weight in pairs(decoded) do
+    if type(weight) ~= 'number' or weight < 1 or
+      weight ~= math.floor(weight) then
+      error(name .. '(): Weight of resource "' .. rid ..
+        '" not a positive integer: ' .. tostring(weight))
+    end
+    table.insert(rids, rid)
+    if weight ~= 1 then
+      weights[rid] = weight
+    end
+  end
+  table.sort(rids)
+  return rids, weights
+end
+
+function QlessResource.check_weights(name, weights)
+  for rid, weight in pairs(weights) do
+    local max = Qless.resource(rid):get()
+    if max and weight > max then
+      error(name .. '(): Weight of resource "' .. rid .. '" (' .. weight ..
+        ') more than its max: ' .. max)
+    end
+  end
+end
+
+function QlessResource.all_exist(resources)
+  for _, res in ipairs(resources) do
+    if redis.call('exists', QlessResource.ns .. res) == 0 then
+      return false
+    end
+  end
+  return true
+end
+
+function QlessResource.pending_counts(now, after, count)
+  return QlessResource.counts('PendingCounts', 'pending_count', after, count)
+end
+
+function QlessResource.locks_counts(now, after, count)
+  return QlessResource.counts('LocksCounts', 'lock_count', after, count)
+end
+
+function QlessResource.counts(name, method, after, count)
+  count = assert(tonumber(count or 25),
+    name .. '(): Arg "count" not a number: ' .. tostring(count))
+
+  local response = {}
+  local start = after and ('(' .. after) or '-'
+  while #response < count do
+    local rids = redis.call(
+      'zrangebylex', 'ql:resources', start, '+', 'limit', 0, 1000)
+    for _, rid in ipairs(rids) do
+      local resource = Qless.resource(rid)
+      local resource_count = resource[method](resource)
+      if resource_count > 0 then
+        table.insert(response, {name = rid, count = resource_count})
+        if #response >= count then
+          return response
+        end
+      end
+    end
+    if #rids < 1000 then
+      break
+    end
+    start = '(' .. rids[#rids]
+  end
+  return response
+end
+
+function QlessResource.backfill(now, cursor, count)
+  cursor = assert(tonumber(cursor),
+    'Backfill(): Arg "cursor" missing or not a number: ' .. tostring(cursor))
+  count = assert(tonumber(count or 1000),
+    'Backfill(): Arg "count" not a number: ' .. tostring(count))
+  if not redis.replicate_commands then
+    error('Backfill(): Redis 3.2 or later is needed to scan for resources')
+  end
+
+  redis.replicate_commands()
+  local reply = redis.call('scan', cursor,
+    'match', QlessResource.ns .. '*', 'count', count)
+
+  local registered = 0
+  for _, key in ipairs(reply[2]) do
+    if redis.call('type', key)['ok'] == 'hash' then
+      local rid = redis.call('hget', key, 'rid')
+      if rid and QlessResource.ns .. rid == key then
+        registered = registered + redis.call('zadd', 'ql:resources', 0, rid)
+      end
+    end
+  end
+  return {cursor = tonumber(reply[1]), registered = registered}
+end
+local QlessAPI = {}
+
+local function tonil(value)
+  if (value == '') then return nil else return value end
+end
+
+local function tooutcomes(outcomes)
+  if #outcomes == 0 then return '[]' else return cjson.encode(outcomes) end
+end
+
+function QlessAPI.get(now, jid, fields)
+  local data = Qless.job(jid):project(QlessJob.projection(tonil(fields)))
+  if not data then
+    return nil
+  end
+  return cjson.encode(data)
+end
+
+function QlessAPI.multiget(now, ...)
+  local results = {}
+  for i, jid in ipairs(arg) do
+    table.insert(results, Qless.job(jid):data())
+  end
+  return cjson.encode(results)
+end
+
+function QlessAPI.project(now, fields, ...)
+  fields = QlessJob.projection(tonil(fields))
+  local results = {}
+  for i, jid in ipairs(arg) do
+    table.insert(results, Qless.job(jid):project(fields))
+  end
+  return cjson.encode(results)
+end
+
+QlessAPI['config.get'] = function(now, key)
+  key = tonil(key)
+  if not key then
+    return cjson.encode(Qless.config.get(key))
+  else
+    return Qless.config.stored()[key] or Qless.config.get(key)
+  end
+end
+
+QlessAPI['config.set'] = function(now, key, value)
+  key = tonil(key)
+  return Qless.config.set(key, value)
+end
+
+QlessAPI['config.unset'] = function(now, key)
+  key = tonil(key)
+  return Qless.config.unset(key)
+end
+
+QlessAPI.queues = function(now, queue)
+  return cjson.encode(QlessQueue.counts(now, queue))
+end
+
+QlessAPI.complete = function(now, jid, worker, queue, data, ...)
+  data = tonil(data)
+  return Qless.job(jid):complete(now, worker, queue, data, unpack(arg))
+end
+
+QlessAPI.complete_many = function(now, worker, queue, jobs)
+  return tooutcomes(QlessJob.complete_many(now, worker, queue, jobs))
+end
+
+QlessAPI.complete_and_pop = function(now, jid, worker, queue, data, popqueue,
+  count, fields, ...)
+  data = tonil(data)
+  fields = QlessJob.projection(tonil(fields))
+  popqueue = assert(tonil(popqueue) or queue,
+    'CompleteAndPop(): Arg "popqueue" missing')
+  count = assert(tonumber(count),
+    'CompleteAndPop(): Arg "count" missing or not a number: ' ..
+    tostring(count))
+  local state = Qless.job(jid):complete(now, worker, queue, data, unpack(arg))
+  local jids = Qless.queue(popqueue):pop(now, worker, count)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, Qless.job(jid):project(fields))
+  end
+  return cjson.encode({state = state, jobs = response})
+end
+
+QlessAPI.failed = function(now, group, start, limit)
+  group = tonil(group)
+  return cjson.encode(Qless.failed(group, start, limit))
+end
+
+QlessAPI.fail = function(now, jid, worker, group, message, data)
+  data = tonil(data)
+  return Qless.job(jid):fail(now, worker, group, message, data)
+end
+
+QlessAPI.fail_many = function(now, worker, group, message, jobs)
+  return tooutcomes(QlessJob.fail_many(now, worker, group, message, jobs))
+end
+
+QlessAPI.gc = function(now, budget)
+  return Qless.gc(now, budget)
+end
+
+QlessAPI.jobs = function(now, state, ...)
+  return Qless.jobs(now, state, unpack(arg))
+end
+
+QlessAPI.retry = function(now, jid, queue, worker, delay, group, message)
+  return Qless.job(jid):retry(now, queue, worker, delay, group, message)
+end
+
+QlessAPI.depends = function(now, jid, command, ...)
+  return Qless.job(jid):depends(now, command, unpack(arg))
+end
+
+QlessAPI.heartbeat = function(now, jid, worker, data)
+  data = tonil(data)
+  return Qless.job(jid):heartbeat(now, worker, data)
+end
+
+QlessAPI.workers = function(now, worker)
+  return cjson.encode(QlessWorker.counts(now, worker))
+end
+
+QlessAPI.worker_stats = function(now, worker, date, percentiles)
+  return cjson.encode(QlessWorker.stats(now, worker, date, percentiles))
+end
+
+QlessAPI.track = function(now, command, jid)
+  return cjson.encode(Qless.track(now, command, jid))
+end
+
+QlessAPI.tag = function(now, command, ...)
+  return cjson.encode(Qless.tag(now, command, unpack(arg)))
+end
+
+QlessAPI.stats = function(now, queue, date, percentiles)
+  return cjson.encode(Qless.queue(queue):stats(now, date, percentiles))
+end
+
+QlessAPI.stats_merged = function(now, queues, from, to, percentiles)
+  return cjson.encode(
+    QlessQueue.merged_stats(now, queues, from, to, percentiles))
+end
+
+QlessAPI.stats_range = function(now, queue, from, to, resolution)
+  return cjson.encode(
+    Qless.queue(queue):stats_range(now, from, to, resolution))
+end
+
+QlessAPI.throughput = function(now, queue, window)
+  return cjson.encode(Qless.queue(queue):throughput(now, tonil(window)))
+end
+
+QlessAPI['stats.compact'] = function(now, since, budget)
+  return cjson.encode(QlessQueue.compact(now, since, tonil(budget)))
+end
+
+QlessAPI.priority = function(now, jid, priority)
+  return Qless.job(jid):priority(priority)
+end
+
+QlessAPI.log = function(now, jid, message, data)
+  assert(jid, "Log(): Argument 'jid' missing")
+  assert(message, "Log(): Argument 'message' missing")
+  if data then
+    data = assert(cjson.decode(data),
+      "Log(): Argument 'data' not cjson: " .. tostring(data))
+  end
+
+  local job = Qless.job(jid)
+  assert(job:exists(), 'Log(): Job ' .. jid .. ' does not exist')
+  job:history(now, message, data)
+end
+
+QlessAPI.peek = function(now, queue, count, fields, mode)
+  fields = QlessJob.projection(tonil(fields))
+  mode = tonil(mode)
+  assert(mode == nil or mode == 'readonly',
+    'Peek(): Arg "mode" must be "readonly": ' .. tostring(mode))
+  local jids = Qless.queue(queue):peek(now, count, mode == 'readonly')
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, Qless.job(jid):project(fields))
+  end
+  return cjson.encode(response)
+end
+
+QlessAPI.pop = function(now, queue, worker, count, fields)
+  fields = QlessJob.projection(tonil(fields))
+  local jids = Qless.queue(queue):pop(now, worker, count)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, Qless.job(jid):project(fields))
+  end
+  return cjson.encode(response)
+end
+
+QlessAPI.multipop = function(now, worker, count, queues, fields)
+  fields = QlessJob.projection(tonil(fields))
+  local jids = QlessQueue.multipop(now, worker, count, queues)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, Qless.job(jid):project(fields))
+  end
+  return cjson.encode(response)
+end
+
+QlessAPI.tick = function(now, budget)
+  return QlessQueue.tick(now, budget)
+end
+
+QlessAPI.pause = function(now, ...)
+  return QlessQueue.pause(now, unpack(arg))
+end
+
+QlessAPI.unpause = function(now, ...)
+  return QlessQueue.unpause(unpack(arg))
+end
+
+QlessAPI.paused = function(now, queue)
+  return Qless.queue(queue):paused()
+end
+
+QlessAPI.cancel = function(now, ...)
+  return Qless.cancel(now, unpack(arg))
+end
+
+QlessAPI.timeout = function(now, ...)
+  for _, jid in ipairs(arg) do
+    Qless.job(jid):timeout(now)
+  end
+end
+
+QlessAPI.put = function(now, me, queue, jid, klass, data, delay, ...)
+  data = tonil(data)
+  return Qless.queue(queue):put(now, me, jid, klass, data, delay, unpack(arg))
+end
+
+QlessAPI.put_many = function(now, me, jobs)
+  return tooutcomes(QlessQueue.put_many(now, me, jobs))
+end
+
+QlessAPI.requeue = function(now, me, queue, jid, ...)
+  local job = Qless.job(jid)
+  assert(job:exists(), 'Requeue(): Job ' .. jid .. ' does not exist')
+  return QlessAPI.put(now, me, queue, jid, unpack(arg))
+end
+
+QlessAPI.unfail = function(now, queue, group, count)
+  return Qless.queue(queue):unfail(now, group, count)
+end
+
+QlessAPI.recur = function(now, queue, jid, klass, data, spec, ...)
+  data = tonil(data)
+  return Qless.queue(queue):recur(now, jid, klass, data, spec, unpack(arg))
+end
+
+QlessAPI.unrecur = function(now, jid)
+  return Qless.recurring(jid):unrecur()
+end
+
+QlessAPI['recur.get'] = function(now, jid)
+  local data = Qless.recurring(jid):data()
+  if not data then
+    return nil
+  end
+  return cjson.encode(data)
+end
+
+QlessAPI['recur.update'] = function(now, jid, ...)
+  return Qless.recurring(jid):update(now, unpack(arg))
+end
+
+QlessAPI['recur.tag'] = function(now, jid, ...)
+  return Qless.recurring(jid):tag(unpack(arg))
+end
+
+QlessAPI['recur.untag'] = function(now, jid, ...)
+  return Qless.recurring(jid):untag(unpack(arg))
+end
+
+QlessAPI.length = function(now, queue)
+  return Qless.queue(queue):length()
+end
+
+QlessAPI['worker.deregister'] = function(now, ...)
+  return QlessWorker.deregister(unpack(arg))
+end
+
+QlessAPI['queue.forget'] = function(now, ...)
+  QlessQueue.deregister(unpack(arg))
+end
+
+QlessAPI['resource.set'] = function(now, rid, max)
+  return Qless.resource(rid):set(now, max)
+end
+
+QlessAPI['resource.get'] = function(now, rid)
+  return Qless.resource(rid):get()
+end
+
+QlessAPI['resource.data'] = function(now, rid)
+  local data = Qless.resource(rid):data()
+  if not data then
+    return nil
+  end
+
+  return cjson.encode(data)
+end
+
+QlessAPI['resource.exists'] = function(now, rid)
+  return Qless.resource(rid):exists()
+end
+
+QlessAPI['resource.unset'] = function(now, rid)
+  return Qless.resource(rid):unset()
+end
+
+QlessAPI['resource.locks'] = function(now, rid)
+  local data = Qless.resource(rid):locks()
+  if not data then
+    return nil
+  end
+
+  return cjson.encode(data)
+end
+
+QlessAPI['resource.lock_count'] = function(now, rid)
+  return Qless.resource(rid):lock_count()
+end
+
+QlessAPI['resource.pending'] = function(now, rid)
+  local data = Qless.resource(rid):pending()
+  if not data then
+    return nil
+  end
+
+  return cjson.encode(data)
+
+end
+
+QlessAPI['resource.pending_count'] = function(now, rid)
+  return Qless.resource(rid):pending_count()
+end
+
+QlessAPI['resource.stats_pending'] = function(now, after, count)
+  return cjson.encode(
+    QlessResource.pending_counts(now, tonil(after), tonil(count)))
+end
+
+QlessAPI['resource.stats_locks'] = function(now, after, count)
+  return cjson.encode(
+    QlessResource.locks_counts(now, tonil(after), tonil(count)))
+end
+
+QlessAPI['resource.backfill'] = function(now, cursor, count)
+  return cjson.encode(QlessResource.backfill(now, cursor, tonil(count)))
+end
+
+
+if #KEYS > 0 then error('No Keys should be provided') end
+
+local command_name = assert(table.remove(ARGV, 1), 'Must provide a command')
+local command      = assert(
+  QlessAPI[command_name], 'Unknown command ' .. command_name)
+
+local now          = tonumber(table.remove(ARGV, 1))
+local now          = assert(
+  now, 'Arg "now" missing or not a number: ' .. (now or 'nil'))
+
+return command(now, unpack(ARGV))
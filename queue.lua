@@ -28,8 +28,12 @@ function Qless.queue(name)
       if priority ~= '+inf' then
         priority = priority - (now / 10000000000)
       end
-      return redis.call('zadd',
-        queue:prefix('work'), priority, jid)
+      return Qless.zadd(queue:prefix('work'), priority, jid, function(added)
+        -- If the queue just went from empty to non-empty, wake up a worker
+        if added > 0 and queue.work.length() == added then
+          queue:signal()
+        end
+      end)
     end, score = function(jid)
       return redis.call('zscore', queue:prefix('work'), jid)
     end, length = function()
@@ -91,7 +95,8 @@ function Qless.queue(name)
       return redis.call('zrangebyscore',
         queue:prefix('scheduled'), 0, now, 'LIMIT', offset, count)
     end, add = function(when, jid)
-      redis.call('zadd', queue:prefix('scheduled'), when, jid)
+      Qless.zadd(queue:prefix('scheduled'), when, jid)
+      queue:due(when)
     end, remove = function(...)
       if #arg > 0 then
         return redis.call('zrem', queue:prefix('scheduled'), unpack(arg))
@@ -109,12 +114,13 @@ function Qless.queue(name)
     end, ready = function(now, offset, count)
     end, add = function(when, jid)
       redis.call('zadd', queue:prefix('recur'), when, jid)
+      queue:due(when)
     end, remove = function(...)
       if #arg > 0 then
         return redis.call('zrem', queue:prefix('recur'), unpack(arg))
       end
     end, update = function(increment, jid)
-      redis.call('zincrby', queue:prefix('recur'), increment, jid)
+      queue:due(redis.call('zincrby', queue:prefix('recur'), increment, jid))
     end, score = function(jid)
       return redis.call('zscore', queue:prefix('recur'), jid)
     end, length = function()
@@ -133,7 +139,15 @@ function QlessQueue:prefix(group)
   end
 end
 
--- Stats(now, date)
+-- The fields of the wait and run stats that hold the histogram, in order
+QlessQueue.histogram = {
+  's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
+  'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
+  'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
+  'd1','d2','d3','d4','d5','d6'
+}
+
+-- Stats(now, date, [percentiles])
 -- ---------------------
 -- Return the current statistics for a given queue on a given date. The
 -- results are returned are a JSON blob:
@@ -165,69 +179,210 @@ end
 -- for the first day, the hour resolution for the first 3 days, and then at
 -- the day resolution from there on out. The `histogram` key is a list of
 -- those values.
-function QlessQueue:stats(now, date)
+--
+-- If `percentiles` is provided as a JSON array of numbers between 0 and 100,
+-- then the histograms are replaced by a `percentiles` list of estimates of
+-- those percentiles.
+function QlessQueue:stats(now, date, percentiles)
   date = assert(tonumber(date),
     'Stats(): Arg "date" missing or not a number: '.. (date or 'nil'))
+  percentiles = QlessQueue.percentiles(percentiles)
 
   -- The bin is midnight of the provided day
   -- 24 * 60 * 60 = 86400
   local bin = date - (date % 86400)
 
-  -- This a table of all the keys we want to use in order to produce a histogram
-  local histokeys = {
-    's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
-    'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
-    'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
-    'd1','d2','d3','d4','d5','d6'
+  local retries, failed, failures = unpack(redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
+  return {
+    retries  = tonumber(retries  or 0),
+    failed   = tonumber(failed   or 0),
+    failures = tonumber(failures or 0),
+    wait     = QlessQueue.summarize(
+      QlessQueue.read_stats('wait', bin, self.name), percentiles),
+    run      = QlessQueue.summarize(
+      QlessQueue.read_stats('run' , bin, self.name), percentiles)
   }
+end
 
-  local mkstats = function(name, bin, queue)
-    -- The results we'll be sending back
-    local results = {}
+-- StatsMerged(now, queues, from, to, [percentiles])
+-- -------------------------------------------------
+-- Return the statistics of all of `queues` (a JSON array of names) over every
+-- day from the day of `from` to the day of `to` combined, in the same form
+-- that `stats` returns them.
+function QlessQueue.merged_stats(now, queues, from, to, percentiles)
+  local ok, names = pcall(cjson.decode, queues or '')
+  if not ok or type(names) ~= 'table' then
+    error('StatsMerged(): Arg "queues" not a JSON array: ' ..
+      tostring(queues))
+  end
+  from = assert(tonumber(from),
+    'StatsMerged(): Arg "from" missing or not a number: ' .. tostring(from))
+  to = assert(tonumber(to),
+    'StatsMerged(): Arg "to" missing or not a number: ' .. tostring(to))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  local first, last = from - (from % 86400), to - (to % 86400)
+  if last < first then
+    error('StatsMerged(): Arg "to" must not be before "from"')
+  elseif #names * ((last - first) / 86400 + 1) > 10000 then
+    error('StatsMerged(): More than 10000 days of queue stats requested')
+  end
 
-    local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
-    local count, mean, vk = unpack(redis.call('hmget', key, 'total', 'mean', 'vk'))
+  local response = {retries = 0, failed = 0, failures = 0}
+  local wait, run = QlessQueue.read_stats(), QlessQueue.read_stats()
+  for _, name in ipairs(names) do
+    for bin = first, last, 86400 do
+      local counts = redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. name,
+        'retries', 'failed', 'failures')
+      response.retries  = response.retries  + (tonumber(counts[1]) or 0)
+      response.failed   = response.failed   + (tonumber(counts[2]) or 0)
+      response.failures = response.failures + (tonumber(counts[3]) or 0)
+      wait = QlessQueue.merge_stats(wait,
+        QlessQueue.read_stats('wait', bin, name))
+      run  = QlessQueue.merge_stats(run,
+        QlessQueue.read_stats('run' , bin, name))
+    end
+  end
+  response.wait = QlessQueue.summarize(wait, percentiles)
+  response.run  = QlessQueue.summarize(run , percentiles)
+  return response
+end
 
-    count = tonumber(count) or 0
-    mean  = tonumber(mean) or 0
-    vk    = tonumber(vk)
+-- Parse the percentiles argument of `stats`, returning nil if none were asked
+-- for
+function QlessQueue.percentiles(percentiles)
+  if percentiles == nil or percentiles == '' then
+    return nil
+  end
+  local ok, decoded = pcall(cjson.decode, percentiles)
+  if not ok or type(decoded) ~= 'table' then
+    error('Stats(): Arg "percentiles" not a JSON array: ' ..
+      tostring(percentiles))
+  end
+  for _, percentile in ipairs(decoded) do
+    if type(percentile) ~= 'number' or percentile < 0 or percentile > 100 then
+      error('Stats(): Percentile not between 0 and 100: ' ..
+        tostring(percentile))
+    end
+  end
+  return decoded
+end
 
-    results.count     = count or 0
-    results.mean      = mean  or 0
-    results.histogram = {}
+-- Read the `name` stats ('wait' or 'run') of `queue` for the day `bin`, as
+-- their count, mean, sum of squared differences from the mean (`vk`) and
+-- histogram. With no arguments, returns empty stats.
+function QlessQueue.read_stats(name, bin, queue)
+  local stats = {count = 0, mean = 0, vk = 0, histogram = {}}
+  if name == nil then
+    for i=1,#QlessQueue.histogram do
+      table.insert(stats.histogram, 0)
+    end
+    return stats
+  end
 
-    if not count then
-      results.std = 0
-    else
-      if count > 1 then
-        results.std = math.sqrt(vk / (count - 1))
-      else
-        results.std = 0
-      end
+  local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
+  local fields = redis.call('hmget', key,
+    'total', 'mean', 'vk', 'count', 'sum', 'sumsq', unpack(QlessQueue.histogram))
+
+  -- Stats may have been accumulated by older versions as a running mean and
+  -- variance (`total`, `mean` and `vk`), and by this one as sums (`count`,
+  -- `sum` and `sumsq`). Either may be present, so combine the two.
+  stats.count = tonumber(fields[1]) or 0
+  stats.mean  = tonumber(fields[2]) or 0
+  stats.vk    = tonumber(fields[3]) or 0
+  local count = tonumber(fields[4]) or 0
+  if count > 0 then
+    local sum   = tonumber(fields[5]) or 0
+    local sumsq = tonumber(fields[6]) or 0
+    local mean  = sum / count
+    stats = QlessQueue.merge_stats(stats, {
+      count = count, mean = mean, vk = math.max(0, sumsq - sum * mean)})
+  end
+
+  stats.histogram = {}
+  for i=1,#QlessQueue.histogram do
+    table.insert(stats.histogram, tonumber(fields[i + 6]) or 0)
+  end
+  return stats
+end
+
+-- Combine two sets of stats, as returned by read_stats. The histogram of the
+-- first is added to in place, if the second has one.
+function QlessQueue.merge_stats(a, b)
+  local count = a.count + b.count
+  local stats = {count = count, mean = a.mean, vk = a.vk,
+    histogram = a.histogram}
+  if b.count > 0 then
+    local delta = b.mean - a.mean
+    stats.mean = (a.count * a.mean + b.count * b.mean) / count
+    stats.vk   = a.vk + b.vk + delta * delta * a.count * b.count / count
+  end
+  if a.histogram and b.histogram then
+    for i=1,#b.histogram do
+      a.histogram[i] = a.histogram[i] + b.histogram[i]
     end
+  end
+  return stats
+end
 
-    local histogram = redis.call('hmget', key, unpack(histokeys))
-    for i=1,#histokeys do
-      table.insert(results.histogram, tonumber(histogram[i]) or 0)
+-- Turn stats, as returned by read_stats, into what `stats` reports: their
+-- count, mean, standard deviation, and either the histogram or, if asked for,
+-- estimates of `percentiles`
+function QlessQueue.summarize(stats, percentiles)
+  local results = {count = stats.count, mean = stats.mean}
+  if stats.count > 1 then
+    results.std = math.sqrt(stats.vk / (stats.count - 1))
+  else
+    results.std = 0
+  end
+
+  if percentiles then
+    results.percentiles = {}
+    for _, percentile in ipairs(percentiles) do
+      table.insert(results.percentiles,
+        QlessQueue.percentile(stats.histogram, percentile))
     end
-    return results
+  else
+    results.histogram = stats.histogram
   end
+  return results
+end
 
-  local retries, failed, failures = unpack(redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
-  return {
-    retries  = tonumber(retries  or 0),
-    failed   = tonumber(failed   or 0),
-    failures = tonumber(failures or 0),
-    wait     = mkstats('wait', bin, self.name),
-    run      = mkstats('run' , bin, self.name)
-  }
+-- Estimate the `percentile` of the values counted in `histogram`, assuming
+-- that the values in each bucket are spread evenly across it, with each at
+-- the middle of its share of the bucket. Returns 0 if there are no values.
+function QlessQueue.percentile(histogram, percentile)
+  local total = 0
+  for _, count in ipairs(histogram) do
+    total = total + count
+  end
+  if total == 0 then
+    return 0
+  end
+
+  local rank = percentile / 100 * total
+  local seen = 0
+  for i, count in ipairs(histogram) do
+    if count > 0 and seen + count >= rank then
+      local field = QlessQueue.histogram[i]
+      local width = QlessQueue.widths[string.sub(field, 1, 1)]
+      local lower = tonumber(string.sub(field, 2)) * width
+      return lower + width * math.max(0, rank - seen - 0.5) / count
+    end
+    seen = seen + count
+  end
 end
 
+-- The width in seconds of the histogram's buckets of each resolution
+QlessQueue.widths = {s = 1, m = 60, h = 3600, d = 86400}
+
 -- Peek
 -------
 -- Examine the next jobs that would be popped from the queue without actually
--- popping them.
-function QlessQueue:peek(now, count)
+-- popping them. If `readonly`, nothing is written: due scheduled jobs are
+-- merged with the work queue in memory rather than being moved into it, and
+-- due recurring jobs are left unspawned.
+function QlessQueue:peek(now, count, readonly)
   count = assert(tonumber(count),
     'Peek(): Arg "count" missing or not a number: ' .. tostring(count))
 
@@ -235,17 +390,17 @@ function QlessQueue:peek(now, count)
   -- that have lost their locks
   local jids = self.locks.expired(now, 0, count)
 
-  -- If we still need jobs in order to meet demand, then we should
-  -- look for all the recurring jobs that need jobs run
-  self:check_recurring(now, count - #jids)
+  if readonly then
+    table.extend(jids, self:preview(now, count - #jids))
+    return jids
+  end
 
-  -- Now we've checked __all__ the locks for this queue the could
-  -- have expired, and are no more than the number requested. If
-  -- we still need values in order to meet the demand, then we
-  -- should check if any scheduled items, and if so, we should
-  -- insert them to ensure correctness when pulling off the next
-  -- unit of work.
-  self:check_scheduled(now, count - #jids)
+  -- If we still need jobs in order to meet demand, then we should
+  -- look for all the recurring jobs that need jobs run, and whether any
+  -- scheduled items should be inserted to ensure correctness when pulling off
+  -- the next unit of work. Both are skipped if nothing in this queue has come
+  -- due yet.
+  self:promote(now, count - #jids)
 
   -- With these in place, we can expand this list of jids based on the work
   -- queue itself and the priorities therein
@@ -254,6 +409,70 @@ function QlessQueue:peek(now, count)
   return jids
 end
 
+-- Return up to `count` jids in the order they would be taken from the work
+-- queue if the due scheduled jobs were first moved into it, without moving
+-- them. Scheduled jobs that couldn't acquire their resources are left out.
+function QlessQueue:preview(now, count)
+  if count <= 0 then
+    return {}
+  end
+
+  -- The candidates, along with the score they have (or would have) in the
+  -- work queue
+  local candidates = {}
+  local work = redis.call(
+    'zrevrange', self:prefix('work'), 0, count - 1, 'WITHSCORES')
+  for i = 1, #work, 2 do
+    table.insert(candidates, {jid = work[i], score = tonumber(work[i + 1])})
+  end
+
+  -- The number of locks on each resource promised to earlier candidates
+  local claimed = {}
+  for _, jid in ipairs(self.scheduled.ready(now, 0, count)) do
+    local priority, resources, weights = unpack(redis.call(
+      'hmget', QlessJob.ns .. jid, 'priority', 'resources', 'weights'))
+    resources = Qless.decode(resources or '[]')
+    weights = Qless.decode(weights or '{}')
+    local available = true
+    for _, rid in ipairs(resources) do
+      available = available and
+        Qless.resource(rid):available(jid, claimed[rid] or 0)
+    end
+    if available then
+      for _, rid in ipairs(resources) do
+        claimed[rid] = (claimed[rid] or 0) + (weights[rid] or 1)
+      end
+      table.insert(candidates, {
+        jid   = jid,
+        score = tonumber(priority or 0) - (now / 10000000000)
+      })
+    end
+  end
+
+  -- Order them the way zrevrange would
+  table.sort(candidates, function(a, b)
+    if a.score ~= b.score then
+      return a.score > b.score
+    end
+    return a.jid > b.jid
+  end)
+
+  local jids = {}
+  for i = 1, math.min(count, #candidates) do
+    table.insert(jids, candidates[i].jid)
+  end
+  return jids
+end
+
+-- Push a readiness token onto this queue's signal list, which clients may
+-- BLPOP on before popping. Tokens are coalesced so that there's never more
+-- than one waiting
+function QlessQueue:signal()
+  local key = self:prefix('signal')
+  redis.call('rpush', key, self.name)
+  redis.call('ltrim', key, 0, 0)
+end
+
 -- Return true if this queue is paused
 function QlessQueue:paused()
   return redis.call('sismember', 'ql:paused_queues', self.name) == 1
@@ -283,9 +502,9 @@ function QlessQueue:pop(now, worker, count)
     'Pop(): Arg "count" missing or not a number: ' .. tostring(count))
 
   -- We should find the heartbeat interval for this queue heartbeat
-  local expires = now + tonumber(
+  local expires = now + (
     Qless.config.get(self.name .. '-heartbeat') or
-    Qless.config.get('heartbeat', 60))
+    Qless.config.get('heartbeat'))
 
   -- If this queue is paused, then return no jobs
   if self:paused() then
@@ -296,8 +515,8 @@ function QlessQueue:pop(now, worker, count)
   redis.call('zadd', 'ql:workers', now, worker)
 
   -- Check our max concurrency, and limit the count
-  local max_concurrency = tonumber(
-    Qless.config.get(self.name .. '-max-concurrency', 0))
+  local max_concurrency =
+    Qless.config.get(self.name .. '-max-concurrency', 0)
 
   if max_concurrency > 0 then
     -- Allow at most max_concurrency - #running
@@ -313,32 +532,31 @@ function QlessQueue:pop(now, worker, count)
   -- have expired, and are no more than the number requested.
 
   -- If we still need jobs in order to meet demand, then we should
-  -- look for all the recurring jobs that need jobs run
-  self:check_recurring(now, count - #jids)
-
-  -- If we still need values in order to meet the demand, then we
-  -- should check if any scheduled items, and if so, we should
-  -- insert them to ensure correctness when pulling off the next
-  -- unit of work.
-  self:check_scheduled(now, count - #jids)
+  -- look for all the recurring jobs that need jobs run, and whether any
+  -- scheduled items should be inserted to ensure correctness when pulling off
+  -- the next unit of work. Both are skipped if nothing in this queue has come
+  -- due yet.
+  self:promote(now, count - #jids)
 
   -- With these in place, we can expand this list of jids based on the work
   -- queue itself and the priorities therein
   table.extend(jids, self.work.peek(now, 0, count - #jids))
 
-  local state
+  -- How long each of these jobs has been waiting
+  local waits = {}
   for index, jid in ipairs(jids) do
     local job = Qless.job(jid)
-    state = unpack(job:data('state'))
     job:history(now, 'popped', {worker = worker})
 
-    -- Update the wait time statistics
-    local time = tonumber(
-      redis.call('hget', QlessJob.ns .. jid, 'time') or now)
-    local waiting = now - time
-    self:stat(now, 'wait', waiting)
-    redis.call('hset', QlessJob.ns .. jid,
-      'time', string.format("%.20f", now))
+    -- Note the wait time for the statistics
+    local time, unique = unpack(
+      redis.call('hmget', QlessJob.ns .. jid, 'time', 'unique'))
+    table.insert(waits, now - tonumber(time or now))
+
+    -- Once it's running, another job with the same unique key may be put
+    if unique then
+      self:release_unique(unique, jid)
+    end
 
     -- Add this job to the list of jobs handled by this worker
     redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, jid)
@@ -347,7 +565,8 @@ function QlessQueue:pop(now, worker, count)
     job:update({
       worker  = worker,
       expires = expires,
-      state   = 'running'
+      state   = 'running',
+      time    = Qless.time(now)
     })
 
     self.locks.add(expires, jid)
@@ -358,62 +577,440 @@ function QlessQueue:pop(now, worker, count)
     end
   end
 
+  -- Update the wait time statistics for all of these jobs at once
+  self:stat(now, 'wait', waits)
+
   -- If we are returning any jobs, then we should remove them from the work
   -- queue
   self.work.remove(unpack(jids))
 
+  -- The token that woke this worker has been consumed, so if there's still
+  -- work left then some other worker should be woken
+  local waiting = self.work.length()
+  if #jids > 0 and waiting > 0 then
+    self:signal()
+  end
+
+  if #jids > 0 then
+    self:record(now, 'pop', #jids)
+    QlessWorker.tally(now, worker, 'popped', #jids)
+  end
+
+  return jids
+end
+
+-- Multipop(now, worker, count, queues)
+-- ------------------------------------
+-- Pop up to `count` jobs from several queues in a single invocation. The
+-- `queues` argument is either a JSON array of queue names, in which case the
+-- queues are drained in the order provided:
+--
+--  ['urgent', 'normal', 'batch']
+--
+-- or a JSON object of queue names to (positive) weights, in which case `count`
+-- is first apportioned between the queues by weight:
+--
+--  {'urgent': 3, 'normal': 1}
+--
+-- Whatever the weighted share of a queue could not fill is then offered to the
+-- queues in order of decreasing weight. Returns the list of popped jids.
+function QlessQueue.multipop(now, worker, count, queues)
+  assert(worker, 'Multipop(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'Multipop(): Arg "count" missing or not a number: ' .. tostring(count))
+  assert(queues, 'Multipop(): Arg "queues" missing')
+  local decoded = cjson.decode(queues)
+  assert(type(decoded) == 'table',
+    'Multipop(): Arg "queues" not a JSON array or object: ' .. queues)
+  queues = decoded
+
+  -- This is the list of queue names in the order they should be drained, and
+  -- the number of jobs we'd like from each before draining in that order
+  local order  = {}
+  local shares = {}
+  if #queues > 0 then
+    for _, name in ipairs(queues) do
+      table.insert(order, name)
+    end
+  else
+    local weights = {}
+    local total   = 0
+    for name, weight in pairs(queues) do
+      weights[name] = assert(tonumber(weight),
+        'Multipop(): Weight for "' .. name .. '" not a number: ' ..
+        tostring(weight))
+      if weights[name] <= 0 then
+        error('Multipop(): Weight for "' .. name .. '" must be positive')
+      end
+      total = total + weights[name]
+      table.insert(order, name)
+    end
+
+    -- Heaviest first, and by name for queues with the same weight
+    table.sort(order, function(a, b)
+      if weights[a] == weights[b] then
+        return a < b
+      end
+      return weights[a] > weights[b]
+    end)
+
+    for _, name in ipairs(order) do
+      shares[name] = math.floor(count * weights[name] / total)
+    end
+  end
+
+  local jids = {}
+  -- First, pop each queue's weighted share, if it has one
+  for _, name in ipairs(order) do
+    local share = math.min(shares[name] or 0, count - #jids)
+    if share > 0 then
+      table.extend(jids, Qless.queue(name):pop(now, worker, share))
+    end
+  end
+
+  -- And then fill whatever remains in order
+  for _, name in ipairs(order) do
+    if #jids >= count then
+      break
+    end
+    table.extend(jids, Qless.queue(name):pop(now, worker, count - #jids))
+  end
+
   return jids
 end
 
--- Update the stats for this queue
-function QlessQueue:stat(now, stat, val)
+-- Update the stats for this queue with one value, or a list of values. The
+-- count, sum and sum of squares are accumulated so that the stats can be
+-- updated without first reading them. The mean and standard deviation are
+-- derived from these when they're read.
+function QlessQueue:stat(now, stat, vals)
+  if type(vals) ~= 'table' then
+    vals = {vals}
+  end
+  if #vals == 0 then
+    return
+  end
+
+  -- In a batch, gather up the values and record them all at once
+  if Qless.batching then
+    local name = 'stat:' .. stat .. ':' .. self.name
+    local pending = Qless.memo(name, function() return {} end)
+    table.extend(pending, vals)
+    return Qless.defer(name, function() self:stat(now, stat, pending) end)
+  end
+
   -- The bin is midnight of the provided day
   local bin = now - (now % 86400)
   local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. self.name
-
-  -- Get the current data
-  local count, mean, vk = unpack(
-    redis.call('hmget', key, 'total', 'mean', 'vk'))
-
-  -- If there isn't any data there presently, then we must initialize it
-  count = count or 0
-  if count == 0 then
-    mean  = val
-    vk    = 0
-    count = 1
-  else
-    count = count + 1
-    local oldmean = mean
-    mean  = mean + (val - mean) / count
-    vk    = vk + (val - mean) * (val - oldmean)
+  local sum, sumsq = QlessQueue.accumulate(key, vals, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+
+  -- Roll the values up into each of the time series, too
+  for _, resolution in ipairs({'minute', 'hour'}) do
+    local series = QlessQueue.series[resolution]
+    local bucket = now - (now % series.width)
+    local key = 'ql:s:' .. stat .. '-' .. resolution .. ':' .. bucket .. ':' ..
+      self.name
+    Qless.hincrby(key, 'count', #vals, function()
+      QlessQueue.expire_series(now, key, resolution, bucket)
+    end)
+    redis.call('hincrbyfloat', key, 'sum', sum)
+    redis.call('hincrbyfloat', key, 'sumsq', sumsq)
   end
+end
 
-  -- Now, update the histogram
+-- Add `vals` to the stats hash `key`: their histogram, count, sum and sum of
+-- squares, calling `created` if this is the first time values have been
+-- added to it. Returns the sum and sum of squares.
+function QlessQueue.accumulate(key, vals, created)
+  -- Update the histogram
   -- - `s1`, `s2`, ..., -- second-resolution histogram counts
   -- - `m1`, `m2`, ..., -- minute-resolution
   -- - `h1`, `h2`, ..., -- hour-resolution
   -- - `d1`, `d2`, ..., -- day-resolution
-  val = math.floor(val)
-  if val < 60 then -- seconds
-    redis.call('hincrby', key, 's' .. val, 1)
-  elseif val < 3600 then -- minutes
-    redis.call('hincrby', key, 'm' .. math.floor(val / 60), 1)
-  elseif val < 86400 then -- hours
-    redis.call('hincrby', key, 'h' .. math.floor(val / 3600), 1)
-  else -- days
-    redis.call('hincrby', key, 'd' .. math.floor(val / 86400), 1)
-  end
-  redis.call('hmset', key, 'total', count, 'mean', mean, 'vk', vk)
+  local sum, sumsq = 0, 0
+  local histogram, buckets = {}, {}
+  for _, val in ipairs(vals) do
+    sum   = sum + val
+    sumsq = sumsq + val * val
+
+    val = math.floor(val)
+    local bucket
+    if val < 60 then -- seconds
+      bucket = 's' .. val
+    elseif val < 3600 then -- minutes
+      bucket = 'm' .. math.floor(val / 60)
+    elseif val < 86400 then -- hours
+      bucket = 'h' .. math.floor(val / 3600)
+    else -- days
+      bucket = 'd' .. math.floor(val / 86400)
+    end
+    if histogram[bucket] == nil then
+      histogram[bucket] = 0
+      table.insert(buckets, bucket)
+    end
+    histogram[bucket] = histogram[bucket] + 1
+  end
+
+  Qless.hincrby(key, 'count', #vals, created)
+  for _, bucket in ipairs(buckets) do
+    Qless.hincrby(key, bucket, histogram[bucket])
+  end
+  redis.call('hincrbyfloat', key, 'sum', sum)
+  redis.call('hincrbyfloat', key, 'sumsq', sumsq)
+  return sum, sumsq
+end
+
+-- Count `count` (or 1) of `event` ('put', 'pop', 'complete', 'fail' or
+-- 'retry') happening in this queue, in the minute's throughput counters. The
+-- first time each event is counted in a minute, the jobs waiting and running
+-- are sampled, too.
+function QlessQueue:record(now, event, count)
+  local bucket = now - (now % 60)
+  local key = 'ql:s:throughput:' .. bucket .. ':' .. self.name
+  Qless.hincrby(key, event, count or 1, function()
+    QlessQueue.expire_series(now, key, 'minute', bucket)
+    self:sample(now, key)
+  end)
+end
+
+-- Record the number of jobs waiting in this queue and running now in the
+-- throughput counters `key`, unless they've already been recorded there. As
+-- this is only done when events are recorded, polling an idle queue costs
+-- nothing more, while a queue with jobs put and none popped is still sampled.
+function QlessQueue:sample(now, key)
+  if redis.call('hexists', key, 'waiting') == 0 then
+    redis.call('hmset', key,
+      'waiting', self.work.length(), 'running', self.locks.running(now))
+  end
+end
+
+-- Set `key`, the `resolution` time series bucket starting at `bucket`, to
+-- expire once it's older than the series is kept for
+function QlessQueue.expire_series(now, key, resolution, bucket)
+  local series = QlessQueue.series[resolution]
+  redis.call('expire', key, math.ceil(bucket + series.width - now +
+    Qless.config.get(series.history)))
+end
+
+-- Throughput(now, window)
+-- -----------------------
+-- Return the number of jobs put, popped, completed, failed and retried in this
+-- queue over the last `window` seconds (by default, 60), along with their
+-- rates per second. Events are counted by the minute, so the window is
+-- stretched back to the start of its first minute, and the seconds it covers
+-- are returned as `window`. The jobs waiting and running are sampled at most
+-- once a minute, and the samples in the window are returned as `depth`:
+--
+--  {
+--      'window': 90,
+--      'counts': {'put': 12, 'pop': 10, 'complete': 9, 'fail': 1, 'retry': 0},
+--      'rates' : {'put': 0.13, ...},
+--      'depth' : [{'time': ..., 'waiting': 3, 'running': 2}, ...]
+--  }
+function QlessQueue:throughput(now, window)
+  window = assert(tonumber(window or 60),
+    'Throughput(): Arg "window" not a number: ' .. tostring(window))
+  -- Counters older than `minute-stats-history` have expired, so a longer
+  -- window would undercount
+  local longest = math.min(86400, Qless.config.get('minute-stats-history'))
+  if window <= 0 or window > longest then
+    error('Throughput(): Arg "window" must be between 0 and ' .. longest ..
+      ': ' .. window)
+  end
+
+  local first = (now - window) - ((now - window) % 60)
+  local elapsed = now - first
+  local events = {'put', 'pop', 'complete', 'fail', 'retry'}
+  local response = {window = elapsed, counts = {}, rates = {}, depth = {}}
+  for _, event in ipairs(events) do
+    response.counts[event] = 0
+  end
+
+  for bucket = first, now, 60 do
+    local values = redis.call('hmget',
+      'ql:s:throughput:' .. bucket .. ':' .. self.name,
+      'waiting', 'running', unpack(events))
+    if values[1] then
+      table.insert(response.depth, {
+        time    = bucket,
+        waiting = tonumber(values[1]),
+        running = tonumber(values[2])
+      })
+    end
+    for index, event in ipairs(events) do
+      response.counts[event] =
+        response.counts[event] + (tonumber(values[index + 2]) or 0)
+    end
+  end
+
+  for _, event in ipairs(events) do
+    response.rates[event] = response.counts[event] / elapsed
+  end
+  return response
+end
+
+-- The time series that the wait and run stats are kept in, besides the daily
+-- stats. Each has buckets `width` seconds wide, which are kept for as many
+-- seconds as its `history` config option says.
+QlessQueue.series = {
+  minute = {width = 60  , history = 'minute-stats-history'},
+  hour   = {width = 3600, history = 'hour-stats-history'  }
+}
+
+-- StatsRange(now, from, to, resolution)
+-- -------------------------------------
+-- Return the wait and run stats of this queue for each bucket of the
+-- `resolution` ('minute' or 'hour') time series from the one holding `from`
+-- to the one holding `to`:
+--
+--  {
+--      'wait': [{'time': ..., 'count': ..., 'mean': ..., 'std': ...}, ...],
+--      'run' : [...]
+--  }
+--
+-- Buckets that saw no values, or that have since expired, have a count of 0.
+function QlessQueue:stats_range(now, from, to, resolution)
+  from = assert(tonumber(from),
+    'StatsRange(): Arg "from" missing or not a number: ' .. tostring(from))
+  to = assert(tonumber(to),
+    'StatsRange(): Arg "to" missing or not a number: ' .. tostring(to))
+  local series = QlessQueue.series[tostring(resolution)]
+  if not series then
+    error('StatsRange(): Arg "resolution" must be "minute" or "hour": ' ..
+      tostring(resolution))
+  end
+
+  local first = from - (from % series.width)
+  local buckets = math.floor((to - first) / series.width) + 1
+  if to < from then
+    error('StatsRange(): Arg "to" must not be before "from"')
+  elseif buckets > 10000 then
+    error('StatsRange(): Range spans more than 10000 buckets: ' .. buckets)
+  end
+
+  local response = {}
+  for _, stat in ipairs({'wait', 'run'}) do
+    local points = {}
+    for index = 0, buckets - 1 do
+      local bucket = first + index * series.width
+      local count, sum, sumsq = unpack(redis.call('hmget',
+        'ql:s:' .. stat .. '-' .. resolution .. ':' .. bucket .. ':' ..
+        self.name, 'count', 'sum', 'sumsq'))
+      count = tonumber(count) or 0
+      sum   = tonumber(sum) or 0
+      sumsq = tonumber(sumsq) or 0
+
+      local mean, std = 0, 0
+      if count > 0 then
+        mean = sum / count
+      end
+      if count > 1 then
+        std = math.sqrt(math.max(0, sumsq - sum * mean) / (count - 1))
+      end
+      table.insert(points, {time = bucket, count = count, mean = mean, std = std})
+    end
+    response[stat] = points
+  end
+  return response
+end
+
+-- Increment the `field` counter ('failed', 'failures' or 'retries') of this
+-- queue's stats by `increment`. The stats are those of the day of `when`, if
+-- provided, and otherwise of today.
+function QlessQueue:tally(now, field, increment, when)
+  when = when or now
+  local bin = when - (when % 86400)
+  local key = 'ql:s:stats:' .. bin .. ':' .. self.name
+  local expire = function() QlessQueue.expire(now, key, bin) end
+  if bin == now - (now % 86400) then
+    Qless.hincrby(key, field, increment, expire)
+  else
+    -- The stats of past days are seldom written to, and may well be past the
+    -- point they should be dropped
+    Qless.hincrby(key, field, increment)
+    Qless.defer('expire:' .. key, expire)
+  end
+end
+
+-- Set the stats `key` for the day `bin` to expire once it's older than the
+-- `stats-history` config option allows
+function QlessQueue.expire(now, key, bin)
+  local days = Qless.config.get('stats-history')
+  redis.call('expire', key, math.ceil(bin + (days + 1) * 86400 - now))
+end
+
+-- Compact(now, since, [budget])
+-- -----------------------------
+-- Enforce the retention of stats recorded by every known queue from the day
+-- of `since` up to today. Stats older than `stats-history` days are deleted,
+-- histograms older than `histogram-history` days are dropped while keeping
+-- their counts, and the rest are set to expire. Stats are expired as they're
+-- recorded, so this is only needed for stats that were recorded before that
+-- was the case.
+--
+-- Whole days are gone through until about `budget` (by default, 1000) keys
+-- have been looked at, though always at least one day. Returns the number of
+-- keys that were changed and, if there are days left, the day to pick up from
+-- as `next`:
+--
+--  {'changed': 9, 'next': 1352073600}
+function QlessQueue.compact(now, since, budget)
+  since = assert(tonumber(since),
+    'Compact(): Arg "since" missing or not a number: ' .. tostring(since))
+  budget = assert(tonumber(budget or 1000),
+    'Compact(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local today = now - (now % 86400)
+  local stats_cutoff = today - Qless.config.get('stats-history') * 86400
+  local histogram_cutoff =
+    today - Qless.config.get('histogram-history') * 86400
+
+  local queues = redis.call('zrange', 'ql:queues', 0, -1)
+  local changed, examined = 0, 0
+  if #queues == 0 then
+    return {changed = changed}
+  end
+
+  for bin = since - (since % 86400), today, 86400 do
+    if examined > 0 and examined + #queues * 3 > budget then
+      return {changed = changed, next = bin}
+    end
+    examined = examined + #queues * 3
+    for _, name in ipairs(queues) do
+      for _, stat in ipairs({'stats', 'wait', 'run'}) do
+        local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. name
+        if bin < stats_cutoff then
+          changed = changed + redis.call('del', key)
+        elseif redis.call('exists', key) == 1 then
+          if bin < histogram_cutoff and stat ~= 'stats' then
+            redis.call('hdel', key, unpack(QlessQueue.histogram))
+          end
+          QlessQueue.expire(now, key, bin)
+          changed = changed + 1
+        end
+      end
+    end
+  end
+  return {changed = changed}
 end
 
 -- Put(now, jid, klass, data, delay,
 --     [priority, p],
 --     [tags, t],
 --     [retries, r],
---     [depends, '[...]'])
+--     [depends, '[...]'],
+--     [unique, key],
+--     [coalesce, 0|1])
 -- -----------------------
 -- Insert a job into the queue with the given priority, tags, delay, klass and
 -- data.
+--
+-- At most one job holding a given `unique` key may be waiting or scheduled in
+-- a queue at a time. Putting another returns the jid of the job already there
+-- instead, having first updated its data (and priority, if given) when
+-- `coalesce` is 1. The key is released once the job is popped.
 function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
   assert(jid  , 'Put(): Arg "jid" missing')
   assert(klass, 'Put(): Arg "klass" missing')
@@ -429,11 +1026,47 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
   local options = {}
   for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
 
+  -- Sanity check on optional args. This happens before anything is written,
+  -- even if the job turns out to be a duplicate of one already in the queue
+  for _, name in ipairs({'priority', 'retries', 'interval', 'replace'}) do
+    if options[name] then
+      assert(tonumber(options[name]),
+        'Put(): Arg "' .. name .. '" not a number: ' .. tostring(options[name]))
+    end
+  end
+  local new_tags = options['tags'] and assert(cjson.decode(options['tags']),
+    'Put(): Arg "tags" not JSON'        .. tostring(options['tags']))
+  local depends = assert(cjson.decode(options['depends'] or '[]') ,
+    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
+  local resources, weights = QlessResource.parse('Put', options['resources'])
+  assert(#resources == 0 or QlessResource.all_exist(resources), 'Put(): invalid resources requested')
+  QlessResource.check_weights('Put', weights)
+
+  -- If another job holding the same unique key is already waiting (or
+  -- scheduled) in this queue, then this put is either dropped or, if asked
+  -- to coalesce, folded into that job. Either way, that job's jid is returned
+  local unique = options['unique']
+  local coalesce = assert(tonumber(options['coalesce'] or 0),
+    'Put(): Arg "coalesce" not a number: ' .. tostring(options['coalesce']))
+  if unique then
+    local existing = self:unique(unique)
+    if existing and existing ~= jid then
+      if coalesce ~= 0 then
+        redis.call('hset', QlessJob.ns .. existing, 'data', data)
+        if options['priority'] then
+          Qless.job(existing):priority(options['priority'])
+        end
+      end
+      return existing
+    end
+  end
+
   -- Let's see what the old priority and tags were
   local job = Qless.job(jid)
-  local priority, tags, oldqueue, state, failure, retries, oldworker, interval, next_run, old_resources =
+  local priority, tags, oldqueue, state, failure, retries, oldworker, interval, next_run, old_resources, history, old_unique =
     unpack(redis.call('hmget', QlessJob.ns .. jid, 'priority', 'tags',
-      'queue', 'state', 'failure', 'retries', 'worker', 'throttle_interval', 'throttle_next_run', 'resources'))
+      'queue', 'state', 'failure', 'retries', 'worker', 'throttle_interval', 'throttle_next_run', 'resources',
+      'history', 'unique'))
 
   next_run = next_run or now
 
@@ -448,32 +1081,29 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
     end
   end
 
-  -- If there are old tags, then we should remove the tags this job has
-  if tags then
-    Qless.tag(now, 'remove', jid, unpack(cjson.decode(tags)))
-  end
+  -- Remember the old tags, so that we only update the index for the tags that
+  -- have actually changed
+  local old_tags = Set.new(Qless.decode(tags or '[]'))
 
-  -- Sanity check on optional args
   retries  = assert(tonumber(options['retries']  or retries or 5) ,
     'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
-  tags     = assert(cjson.decode(options['tags'] or tags or '[]' ),
-    'Put(): Arg "tags" not JSON'          .. tostring(options['tags']))
+  tags = new_tags or Qless.decode(tags or '[]')
   priority = assert(tonumber(options['priority'] or priority or 0),
     'Put(): Arg "priority" not a number'  .. tostring(options['priority']))
-  local depends = assert(cjson.decode(options['depends'] or '[]') ,
-    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
-
-  local resources = assert(cjson.decode(options['resources'] or '[]'),
-    'Put(): Arg "resources" not JSON array: '     .. tostring(options['resources']))
-  assert(#resources == 0 or QlessResource.all_exist(resources), 'Put(): invalid resources requested')
 
     -- if there were previously acquired resources, verify consistency
   if old_resources then
-    old_resources = Set.new(cjson.decode(old_resources))
+    old_resources = Set.new(Qless.decode(old_resources))
     local removed_resources = Set.diff(old_resources, Set.new(resources))
     for k in pairs(removed_resources) do
       Qless.resource(k):release(now, jid)
     end
+    -- The locks it keeps may need a different number of units now
+    for _, rid in ipairs(resources) do
+      if old_resources[rid] then
+        Qless.resource(rid):reweigh(now, jid, weights[rid] or 1)
+      end
+    end
   end
 
   local interval = assert(tonumber(options['interval'] or interval or 0),
@@ -505,7 +1135,7 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
       if new[dep] == nil or new[dep] == false then
         -- Remove k as a dependency
         redis.call('srem', QlessJob.ns .. dep .. '-dependents'  , jid)
-        redis.call('srem', QlessJob.ns .. jid .. '-dependencies', dep)
+        job:remove_dependency(dep)
       end
     end
   end
@@ -517,7 +1147,11 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
     queue = self.name
   }))
 
-  -- Update the history to include this new change
+  -- Update the history to include this new change, first bringing forward
+  -- any old-style history this job might have
+  if history then
+    job:migrate_history(history)
+  end
   job:history(now, 'put', {q = self.name})
 
   -- If this item was previously in another queue, then we should remove it from there
@@ -527,6 +1161,9 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
     queue_obj.locks.remove(jid)
     queue_obj.depends.remove(jid)
     queue_obj.scheduled.remove(jid)
+    if old_unique then
+      queue_obj:release_unique(old_unique, jid)
+    end
   end
 
   -- If this had previously been given out to a worker, make sure to remove it
@@ -553,62 +1190,67 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
     redis.call('zrem', 'ql:completed', jid)
   end
 
-  -- Add this job to the list of jobs tagged with whatever tags were supplied
-  for i, tag in ipairs(tags) do
+  -- Remove this job from the tags it no longer has, and add it to those it
+  -- didn't have before
+  local new_tags = Set.new(tags)
+  for tag in pairs(Set.diff(old_tags, new_tags)) do
+    redis.call('zrem', 'ql:t:' .. tag, jid)
+    redis.call('zincrby', 'ql:tags', -1, tag)
+  end
+  for tag in pairs(Set.diff(new_tags, old_tags)) do
     redis.call('zadd', 'ql:t:' .. tag, now, jid)
     redis.call('zincrby', 'ql:tags', 1, tag)
   end
 
   -- If we're in the failed state, remove all of our data
   if state == 'failed' then
-    failure = cjson.decode(failure)
+    failure = Qless.decode(failure)
     -- We need to make this remove it from the failed queues
     redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
     if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
       redis.call('srem', 'ql:failures', failure.group)
     end
-    -- The bin is midnight of the provided day
-    -- 24 * 60 * 60 = 86400
-    local bin = failure.when - (failure.when % 86400)
     -- We also need to decrement the stats about the queue on
     -- the day that this failure actually happened.
-    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , -1)
-  end
-
-  -- First, let's save its data
-  redis.call('hmset', QlessJob.ns .. jid,
-    'jid'      , jid,
-    'klass'    , klass,
-    'data'     , data,
-    'priority' , priority,
-    'tags'     , cjson.encode(tags),
-    'resources', cjson.encode(resources),
-    'state'    , ((delay > 0) and 'scheduled') or 'waiting',
-    'worker'   , '',
-    'expires'  , 0,
-    'queue'    , self.name,
-    'retries'  , retries,
-    'remaining', retries,
-    'time'     , string.format("%.20f", now),
-    'throttle_interval', interval,
-    'throttle_next_run', next_run,
-    'result_data', '{}')
+    self:tally(now, 'failed', -1, failure.when)
+  end
 
-  -- These are the jids we legitimately have to wait on
-  for i, j in ipairs(depends) do
-    -- Make sure it's something other than 'nil' or complete.
-    local state = redis.call('hget', QlessJob.ns .. j, 'state')
-    if (state and state ~= 'complete') then
-      redis.call('sadd', QlessJob.ns .. j .. '-dependents'  , jid)
-      redis.call('sadd', QlessJob.ns .. jid .. '-dependencies', j)
-    end
+  -- First, let's save its data. Fields that are left at their defaults are
+  -- not stored at all
+  job:update({
+    jid               = jid,
+    klass             = klass,
+    data              = data,
+    priority          = priority,
+    tags              = Qless.encode(tags),
+    resources         = Qless.encode(resources),
+    weights           = Qless.encode(weights),
+    state             = ((delay > 0) and 'scheduled') or 'waiting',
+    worker            = '',
+    expires           = 0,
+    queue             = self.name,
+    retries           = retries,
+    remaining         = retries,
+    time              = Qless.time(now),
+    throttle_interval = interval,
+    throttle_next_run = next_run,
+    result_data       = '{}'
+  })
+
+  -- Claim the unique key, if there is one
+  if unique then
+    redis.call('set', 'ql:u:' .. self.name .. ':' .. unique, jid)
+    redis.call('hset', QlessJob.ns .. jid, 'unique', unique)
   end
 
+  -- These are the jids we legitimately have to wait on
+  local unresolved = job:add_dependencies(depends)
+
   -- Now, if a delay was provided, and if it's in the future,
   -- then we'll have to schedule it. Otherwise, we're just
   -- going to add it to the work queue.
   if delay > 0 then
-    if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
+    if unresolved > 0 then
       -- We've already put it in 'depends'. Now, we must just save the data
       -- for when it's scheduled
       self.depends.add(now, jid)
@@ -619,7 +1261,7 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
       self.scheduled.add(now + delay, jid)
     end
   else
-    if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
+    if unresolved > 0 then
       self.depends.add(now, jid)
       redis.call('hset', QlessJob.ns .. jid, 'state', 'depends')
     elseif #resources > 0 then
@@ -631,20 +1273,118 @@ function QlessQueue:put(now, worker, jid, klass, data, delay, ...)
     end
   end
 
+  self:record(now, 'put')
+
   -- Lastly, we're going to make sure that this item is in the
   -- set of known queues. We should keep this sorted by the
   -- order in which we saw each of these queues
-  if redis.call('zscore', 'ql:queues', self.name) == false then
-    redis.call('zadd', 'ql:queues', now, self.name)
-  end
+  Qless.defer('known:' .. self.name, function()
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+  end)
 
-  if redis.call('zscore', 'ql:tracked', jid) ~= false then
+  if Qless.tracked(jid) then
     Qless.publish('put', jid)
   end
 
   return jid
 end
 
+-- Put_many(now, worker, jobs)
+-- ---------------------------
+-- Put many jobs, possibly into several queues, in a single invocation. `jobs`
+-- is a JSON array of job specs, each with the arguments `put` would take:
+--
+--  [{
+--      'queue': 'queue',
+--      'jid': 'jid',
+--      'klass': 'klass',
+--      'data': {...},
+--      'delay': 0,
+--      # Any of put's options may also be given, like
+--      'priority': 10,
+--      'tags': ['foo', 'bar']
+--  }, ...]
+--
+-- Each job is put on its own, so one bad spec doesn't affect the others, and
+-- an outcome is returned for each, in order. That's either what `put` would
+-- have returned, or the error it raised:
+--
+--  [{'jid': 'jid', 'result': 'jid'}, {'jid': 'other', 'error': '...'}, ...]
+function QlessQueue.put_many(now, worker, jobs)
+  jobs = assert(cjson.decode(jobs or ''),
+    'Put_many(): Arg "jobs" missing or not JSON: ' .. tostring(jobs))
+  assert(type(jobs) == 'table',
+    'Put_many(): Arg "jobs" not a JSON array: ' .. tostring(jobs))
+
+  -- Options are JSON-encoded when given to put
+  local encoded = {
+    tags = true, depends = true, resources = true
+  }
+  local fields = {
+    queue = true, jid = true, klass = true, data = true, delay = true
+  }
+
+  local seen = {}
+  return Qless.outcomes(jobs, function(spec)
+    assert(type(spec) == 'table', 'Put_many(): job spec not an object')
+    assert(spec.queue, 'Put_many(): Arg "queue" missing')
+    assert(not seen[spec.jid],
+      'Put_many(): job ' .. tostring(spec.jid) .. ' given more than once')
+    if spec.jid then
+      seen[spec.jid] = true
+    end
+
+    local data = spec.data or '{}'
+    if type(data) == 'table' then
+      data = cjson.encode(data)
+    end
+
+    local options = {}
+    for key, value in pairs(spec) do
+      if not fields[key] then
+        if encoded[key] and type(value) == 'table' then
+          value = cjson.encode(value)
+        end
+        table.insert(options, key)
+        table.insert(options, value)
+      end
+    end
+
+    return Qless.queue(spec.queue):put(now, worker, spec.jid,
+      spec.klass, data, spec.delay or 0, unpack(options))
+  end)
+end
+
+-- Return the jid of the job waiting (or scheduled) in this queue that holds
+-- the unique `key`, if there is one. The index may be stale, so it's checked
+-- against the job itself
+function QlessQueue:unique(key)
+  local jid = redis.call('get', 'ql:u:' .. self.name .. ':' .. key)
+  if not jid then
+    return nil
+  end
+
+  local queue, state, unique = unpack(redis.call(
+    'hmget', QlessJob.ns .. jid, 'queue', 'state', 'unique'))
+  if queue == self.name and unique == key and
+    (state == 'waiting' or state == 'scheduled') then
+    return jid
+  end
+  return nil
+end
+
+-- Release the unique `key` held by `jid` in this queue, so that another job
+-- with the same key may be put
+function QlessQueue:release_unique(key, jid)
+  local index = 'ql:u:' .. self.name .. ':' .. key
+  if redis.call('get', index) == jid then
+    redis.call('del', index)
+  end
+  redis.call('hdel', QlessJob.ns .. jid, 'unique')
+end
+
 -- Move `count` jobs out of the failed state and into this queue
 function QlessQueue:unfail(now, group, count)
   assert(group, 'Unfail(): Arg "group" missing')
@@ -658,14 +1398,15 @@ function QlessQueue:unfail(now, group, count)
   local toinsert = {}
   for index, jid in ipairs(jids) do
     local job = Qless.job(jid)
-    local data = job:data()
+    local data = job:project({'jid', 'priority', 'retries', 'resources'})
     job:history(now, 'put', {q = self.name})
-    redis.call('hmset', QlessJob.ns .. data.jid,
-      'state'    , 'waiting',
-      'worker'   , '',
-      'expires'  , 0,
-      'queue'    , self.name,
-      'remaining', data.retries or 5)
+    job:update({
+      state     = 'waiting',
+      worker    = '',
+      expires   = 0,
+      queue     = self.name,
+      remaining = data.retries or 5
+    })
 
     if #data['resources'] then
       if job:acquire_resources(now) then
@@ -724,8 +1465,10 @@ function QlessQueue:recur(now, jid, klass, data, spec, ...)
     options.backlog = assert(tonumber(options.backlog  or 0),
       'Recur(): Arg "backlog" not a number: ' .. tostring(
         options.backlog))
-    options.resources = assert(cjson.decode(options['resources'] or '[]'),
-      'Recur(): Arg "resources" not JSON array: '     .. tostring(options['resources']))
+    -- Make sure the resources are valid, though they're stored as declared
+    QlessResource.check_weights('Recur',
+      select(2, QlessResource.parse('Recur', options['resources'])))
+    options.resources = cjson.decode(options['resources'] or '[]')
 
     local count, old_queue = unpack(redis.call('hmget', 'ql:r:' .. jid, 'count', 'queue'))
     count = count or 0
@@ -776,7 +1519,78 @@ end
 -------------------------------------------------------------------------------
 -- Housekeeping methods
 -------------------------------------------------------------------------------
--- Instantiate any recurring jobs that are ready
+-- Note that this queue has a scheduled or recurring job due at `when`, so
+-- that its entry in the global due-time index is no later than that
+function QlessQueue:due(when)
+  -- In a batch, the entry is recomputed once all its additions are made
+  if Qless.batching then
+    return Qless.defer('due:' .. self.name, function() self:reindex() end)
+  end
+
+  local score = redis.call('zscore', 'ql:due', self.name)
+  if (not score) or (tonumber(when) < tonumber(score)) then
+    redis.call('zadd', 'ql:due', when, self.name)
+  end
+end
+
+-- Recompute this queue's entry in the due-time index from the earliest of its
+-- scheduled and recurring jobs. Queues with neither are kept in the index
+-- with a score of '+inf', so that they can be told apart from queues that
+-- were created before the index existed, which we always have to check
+function QlessQueue:reindex()
+  local when = '+inf'
+  for _, group in ipairs({'scheduled', 'recur'}) do
+    local first = redis.call(
+      'zrange', self:prefix(group), 0, 0, 'WITHSCORES')[2]
+    if first and (when == '+inf' or tonumber(first) < when) then
+      when = tonumber(first)
+    end
+  end
+  redis.call('zadd', 'ql:due', when, self.name)
+end
+
+-- Instantiate up to `count` recurring jobs and move up to `count` scheduled
+-- jobs into the work queue, but only if the due-time index says that
+-- something in this queue has come due. Returns the number of jobs promoted
+function QlessQueue:promote(now, count)
+  local due = redis.call('zscore', 'ql:due', self.name)
+  if due and tonumber(due) > now then
+    return 0
+  end
+
+  local moved = self:check_recurring(now, count)
+  moved = moved + self:check_scheduled(now, count)
+  self:reindex()
+  return moved
+end
+
+-- Tick(now, budget)
+-- -----------------
+-- Promote due scheduled jobs and spawn due recurring jobs across all queues,
+-- earliest due first, without waiting for somebody to pop those queues.
+-- At most `budget` jobs are promoted per call, so a large backlog may take
+-- several ticks to drain. Returns the number of jobs promoted.
+function QlessQueue.tick(now, budget)
+  budget = assert(tonumber(budget),
+    'Tick(): Arg "budget" missing or not a number: ' .. tostring(budget))
+
+  local moved = 0
+  local queues = redis.call(
+    'zrangebyscore', 'ql:due', '-inf', now, 'LIMIT', 0, budget)
+  for _, name in ipairs(queues) do
+    if moved >= budget then
+      break
+    end
+    local queue = Qless.queue(name)
+    moved = moved + queue:check_recurring(now, budget - moved)
+    moved = moved + queue:check_scheduled(now, budget - moved)
+    queue:reindex()
+  end
+  return moved
+end
+
+-- Instantiate any recurring jobs that are ready, returning how many were
+-- spawned
 function QlessQueue:check_recurring(now, count)
   -- This is how many jobs we've moved so far
   local moved = 0
@@ -791,7 +1605,7 @@ function QlessQueue:check_recurring(now, count)
       redis.call('hmget', 'ql:r:' .. jid, 'klass', 'data', 'priority',
         'tags', 'retries', 'interval', 'backlog', 'resources'))
     local _tags = cjson.decode(tags)
-    local resources = cjson.decode(resources or '[]')
+    local resources, weights = QlessResource.parse('Recur', resources)
     local score = math.floor(tonumber(self.recurring.score(jid)))
     interval = tonumber(interval)
 
@@ -825,24 +1639,25 @@ function QlessQueue:check_recurring(now, count)
       end
 
       -- First, let's save its data
-      redis.call('hmset', QlessJob.ns .. child_jid,
-        'jid'              , child_jid,
-        'klass'            , klass,
-        'data'             , data,
-        'priority'         , priority,
-        'tags'             , tags,
-        'state'            , 'waiting',
-        'worker'           , '',
-        'expires'          , 0,
-        'queue'            , self.name,
-        'retries'          , retries,
-        'remaining'        , retries,
-        'resources'        , cjson.encode(resources),
-        'throttle_interval', 0,
-        'time'             , string.format("%.20f", score),
-        'spawned_from_jid' , jid)
-
       local job = Qless.job(child_jid)
+      job:update({
+        jid               = child_jid,
+        klass             = klass,
+        data              = data,
+        priority          = priority,
+        tags              = Qless.encode(_tags),
+        state             = 'waiting',
+        worker            = '',
+        expires           = 0,
+        queue             = self.name,
+        retries           = retries,
+        remaining         = retries,
+        resources         = Qless.encode(resources),
+        weights           = Qless.encode(weights),
+        throttle_interval = 0,
+        time              = Qless.time(score),
+        spawned_from_jid  = jid
+      })
       job:history(score, 'put', {q = self.name})
 
       -- Now, if a delay was provided, and if it's in the future,
@@ -861,11 +1676,12 @@ function QlessQueue:check_recurring(now, count)
       self.recurring.add(score, jid)
     end
   end
+  return moved
 end
 
 -- Check for any jobs that have been scheduled, and shovel them onto
--- the work queue. Returns nothing, but afterwards, up to `count`
--- scheduled jobs will be moved into the work queue
+-- the work queue. Up to `count` scheduled jobs will be moved into the work
+-- queue, and the number moved is returned
 function QlessQueue:check_scheduled(now, count)
   -- zadd is a list of arguments that we'll be able to use to
   -- insert into the work queue
@@ -886,6 +1702,7 @@ function QlessQueue:check_scheduled(now, count)
     -- instead of 'scheduled'
     redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
   end
+  return #scheduled
 end
 
 -- Check for and invalidate any locks that have been lost. Returns the
@@ -904,7 +1721,7 @@ function QlessQueue:invalidate_locks(now, count)
     -- We'll provide a grace period after jobs time out for them to give
     -- some indication of the failure mode. After that time, however, we'll
     -- consider the worker dust in the wind
-    local grace_period = tonumber(Qless.config.get('grace-period'))
+    local grace_period = Qless.config.get('grace-period')
 
     -- Whether or not we've already sent a coutesy message
     local courtesy_sent = tonumber(
@@ -941,13 +1758,11 @@ function QlessQueue:invalidate_locks(now, count)
       Qless.publish('w:' .. worker, encoded)
       Qless.publish('log', encoded)
       self.locks.add(now + grace_period, jid)
+      QlessWorker.tally(now, worker, 'lost', 1)
 
       -- If we got any expired locks, then we should increment the
-      -- number of retries for this stage for this bin. The bin is
-      -- midnight of the provided day
-      local bin = now - (now % 86400)
-      redis.call('hincrby',
-        'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 1)
+      -- number of retries for this stage for this bin
+      self:tally(now, 'retries', 1)
     end
 
     if invalidate then
@@ -969,15 +1784,13 @@ function QlessQueue:invalidate_locks(now, count)
         self.locks.remove(jid)
         self.scheduled.remove(jid)
 
-        local group = 'failed-retries-' .. Qless.job(jid):data()['queue']
+        local group = 'failed-retries-' .. unpack(Qless.job(jid):data('queue'))
         local job = Qless.job(jid)
         job:history(now, 'failed', {group = group})
-        redis.call('hmset', QlessJob.ns .. jid, 'state', 'failed',
-          'worker', '',
-          'expires', '')
+        job:update({state = 'failed', worker = '', expires = 0})
         -- If the failure has not already been set, then set it
         redis.call('hset', QlessJob.ns .. jid,
-        'failure', cjson.encode({
+        'failure', Qless.encode({
           ['group']   = group,
           ['message'] =
             'Job exhausted retries in queue "' .. self.name .. '"',
@@ -1003,11 +1816,10 @@ function QlessQueue:invalidate_locks(now, count)
         }))
 
         -- Increment the count of the failed jobs
-        local bin = now - (now % 86400)
-        redis.call('hincrby',
-          'ql:s:stats:' .. bin .. ':' .. self.name, 'failures', 1)
-        redis.call('hincrby',
-          'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , 1)
+        self:tally(now, 'failures', 1)
+        self:tally(now, 'failed'  , 1)
+        self:record(now, 'fail')
+        QlessWorker.tally(now, worker, 'failed', 1)
       else
         table.insert(jids, jid)
       end
@@ -1020,6 +1832,7 @@ end
 -- Forget the provided queues. As in, remove them from the list of known queues
 function QlessQueue.deregister(...)
   redis.call('zrem', Qless.ns .. 'queues', unpack(arg))
+  redis.call('zrem', Qless.ns .. 'due', unpack(arg))
 end
 
 -- Return information about a particular queue, or all queues
@@ -20,6 +20,7 @@ function QlessResource:data(...)
   local data = {
     rid          = res[1],
     max          = tonumber(res[2] or 0),
+    used         = self:used(),
     pending      = self:pending(),
     locks        = self:locks(),
   }
@@ -42,46 +43,17 @@ end
 function QlessResource:set(now, max)
   local max = assert(tonumber(max), 'Set(): Arg "max" not a number: ' .. tostring(max))
 
-  local current_max = self:get()
-  if current_max == nil then
-    current_max = max
-  end
-
-  local keyLocks = self:prefix('locks')
-  local current_locks = redis.pcall('scard', keyLocks)
-  -- get the max of the current limit and the current locks
-  -- this is just in case the limit was decreased immediately before and the locks have not come down to the limit yet.
-  local confirm_limit = math.max(current_max,current_locks)
-  local max_change = max - confirm_limit
-  local keyPending = self:prefix('pending')
-
   redis.call('hmset', QlessResource.ns .. self.rid, 'rid', self.rid, 'max', max);
+  redis.call('zadd', 'ql:resources', 0, self.rid)
 
-  if max_change > 0 then
-    local jids = redis.call('zrevrange', keyPending, 0, max_change - 1, 'withscores')
-    local jid_count = #jids
-    if jid_count == 0 then
-      return self.rid
-    end
-
-    for i = 1, jid_count, 2 do
-
-      local newJid = jids[i]
-      local score = jids[i + 1]
-
-      -- we know there is capacity to get this released resource, need to check all resources in case waiting on multiple
-      if Qless.job(newJid):acquire_resources(now) then
-        local data = Qless.job(newJid):data()
-        local queue = Qless.queue(data['queue'])
-        queue.work.add(score, 0, newJid)
-      end
-    end
-  end
+  -- If the max has gone up, there may be locks free for jobs waiting on it
+  self:grant(now)
 
   return self.rid
 end
 
 function QlessResource:unset()
+  redis.call('zrem', 'ql:resources', self.rid)
   return redis.call('del', QlessResource.ns .. self.rid);
 end
 
@@ -93,7 +65,39 @@ function QlessResource:prefix(group)
   return QlessResource.ns..self.rid
 end
 
-function QlessResource:acquire(now, priority, jid)
+-- Return whether `jid` holds, or could acquire, a lock on this resource
+-- without acquiring it, given that `claimed` further units have already been
+-- promised elsewhere
+function QlessResource:available(jid, claimed)
+  local max = self:get()
+  if max == nil then
+    return false
+  end
+
+  if redis.call('sismember', self:prefix('locks'), jid) == 1 then
+    return true
+  end
+
+  return max - self:used() - self:held_back(jid) - (claimed or 0) >=
+    Qless.job(jid):weight(self.rid)
+end
+
+-- Return the number of free units that are held back from `jid` for a job
+-- that needs more than are free, and that's waiting ahead of it
+function QlessResource:held_back(jid)
+  local reserved = redis.call('hget', QlessResource.ns .. self.rid, 'reserved')
+  if not reserved or reserved == jid or
+    redis.call('zscore', self:prefix('pending'), reserved) == false then
+    return 0
+  end
+  return Qless.job(reserved):weight(self.rid)
+end
+
+-- Acquire a lock on this resource for `jid`, which takes `weight` (by
+-- default, 1) of its units, or else add it to the jobs waiting on it. If it
+-- has to wait because too few units are free, rather than because they're
+-- held back for another job, then they're held back for it from then on.
+function QlessResource:acquire(now, priority, jid, weight)
   local keyLocks = self:prefix('locks')
   local max = self:get()
   if max == nil then
@@ -110,11 +114,17 @@ function QlessResource:acquire(now, priority, jid)
     return true
   end
 
-  local remaining = max - redis.pcall('scard', keyLocks)
+  local held_back = self:held_back(jid)
+  local remaining = max - self:used() - held_back
+  weight = weight or 1
 
-  if remaining > 0 then
+  if remaining >= weight then
     -- acquire a lock and release it from the pending queue
     redis.call('sadd', keyLocks, jid)
+    if weight ~= 1 then
+      redis.call('hset', self:prefix('weights'), jid, weight)
+    end
+    redis.call('hincrby', self:prefix(), 'used', weight)
     redis.call('zrem', self:prefix('pending'), jid)
 
     return true
@@ -125,6 +135,11 @@ function QlessResource:acquire(now, priority, jid)
     redis.call('zadd', self:prefix('pending'), priority - (now / 10000000000), jid)
   end
 
+  -- Jobs needing more than the max can only wait for it to be raised
+  if held_back == 0 and weight <= max then
+    redis.call('hset', self:prefix(), 'reserved', jid)
+  end
+
   return false
 end
 
@@ -136,25 +151,108 @@ function QlessResource:release(now, jid)
   local keyLocks = self:prefix('locks')
   local keyPending = self:prefix('pending')
 
-  redis.call('srem', keyLocks, jid)
+  if redis.call('sismember', keyLocks, jid) == 1 then
+    self:use(-tonumber(redis.call('hget', self:prefix('weights'), jid) or 1))
+    redis.call('srem', keyLocks, jid)
+    redis.call('hdel', self:prefix('weights'), jid)
+  end
   redis.call('zrem', keyPending, jid)
 
-  local jids = redis.call('zrevrange', keyPending, 0, 0, 'withscores')
-  if #jids == 0 then
-    return false
+  return self:grant(now)[1] or false
+end
+
+-- Change the number of units that the lock `jid` holds on this resource takes
+-- to `weight`, if it holds one. If too few units are free for that, the lock
+-- is released instead, for the job to wait on it again.
+function QlessResource:reweigh(now, jid, weight)
+  if redis.call('sismember', self:prefix('locks'), jid) == 0 then
+    return
+  end
+
+  local held = tonumber(redis.call('hget', self:prefix('weights'), jid) or 1)
+  if held == weight then
+    return
+  end
+
+  if self:used() - held + weight > (self:get() or 0) then
+    self:release(now, jid)
+    return
+  end
+
+  self:use(weight - held)
+  if weight == 1 then
+    redis.call('hdel', self:prefix('weights'), jid)
+  else
+    redis.call('hset', self:prefix('weights'), jid, weight)
+  end
+  -- Units that it no longer needs may be of use to the jobs waiting
+  if weight < held then
+    self:grant(now)
+  end
+end
+
+-- Grant this resource's free units to the jobs waiting on it, in order of
+-- priority. Jobs that are also waiting on another resource are passed over in
+-- favour of later ones that can run, looking at no more than
+-- `resource-grant-budget` (100 by default) of them. If there's still room after
+-- that, the first job passed over takes a lock, so that jobs that need several
+-- resources aren't starved. Likewise, once a job needs more units than are
+-- free, the free units are held back for it rather than granted to the jobs
+-- after it, so that jobs that need many units aren't starved either. Returns
+-- the jids that took locks.
+function QlessResource:grant(now)
+  local max = self:get()
+  if max == nil then
+    return {}
   end
 
-  local newJid = jids[1]
-  local score = jids[2]
+  -- Whichever job units were held back for, it's decided again here
+  redis.call('hdel', QlessResource.ns .. self.rid, 'reserved')
+  local free = max - self:used()
+  if free <= 0 then
+    return {}
+  end
+
+  local budget = Qless.config.get('resource-grant-budget')
+  local jids = redis.call(
+    'zrevrange', self:prefix('pending'), 0, budget - 1, 'withscores')
+
+  local granted, passed = {}, nil
+  for i = 1, #jids, 2 do
+    if free <= 0 then
+      break
+    end
+
+    local weight = Qless.job(jids[i]):weight(self.rid)
+    if weight > max then
+      -- The max has been lowered below what it needs, so it can only wait
+      -- for it to be raised again
+    elseif weight > free then
+      redis.call('hset', QlessResource.ns .. self.rid, 'reserved', jids[i])
+      break
+    elseif Qless.job(jids[i]):blocked(self.rid) then
+      passed = passed or i
+    else
+      self:admit(now, jids[i], jids[i + 1])
+      table.insert(granted, jids[i])
+      free = max - self:used()
+    end
+  end
 
-  -- we know there is capacity to get this released resource but need to check all resources in case multiple.
-  if Qless.job(newJid):acquire_resources(now) then
-    local data = Qless.job(newJid):data()
-    local queue = Qless.queue(data['queue'])
-    queue.work.add(score, 0, newJid)
+  if passed and self:available(jids[passed]) then
+    self:admit(now, jids[passed], jids[passed + 1])
+    table.insert(granted, jids[passed])
   end
+  return granted
+end
 
-  return newJid
+-- Have the pending `jid` acquire its resources, and if it gets them all, add
+-- it to the work queue of its queue with the pending `score`
+function QlessResource:admit(now, jid, score)
+  if Qless.job(jid):acquire_resources(now) then
+    local queue = Qless.queue(unpack(Qless.job(jid):data('queue')))
+    queue.work.add(score, 0, jid)
+  end
 end
 
 --- Return the list of job IDs with locks for this resource
@@ -169,6 +267,41 @@ function QlessResource:lock_count()
   return redis.call('scard', self:prefix('locks'))
 end
 
+--- Return the number of units of this resource that its locks take. This is
+--  kept in the `used` field of its hash as locks are taken and released. If
+--  it isn't there yet (as for resources whose locks were taken before it was
+--  kept), it's counted from the locks, each of which takes one unit except
+--  for those with a weight in the `-weights` hash, and then kept from then on.
+--  Returns whether it's kept, too, which it isn't for resources that have been
+--  unset.
+--
+function QlessResource:used()
+  local used = redis.call('hget', self:prefix(), 'used')
+  if used then
+    return tonumber(used), true
+  end
+
+  used = self:lock_count()
+  for _, weight in ipairs(redis.call('hvals', self:prefix('weights'))) do
+    used = used + tonumber(weight) - 1
+  end
+  if redis.call('exists', self:prefix()) == 0 then
+    return used, false
+  end
+  redis.call('hset', self:prefix(), 'used', used)
+  return used, true
+end
+
+--- Add `units` (which may be negative) to the number of units in use, which
+--  must be done before the locks themselves change
+--
+function QlessResource:use(units)
+  local _, kept = self:used()
+  if kept then
+    redis.call('hincrby', self:prefix(), 'used', units)
+  end
+end
+
 --- Return the list of job identifiers waiting for this resource
 --
 function QlessResource:pending()
@@ -185,6 +318,50 @@ function QlessResource:exists()
   return redis.call('exists', self:prefix()) == 1
 end
 
+-- Parse the resources that a job needs, declared by `name` ('Put' or 'Recur')
+-- as either a JSON array of resource ids, each needing a single unit, or a
+-- JSON object mapping resource ids to the number of units needed. Returns the
+-- list of resource ids, and a table of the weights of those that need more
+-- than a single unit.
+function QlessResource.parse(name, resources)
+  local ok, decoded = pcall(cjson.decode, resources or '[]')
+  if not ok or type(decoded) ~= 'table' then
+    error(name .. '(): Arg "resources" not JSON array or object: ' ..
+      tostring(resources))
+  end
+  if #decoded > 0 or next(decoded) == nil then
+    return decoded, {}
+  end
+
+  local rids, weights = {}, {}
+  for rid, weight in pairs(decoded) do
+    if type(weight) ~= 'number' or weight < 1 or
+      weight ~= math.floor(weight) then
+      error(name .. '(): Weight of resource "' .. rid ..
+        '" not a positive integer: ' .. tostring(weight))
+    end
+    table.insert(rids, rid)
+    if weight ~= 1 then
+      weights[rid] = weight
+    end
+  end
+  table.sort(rids)
+  return rids, weights
+end
+
+-- Raise an error on behalf of `name` ('Put' or 'Recur') if any of `weights`
+-- is more than the units that its resource has, since that job could never
+-- run. Resources that don't exist are left for the caller to check.
+function QlessResource.check_weights(name, weights)
+  for rid, weight in pairs(weights) do
+    local max = Qless.resource(rid):get()
+    if max and weight > max then
+      error(name .. '(): Weight of resource "' .. rid .. '" (' .. weight ..
+        ') more than its max: ' .. max)
+    end
+  end
+end
+
 ---- Return true if all resources exist
 --
 function QlessResource.all_exist(resources)
@@ -196,46 +373,105 @@ function QlessResource.all_exist(resources)
   return true
 end
 
--- Return resources pending
+-- Return the resources with jobs waiting on them, and how many, in order of
+-- their ids, starting after the id `after` (if provided) and returning at
+-- most `count` (by default, 25) of them. The next page starts after the last
+-- id returned.
 --  [
 --      {
---          'name': 'res',
+--          'name': 'res-1',
 --          'count': 5
 --      }, {
---          'name': 'res',
+--          'name': 'res-2',
 --          'count': 2
 --      }
 --  ]
-function QlessResource.pending_counts(now)
-  local search = QlessResource.ns..'*-pending'
-  local reply = redis.call('keys', search)
-  local response = {}
-  for index, rname in ipairs(reply) do
-    local count = redis.call('zcard', rname)
-    local resStat = {name = rname, count = count}
-    table.insert(response,resStat)
-  end
-  return response
+function QlessResource.pending_counts(now, after, count)
+  return QlessResource.counts('PendingCounts', 'pending_count', after, count)
 end
 
--- Return resources locks
+-- Return the resources with locks held on them, and how many, in order of
+-- their ids, paginated as `pending_counts` is
 --  [
 --      {
---          'name': 'res',
+--          'name': 'res-1',
 --          'count': 5
 --      }, {
---          'name': 'res',
+--          'name': 'res-2',
 --          'count': 2
 --      }
 --  ]
-function QlessResource.locks_counts(now)
-  local search = QlessResource.ns..'*-locks'
-  local reply = redis.call('keys', search)
+function QlessResource.locks_counts(now, after, count)
+  return QlessResource.counts('LocksCounts', 'lock_count', after, count)
+end
+
+-- Walk the registry of resources in `ql:resources`, returning those for which
+-- the `method` count is non-zero, paginated by `after` and `count`. All of
+-- the registry's scores are 0, so it's walked in order of id from `after`,
+-- rather than from its start.
+function QlessResource.counts(name, method, after, count)
+  count = assert(tonumber(count or 25),
+    name .. '(): Arg "count" not a number: ' .. tostring(count))
+
   local response = {}
-  for index, rname in ipairs(reply) do
-    local count = redis.call('scard', rname)
-    local resStat = {name = rname, count = count}
-    table.insert(response,resStat)
+  local start = after and ('(' .. after) or '-'
+  while #response < count do
+    local rids = redis.call(
+      'zrangebylex', 'ql:resources', start, '+', 'limit', 0, 1000)
+    for _, rid in ipairs(rids) do
+      local resource = Qless.resource(rid)
+      local resource_count = resource[method](resource)
+      if resource_count > 0 then
+        table.insert(response, {name = rid, count = resource_count})
+        if #response >= count then
+          return response
+        end
+      end
+    end
+    if #rids < 1000 then
+      break
+    end
+    start = '(' .. rids[#rids]
   end
   return response
-end
\ No newline at end of file
+end
+
+-- Backfill(now, cursor, [count])
+-- ------------------------------
+-- Add the resources that were set before the `ql:resources` registry existed
+-- to it. This scans about `count` (by default, 1000) keys from `cursor` (0 to
+-- begin with) for resources, and returns the cursor to continue from, which is
+-- 0 once every key has been seen, along with how many resources were added:
+--
+--  {'cursor': 1234, 'registered': 5}
+--
+-- This needs Redis 3.2 or later, since a script can only write after scanning
+-- once its writes are replicated in place of the script.
+function QlessResource.backfill(now, cursor, count)
+  cursor = assert(tonumber(cursor),
+    'Backfill(): Arg "cursor" missing or not a number: ' .. tostring(cursor))
+  count = assert(tonumber(count or 1000),
+    'Backfill(): Arg "count" not a number: ' .. tostring(count))
+  if not redis.replicate_commands then
+    error('Backfill(): Redis 3.2 or later is needed to scan for resources')
+  end
+
+  -- Scanning isn't deterministic, so replicate the writes that follow rather
+  -- than the script
+  redis.replicate_commands()
+  local reply = redis.call('scan', cursor,
+    'match', QlessResource.ns .. '*', 'count', count)
+
+  local registered = 0
+  for _, key in ipairs(reply[2]) do
+    -- A resource's own hash has its rid, unlike its locks, pending jobs and
+    -- weights
+    if redis.call('type', key)['ok'] == 'hash' then
+      local rid = redis.call('hget', key, 'rid')
+      if rid and QlessResource.ns .. rid == key then
+        registered = registered + redis.call('zadd', 'ql:resources', 0, rid)
+      end
+    end
+  end
+  return {cursor = tonumber(reply[1]), registered = registered}
+end
@@ -9,12 +9,17 @@ class TestConfig(TestQless):
         '''Should be able to access all configurations'''
         self.assertEqual(self.lua('config.get', 0), {
             'application': 'qless',
+            'gc-budget': 10,
             'grace-period': 10,
             'heartbeat': 60,
             'histogram-history': 7,
+            'hour-stats-history': 604800,
             'jobs-history': 604800,
             'jobs-history-count': 50000,
-            'stats-history': 30})
+            'minute-stats-history': 21600,
+            'resource-grant-budget': 100,
+            'stats-history': 30,
+            'storage-format': 'json'})
 
     def test_get(self):
         '''Should be able to get each key individually'''
@@ -41,3 +46,18 @@ class TestConfig(TestQless):
         self.assertEqual(self.lua('config.get', 0, 'foo'), 5)
         self.lua('config.unset', 0, 'foo')
         self.assertEqual(self.lua('config.get', 0, 'foo'), None)
+
+    def test_all_with_overrides(self):
+        '''Getting all configurations includes those that have been set'''
+        self.lua('config.set', 0, 'heartbeat', 100)
+        self.lua('config.set', 0, 'foo', 'bar')
+        config = self.lua('config.get', 0)
+        self.assertEqual(config['heartbeat'], '100')
+        self.assertEqual(config['foo'], 'bar')
+        self.assertEqual(config['grace-period'], 10)
+        # And once unset, defaults come back and others disappear
+        self.lua('config.unset', 0, 'heartbeat')
+        self.lua('config.unset', 0, 'foo')
+        config = self.lua('config.get', 0)
+        self.assertEqual(config['heartbeat'], 60)
+        self.assertNotIn('foo', config)
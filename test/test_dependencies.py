@@ -229,3 +229,73 @@ class TestDependencies(TestQless):
             self.lua, 'depends', 0, 'jid', 'on', 'a')
         self.assertRaisesRegexp(redis.ResponseError, r'in the depends state',
             self.lua, 'depends', 0, 'jid', 'off', 'a')
+
+    def test_unresolved(self):
+        '''Jobs count their unresolved dependencies'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('put', 2, 'worker', 'queue', 'c', 'klass', {}, 0,
+            'depends', ['a', 'b', 'a'])
+        self.assertEqual(self.redis.hget('ql:j:c', 'unresolved'), '2')
+        self.lua('pop', 3, 'queue', 'worker', 10)
+        self.lua('complete', 4, 'a', 'worker', 'queue', {})
+        self.assertEqual(self.redis.hget('ql:j:c', 'unresolved'), '1')
+        self.lua('complete', 5, 'b', 'worker', 'queue', {})
+        self.assertEqual(self.redis.hget('ql:j:c', 'unresolved'), None)
+        self.assertEqual(self.lua('get', 6, 'c')['state'], 'waiting')
+
+    def test_mixed_states(self):
+        '''Only dependencies that exist and aren't complete are kept'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('pop', 2, 'queue', 'worker', 1)
+        self.lua('complete', 3, 'a', 'worker', 'queue', {})
+        self.lua('put', 4, 'worker', 'queue', 'c', 'klass', {}, 0,
+            'depends', ['a', 'b', 'd'])
+        self.assertEqual(self.lua('get', 5, 'c')['dependencies'], ['b'])
+        self.assertEqual(self.redis.hget('ql:j:c', 'unresolved'), '1')
+        self.assertFalse(self.redis.exists('ql:j:c-candidates'))
+        # The same goes for dependencies given on completion
+        self.lua('put', 6, 'worker', 'other', 'e', 'klass', {}, 0)
+        self.lua('pop', 7, 'queue', 'worker', 1)
+        self.lua('complete', 8, 'b', 'worker', 'queue', {},
+            'next', 'queue', 'depends', ['a', 'd', 'e'])
+        self.assertEqual(self.lua('get', 9, 'b')['dependencies'], ['e'])
+
+    def test_uncounted(self):
+        '''Dependencies recorded without a count are counted from the set'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('put', 2, 'worker', 'queue', 'c', 'klass', {}, 0,
+            'depends', ['a', 'b'])
+        self.redis.hdel('ql:j:c', 'unresolved')
+        self.lua('pop', 3, 'queue', 'worker', 10)
+        self.lua('complete', 4, 'a', 'worker', 'queue', {})
+        self.assertEqual(self.lua('get', 5, 'c')['state'], 'depends')
+        self.lua('complete', 6, 'b', 'worker', 'queue', {})
+        self.assertEqual(self.lua('get', 7, 'c')['state'], 'waiting')
+
+    def test_remove_other(self):
+        '''Removing a job that isn't a dependency doesn't release the job'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('put', 2, 'worker', 'queue', 'c', 'klass', {}, 0,
+            'depends', ['a'])
+        self.lua('depends', 3, 'c', 'off', 'b')
+        self.assertEqual(self.lua('get', 4, 'c')['state'], 'depends')
+        self.lua('depends', 5, 'c', 'off', 'a', 'b')
+        self.assertEqual(self.lua('get', 6, 'c')['state'], 'waiting')
+
+    def test_fan_out(self):
+        '''Completing a job releases all of its dependents at once'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        for index in range(20):
+            self.lua('put', index, 'worker', 'queue-%i' % (index % 2),
+                'jid-%i' % index, 'klass', {}, 0, 'depends', ['a'])
+        self.lua('pop', 100, 'queue', 'worker', 10)
+        self.lua('complete', 101, 'a', 'worker', 'queue', {})
+        for queue in ('queue-0', 'queue-1'):
+            counts = self.lua('queues', 102, queue)
+            self.assertEqual(counts['waiting'], 10)
+            self.assertEqual(counts['depends'], 0)
+        self.assertEqual(self.lua('get', 102, 'a')['dependents'], {})
@@ -107,6 +107,31 @@ class TestFail(TestQless):
             self.lua, 'fail', 4, 'jid', 'worker', 'group', 'message', {})
 
 
+class TestFailMany(TestQless):
+    '''Test failing several jobs at once'''
+    def test_malformed(self):
+        '''Enumerate all the ways the jobs can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('fail_many', 0, 'worker', 'group', 'message', '[}'),
+            ('fail_many', 0, 'worker', 'group', 'message', 5)
+        ])
+
+    def test_basic(self):
+        '''Each job is failed, with its own group and message if given'''
+        for index, jid in enumerate(('a', 'b', 'c')):
+            self.lua('put', index, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 3, 'queue', 'worker', 2)
+        results = self.lua('fail_many', 2, 'worker', 'group', 'message', [
+            'a', {'jid': 'b', 'group': 'other', 'message': 'oops'}, 'c'])
+        self.assertEqual(results[:2], [
+            {'jid': 'a', 'result': 'a'}, {'jid': 'b', 'result': 'b'}])
+        self.assertIn('not currently running', results[2]['error'])
+        self.assertEqual(self.lua('failed', 2), {'group': 1, 'other': 1})
+        self.assertEqual(self.lua('get', 2, 'b')['failure']['message'], 'oops')
+        stats = self.lua('stats', 0, 'queue', 0)
+        self.assertEqual((stats['failed'], stats['failures']), (2, 2))
+
+
 class TestFailed(TestQless):
     '''Test access to our failed jobs'''
     def test_malformed(self):
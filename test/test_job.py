@@ -40,6 +40,80 @@ class TestJob(TestQless):
             {'q': 'queue', 'what': 'put', 'when': 98},
             {'q': 'queue', 'what': 'put', 'when': 99}])
 
+    def test_history_at_limit(self):
+        '''History isn't truncated until it exceeds max-job-history'''
+        self.lua('config.set', 0, 'max-job-history', 3)
+        for index in range(3):
+            self.lua('put', index, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            [h['when'] for h in self.lua('get', 0, 'jid')['history']], [0, 1, 2])
+        self.lua('put', 3, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            [h['when'] for h in self.lua('get', 0, 'jid')['history']], [0, 2, 3])
+
+class TestProjection(TestQless):
+    '''We can ask for only some of a job's attributes'''
+    def test_malformed(self):
+        '''Enumerate all the ways that projections can be malformed'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertMalformed(self.lua, [
+            ('get', 0, 'jid', 'foo'),
+            ('get', 0, 'jid', ['foo']),
+            ('pop', 0, 'queue', 'worker', 10, '{"jid": 1}'),
+            ('project', 0, ['jid', 'foo'], 'jid')
+        ])
+
+    def test_fields(self):
+        '''Only the requested fields are returned'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['foo'])
+        self.assertEqual(self.lua('get', 0, 'jid', ['jid', 'tags', 'tracked']), {
+            'jid': 'jid', 'tags': ['foo'], 'tracked': False})
+
+    def test_full(self):
+        '''The full profile (or no profile) returns everything'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('get', 0, 'jid', 'full'), self.lua('get', 0, 'jid'))
+        self.assertEqual(
+            self.lua('get', 0, 'jid', ''), self.lua('get', 0, 'jid'))
+
+    def test_worker_profile(self):
+        '''The worker profile returns what workers need to run jobs'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.lua('pop', 1, 'queue', 'worker', 10, 'worker'), [{
+            'jid': 'jid',
+            'klass': 'klass',
+            'state': 'running',
+            'queue': 'queue',
+            'worker': 'worker',
+            'priority': 0,
+            'expires': 61,
+            'retries': 5,
+            'remaining': 5,
+            'data': '{}'}])
+
+    def test_ui_profile(self):
+        '''The ui profile omits history, data and dependencies'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        job = self.lua('peek', 0, 'queue', 10, 'ui')[0]
+        for key in ('history', 'data', 'dependents', 'dependencies'):
+            self.assertNotIn(key, job)
+        self.assertEqual(job['jid'], 'jid')
+
+    def test_nonexistent(self):
+        '''Projecting a nonexistent job returns nothing'''
+        self.assertEqual(self.lua('get', 0, 'jid', 'worker'), None)
+
+    def test_project(self):
+        '''We can project several jobs at once'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.assertEqual(self.lua('project', 0, ['jid', 'state'], 'a', 'b'), [
+            {'jid': 'a', 'state': 'waiting'},
+            {'jid': 'b', 'state': 'waiting'}])
+
+
 class TestRequeue(TestQless):
     def test_requeue_existing_job(self):
         '''Requeueing an existing job is identical to `put`'''
@@ -271,6 +345,284 @@ class TestComplete(TestQless):
         self.assertEqual(res['pending'], {})
 
 
+class TestGc(TestQless):
+    '''Test the collection of completed jobs'''
+    def complete(self, count, now=0):
+        '''Complete `count` jobs'''
+        for jid in xrange(count):
+            self.lua('put', now, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('pop', now, 'queue', 'worker', 10)
+            self.lua('complete', now, jid, 'worker', 'queue', {})
+
+    def test_malformed(self):
+        '''Enumerate all the ways it can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('gc', 0),
+            ('gc', 0, 'foo')
+        ])
+
+    def test_age(self):
+        '''Jobs older than jobs-history are collected within the budget'''
+        self.complete(5)
+        self.lua('config.set', 0, 'jobs-history', 10)
+        self.assertEqual(self.lua('gc', 5, 10), 0)
+        self.assertEqual(self.lua('gc', 20, 3), 3)
+        self.assertEqual(self.lua('jobs', 20, 'complete'), ['4', '3'])
+        self.assertEqual(self.lua('get', 20, '0'), None)
+        self.assertEqual(self.lua('gc', 20, 3), 2)
+        self.assertEqual(self.lua('jobs', 20, 'complete'), [])
+
+    def test_count(self):
+        '''Jobs beyond jobs-history-count are collected within the budget'''
+        self.complete(5)
+        self.lua('config.set', 0, 'jobs-history-count', 1)
+        self.assertEqual(self.lua('gc', 0, 3), 3)
+        self.assertEqual(self.lua('gc', 0, 3), 1)
+        self.assertEqual(self.lua('jobs', 0, 'complete'), ['4'])
+
+    def test_complete(self):
+        '''Complete collects no more than gc-budget jobs'''
+        self.complete(5)
+        self.lua('config.set', 0, 'gc-budget', 2)
+        self.lua('config.set', 0, 'jobs-history', 10)
+        self.lua('put', 20, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 20, 'queue', 'worker', 10)
+        self.lua('complete', 20, 'jid', 'worker', 'queue', {})
+        self.assertEqual(len(self.lua('jobs', 20, 'complete')), 4)
+
+
+class TestStorageFormat(TestQless):
+    '''Test the msgpack storage format for job metadata'''
+    def run_job(self):
+        '''Put, tag, log and fail a job, returning its data'''
+        self.lua('resource.set', 0, 'r-1', 5)
+        self.lua('put', 1, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['a', 'b'], 'resources', ['r-1'])
+        self.lua('tag', 2, 'add', 'jid', 'c')
+        self.lua('tag', 3, 'remove', 'jid', 'a')
+        self.lua('log', 4, 'jid', 'foo', {'x': 1})
+        self.lua('pop', 5, 'queue', 'worker', 10)
+        self.lua('fail', 6, 'jid', 'worker', 'group', 'message', {})
+        return self.lua('get', 7, 'jid')
+
+    def test_matches_json(self):
+        '''Jobs read back the same in either format'''
+        expected = self.run_job()
+        self.redis.flushdb()
+        self.lua('config.set', 0, 'storage-format', 'msgpack')
+        self.assertEqual(self.run_job(), expected)
+
+    def test_packed(self):
+        '''Metadata fields are stored packed'''
+        self.lua('config.set', 0, 'storage-format', 'msgpack')
+        self.run_job()
+        self.assertEqual(
+            self.redis.hget('ql:j:jid', 'tags'), '\x92\xa1b\xa1c')
+        self.assertEqual(
+            self.redis.hget('ql:j:jid', 'resources'), '\x91\xa3r-1')
+        self.assertEqual(self.redis.hget('ql:j:jid', 'failure')[0], '\x84')
+
+    def test_switch(self):
+        '''Jobs written in one format can be used after switching'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['a'])
+        self.lua('config.set', 0, 'storage-format', 'msgpack')
+        self.lua('tag', 1, 'add', 'jid', 'b')
+        self.assertEqual(self.lua('get', 1, 'jid')['tags'], ['a', 'b'])
+        self.lua('config.unset', 0, 'storage-format')
+        self.lua('put', 2, 'worker', 'other', 'jid', 'klass', {}, 0)
+        job = self.lua('get', 2, 'jid')
+        self.assertEqual(job['tags'], ['a', 'b'])
+        self.assertEqual(
+            [h['what'] for h in job['history']], ['put', 'put'])
+        self.lua('cancel', 3, 'jid')
+        self.assertEqual(self.lua('tag', 3, 'get', 'a', 0, 10)['total'], 0)
+
+
+class TestSparse(TestQless):
+    '''Test that fields with default values are left out of job hashes'''
+    defaults = set(['worker', 'expires', 'tags', 'resources', 'weights',
+        'failure', 'result_data', 'throttle_interval', 'throttle_next_run'])
+
+    def fields(self, jid='jid'):
+        '''The fields stored in a job's hash'''
+        return set(self.redis.hkeys('ql:j:' + jid))
+
+    def test_put(self):
+        '''Put stores only the fields that aren't defaults'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.fields() & self.defaults, set())
+        job = self.lua('get', 0, 'jid')
+        self.assertEqual(job['worker'], '')
+        self.assertEqual(job['expires'], 0)
+        self.assertEqual(job['tags'], {})
+        self.assertEqual(job['interval'], 0)
+        self.assertEqual(job['result_data'], {})
+
+    def test_lifecycle(self):
+        '''Fields are stored while they're set, and removed when reset'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['foo'])
+        self.assertEqual(self.fields() & self.defaults, set(['tags']))
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual(self.fields() & self.defaults,
+            set(['tags', 'worker', 'expires']))
+        self.lua('tag', 2, 'remove', 'jid', 'foo')
+        self.lua('complete', 3, 'jid', 'worker', 'queue', {})
+        self.assertEqual(self.fields() & self.defaults, set())
+
+    def test_recurring(self):
+        '''Recurring jobs spawn sparse jobs'''
+        self.lua('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 60, 0)
+        self.lua('pop', 0, 'queue', 'worker', 10)
+        self.assertEqual(self.fields('jid-1') & self.defaults,
+            set(['worker', 'expires']))
+
+    def test_untagged(self):
+        '''Jobs without tags can still be tagged'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.lua('tag', 0, 'add', 'jid', 'foo'), ['foo'])
+
+    def test_nonexistent(self):
+        '''Missing jobs are still reported as missing'''
+        self.assertRaisesRegexp(redis.ResponseError, r'does not exist',
+            self.lua, 'complete', 0, 'jid', 'worker', 'queue', {})
+        self.assertRaisesRegexp(redis.ResponseError, r'does not exist',
+            self.lua, 'heartbeat', 0, 'jid', 'worker', {})
+        self.assertRaisesRegexp(redis.ResponseError, r'does not exist',
+            self.lua, 'tag', 0, 'add', 'jid', 'foo')
+
+
+class TestCompleteMany(TestQless):
+    '''Test completing several jobs at once'''
+    def test_malformed(self):
+        '''Enumerate all the ways the jobs can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('complete_many', 0, 'worker', 'queue', '[}'),
+            ('complete_many', 0, 'worker', 'queue', 5)
+        ])
+
+    def test_basic(self):
+        '''Each job is completed, or moved on to its next queue'''
+        for jid in ('a', 'b', 'c'):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual(
+            self.lua('complete_many', 2, 'worker', 'queue', [
+                'a',
+                {'jid': 'b', 'data': {'foo': 'bar'}},
+                {'jid': 'c', 'next': 'other', 'delay': 10}
+            ]), [
+                {'jid': 'a', 'result': 'complete'},
+                {'jid': 'b', 'result': 'complete'},
+                {'jid': 'c', 'result': 'scheduled'}
+            ])
+        self.assertEqual(self.lua('get', 2, 'b')['data'], '{"foo":"bar"}')
+        self.assertEqual(self.lua('get', 2, 'c')['queue'], 'other')
+        self.assertEqual(self.lua('jobs', 2, 'complete'), ['b', 'a'])
+
+    def test_errors(self):
+        '''Jobs the worker doesn't own are reported, not completed'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 1)
+        results = self.lua('complete_many', 2, 'worker', 'queue',
+            ['a', 'b', 'c', 'a'])
+        self.assertEqual(results[0], {'jid': 'a', 'result': 'complete'})
+        for result, message in zip(results[1:], [
+            'not currently running', 'does not exist', 'not currently running']):
+            self.assertIn(message, result['error'])
+        self.assertEqual(self.lua('get', 2, 'b')['state'], 'waiting')
+
+    def test_stats(self):
+        '''Run times for the whole batch are recorded'''
+        for jid in xrange(3):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 0, 'queue', 'worker', 10)
+        self.lua('complete_many', 3, 'worker', 'queue', ['0', '1', '2'])
+        stats = self.lua('stats', 0, 'queue', 0)['run']
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['mean'], 3)
+        self.assertEqual(stats['histogram'][3], 3)
+
+    def test_retention(self):
+        '''Retention applies once the whole batch is complete'''
+        self.lua('config.set', 0, 'jobs-history-count', 2)
+        for jid in xrange(5):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 0, 'queue', 'worker', 10)
+        self.lua('complete_many', 1, 'worker', 'queue',
+            ['0', '1', '2', '3', '4'])
+        self.assertEqual(len(self.lua('jobs', 1, 'complete')), 2)
+
+    def test_events(self):
+        '''Log messages are published as a single batch'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('pop', 0, 'queue', 'worker', 10)
+        with self.lua:
+            self.lua('complete_many', 1, 'worker', 'queue', ['a', 'b'])
+        self.assertEqual(self.lua.log, [{
+            'channel': 'ql:log',
+            'data': '{"event":"batch","events":['
+                '{"jid":"a","event":"completed","queue":"queue"},'
+                '{"jid":"b","event":"completed","queue":"queue"}]}'
+        }])
+
+
+class TestCompleteAndPop(TestQless):
+    '''Test completing a job and popping the next in one call'''
+    def setUp(self):
+        TestQless.setUp(self)
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('pop', 2, 'queue', 'worker', 1)
+
+    def test_malformed(self):
+        '''Enumerate all the ways it can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('complete_and_pop', 3, 'a', 'worker', 'queue', {}, '', 'foo'),
+            ('complete_and_pop', 3, 'a', 'worker', 'queue', {}, '', 1,
+                '["nope"]'),
+            ('complete_and_pop', 3, 'a', 'worker', 'queue', {}, '', 1, '',
+                'delay', 'foo')
+        ])
+        # None of those should have completed the job
+        self.assertEqual(self.lua('get', 3, 'a')['state'], 'running')
+
+    def test_basic(self):
+        '''Completes the job and pops the next'''
+        result = self.lua(
+            'complete_and_pop', 3, 'a', 'worker', 'queue', {}, '', 10)
+        self.assertEqual(result['state'], 'complete')
+        self.assertEqual([job['jid'] for job in result['jobs']], ['b'])
+        self.assertEqual(self.lua('get', 4, 'a')['state'], 'complete')
+        self.assertEqual(self.lua('get', 4, 'b')['worker'], 'worker')
+
+    def test_advance(self):
+        '''Can advance the job and pop from another queue'''
+        self.lua('put', 3, 'worker', 'other', 'c', 'klass', {}, 0)
+        result = self.lua('complete_and_pop', 4, 'a', 'worker', 'queue', {},
+            'other', 10, 'worker', 'next', 'other')
+        self.assertEqual(result['state'], 'waiting')
+        self.assertEqual(
+            [job['jid'] for job in result['jobs']], ['c', 'a'])
+        self.assertEqual(self.lua('peek', 5, 'queue', 10)[0]['jid'], 'b')
+
+    def test_empty(self):
+        '''Returns no jobs when there are none to pop'''
+        self.lua('pop', 3, 'queue', 'worker', 1)
+        result = self.lua(
+            'complete_and_pop', 4, 'a', 'worker', 'queue', {}, '', 10)
+        self.assertEqual(result['jobs'], {})
+
+    def test_not_running(self):
+        '''Nothing is popped if the job can't be completed'''
+        self.assertRaisesRegexp(redis.ResponseError, r'another worker',
+            self.lua, 'complete_and_pop', 3, 'a', 'other', 'queue', {}, '', 10)
+        self.assertEqual(self.lua('get', 4, 'b')['state'], 'waiting')
+
+
 class TestCancel(TestQless):
     '''Canceling jobs'''
     def test_cancel_waiting(self):
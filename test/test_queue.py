@@ -620,6 +620,197 @@ class TestPut(TestQless):
         self.assertEqual(res[0]['jid'], 'jid-1')
 
 
+class TestUnique(TestQless):
+    '''Test putting jobs with unique keys'''
+    def test_malformed(self):
+        '''Coalesce must be a number'''
+        self.assertMalformed(self.lua, [
+            ('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+                'unique', 'key', 'coalesce', 'foo')
+        ])
+
+    def test_reject(self):
+        '''A second job with the same key isn't created'''
+        self.assertEqual(self.lua('put', 0, 'worker', 'queue', 'a', 'klass',
+            {'x': 1}, 0, 'unique', 'key'), 'a')
+        self.assertEqual(self.lua('put', 1, 'worker', 'queue', 'b', 'klass',
+            {'x': 2}, 0, 'unique', 'key'), 'a')
+        self.assertEqual(self.lua('get', 1, 'b'), None)
+        self.assertEqual(self.lua('get', 1, 'a')['data'], '{"x": 1}')
+        self.assertEqual(self.lua('queues', 1, 'queue')['waiting'], 1)
+
+    def test_malformed_duplicate(self):
+        '''Options are checked even when the key is already taken'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'unique', 'key')
+        self.assertMalformed(self.lua, [
+            ('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0,
+                'unique', 'key', 'priority', 'foo'),
+            ('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0,
+                'unique', 'key', 'depends', '[}'),
+            ('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0,
+                'unique', 'key', 'resources', ['r-1'])
+        ])
+
+    def test_coalesce(self):
+        '''Coalescing updates the existing job's data and priority'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {'x': 1}, 0,
+            'unique', 'key')
+        self.lua('put', 0, 'worker', 'queue', 'other', 'klass', {}, 0,
+            'priority', 5)
+        self.assertEqual(self.lua('put', 1, 'worker', 'queue', 'b', 'klass',
+            {'x': 2}, 0, 'unique', 'key', 'coalesce', 1, 'priority', 10), 'a')
+        job = self.lua('get', 1, 'a')
+        self.assertEqual((job['data'], job['priority']), ('{"x": 2}', 10))
+        self.assertEqual(
+            [job['jid'] for job in self.lua('peek', 1, 'queue', 10)],
+            ['a', 'other'])
+
+    def test_scheduled(self):
+        '''Scheduled jobs hold their keys too'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 10,
+            'unique', 'key')
+        self.assertEqual(self.lua('put', 1, 'worker', 'queue', 'b', 'klass',
+            {}, 0, 'unique', 'key'), 'a')
+
+    def test_per_queue(self):
+        '''Keys are unique per queue'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'unique', 'key')
+        self.assertEqual(self.lua('put', 0, 'worker', 'other', 'b', 'klass',
+            {}, 0, 'unique', 'key'), 'b')
+
+    def test_popped(self):
+        '''Once a job is popped, its key may be used again'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'unique', 'key')
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('put', 2, 'worker', 'queue', 'b', 'klass',
+            {}, 0, 'unique', 'key'), 'b')
+        self.assertEqual(self.lua('put', 3, 'worker', 'queue', 'c', 'klass',
+            {}, 0, 'unique', 'key'), 'b')
+
+    def test_canceled(self):
+        '''Once a job is canceled, its key may be used again'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'unique', 'key')
+        self.lua('cancel', 1, 'a')
+        self.assertEqual(self.lua('put', 2, 'worker', 'queue', 'b', 'klass',
+            {}, 0, 'unique', 'key'), 'b')
+
+    def test_moved(self):
+        '''A job moved to another queue gives up its key'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'unique', 'key')
+        self.lua('put', 1, 'worker', 'other', 'a', 'klass', {}, 0)
+        self.assertEqual(self.lua('put', 2, 'worker', 'queue', 'b', 'klass',
+            {}, 0, 'unique', 'key'), 'b')
+
+    def test_requeue_same_job(self):
+        '''A job may be put again with its own key'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'unique', 'key')
+        self.assertEqual(self.lua('put', 1, 'worker', 'queue', 'a', 'klass',
+            {'x': 1}, 0, 'unique', 'key'), 'a')
+        self.assertEqual(self.lua('get', 1, 'a')['data'], '{"x": 1}')
+        self.assertEqual(self.lua('put', 2, 'worker', 'queue', 'b', 'klass',
+            {}, 0, 'unique', 'key'), 'a')
+
+
+class TestPutMany(TestQless):
+    '''Test putting many jobs at once'''
+    def test_malformed(self):
+        '''Enumerate all the ways in which the input can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('put_many', 0, 'worker'),
+            ('put_many', 0, 'worker', '[}'),
+            ('put_many', 0, 'worker', 5)
+        ])
+
+    def test_basic(self):
+        '''We can put jobs into several queues at once'''
+        self.assertEqual(self.lua('put_many', 0, 'worker', [
+            {'queue': 'a', 'jid': 'a', 'klass': 'klass', 'data': {'x': 1}},
+            {'queue': 'b', 'jid': 'b', 'klass': 'klass', 'delay': 10,
+                'priority': 5, 'tags': ['foo']}
+        ]), [{'jid': 'a', 'result': 'a'}, {'jid': 'b', 'result': 'b'}])
+        job = self.lua('get', 0, 'a')
+        self.assertEqual((job['queue'], job['state'], job['data']),
+            ('a', 'waiting', '{"x":1}'))
+        job = self.lua('get', 0, 'b')
+        self.assertEqual(
+            (job['queue'], job['state'], job['priority'], job['tags']),
+            ('b', 'scheduled', 5, ['foo']))
+        self.assertEqual(
+            [queue['name'] for queue in self.lua('queues', 0)], ['a', 'b'])
+
+    def test_matches_put(self):
+        '''Putting jobs in bulk is the same as putting them one at a time'''
+        for jid in xrange(10):
+            self.lua('put', 0, 'worker', 'a', 'a-%s' % jid, 'klass', {},
+                jid % 2, 'priority', jid % 3)
+        self.lua('put_many', 0, 'worker', [
+            {'queue': 'b', 'jid': 'b-%s' % jid, 'klass': 'klass',
+                'delay': jid % 2, 'priority': jid % 3} for jid in xrange(10)])
+        self.assertEqual(
+            [job['jid'][2:] for job in self.lua('pop', 5, 'a', 'worker', 10)],
+            [job['jid'][2:] for job in self.lua('pop', 5, 'b', 'worker', 10)])
+
+    def test_errors(self):
+        '''Each job's outcome is reported independently'''
+        results = self.lua('put_many', 0, 'worker', [
+            {'queue': 'queue', 'jid': 'a', 'klass': 'klass'},
+            {'queue': 'queue', 'jid': 'b'},
+            {'queue': 'queue', 'jid': 'c', 'klass': 'klass', 'delay': 'foo'},
+            {'queue': 'queue', 'jid': 'a', 'klass': 'klass'},
+            {'queue': 'queue', 'jid': 'd', 'klass': 'klass'}
+        ])
+        self.assertEqual([result['jid'] for result in results],
+            ['a', 'b', 'c', 'a', 'd'])
+        self.assertEqual([result.get('result') for result in results],
+            ['a', None, None, None, 'd'])
+        for result in results[1:4]:
+            self.assertIn('Put', result['error'])
+            # Without where in the script they were raised
+            self.assertNotIn('user_script', result['error'])
+        self.assertEqual(self.lua('queues', 0, 'queue')['waiting'], 2)
+
+    def test_empty(self):
+        '''An empty batch has no outcomes'''
+        self.assertEqual(self.lua('put_many', 0, 'worker', []), [])
+        self.assertEqual(
+            self.lua('complete_many', 0, 'worker', 'queue', []), [])
+        self.assertEqual(
+            self.lua('fail_many', 0, 'worker', 'group', 'message', []), [])
+
+    def test_signal(self):
+        '''The queue is signalled once for the whole batch'''
+        self.lua('put_many', 0, 'worker', [
+            {'queue': 'queue', 'jid': str(jid), 'klass': 'klass'}
+            for jid in xrange(5)])
+        self.assertEqual(
+            self.redis.lrange('ql:q:queue-signal', 0, -1), ['queue'])
+
+    def test_scheduled(self):
+        '''Scheduled jobs in a batch are found by tick'''
+        self.lua('put_many', 0, 'worker', [
+            {'queue': 'queue', 'jid': 'a', 'klass': 'klass', 'delay': 20},
+            {'queue': 'queue', 'jid': 'b', 'klass': 'klass', 'delay': 10}])
+        self.assertEqual(self.lua('tick', 10, 10), 1)
+        self.assertEqual(self.lua('get', 10, 'b')['state'], 'waiting')
+
+    def test_tracked(self):
+        '''Tracked jobs still get their put events'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('track', 0, 'track', 'a')
+        with self.lua:
+            self.lua('put_many', 0, 'worker', [
+                {'queue': 'queue', 'jid': 'a', 'klass': 'klass'},
+                {'queue': 'queue', 'jid': 'b', 'klass': 'klass'}])
+        self.assertIn({'channel': 'ql:put', 'data': 'a'}, self.lua.log)
+        self.assertNotIn({'channel': 'ql:put', 'data': 'b'}, self.lua.log)
+
+
 class TestPeek(TestQless):
     '''Test peeking jobs'''
     # For reference:
@@ -725,6 +916,62 @@ class TestPeek(TestQless):
         self.assertEqual(len(res), 2)
 
 
+class TestReadonlyPeek(TestQless):
+    '''Test peeking without writing anything'''
+    def test_malformed(self):
+        '''The only mode is readonly'''
+        self.assertMalformed(self.lua, [
+            ('peek', 0, 'queue', 10, '', 'foo'),
+        ])
+
+    def test_scheduled(self):
+        '''Due scheduled jobs are included, but left scheduled'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 10,
+            'priority', 1)
+        self.lua('put', 0, 'worker', 'queue', 'c', 'klass', {}, 20)
+        jobs = self.lua('peek', 15, 'queue', 10, '', 'readonly')
+        self.assertEqual([job['jid'] for job in jobs], ['b', 'a'])
+        self.assertEqual(jobs[0]['state'], 'scheduled')
+        self.assertEqual(self.lua('get', 15, 'b')['state'], 'scheduled')
+
+    def test_matches_peek(self):
+        '''A readonly peek agrees with a regular peek'''
+        for jid in xrange(10):
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, jid % 3,
+                'priority', jid % 2)
+        readonly = self.lua('peek', 20, 'queue', 7, 'ui', 'readonly')
+        peeked = self.lua('peek', 20, 'queue', 7, 'ui')
+        self.assertEqual(
+            [job['jid'] for job in readonly], [job['jid'] for job in peeked])
+
+    def test_expired_locks(self):
+        '''Jobs with expired locks come first'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('pop', 2, 'queue', 'worker', 1)
+        jobs = self.lua('peek', 100, 'queue', 10, '', 'readonly')
+        self.assertEqual([job['jid'] for job in jobs], ['a', 'b'])
+        self.assertEqual(self.lua('get', 100, 'a')['state'], 'running')
+
+    def test_recurring(self):
+        '''Recurring jobs aren't spawned'''
+        self.lua('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 10, 0)
+        self.assertEqual(self.lua('peek', 99, 'queue', 100, '', 'readonly'), {})
+        self.assertEqual(self.lua('get', 99, 'jid-1'), None)
+
+    def test_resources(self):
+        '''Scheduled jobs that couldn't get their resources are left out'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 10,
+            'resources', ['r-1'])
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 10,
+            'resources', ['r-1'])
+        jobs = self.lua('peek', 10, 'queue', 10, '', 'readonly')
+        self.assertEqual([job['jid'] for job in jobs], ['a'])
+        self.assertEqual(self.lua('resource.lock_count', 10, 'r-1'), 0)
+
+
 class TestPop(TestQless):
     '''Test popping jobs'''
     # For reference:
@@ -856,6 +1103,185 @@ class TestPop(TestQless):
         self.assertEqual(job['jid'], 'b')
 
 
+class TestMultipop(TestQless):
+    '''Test popping jobs from several queues at once'''
+    # For reference:
+    #
+    #   QlessAPI.multipop = function(now, worker, count, queues)
+    def test_malformed(self):
+        '''Enumerate all the ways this can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('multipop', 0),
+            ('multipop', 0, 'worker'),
+            ('multipop', 0, 'worker', 'number', ['queue']),
+            ('multipop', 0, 'worker', 10),
+            ('multipop', 0, 'worker', 10, 'foo'),
+            ('multipop', 0, 'worker', 10, 5),
+            ('multipop', 0, 'worker', 10, {'queue': 'foo'}),
+            ('multipop', 0, 'worker', 10, {'queue': 0}),
+        ])
+
+    def test_ordered(self):
+        '''Queues in a list are drained in order'''
+        for jid in xrange(3):
+            self.lua('put', jid, 'worker', 'a', 'a-%s' % jid, 'klass', {}, 0)
+            self.lua('put', jid, 'worker', 'b', 'b-%s' % jid, 'klass', {}, 0)
+        jobs = self.lua('multipop', 10, 'worker', 4, ['b', 'a'])
+        self.assertEqual([job['jid'] for job in jobs],
+            ['b-0', 'b-1', 'b-2', 'a-0'])
+        self.assertEqual(
+            [job['state'] for job in jobs], ['running'] * 4)
+        jobs = self.lua('multipop', 10, 'worker', 4, ['b', 'a'])
+        self.assertEqual([job['jid'] for job in jobs], ['a-1', 'a-2'])
+
+    def test_empty(self):
+        '''Popping from empty or unknown queues returns no jobs'''
+        self.assertEqual(self.lua('multipop', 0, 'worker', 10, []), {})
+        self.assertEqual(self.lua('multipop', 0, 'worker', 10, ['foo']), {})
+
+    def test_weighted(self):
+        '''Weighted queues share the count in proportion to their weight'''
+        for jid in xrange(10):
+            self.lua('put', jid, 'worker', 'a', 'a-%s' % jid, 'klass', {}, 0)
+            self.lua('put', jid, 'worker', 'b', 'b-%s' % jid, 'klass', {}, 0)
+        jobs = self.lua('multipop', 10, 'worker', 4, {'a': 3, 'b': 1})
+        self.assertEqual([job['jid'] for job in jobs],
+            ['a-0', 'a-1', 'a-2', 'b-0'])
+
+    def test_weighted_backfill(self):
+        '''Capacity a queue can't use is given to the others'''
+        for jid in xrange(10):
+            self.lua('put', jid, 'worker', 'a', 'a-%s' % jid, 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'b', 'b-0', 'klass', {}, 0)
+        jobs = self.lua('multipop', 10, 'worker', 6, {'a': 1, 'b': 1})
+        self.assertEqual([job['jid'] for job in jobs],
+            ['a-0', 'a-1', 'a-2', 'b-0', 'a-3', 'a-4'])
+
+    def test_paused(self):
+        '''Paused queues are skipped'''
+        self.lua('put', 0, 'worker', 'a', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'b', 'b', 'klass', {}, 0)
+        self.lua('pause', 0, 'a')
+        jobs = self.lua('multipop', 10, 'worker', 10, ['a', 'b'])
+        self.assertEqual([job['jid'] for job in jobs], ['b'])
+
+
+class TestTick(TestQless):
+    '''Test promoting due jobs across all queues'''
+    def test_malformed(self):
+        '''Enumerate all the ways it can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('tick', 0),
+            ('tick', 0, 'foo')
+        ])
+
+    def test_scheduled(self):
+        '''Due scheduled jobs are moved into their work queues'''
+        self.lua('put', 0, 'worker', 'a', 'a', 'klass', {}, 10)
+        self.lua('put', 0, 'worker', 'b', 'b', 'klass', {}, 20)
+        self.assertEqual(self.lua('tick', 5, 10), 0)
+        self.assertEqual(self.lua('tick', 15, 10), 1)
+        self.assertEqual(self.lua('get', 15, 'a')['state'], 'waiting')
+        self.assertEqual(self.lua('get', 15, 'b')['state'], 'scheduled')
+        self.assertEqual(self.lua('tick', 25, 10), 1)
+        self.assertEqual(self.lua('get', 25, 'b')['state'], 'waiting')
+
+    def test_recurring(self):
+        '''Due recurring jobs are spawned'''
+        self.lua('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 60, 0)
+        self.assertEqual(self.lua('tick', 0, 10), 1)
+        self.assertEqual(self.lua('tick', 59, 10), 0)
+        self.assertEqual(self.lua('tick', 120, 10), 2)
+        self.assertEqual(
+            self.lua('jobs', 120, 'waiting', 'queue'),
+            ['jid-1', 'jid-2', 'jid-3'])
+
+    def test_budget(self):
+        '''No more than `budget` jobs are promoted per tick'''
+        for jid in xrange(5):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 10)
+        self.assertEqual(self.lua('tick', 10, 3), 3)
+        self.assertEqual(self.lua('tick', 10, 3), 2)
+        self.assertEqual(self.lua('tick', 10, 3), 0)
+        self.assertEqual(len(self.lua('jobs', 10, 'waiting', 'queue')), 5)
+
+    def test_earliest_first(self):
+        '''Queues with the earliest due jobs are ticked first'''
+        self.lua('put', 0, 'worker', 'a', 'a', 'klass', {}, 20)
+        self.lua('put', 0, 'worker', 'b', 'b', 'klass', {}, 10)
+        self.assertEqual(self.lua('tick', 30, 1), 1)
+        self.assertEqual(self.lua('get', 30, 'a')['state'], 'scheduled')
+        self.assertEqual(self.lua('get', 30, 'b')['state'], 'waiting')
+
+    def test_recur_update(self):
+        '''Shortening a recurring interval is picked up by tick'''
+        self.lua('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 60, 0)
+        self.lua('tick', 0, 10)
+        self.lua('recur.update', 0, 'jid', 'interval', 10)
+        self.assertEqual(self.lua('tick', 10, 10), 1)
+
+    def test_pop_after_tick(self):
+        '''Jobs promoted by tick are popped as usual'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 10)
+        self.lua('tick', 10, 10)
+        self.assertEqual(
+            self.lua('pop', 10, 'queue', 'worker', 10)[0]['jid'], 'jid')
+
+
+class TestSignal(TestQless):
+    '''Test the readiness signal that workers can block on'''
+    def signals(self, queue='queue'):
+        '''The tokens waiting on a queue's signal list'''
+        return self.redis.lrange('ql:q:%s-signal' % queue, 0, -1)
+
+    def test_put(self):
+        '''Putting a job into an empty queue signals it'''
+        self.assertEqual(self.signals(), [])
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.assertEqual(self.signals(), ['queue'])
+
+    def test_coalesced(self):
+        '''There's never more than one token waiting'''
+        for jid in xrange(5):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.assertEqual(self.signals(), ['queue'])
+
+    def test_only_when_empty(self):
+        '''Only the transition from empty to non-empty signals'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.redis.delete('ql:q:queue-signal')
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.assertEqual(self.signals(), [])
+
+    def test_scheduled(self):
+        '''Promoting a scheduled job signals its queue'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 10)
+        self.assertEqual(self.signals(), [])
+        self.lua('tick', 10, 10)
+        self.assertEqual(self.signals(), ['queue'])
+
+    def test_pop_rearms(self):
+        '''Popping signals again if there's work left'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.redis.delete('ql:q:queue-signal')
+        self.lua('pop', 1, 'queue', 'worker', 1)
+        self.assertEqual(self.signals(), ['queue'])
+        self.redis.delete('ql:q:queue-signal')
+        self.lua('pop', 1, 'queue', 'worker', 1)
+        self.assertEqual(self.signals(), [])
+
+    def test_dependencies(self):
+        '''A job whose dependencies are met signals its queue'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'other', 'b', 'klass', {}, 0,
+            'depends', ['a'])
+        self.assertEqual(self.signals('other'), [])
+        self.lua('pop', 1, 'queue', 'worker', 1)
+        self.lua('complete', 2, 'a', 'worker', 'queue', {})
+        self.assertEqual(self.signals('other'), ['other'])
+
+
 class TestResources(TestQless):
     """Queues should correctly handle jobs that require resources"""
 
@@ -1107,61 +1533,49 @@ class TestMultipleResources(TestQless):
 
         #pop again
         res = self.lua('pop', 17, 'queue', 'worker-1', 1)
-        #r-1 is released, but jid-4 will have to get r-1 after jid-3
+        #r-1 is released, and since jid-3 is still waiting on r-2, jid-4 gets
+        #r-1 ahead of it
         self.assertEqual(self.lua('workers', 18, 'worker-1'), {
-            'jobs': ['jid-2'],
+            'jobs': ['jid-4'],
             'stalled': {}
         })
 
-        # jobs 3 has the lock on r-1, job 4 is pending
-        res = self.lua('resource.data', 19, 'r-1')
-        self.assertEqual(res['locks'], ['jid-3'])
-        self.assertEqual(res['pending'], ['jid-4'])
+        res = self.lua('resource.data', 18, 'r-1')
+        self.assertEqual(res['locks'], ['jid-4'])
+        self.assertEqual(res['pending'], ['jid-3'])
 
-        #job 3 is waiting on r-1
-        res = self.lua('resource.data', 19, 'r-2')
+        res = self.lua('resource.data', 18, 'r-2')
         self.assertEqual(res['locks'], ['jid-2'])
         self.assertEqual(res['pending'], ['jid-3'])
 
-        #complete jid-2
+        #complete jid-4. No one else can use r-1, so jid-3 holds it while it
+        #waits on r-2
+        self.lua('complete', 18, 'jid-4', 'worker-1', 'queue', {})
+
+        res = self.lua('resource.data', 18, 'r-1')
+        self.assertEqual(res['locks'], ['jid-3'])
+        self.assertEqual(res['pending'], {})
+
+        #pop and complete jid-2
+        res = self.lua('pop', 19, 'queue', 'worker-1', 1)
+        self.assertEqual(self.lua('workers', 19, 'worker-1'), {
+            'jobs': ['jid-2'],
+            'stalled': {}
+        })
         self.lua('complete', 19, 'jid-2', 'worker-1', 'queue', {})
 
         #pop again
         res = self.lua('pop', 20, 'queue', 'worker-1', 1)
-
-        #test to make sure job-3 is not on a worker
         self.assertEqual(self.lua('workers', 20, 'worker-1'), {
             'jobs': ['jid-3'],
             'stalled': {}
         })
 
-         # jobs 3 has the lock on r-1, job 4 is pending
+        #job 3 has the locks on both
         res = self.lua('resource.data', 20, 'r-1')
         self.assertEqual(res['locks'], ['jid-3'])
-        self.assertEqual(res['pending'], ['jid-4'])
+        self.assertEqual(res['pending'], {})
 
-        #job 3 has the lock on r-2
         res = self.lua('resource.data', 20, 'r-2')
         self.assertEqual(res['locks'], ['jid-3'])
         self.assertEqual(res['pending'], {})
-
-         #complete jid-3
-        self.lua('complete', 21, 'jid-3', 'worker-1', 'queue', {})
-
-        #pop again
-        res = self.lua('pop', 21, 'queue', 'worker-1', 1)
-
-        self.assertEqual(self.lua('workers', 21, 'worker-1'), {
-            'jobs': ['jid-4'],
-            'stalled': {}
-        })
-
-        # jobs 4 has the lock on r-1
-        res = self.lua('resource.data', 21, 'r-1')
-        self.assertEqual(res['locks'], ['jid-4'])
-        self.assertEqual(res['pending'], {})
-
-        #r-2 is empty
-        res = self.lua('resource.data', 21, 'r-2')
-        self.assertEqual(res['locks'], {})
-        self.assertEqual(res['pending'], {})
@@ -271,3 +271,232 @@ class TestResources(TestQless):
         expected['waiting'] = 1
         self.assertEqual(self.lua('queues', 0, 'queue'), expected)
         self.assertEqual(self.lua('queues', 0), [expected])
+
+    def test_release_skips_blocked(self):
+        """Released locks go to the first pending job that can run"""
+        self.lua('resource.set', 0, 'r-1', 1)
+        self.lua('resource.set', 0, 'r-2', 1)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', ['r-1', 'r-2'])
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', ['r-1', 'r-2'])
+        self.lua('put', 2, None, 'queue', 'jid-3', 'klass', {}, 0, 'resources', ['r-1'])
+        self.lua('put', 3, None, 'queue', 'jid-4', 'klass', {}, 0, 'resources', ['r-1'])
+        self.assertEqual(
+            self.lua('resource.pending', 0, 'r-1'), ['jid-2', 'jid-3', 'jid-4'])
+
+        # Free r-1 while jid-1 keeps r-2, by moving it to another resource.
+        # jid-2 can't run without r-2, so jid-3 gets r-1 instead
+        self.lua('resource.set', 0, 'r-3', 1)
+        self.lua('put', 4, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', ['r-2', 'r-3'])
+        res = self.lua('resource.data', 0, 'r-1')
+        self.assertEqual(res['locks'], ['jid-3'])
+        self.assertEqual(res['pending'], ['jid-2', 'jid-4'])
+        self.assertEqual(self.lua('resource.pending', 0, 'r-2'), ['jid-2'])
+
+    def test_set_fills_capacity(self):
+        """Raising the max grants every free lock, passing over blocked jobs"""
+        self.lua('resource.set', 0, 'r-1', 0)
+        self.lua('resource.set', 0, 'r-2', 0)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', ['r-1', 'r-2'])
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', ['r-1'])
+        self.lua('put', 2, None, 'queue', 'jid-3', 'klass', {}, 0, 'resources', ['r-1'])
+        self.lua('resource.set', 0, 'r-1', 2)
+        self.assertEqual(
+            sorted(self.lua('resource.locks', 0, 'r-1')), ['jid-2', 'jid-3'])
+        self.assertEqual(self.lua('resource.pending', 0, 'r-1'), ['jid-1'])
+        self.assertEqual(self.lua('queues', 0, 'queue')['waiting'], 2)
+
+    def test_grant_budget(self):
+        """Only so many pending jobs are looked at for each grant"""
+        self.lua('config.set', 0, 'resource-grant-budget', 1)
+        self.lua('resource.set', 0, 'r-1', 0)
+        self.lua('resource.set', 0, 'r-2', 0)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', ['r-1', 'r-2'])
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', ['r-1'])
+        self.lua('resource.set', 0, 'r-1', 1)
+        # Having passed over jid-1, no one else was looked at, so it holds r-1
+        self.assertEqual(self.lua('resource.locks', 0, 'r-1'), ['jid-1'])
+        self.assertEqual(self.lua('resource.pending', 0, 'r-1'), ['jid-2'])
+
+
+class TestWeightedResources(TestQless):
+    """Jobs may need several units of a resource"""
+    def test_malformed(self):
+        """Enumerate all the ways to send malformed requests"""
+        self.lua('resource.set', 0, 'r-1', 4)
+        self.assertMalformed(self.lua, [
+            ('put', 0, None, 'queue', 'jid', 'klass', {}, 0, 'resources', '[}'),
+            ('put', 0, None, 'queue', 'jid', 'klass', {}, 0, 'resources', '"r-1"'),
+            ('put', 0, None, 'queue', 'jid', 'klass', {}, 0, 'resources', {'r-1': 0}),
+            ('put', 0, None, 'queue', 'jid', 'klass', {}, 0, 'resources', {'r-1': 1.5}),
+            ('put', 0, None, 'queue', 'jid', 'klass', {}, 0, 'resources', {'r-1': 'foo'}),
+            ('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 60, 0, 'resources', {'r-1': -1}),
+            # More units than the resource has
+            ('put', 0, None, 'queue', 'jid', 'klass', {}, 0, 'resources', {'r-1': 5}),
+            ('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 60, 0, 'resources', {'r-1': 5})
+        ])
+        self.assertEqual(self.lua('get', 0, 'jid'), None)
+
+    def test_acquire(self):
+        """Jobs take as many units as they need, and wait for them otherwise"""
+        self.lua('resource.set', 0, 'r-1', 4)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', {'r-1': 3})
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', {'r-1': 2})
+        self.lua('put', 2, None, 'queue', 'jid-3', 'klass', {}, 0, 'resources', ['r-1'])
+        # The unit that's free is held back for jid-2, which was put first
+        res = self.lua('resource.data', 0, 'r-1')
+        self.assertEqual(res['locks'], ['jid-1'])
+        self.assertEqual(res['pending'], ['jid-2', 'jid-3'])
+        self.assertEqual(res['used'], 3)
+        self.assertEqual(self.lua('get', 0, 'jid-1')['resources'], {'r-1': 3})
+        self.assertEqual(self.lua('get', 0, 'jid-3')['resources'], ['r-1'])
+
+    def test_release(self):
+        """Released units go to the waiting jobs in order, as they fit"""
+        self.lua('resource.set', 0, 'r-1', 4)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', {'r-1': 3})
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', ['r-1'])
+        self.lua('put', 2, None, 'queue', 'jid-3', 'klass', {}, 0, 'resources', {'r-1': 4})
+        self.lua('put', 3, None, 'queue', 'jid-4', 'klass', {}, 0, 'resources', {'r-1': 2})
+        self.lua('put', 4, None, 'queue', 'jid-5', 'klass', {}, 0, 'resources', ['r-1'])
+        self.assertEqual(
+            self.lua('resource.pending', 4, 'r-1'), ['jid-3', 'jid-4', 'jid-5'])
+        self.lua('pop', 5, 'queue', 'worker', 10)
+        self.lua('complete', 6, 'jid-1', 'worker', 'queue', {})
+        # jid-3 needs more than are free, so they're held back for it rather
+        # than going to jid-4 and jid-5
+        res = self.lua('resource.data', 6, 'r-1')
+        self.assertEqual(res['locks'], ['jid-2'])
+        self.assertEqual(res['pending'], ['jid-3', 'jid-4', 'jid-5'])
+        self.assertEqual(res['used'], 1)
+        self.lua('complete', 7, 'jid-2', 'worker', 'queue', {})
+        res = self.lua('resource.data', 7, 'r-1')
+        self.assertEqual(res['locks'], ['jid-3'])
+        self.assertEqual(res['pending'], ['jid-4', 'jid-5'])
+        self.assertEqual(res['used'], 4)
+        self.lua('pop', 8, 'queue', 'worker', 10)
+        self.lua('complete', 9, 'jid-3', 'worker', 'queue', {})
+        res = self.lua('resource.data', 9, 'r-1')
+        self.assertEqual(sorted(res['locks']), ['jid-4', 'jid-5'])
+        self.assertEqual(res['used'], 3)
+        self.assertEqual(
+            sorted(job['jid'] for job in self.lua('peek', 9, 'queue', 10)),
+            ['jid-4', 'jid-5'])
+
+    def test_reweigh(self):
+        """Putting a job again with a different weight changes its lock"""
+        self.lua('resource.set', 0, 'db', 10)
+        self.lua('put', 0, None, 'queue', 'a', 'klass', {}, 0, 'resources', ['db'])
+        self.lua('put', 1, None, 'queue', 'a', 'klass', {}, 0, 'resources', {'db': 8})
+        self.assertEqual(self.lua('resource.data', 1, 'db')['used'], 8)
+        self.lua('put', 2, None, 'queue', 'b', 'klass', {}, 0, 'resources', {'db': 5})
+        res = self.lua('resource.data', 2, 'db')
+        self.assertEqual(res['locks'], ['a'])
+        self.assertEqual(res['pending'], ['b'])
+        self.assertEqual(res['used'], 8)
+
+        # Needing fewer units frees them for the jobs waiting
+        self.lua('put', 3, None, 'queue', 'a', 'klass', {}, 0, 'resources', {'db': 2})
+        res = self.lua('resource.data', 3, 'db')
+        self.assertEqual(sorted(res['locks']), ['a', 'b'])
+        self.assertEqual(res['used'], 7)
+
+        # Needing more units than are free means waiting for them
+        self.lua('put', 4, None, 'queue', 'a', 'klass', {}, 0, 'resources', {'db': 6})
+        res = self.lua('resource.data', 4, 'db')
+        self.assertEqual(res['locks'], ['b'])
+        self.assertEqual(res['pending'], ['a'])
+        self.assertEqual(res['used'], 5)
+
+    def test_used_kept(self):
+        """The units in use are kept as locks are taken and released"""
+        self.lua('resource.set', 0, 'r-1', 4)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', {'r-1': 3})
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', ['r-1'])
+        self.assertEqual(self.redis.hget('ql:rs:r-1', 'used'), '4')
+        self.lua('pop', 2, 'queue', 'worker', 10)
+        self.lua('complete', 3, 'jid-1', 'worker', 'queue', {})
+        self.assertEqual(self.redis.hget('ql:rs:r-1', 'used'), '1')
+
+        # Resources whose locks were taken before it was kept are counted once
+        self.lua('put', 4, None, 'queue', 'jid-3', 'klass', {}, 0, 'resources', {'r-1': 2})
+        self.redis.hdel('ql:rs:r-1', 'used')
+        self.lua('complete', 5, 'jid-2', 'worker', 'queue', {})
+        self.assertEqual(self.redis.hget('ql:rs:r-1', 'used'), '2')
+        self.assertEqual(self.lua('resource.data', 5, 'r-1')['used'], 2)
+
+        # And unset resources aren't brought back by releasing their locks
+        self.lua('resource.unset', 6, 'r-1')
+        self.lua('cancel', 6, 'jid-3')
+        self.assertFalse(self.redis.exists('ql:rs:r-1'))
+
+    def test_heavy_not_starved(self):
+        """Units are held back for a job that needs more than are free"""
+        self.lua('resource.set', 0, 'r-1', 4)
+        for index in range(4):
+            self.lua('put', index, None, 'queue', 'a-%i' % index, 'klass', {}, 0,
+                'resources', ['r-1'])
+        self.lua('put', 4, None, 'queue', 'heavy', 'klass', {}, 0,
+            'resources', {'r-1': 4}, 'priority', 10)
+        self.lua('put', 5, None, 'queue', 'b-0', 'klass', {}, 0, 'resources', ['r-1'])
+        self.lua('pop', 6, 'queue', 'worker', 10)
+
+        # The unit that's freed isn't granted to b-0, nor taken by a new job
+        self.lua('complete', 7, 'a-0', 'worker', 'queue', {})
+        self.lua('put', 8, None, 'queue', 'b-1', 'klass', {}, 0, 'resources', ['r-1'])
+        res = self.lua('resource.data', 8, 'r-1')
+        self.assertEqual(sorted(res['locks']), ['a-1', 'a-2', 'a-3'])
+        self.assertEqual(res['pending'], ['heavy', 'b-0', 'b-1'])
+
+        for index in range(1, 4):
+            self.lua('complete', 9, 'a-%i' % index, 'worker', 'queue', {})
+        res = self.lua('resource.data', 9, 'r-1')
+        self.assertEqual(res['locks'], ['heavy'])
+        self.assertEqual(res['pending'], ['b-0', 'b-1'])
+        self.assertEqual(self.lua('peek', 9, 'queue', 10)[0]['jid'], 'heavy')
+
+    def test_heavy_not_overtaken(self):
+        """Units are held back for a job put when too few of them are free"""
+        self.lua('resource.set', 0, 'db', 10)
+        self.lua('put', 0, None, 'queue', 'holder', 'klass', {}, 0, 'resources', {'db': 8})
+        self.lua('put', 1, None, 'queue', 'heavy', 'klass', {}, 0, 'resources', {'db': 9})
+        self.assertEqual(self.redis.hget('ql:rs:db', 'reserved'), 'heavy')
+        for index in range(2):
+            self.lua('put', 2 + index, None, 'queue', 'light-%i' % index, 'klass',
+                {}, 0, 'resources', ['db'])
+        res = self.lua('resource.data', 3, 'db')
+        self.assertEqual(res['locks'], ['holder'])
+        self.assertEqual(res['pending'], ['heavy', 'light-0', 'light-1'])
+
+        # Once the holder's done, the heavy job goes first
+        self.lua('pop', 4, 'queue', 'worker', 10)
+        self.lua('complete', 5, 'holder', 'worker', 'queue', {})
+        res = self.lua('resource.data', 5, 'db')
+        self.assertEqual(sorted(res['locks']), ['heavy', 'light-0'])
+        self.assertEqual(res['pending'], ['light-1'])
+        self.assertEqual(res['used'], 10)
+
+    def test_set(self):
+        """Raising the max grants locks to jobs that now fit"""
+        self.lua('resource.set', 0, 'r-1', 2)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', ['r-1'])
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', {'r-1': 2})
+        self.assertEqual(self.lua('resource.data', 1, 'r-1')['locks'], ['jid-1'])
+        self.lua('resource.set', 1, 'r-1', 3)
+        res = self.lua('resource.data', 1, 'r-1')
+        self.assertEqual(sorted(res['locks']), ['jid-1', 'jid-2'])
+        self.assertEqual(res['used'], 3)
+        self.assertEqual(
+            sorted(job['jid'] for job in self.lua('peek', 1, 'queue', 10)),
+            ['jid-1', 'jid-2'])
+
+    def test_recur(self):
+        """Recurring jobs spawn jobs with the weights they were declared with"""
+        self.lua('resource.set', 0, 'r-1', 4)
+        self.lua('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 60, 0,
+            'resources', {'r-1': 3})
+        self.lua('pop', 0, 'queue', 'worker', 10)
+        self.lua('pop', 60, 'queue', 'worker', 10)
+        res = self.lua('resource.data', 60, 'r-1')
+        self.assertEqual(res['locks'], ['jid-1'])
+        self.assertEqual(res['pending'], ['jid-2'])
+        self.assertEqual(self.lua('get', 60, 'jid-1')['resources'], {'r-1': 3})
@@ -1,5 +1,6 @@
 '''Test the stats we keep about queues'''
 
+import redis
 from common import TestQless
 
 
@@ -52,6 +53,30 @@ class TestStats(TestQless):
         self.assertEqual(stats['run']['histogram'][0:20], [1] * 20)
         self.assertEqual(sum(stats['run']['histogram']), 20)
 
+    def test_wait_batch(self):
+        '''It correctly tracks wait times for jobs popped together'''
+        jids = map(str, range(20))
+        for jid in jids:
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 19, 'queue', 'worker', 20)
+
+        stats = self.lua('stats', 0, 'queue', 0)
+        self.assertEqual(stats['wait']['count'], 20)
+        self.assertAlmostEqual(stats['wait']['mean'], 9.5)
+        self.assertAlmostEqual(stats['wait']['std'], 5.916079783099)
+        self.assertEqual(stats['wait']['histogram'][0:20], [1] * 20)
+        self.assertEqual(sum(stats['wait']['histogram']), 20)
+
+    def test_single(self):
+        '''A single data point has no deviation'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 90, 'queue', 'worker', 1)
+        stats = self.lua('stats', 0, 'queue', 0)
+        self.assertEqual(stats['wait']['count'], 1)
+        self.assertAlmostEqual(stats['wait']['mean'], 90)
+        self.assertEqual(stats['wait']['std'], 0)
+        self.assertEqual(stats['wait']['histogram'][60], 1)
+
     def test_failed(self):
         '''It correctly tracks failed jobs and failures'''
         # The distinction here between 'failed' and 'failure' is that 'failed'
@@ -125,15 +150,361 @@ class TestStats(TestQless):
         self.lua('resource.set', 0, 'r-1', 1)
         self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', ['r-1'])
         self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0, 'resources', ['r-1'])
-        self.assertEqual(self.lua('resource.stats_pending',0)[0]['name'],'ql:rs:r-1-pending')
+        self.assertEqual(self.lua('resource.stats_pending',0)[0]['name'],'r-1')
         self.assertEqual(self.lua('resource.stats_pending',0)[0]['count'], 1)
         self.lua('resource.set', 0, 'r-2', 1)
         self.lua('put', 0, None, 'queue', 'jid-3', 'klass', {}, 0, 'resources', ['r-2'])
         self.lua('put', 1, None, 'queue', 'jid-4', 'klass', {}, 0, 'resources', ['r-2'])
-        self.assertEqual(self.lua('resource.stats_pending',0)[0]['name'],'ql:rs:r-1-pending')
+        self.assertEqual(self.lua('resource.stats_pending',0)[0]['name'],'r-1')
         self.assertEqual(self.lua('resource.stats_pending',0)[0]['count'], 1)
-        self.assertEqual(self.lua('resource.stats_pending',0)[1]['name'],'ql:rs:r-2-pending')
+        self.assertEqual(self.lua('resource.stats_pending',0)[1]['name'],'r-2')
         self.assertEqual(self.lua('resource.stats_pending',0)[1]['count'], 1)
         self.lua('resource.set', 0, 'r-1', 2)
-        self.assertEqual(self.lua('resource.stats_pending',0)[0]['name'],'ql:rs:r-2-pending')
+        self.assertEqual(self.lua('resource.stats_pending',0)[0]['name'],'r-2')
         self.assertEqual(self.lua('resource.stats_pending',0)[0]['count'], 1)
+
+    def test_resource_counts_paginated(self):
+        '''Resource stats are paginated over the registry of resources'''
+        for rid in ['r-1', 'r-2', 'r-3']:
+            self.lua('resource.set', 0, rid, 1)
+            for index in range(2):
+                self.lua('put', index, None, 'queue', '%s-%i' % (rid, index),
+                    'klass', {}, 0, 'resources', [rid])
+        self.assertEqual(self.redis.zrange('ql:resources', 0, -1),
+            ['r-1', 'r-2', 'r-3'])
+        self.assertEqual(self.lua('resource.stats_pending', 0, 'r-1', 1),
+            [{'name': 'r-2', 'count': 1}])
+        self.assertEqual(
+            [res['name'] for res in self.lua('resource.stats_locks', 0, 'r-1')],
+            ['r-2', 'r-3'])
+        # Pages stop once they're full, and pick up after their last id
+        self.assertEqual(self.lua('resource.stats_pending', 0, '', 2),
+            [{'name': 'r-1', 'count': 1}, {'name': 'r-2', 'count': 1}])
+        self.assertEqual(self.lua('resource.stats_pending', 0, 'r-2', 2),
+            [{'name': 'r-3', 'count': 1}])
+        # Unset resources are dropped from the registry
+        self.lua('resource.unset', 0, 'r-1')
+        self.assertEqual(self.redis.zrange('ql:resources', 0, -1),
+            ['r-2', 'r-3'])
+        # Resources without any are skipped
+        self.lua('resource.set', 0, 'r-0', 1)
+        self.lua('resource.set', 0, 'r-2a', 1)
+        self.assertEqual(
+            [res['name'] for res in self.lua('resource.stats_locks', 0, '', 2)],
+            ['r-2', 'r-3'])
+        self.assertMalformed(self.lua, [
+            ('resource.stats_pending', 0, '', 'foo'),
+            ('resource.stats_locks', 0, 'r-1', 'foo')
+        ])
+
+    def test_resource_backfill(self):
+        '''Resources set before the registry existed can be added to it'''
+        for rid in ['r-1', 'r-2', 'r-3']:
+            self.lua('resource.set', 0, rid, 1)
+            self.lua('put', 0, None, 'queue', rid, 'klass', {}, 0,
+                'resources', [rid])
+        self.redis.delete('ql:resources')
+        self.assertEqual(self.lua('resource.stats_locks', 0), {})
+
+        registered, cursor = 0, 0
+        while True:
+            result = self.lua('resource.backfill', 0, cursor, 2)
+            registered += result['registered']
+            cursor = result['cursor']
+            if cursor == 0:
+                break
+        self.assertEqual(registered, 3)
+        self.assertEqual(self.redis.zrange('ql:resources', 0, -1),
+            ['r-1', 'r-2', 'r-3'])
+        self.assertEqual(
+            [res['name'] for res in self.lua('resource.stats_locks', 0)],
+            ['r-1', 'r-2', 'r-3'])
+        self.assertMalformed(self.lua, [
+            ('resource.backfill', 0),
+            ('resource.backfill', 0, 'foo'),
+            ('resource.backfill', 0, 0, 'foo')
+        ])
+
+
+class TestStatsRetention(TestQless):
+    '''Test that stats are only kept as long as configured'''
+    day = 86400
+
+    def record(self, now):
+        '''Record wait, run and failure stats at `now`'''
+        self.lua('put', now, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', now, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('pop', now, 'queue', 'worker', 10)
+        self.lua('complete', now + 1, 'a', 'worker', 'queue', {})
+        self.lua('fail', now + 1, 'b', 'worker', 'group', 'message', {})
+
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('stats.compact', 0),
+            ('stats.compact', 0, 'foo'),
+            ('stats.compact', 0, 0, 'foo')
+        ])
+
+    def test_expire(self):
+        '''Stats expire once they're older than stats-history'''
+        self.record(0)
+        for stat in ('wait', 'run', 'stats'):
+            ttl = self.redis.ttl('ql:s:%s:0:queue' % stat)
+            self.assertTrue(30 * self.day < ttl <= 31 * self.day, ttl)
+        # Which is looked up when each day's stats are first written
+        self.lua('config.set', 0, 'stats-history', 1)
+        self.lua('put', self.day, 'worker', 'queue', 'c', 'klass', {}, 0)
+        self.lua('pop', self.day, 'queue', 'worker', 10)
+        self.assertTrue(
+            self.redis.ttl('ql:s:wait:%i:queue' % self.day) <= 2 * self.day)
+
+    def test_expire_once(self):
+        '''Stats are only set to expire when they're first written'''
+        self.record(0)
+        self.redis.persist('ql:s:wait:0:queue')
+        self.record(10)
+        self.assertIsNone(self.redis.ttl('ql:s:wait:0:queue'))
+
+    def test_old_day(self):
+        '''Stats recorded for days long past are dropped'''
+        self.record(0)
+        self.lua('put', 40 * self.day, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.assertEqual(self.redis.exists('ql:s:stats:0:queue'), False)
+
+    def test_compact(self):
+        '''Compaction drops old stats and histograms but keeps counts'''
+        for days in (0, 20, 28):
+            self.record(days * self.day)
+            self.lua('put', days * self.day, 'worker', 'queue', 'b', 'klass',
+                {}, 0)
+        for key in self.redis.keys('ql:s:*'):
+            self.redis.persist(key)
+
+        now = 35 * self.day
+        self.assertEqual(self.lua('stats.compact', now, 0), {'changed': 9})
+        for stat in ('wait', 'run', 'stats'):
+            self.assertFalse(self.redis.exists('ql:s:%s:0:queue' % stat))
+        stats = self.lua('stats', now, 'queue', 20 * self.day)
+        self.assertEqual(stats['wait']['count'], 2)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(sum(stats['wait']['histogram']), 0)
+        stats = self.lua('stats', now, 'queue', 28 * self.day)
+        self.assertEqual(sum(stats['wait']['histogram']), 2)
+        self.assertTrue(self.redis.ttl('ql:s:run:%i:queue' % (20 * self.day)) > 0)
+
+    def test_compact_budget(self):
+        '''Compaction stops after its budget, saying where to pick up'''
+        for days in (0, 20):
+            self.record(days * self.day)
+        for key in self.redis.keys('ql:s:*'):
+            self.redis.persist(key)
+
+        now = 35 * self.day
+        # Each day of the one queue's stats is three keys
+        self.assertEqual(self.lua('stats.compact', now, 0, 30),
+            {'changed': 3, 'next': 10 * self.day})
+        self.assertFalse(self.redis.exists('ql:s:stats:0:queue'))
+        self.assertIsNone(self.redis.ttl('ql:s:stats:%i:queue' % (20 * self.day)))
+        self.assertEqual(self.lua('stats.compact', now, 10 * self.day, 30),
+            {'changed': 0, 'next': 20 * self.day})
+        self.assertEqual(self.lua('stats.compact', now, 20 * self.day, 1),
+            {'changed': 3, 'next': 21 * self.day})
+        self.assertTrue(self.redis.ttl('ql:s:stats:%i:queue' % (20 * self.day)) > 0)
+
+
+class TestStatsRange(TestQless):
+    '''Test the minute and hour time series of stats'''
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('stats_range', 0, 'queue'),
+            ('stats_range', 0, 'queue', 'foo', 60, 'minute'),
+            ('stats_range', 0, 'queue', 0, 'foo', 'minute'),
+            ('stats_range', 0, 'queue', 0, 60),
+            ('stats_range', 0, 'queue', 0, 60, 'second'),
+            ('stats_range', 0, 'queue', 60, 0, 'minute'),
+            ('stats_range', 0, 'queue', 0, 86400 * 30, 'minute')
+        ])
+
+    def test_minute(self):
+        '''Values are bucketed by the minute'''
+        for index, when in enumerate([10, 20, 70, 200]):
+            self.lua('put', 0, 'worker', 'queue', index, 'klass', {}, 0)
+            self.lua('pop', when, 'queue', 'worker', 1)
+        stats = self.lua('stats_range', 200, 'queue', 30, 200, 'minute')
+        self.assertEqual([point['time'] for point in stats['wait']],
+            [0, 60, 120, 180])
+        self.assertEqual([point['count'] for point in stats['wait']],
+            [2, 1, 0, 1])
+        self.assertAlmostEqual(stats['wait'][0]['mean'], 15)
+        self.assertAlmostEqual(stats['wait'][0]['std'], 7.0710678118)
+        self.assertEqual([point['count'] for point in stats['run']],
+            [0, 0, 0, 0])
+
+    def test_hour(self):
+        '''Values are rolled up by the hour'''
+        for index, when in enumerate([10, 70, 3700]):
+            self.lua('put', 0, 'worker', 'queue', index, 'klass', {}, 0)
+            self.lua('pop', when, 'queue', 'worker', 1)
+            self.lua('complete', when + index, index, 'worker', 'queue', {})
+        stats = self.lua('stats_range', 3700, 'queue', 0, 3600, 'hour')
+        self.assertEqual([point['count'] for point in stats['wait']], [2, 1])
+        self.assertAlmostEqual(stats['wait'][0]['mean'], 40)
+        self.assertEqual([point['count'] for point in stats['run']], [2, 1])
+        self.assertAlmostEqual(stats['run'][0]['mean'], 0.5)
+
+    def test_expire(self):
+        '''Buckets expire once they're older than configured'''
+        self.lua('config.set', 0, 'minute-stats-history', 600)
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 0, 'queue', 'worker', 1)
+        self.assertEqual(self.redis.ttl('ql:s:wait-minute:0:queue'), 660)
+        self.assertEqual(self.redis.ttl('ql:s:wait-hour:0:queue'), 608400)
+
+
+class TestPercentiles(TestQless):
+    '''Test percentiles estimated from the stats histograms'''
+    def wait(self, queue, now, waits):
+        '''Record jobs in `queue` that waited each of `waits` seconds'''
+        for index, wait in enumerate(waits):
+            jid = '%s-%i-%i' % (queue, now, index)
+            self.lua('put', now, 'worker', queue, jid, 'klass', {}, 0)
+            self.lua('pop', now + wait, queue, 'worker', 1)
+
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('stats', 0, 'queue', 0, '[}'),
+            ('stats', 0, 'queue', 0, '["foo"]'),
+            ('stats', 0, 'queue', 0, '[101]'),
+            ('stats_merged', 0, '[}', 0, 0),
+            ('stats_merged', 0, '["queue"]', 'foo', 0),
+            ('stats_merged', 0, '["queue"]', 0, 'foo'),
+            ('stats_merged', 0, '["queue"]', 86400, 0),
+            ('stats_merged', 0, '["queue"]', 0, 0, '[-1]')
+        ])
+
+    def test_percentiles(self):
+        '''Percentiles are estimated within the histogram's buckets'''
+        self.wait('queue', 0, range(10) + [90, 150])
+        stats = self.lua('stats', 200, 'queue', 0, [0, 50, 100])
+        self.assertNotIn('histogram', stats['wait'])
+        self.assertEqual(stats['wait']['count'], 12)
+        self.assertEqual(stats['wait']['percentiles'], [0, 5.5, 150])
+        self.assertEqual(
+            self.lua('stats', 200, 'queue', 0, [50])['run']['percentiles'],
+            [0])
+
+    def test_no_percentiles(self):
+        '''Without percentiles, the histogram is returned as before'''
+        self.wait('queue', 0, [1])
+        stats = self.lua('stats', 200, 'queue', 0, '')
+        self.assertEqual(len(stats['wait']['histogram']), 148)
+        self.assertNotIn('percentiles', stats['wait'])
+
+    def test_merged(self):
+        '''Stats are combined across queues and days'''
+        self.wait('a', 0, [1, 2, 3])
+        self.wait('b', 0, [4])
+        self.wait('a', 86400, [5, 6])
+        self.wait('a', 2 * 86400, [100])
+        stats = self.lua('stats_merged', 0, ['a', 'b'], 0, 86400, [50])
+        self.assertEqual(stats['wait']['count'], 6)
+        self.assertAlmostEqual(stats['wait']['mean'], 3.5)
+        self.assertAlmostEqual(stats['wait']['std'], 1.8708286934)
+        self.assertEqual(stats['wait']['percentiles'], [3.5])
+        stats = self.lua('stats_merged', 0, ['a', 'b'], 0, 86400)
+        self.assertEqual(sum(stats['wait']['histogram']), 6)
+        self.assertEqual(stats['failed'], 0)
+
+
+class TestThroughput(TestQless):
+    '''Test the per-minute throughput of queues'''
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('throughput', 0, 'queue', 'foo'),
+            ('throughput', 0, 'queue', 0),
+            ('throughput', 0, 'queue', 86401),
+            # Counts are only kept for minute-stats-history
+            ('throughput', 0, 'queue', 21601)
+        ])
+
+    def test_history_window(self):
+        '''The window can be as long as the counts are kept'''
+        self.lua('config.set', 0, 'minute-stats-history', 600)
+        self.assertEqual(self.lua('throughput', 600, 'queue', 600)['window'], 600)
+        self.assertRaisesRegexp(redis.ResponseError, r'between 0 and 600',
+            self.lua, 'throughput', 600, 'queue', 601)
+
+    def test_counts(self):
+        '''Each kind of event is counted and turned into a rate'''
+        for jid in range(4):
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 10, 'queue', 'worker', 3)
+        self.lua('complete', 20, 0, 'worker', 'queue', {})
+        self.lua('fail', 30, 1, 'worker', 'group', 'message', {})
+        self.lua('retry', 40, 2, 'queue', 'worker', 0)
+        stats = self.lua('throughput', 90, 'queue', 60)
+        self.assertEqual(stats['window'], 90)
+        self.assertEqual(stats['counts'], {
+            'put': 4, 'pop': 3, 'complete': 1, 'fail': 1, 'retry': 1})
+        self.assertAlmostEqual(stats['rates']['put'], 4 / 90.0)
+        # Older minutes fall outside of the window
+        stats = self.lua('throughput', 150, 'queue', 60)
+        self.assertEqual(stats['window'], 90)
+        self.assertEqual(stats['counts']['put'], 0)
+
+    def test_depth(self):
+        '''The first event in each minute samples the depth of the queue'''
+        for jid in range(4):
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 10, 'queue', 'worker', 1)
+        self.lua('pop', 20, 'queue', 'worker', 1)
+        self.lua('pop', 70, 'queue', 'worker', 1)
+        self.assertEqual(self.lua('throughput', 70, 'queue', 120)['depth'], [
+            {'time': 0, 'waiting': 1, 'running': 0},
+            {'time': 60, 'waiting': 1, 'running': 3}])
+
+    def test_unpopped_depth(self):
+        '''A queue that jobs are put in but not popped from is sampled'''
+        for jid in range(3):
+            self.lua('put', jid * 60, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.assertEqual(
+            [sample['waiting'] for sample in
+                self.lua('throughput', 120, 'queue', 120)['depth']],
+            [1, 2, 3])
+
+    def test_idle_depth(self):
+        '''Pops that return no jobs don't sample the depth of the queue'''
+        self.lua('pop', 10, 'queue', 'worker', 1)
+        self.assertFalse(self.redis.exists('ql:s:throughput:0:queue'))
+
+    def test_failed_paths(self):
+        '''Jobs that fail by exhausting their retries are counted'''
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('config.set', 0, 'heartbeat', 10)
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'retries', 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'retries', 0)
+        self.lua('pop', 2, 'queue', 'worker', 10)
+        # One runs out of retries when its lock expires, and one when it's
+        # retried
+        self.lua('retry', 3, 'b', 'queue', 'worker', 0)
+        self.lua('pop', 20, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('get', 20, 'a')['state'], 'failed')
+        self.assertEqual(self.lua('get', 20, 'b')['state'], 'failed')
+        counts = self.lua('throughput', 20, 'queue', 60)['counts']
+        self.assertEqual(counts['fail'], 2)
+        self.assertEqual(counts['fail'],
+            self.lua('stats', 20, 'queue', 0)['failed'])
+
+    def test_expire(self):
+        '''The counts expire along with the other per-minute stats'''
+        self.lua('config.set', 0, 'minute-stats-history', 600)
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 0, 'queue', 'worker', 1)
+        self.assertEqual(self.redis.ttl('ql:s:throughput:0:queue'), 660)
@@ -129,6 +129,34 @@ class TestTag(TestQless):
         self.assertEqual(
             self.lua('tag', 1, 'get', 'foo', 0, 10)['jobs'], {})
 
+    def test_requeue(self):
+        '''Requeueing with the same tags leaves the index alone'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'tags', ['foo', 'bar'])
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'tags', ['foo', 'bar'])
+        self.lua('put', 2, 'worker', 'other', 'a', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('tag', 2, 'get', 'foo', 0, 10)['jobs'], ['a', 'b'])
+        self.assertEqual(self.lua('tag', 2, 'top', 0, 10), ['foo', 'bar'])
+
+    def test_requeue_changed(self):
+        '''Requeueing with different tags only updates those that changed'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'tags', ['foo', 'bar'])
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'tags', ['foo', 'bar'])
+        self.lua('put', 2, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'tags', ['foo', 'baz'])
+        self.assertEqual(
+            self.lua('tag', 2, 'get', 'foo', 0, 10)['jobs'], ['a', 'b'])
+        self.assertEqual(
+            self.lua('tag', 2, 'get', 'bar', 0, 10)['jobs'], ['b'])
+        self.assertEqual(
+            self.lua('tag', 2, 'get', 'baz', 0, 10)['jobs'], ['a'])
+        self.assertEqual(self.lua('tag', 2, 'top', 0, 10), ['foo'])
+        self.assertEqual(self.lua('get', 2, 'a')['tags'], ['foo', 'baz'])
+
     def test_top(self):
         '''Ensure that we can find the most common tags'''
         for tag in range(10):
@@ -196,3 +196,85 @@ class TestWorker(TestQless):
             'jobs': {},
             'stalled': {}
         })
+
+
+class TestWorkerStats(TestQless):
+    '''Test the stats we keep about each worker'''
+    def setUp(self):
+        TestQless.setUp(self)
+        # No grace period
+        self.lua('config.set', 0, 'grace-period', 0)
+
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('worker_stats', 0),
+            ('worker_stats', 0, 'worker'),
+            ('worker_stats', 0, 'worker', 'foo'),
+            ('worker_stats', 0, 'worker', 0, '[101]')
+        ])
+
+    def test_counts(self):
+        '''Pops, completions, failures and lost locks are counted'''
+        for jid in range(4):
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 10, 'queue', 'worker', 3)
+        self.lua('complete', 20, 0, 'worker', 'queue', {})
+        self.lua('fail', 30, 1, 'worker', 'group', 'message', {})
+        # The last job's lock expires and it's handed to another worker
+        self.lua('pop', 100, 'queue', 'other', 2)
+        stats = self.lua('worker_stats', 100, 'worker', 0)
+        self.assertEqual(
+            [stats[key] for key in ('popped', 'completed', 'failed', 'lost')],
+            [3, 1, 1, 1])
+        self.assertEqual(self.lua('worker_stats', 100, 'other', 0)['popped'], 2)
+
+    def test_completed_many(self):
+        '''Jobs completed in a batch are counted with their run times'''
+        for jid in range(3):
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 10, 'queue', 'worker', 3)
+        self.lua('complete_many', 20, 'worker', 'queue', [0, 1, 2])
+        stats = self.lua('worker_stats', 20, 'worker', 0)
+        self.assertEqual((stats['completed'], stats['run']['count']), (3, 3))
+
+    def test_failed_paths(self):
+        '''Jobs that exhaust their retries count as the worker's failures'''
+        self.lua('config.set', 0, 'heartbeat', 10)
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'retries', 0)
+        self.lua('put', 1, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'retries', 0)
+        self.lua('pop', 2, 'queue', 'worker', 10)
+        self.lua('retry', 3, 'b', 'queue', 'worker', 0)
+        # The lock on the other expires, and it runs out of retries
+        self.lua('pop', 20, 'queue', 'other', 10)
+        stats = self.lua('worker_stats', 20, 'worker', 0)
+        self.assertEqual(stats['failed'], 2)
+        self.assertEqual(stats['failed'],
+            self.lua('stats', 20, 'queue', 0)['failed'])
+
+    def test_run(self):
+        '''Run times of completed jobs are kept like those of queues'''
+        for jid in range(4):
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 10, 'queue', 'worker', 4)
+        for jid, when in enumerate([11, 12, 13, 30]):
+            self.lua('complete', when, jid, 'worker', 'queue', {})
+        stats = self.lua('worker_stats', 30, 'worker', 0)['run']
+        self.assertEqual(stats['count'], 4)
+        self.assertAlmostEqual(stats['mean'], 6.5)
+        self.assertEqual(sum(stats['histogram']), 4)
+        stats = self.lua('worker_stats', 30, 'worker', 0, [50, 95])['run']
+        self.assertEqual(stats['percentiles'], [2.5, 20.3])
+        # Other days are kept separately
+        self.assertEqual(
+            self.lua('worker_stats', 30, 'worker', 86400)['run']['count'], 0)
+
+    def test_expire(self):
+        '''Worker stats expire along with the stats of queues'''
+        self.lua('config.set', 0, 'stats-history', 2)
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 0, 'queue', 'worker', 1)
+        self.assertEqual(
+            self.redis.ttl('ql:s:worker:0:worker'), 3 * 86400)
@@ -35,7 +35,7 @@ function QlessWorker.counts(now, worker)
   -- Clean up all the workers' job lists if they're too old. This is
   -- determined by the `max-worker-age` configuration, defaulting to the
   -- last day. Seems like a 'reasonable' default
-  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
+  local interval = Qless.config.get('max-worker-age', 86400)
 
   local workers  = redis.call('zrangebyscore', 'ql:workers', 0, now - interval)
   for index, worker in ipairs(workers) do
@@ -63,3 +63,81 @@ function QlessWorker.counts(now, worker)
     return response
   end
 end
+
+-- Stats(now, worker, date, [percentiles])
+-- ---------------------------------------
+-- Return the stats of `worker` for the day of `date`, kept much as those of
+-- queues are. It returns how many jobs it popped, completed and failed, how
+-- many locks it lost, and the run time of the jobs that it completed:
+--
+--  {
+--      'popped'   : 12,
+--      'completed': 10,
+--      'failed'   : 1,
+--      'lost'     : 1,
+--      'run'      : {
+--          'count'    : 10,
+--          'mean'     : ...,
+--          'std'      : ...,
+--          'histogram': [...]
+--      }
+--  }
+--
+-- As with the stats of queues, if `percentiles` is provided as a JSON array of
+-- numbers between 0 and 100, then the run time histogram is replaced by a
+-- `percentiles` list of estimates of those percentiles.
+function QlessWorker.stats(now, worker, date, percentiles)
+  worker = assert(worker, 'WorkerStats(): Arg "worker" missing')
+  date = assert(tonumber(date),
+    'WorkerStats(): Arg "date" missing or not a number: ' .. tostring(date))
+  percentiles = QlessQueue.percentiles(percentiles)
+
+  -- The run time of every job completed is recorded, so the number completed
+  -- is the count of those
+  local bin = date - (date % 86400)
+  local popped, completed, failed, lost = unpack(redis.call('hmget',
+    'ql:s:worker:' .. bin .. ':' .. worker,
+    'popped', 'count', 'failed', 'lost'))
+  return {
+    popped    = tonumber(popped    or 0),
+    completed = tonumber(completed or 0),
+    failed    = tonumber(failed    or 0),
+    lost      = tonumber(lost      or 0),
+    run       = QlessQueue.summarize(
+      QlessQueue.read_stats('worker', bin, worker), percentiles)
+  }
+end
+
+-- Increment the `field` counter ('popped', 'failed' or 'lost')
+-- of today's stats for `worker` by `increment`
+function QlessWorker.tally(now, worker, field, increment)
+  local bin = now - (now % 86400)
+  local key = 'ql:s:worker:' .. bin .. ':' .. worker
+  Qless.hincrby(key, field, increment, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+end
+
+-- Record the run times `vals` (a number or a table of them) of jobs that
+-- `worker` completed in today's stats
+function QlessWorker.stat(now, worker, vals)
+  if type(vals) ~= 'table' then
+    vals = {vals}
+  end
+
+  -- In a batch, gather up the values and record them all at once
+  if Qless.batching then
+    local name = 'stat:worker:' .. worker
+    local pending = Qless.memo(name, function() return {} end)
+    table.extend(pending, vals)
+    return Qless.defer(name, function()
+      QlessWorker.stat(now, worker, pending)
+    end)
+  end
+
+  local bin = now - (now % 86400)
+  local key = 'ql:s:worker:' .. bin .. ':' .. worker
+  QlessQueue.accumulate(key, vals, function()
+    QlessQueue.expire(now, key, bin)
+  end)
+end